@@ -24,6 +24,7 @@ exclude-from= a file that contains exclude paths (can be used more than once)
 exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 q,quiet  don't actually print filenames
+j,jobs=  number of threads scanning directories [1]
 profile  run under the python profiler
 """
 o = options.Options(optspec)
@@ -31,6 +32,8 @@ o = options.Options(optspec)
 
 if len(extra) != 1:
     o.fatal("exactly one filename expected")
+if opt.jobs < 1:
+    o.fatal('jobs must be a positive integer')
 
 drecurse_top = argv_bytes(extra[0])
 excluded_paths = parse_excludes(flags, o.fatal)
@@ -39,7 +42,8 @@ if not drecurse_top.startswith(b'/'):
 exclude_rxs = parse_rx_excludes(flags, o.fatal)
 it = drecurse.recursive_dirlist([drecurse_top], opt.xdev,
                                 excluded_paths=excluded_paths,
-                                exclude_rxs=exclude_rxs)
+                                exclude_rxs=exclude_rxs,
+                                jobs=opt.jobs)
 if opt.profile:
     import cProfile
     def do_it():
@@ -32,39 +32,125 @@ if sys.version_info[0] > 2:
               file=sys.stderr)
         sys.exit(2)
 
+import signal, threading, types
+
 from bup import options, git, vfs, xstat
 from bup.compat import argv_bytes, fsdecode, py_maj
-from bup.helpers import log
+from bup.helpers import WorkerPool, log, parse_num
 from bup.repo import LocalRepo
 
 
+class LockedRepo(object):
+    """Serialize all access to repo, which isn't thread-safe, fully
+    consuming any generator a method returns while holding the lock.
+    The (reentrant) lock is also available to callers that have to
+    make a series of calls atomically."""
+    def __init__(self, repo):
+        self._repo = repo
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._repo, name)
+        if not callable(attr):
+            return attr
+        def locked(*args, **kwargs):
+            with self.lock:
+                result = attr(*args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = iter(list(result))
+                return result
+        return locked
+
+
+class OpenFile(object):
+    """State for one open() of a file: its reader, and the readahead
+    that's started when the reads look sequential."""
+    def __init__(self, fs, item):
+        self.fs = fs
+        self.item = item
+        self.lock = threading.Lock()
+        self.reader = vfs.fopen(fs.repo, item, chunk_cache=fs.chunk_cache)
+        self.ahead_reader = None
+        self.ahead_to = 0
+        self.ahead_job = None
+
+    def _read_ahead(self, ofs, count):
+        # Only runs in one pool thread at a time per file; reading
+        # fills the shared chunk cache that read() draws from.
+        if not self.ahead_reader:
+            self.ahead_reader = vfs.fopen(self.fs.repo, self.item,
+                                          chunk_cache=self.fs.chunk_cache)
+        try:
+            self.ahead_reader.seek(ofs)
+        except IOError as ex:
+            if ex.errno != errno.EINVAL:
+                raise
+            return
+        while count > 0:
+            buf = self.ahead_reader.read(min(count, 1024 * 1024))
+            if not buf:
+                break
+            count -= len(buf)
+
+    def read(self, size, offset):
+        with self.lock:
+            sequential = offset == self.reader.tell()
+            try:
+                self.reader.seek(offset)
+            except IOError as ex:
+                if ex.errno != errno.EINVAL:
+                    raise
+                return b''  # past EOF
+            buf = self.reader.read(size)
+            end = offset + len(buf)
+            readahead = self.fs.readahead
+            pending = self.ahead_job and not self.ahead_job.done.is_set()
+            if sequential and buf and readahead and not pending \
+               and end + readahead // 2 > self.ahead_to:
+                start = max(end, self.ahead_to)
+                count = end + readahead - start
+                self.ahead_to = start + count
+                self.ahead_job = \
+                    self.fs.pool.submit(lambda: self._read_ahead(start, count),
+                                        count)
+        return buf
+
+
 # FIXME: self.meta and want_meta?
 
 # The path handling is just wrong, but the current fuse module can't
 # handle bytes paths.
 
 class BupFs(fuse.Fuse):
-    def __init__(self, repo, verbose=0, fake_metadata=False):
+    def __init__(self, repo, verbose=0, fake_metadata=False,
+                 cache_size=64 * 1024 * 1024, readahead=0, jobs=4):
         fuse.Fuse.__init__(self)
-        self.repo = repo
+        self.repo = LockedRepo(repo)
         self.verbose = verbose
         self.fake_metadata = fake_metadata
-    
+        self.chunk_cache = vfs.ChunkCache(cache_size)
+        self.readahead = readahead
+        self.pool = WorkerPool(jobs, max(1, jobs * readahead))
+
     def getattr(self, path):
         path = argv_bytes(path)
         global opt
         if self.verbose > 0:
             log('--getattr(%r)\n' % path)
-        res = vfs.resolve(self.repo, path, want_meta=(not self.fake_metadata),
-                          follow=False)
-        name, item = res[-1]
-        if not item:
-            return -errno.ENOENT
-        if self.fake_metadata:
-            item = vfs.augment_item_meta(self.repo, item, include_size=True)
-        else:
-            item = vfs.ensure_item_has_metadata(self.repo, item,
-                                                include_size=True)
+        # The vfs cache isn't thread-safe either
+        with self.repo.lock:
+            res = vfs.resolve(self.repo, path,
+                              want_meta=(not self.fake_metadata),
+                              follow=False)
+            name, item = res[-1]
+            if not item:
+                return -errno.ENOENT
+            if self.fake_metadata:
+                item = vfs.augment_item_meta(self.repo, item,
+                                             include_size=True)
+            else:
+                item = vfs.ensure_item_has_metadata(self.repo, item,
+                                                    include_size=True)
         meta = item.meta
         # FIXME: do we want/need to do anything more with nlink?
         st = fuse.Stat(st_mode=meta.mode, st_nlink=1, st_size=meta.size)
@@ -79,13 +165,18 @@ class BupFs(fuse.Fuse):
     def readdir(self, path, offset):
         path = argv_bytes(path)
         assert not offset  # We don't return offsets, so offset should be unused
-        res = vfs.resolve(self.repo, path, follow=False)
-        dir_name, dir_item = res[-1]
+        with self.repo.lock:
+            res = vfs.resolve(self.repo, path, follow=False)
+            dir_name, dir_item = res[-1]
+            if dir_item:
+                # FIXME: make sure want_meta=False is being completely respected
+                names = [ent_name for ent_name, ent_item
+                         in vfs.contents(self.repo, dir_item, want_meta=False)]
         if not dir_item:
             yield -errno.ENOENT
+            return
         yield fuse.Direntry('..')
-        # FIXME: make sure want_meta=False is being completely respected
-        for ent_name, ent_item in vfs.contents(repo, dir_item, want_meta=False):
+        for ent_name in names:
             fusename = fsdecode(ent_name.replace(b'/', b'-'))
             yield fuse.Direntry(fusename)
 
@@ -93,38 +184,41 @@ class BupFs(fuse.Fuse):
         path = argv_bytes(path)
         if self.verbose > 0:
             log('--readlink(%r)\n' % path)
-        res = vfs.resolve(self.repo, path, follow=False)
-        name, item = res[-1]
-        if not item:
-            return -errno.ENOENT
-        return fsdecode(vfs.readlink(repo, item))
+        with self.repo.lock:
+            res = vfs.resolve(self.repo, path, follow=False)
+            name, item = res[-1]
+            if not item:
+                return -errno.ENOENT
+            return fsdecode(vfs.readlink(self.repo, item))
 
     def open(self, path, flags):
         path = argv_bytes(path)
         if self.verbose > 0:
             log('--open(%r)\n' % path)
-        res = vfs.resolve(self.repo, path, follow=False)
+        with self.repo.lock:
+            res = vfs.resolve(self.repo, path, follow=False)
         name, item = res[-1]
         if not item:
             return -errno.ENOENT
         accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
         if (flags & accmode) != os.O_RDONLY:
             return -errno.EACCES
-        # Return None since read doesn't need the file atm...
-        # If we *do* return the file, it'll show up as the last argument
-        #return vfs.fopen(repo, item)
+        # The fuse module keeps this for us, and passes it as the last
+        # argument to read() and release().
+        return OpenFile(self, item)
 
-    def read(self, path, size, offset):
-        path = argv_bytes(path)
+    def read(self, path, size, offset, fh=None):
         if self.verbose > 0:
-            log('--read(%r)\n' % path)
-        res = vfs.resolve(self.repo, path, follow=False)
-        name, item = res[-1]
-        if not item:
-            return -errno.ENOENT
-        with vfs.fopen(repo, item) as f:
-            f.seek(offset)
-            return f.read(size)
+            log('--read(%r)\n' % argv_bytes(path))
+        if not fh:
+            return -errno.EBADF
+        return fh.read(size, offset)
+
+    def release(self, path, flags, fh=None):
+        if self.verbose > 0:
+            log('--release(%r)\n' % argv_bytes(path))
+        if fh:
+            fh.reader.close()
 
 
 optspec = """
@@ -135,6 +229,11 @@ d,debug       run in the foreground and display FUSE debug information
 o,allow-other allow other users to access the filesystem
 meta          report original metadata for paths when available
 v,verbose     increase log output (can be used more than once)
+single-threaded  serve only one request at a time
+cache-size=   size of the file data cache shared by all open files [64M]
+readahead=    read this far ahead of sequential reads (0 to disable) [4M]
+jobs=         number of threads reading ahead [4]
+vfs-cache-size=  approximate size of the repository metadata cache [32M]
 """
 o = options.Options(optspec)
 opt, flags, extra = o.parse(sys.argv[1:])
@@ -149,10 +248,19 @@ sys.stderr = os.fdopen(errfd, 'w', 1)
 
 if len(extra) != 1:
     o.fatal('only one mount point argument expected')
+cache_size = parse_num(opt.cache_size)
+readahead = parse_num(opt.readahead)
+vfs_cache_size = parse_num(opt.vfs_cache_size)
+if cache_size < 0 or readahead < 0 or vfs_cache_size < 0:
+    o.fatal('--cache-size, --readahead, and --vfs-cache-size must not be negative')
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 git.check_repo_or_die()
+vfs.set_cache_limits(max_bytes=vfs_cache_size)
 repo = LocalRepo()
-f = BupFs(repo=repo, verbose=opt.verbose, fake_metadata=(not opt.meta))
+f = BupFs(repo=repo, verbose=opt.verbose, fake_metadata=(not opt.meta),
+          cache_size=cache_size, readahead=readahead, jobs=opt.jobs)
 
 # This is likely wrong, but the fuse module doesn't currently accept bytes
 f.fuse_args.mountpoint = extra[0]
@@ -161,7 +269,17 @@ if opt.debug:
     f.fuse_args.add('debug')
 if opt.foreground:
     f.fuse_args.setmod('foreground')
-f.multithreaded = False
+f.multithreaded = not opt.single_threaded
 if opt.allow_other:
     f.fuse_args.add('allow_other')
+
+def log_cache_stats(*args):
+    with f.repo.lock:
+        lines = vfs.cache_stats_summary()
+    for line in lines:
+        log('vfs cache: %s\n' % line)
+
+signal.signal(signal.SIGUSR1, log_cache_stats)
 f.main()
+if opt.verbose:
+    log_cache_stats()
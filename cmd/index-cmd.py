@@ -9,12 +9,13 @@ from __future__ import absolute_import, print_function
 from binascii import hexlify
 import sys, stat, time, os, errno, re
 
-from bup import metadata, options, git, index, drecurse, hlinkdb
+from bup import metadata, options, git, index, drecurse, hlinkdb, journal
 from bup.compat import argv_bytes
 from bup.drecurse import recursive_dirlist
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE
-from bup.helpers import (add_error, handle_ctrl_c, log, parse_excludes, parse_rx_excludes,
-                         progress, qprogress, saved_errors)
+from bup.helpers import (add_error, handle_ctrl_c, log, parallel_imap,
+                         parse_excludes, parse_rx_excludes, progress,
+                         qprogress, saved_errors)
 from bup.io import byte_stream, path_msg
 
 
@@ -61,7 +62,8 @@ def check_index(reader):
 
 
 def clear_index(indexfile):
-    indexfiles = [indexfile, indexfile + b'.meta', indexfile + b'.hlink']
+    indexfiles = [indexfile, indexfile + b'.meta', indexfile + b'.meta.idx',
+                  indexfile + b'.hlink']
     for indexfile in indexfiles:
         path = git.repo(indexfile)
         try:
@@ -73,13 +75,45 @@ def clear_index(indexfile):
                 raise
 
 
-def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
+def indexed(path):
+    """Return true if the index has an entry for path (a directory)."""
+    ri = index.Reader(indexfile)
+    try:
+        return any(e.name == path
+                   for e in ri.iter(name=path,
+                                    wantrecurse=lambda e: path.startswith(e.name)))
+    finally:
+        ri.close()
+
+
+def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None,
+                 changes=None):
+    # If changes isn't None, only visit the parts of top that the
+    # journal records in changes say have changed.
     # tmax and start must be epoch nanoseconds.
     tmax = (time.time() - 1) * 10**9
     ri = index.Reader(indexfile)
     msw = index.MetaStoreWriter(indexfile + b'.meta')
     wi = index.Writer(indexfile, msw, tmax)
-    rig = IterHelper(ri.iter(name=top))
+    bup_dir = os.path.abspath(git.repo())
+    if changes is None:
+        walk = None
+        paths = recursive_dirlist([top],
+                                  xdev=opt.xdev,
+                                  bup_dir=bup_dir,
+                                  excluded_paths=excluded_paths,
+                                  exclude_rxs=exclude_rxs,
+                                  xdev_exceptions=xdev_exceptions,
+                                  jobs=opt.jobs)
+        rig = IterHelper(ri.iter(name=top))
+    else:
+        walk = paths = drecurse.DirtyWalk(top, changes,
+                                          xdev=opt.xdev,
+                                          bup_dir=bup_dir,
+                                          excluded_paths=excluded_paths,
+                                          exclude_rxs=exclude_rxs,
+                                          xdev_exceptions=xdev_exceptions)
+        rig = IterHelper(ri.iter(name=top, wantrecurse=walk.wantrecurse))
     tstart = int(time.time()) * 10**9
 
     hlinks = hlinkdb.HLinkDB(indexfile + b'.hlink')
@@ -90,14 +124,38 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
             return (GIT_MODE_FILE, index.FAKE_SHA)
 
     total = 0
-    bup_dir = os.path.abspath(git.repo())
+
+    def plan():
+        # Match the filesystem up with the existing index (only
+        # reading the latter), so that the metadata for the new and
+        # stale paths can be read concurrently (see read_meta()).
+        for path, pst in paths:
+            deleted = []
+            while rig.cur and rig.cur.name > path:  # deleted paths
+                if rig.cur.exists() and (not walk or walk.covers(rig.cur.name)):
+                    deleted.append(rig.cur)
+                rig.next()
+            if rig.cur and rig.cur.name == path:    # paths that already existed
+                cur = rig.cur
+                stale = cur.stale(pst, tstart, check_device=opt.check_device)
+                rig.next()
+            else:  # new paths
+                cur = None
+                stale = True
+            yield path, pst, deleted, cur, stale
+
+    def read_meta(item):
+        path, pst, deleted, cur, stale = item
+        if not stale:
+            return item, None, None
+        try:
+            return item, metadata.from_path(path, statinfo=pst), None
+        except (OSError, IOError) as e:
+            return item, None, e
+
     index_start = time.time()
-    for path, pst in recursive_dirlist([top],
-                                       xdev=opt.xdev,
-                                       bup_dir=bup_dir,
-                                       excluded_paths=excluded_paths,
-                                       exclude_rxs=exclude_rxs,
-                                       xdev_exceptions=xdev_exceptions):
+    for (path, pst, deleted, cur, stale), meta, meta_err \
+        in parallel_imap(read_meta, plan(), opt.jobs):
         if opt.verbose>=2 or (opt.verbose==1 and stat.S_ISDIR(pst.st_mode)):
             out.write(b'%s\n' % path)
             out.flush()
@@ -110,25 +168,20 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
             qprogress('Indexing: %d (%d paths/s)\r' % (total, paths_per_sec))
         total += 1
 
-        while rig.cur and rig.cur.name > path:  # deleted paths
-            if rig.cur.exists():
-                rig.cur.set_deleted()
-                rig.cur.repack()
-                if rig.cur.nlink > 1 and not stat.S_ISDIR(rig.cur.mode):
-                    hlinks.del_path(rig.cur.name)
-            rig.next()
+        for ent in deleted:
+            ent.set_deleted()
+            ent.repack()
+            if ent.nlink > 1 and not stat.S_ISDIR(ent.mode):
+                hlinks.del_path(ent.name)
 
-        if rig.cur and rig.cur.name == path:    # paths that already existed
+        if cur:    # paths that already existed
             need_repack = False
-            if(rig.cur.stale(pst, tstart, check_device=opt.check_device)):
-                try:
-                    meta = metadata.from_path(path, statinfo=pst)
-                except (OSError, IOError) as e:
-                    add_error(e)
-                    rig.next()
+            if stale:
+                if meta_err:
+                    add_error(meta_err)
                     continue
-                if not stat.S_ISDIR(rig.cur.mode) and rig.cur.nlink > 1:
-                    hlinks.del_path(rig.cur.name)
+                if not stat.S_ISDIR(cur.mode) and cur.nlink > 1:
+                    hlinks.del_path(cur.name)
                 if not stat.S_ISDIR(pst.st_mode) and pst.st_nlink > 1:
                     hlinks.add_path(path, pst.st_dev, pst.st_ino)
                 # Clear these so they don't bloat the store -- they're
@@ -145,26 +198,23 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
                 # them below.
                 meta.ctime = meta.mtime = meta.atime = 0
                 meta_ofs = msw.store(meta)
-                rig.cur.update_from_stat(pst, meta_ofs)
-                rig.cur.invalidate()
+                cur.update_from_stat(pst, meta_ofs)
+                cur.invalidate()
                 need_repack = True
-            if not (rig.cur.flags & index.IX_HASHVALID):
+            if not (cur.flags & index.IX_HASHVALID):
                 if fake_hash:
-                    if rig.cur.sha == index.EMPTY_SHA:
-                        rig.cur.gitmode, rig.cur.sha = fake_hash(path)
-                    rig.cur.flags |= index.IX_HASHVALID
+                    if cur.sha == index.EMPTY_SHA:
+                        cur.gitmode, cur.sha = fake_hash(path)
+                    cur.flags |= index.IX_HASHVALID
                     need_repack = True
             if opt.fake_invalid:
-                rig.cur.invalidate()
+                cur.invalidate()
                 need_repack = True
             if need_repack:
-                rig.cur.repack()
-            rig.next()
+                cur.repack()
         else:  # new paths
-            try:
-                meta = metadata.from_path(path, statinfo=pst)
-            except (OSError, IOError) as e:
-                add_error(e)
+            if meta_err:
+                add_error(meta_err)
                 continue
             # See same assignment to 0, above, for rationale.
             meta.atime = meta.mtime = meta.ctime = 0
@@ -207,7 +257,7 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
 
 
 optspec = """
-bup index <-p|-m|-s|-u|--clear|--check> [options...] <filenames...>
+bup index <-p|-m|-s|-u|--clear|--check|--compact> [options...] <filenames...>
 --
  Modes:
 p,print    print the index entries for the given names (also works with -u)
@@ -216,12 +266,14 @@ s,status   print each filename with a status char (A/M/D) (implies -p)
 u,update   recursively update the index entries for the given file/dir names (default if no mode is specified)
 check      carefully check index file integrity
 clear      clear the default index
+compact    drop the metadata the index no longer refers to (after any -u)
  Options:
 H,hash     print the hash for each object next to its name
 l,long     print more information about each file
 no-check-device don't invalidate an entry if the containing device changes
 fake-valid mark all index entries as up-to-date even if they aren't
 fake-invalid mark all index entries as invalid
+from-journal only visit what bup watch has seen change (with -u)
 f,indexfile=  the name of the index file (normally BUP_DIR/bupindex)
 exclude= a path to exclude from the backup (may be repeated)
 exclude-from= skip --exclude paths in file (may be repeated)
@@ -229,6 +281,7 @@ exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 v,verbose  increase log output (can be used more than once)
 x,xdev,one-file-system  don't cross filesystem boundaries
+j,jobs=    number of threads scanning directories and reading metadata [1]
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -238,14 +291,19 @@ if not (opt.modified or \
         opt.status or \
         opt.update or \
         opt.check or \
-        opt.clear):
+        opt.clear or \
+        opt.compact):
     opt.update = 1
 if (opt.fake_valid or opt.fake_invalid) and not opt.update:
     o.fatal('--fake-{in,}valid are meaningless without -u')
+if opt.from_journal and not opt.update:
+    o.fatal('--from-journal is meaningless without -u')
 if opt.fake_valid and opt.fake_invalid:
     o.fatal('--fake-valid is incompatible with --fake-invalid')
 if opt.clear and opt.indexfile:
     o.fatal('cannot clear an external index (via -f)')
+if opt.jobs < 1:
+    o.fatal('jobs must be a positive integer')
 
 # FIXME: remove this once we account for timestamp races, i.e. index;
 # touch new-file; index.  It's possible for this to happen quickly
@@ -284,9 +342,34 @@ if opt.update:
     excluded_paths = parse_excludes(flags, o.fatal)
     exclude_rxs = parse_rx_excludes(flags, o.fatal)
     xexcept = index.unique_resolved_paths(extra)
+    # Any changes bup watch recorded under the paths are handled
+    # below, whether or not the journal is used to find them.
+    remaining = journal.take(indexfile)
+    if opt.from_journal:
+        roots = journal.watched_roots(indexfile)
+        if roots is None:
+            log('index: bup watch is not running; scanning everything\n')
     for rp, path in index.reduce_paths(extra):
+        changes = set(r for r in remaining if r[1].startswith(rp))
+        remaining -= changes
+        # The journal doesn't say anything about what happened
+        # before the watcher started, or where it lost track.
+        if not opt.from_journal or roots is None \
+           or not rp.endswith(b'/') \
+           or not any(rp.startswith(root) for root in roots) \
+           or any(kind == journal.TREE and rp.startswith(p)
+                  for kind, p in remaining) \
+           or not indexed(rp):
+            changes = None
         update_index(rp, excluded_paths, exclude_rxs, xdev_exceptions=xexcept,
-                     out=out)
+                     out=out, changes=changes)
+    journal.finish(indexfile, remaining)
+
+if opt.compact and os.path.exists(indexfile):
+    before, after = index.compact_meta(indexfile)
+    if opt.verbose:
+        log('compact: metadata store reduced from %d to %d bytes\n'
+            % (before, after))
 
 if opt['print'] or opt.status or opt.modified:
     extra = [argv_bytes(x) for x in extra]
@@ -279,8 +279,14 @@ if opt.check:
 else:
     if extra:
         sys.stdout.flush()
-        do_midx(git.repo(b'objects/pack'), opt.output, extra, b'',
-                byte_stream(sys.stdout))
+        outdir = opt.dir or git.repo(b'objects/pack')
+        prout = byte_stream(sys.stdout)
+        if opt.output:
+            do_midx(outdir, opt.output, extra, b'', prout)
+        else:
+            for sz, name in do_midx_group(outdir, None, extra):
+                if opt['print']:
+                    prout.write(name + b'\n')
     elif opt.auto or opt.force:
         sys.stdout.flush()
         paths = opt.dir and [opt.dir] or git.all_packdirs()
@@ -6,15 +6,17 @@ exec "$bup_python" "$0" ${1+"$@"}
 # end of bup preamble
 
 from __future__ import absolute_import
+from collections import deque
 from stat import S_ISDIR
-import copy, errno, os, sys, stat, re
+import copy, errno, os, sys, stat, re, threading
 
 from bup import options, git, metadata, vfs
 from bup._helpers import write_sparsely
 from bup.compat import argv_bytes, fsencode, wrap_main
-from bup.helpers import (add_error, chunkyreader, die_if_errors, handle_ctrl_c,
-                         log, mkdirp, parse_rx_excludes, progress, qprogress,
-                         saved_errors, should_rx_exclude_path, unlink)
+from bup.helpers import (WorkerPool, add_error, chunkyreader, die_if_errors,
+                         handle_ctrl_c, log, mkdirp, parse_rx_excludes,
+                         progress, qprogress, saved_errors,
+                         should_rx_exclude_path, unlink)
 from bup.io import byte_stream
 from bup.repo import from_opts
 
@@ -28,6 +30,7 @@ numeric-ids restore numeric IDs (user, group, etc.) rather than names
 exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 sparse      create sparse files
+j,jobs=     number of files to restore concurrently [1]
 v,verbose   increase log output (can be used more than once)
 map-user=   given OLD=NEW, restore OLD user as NEW user
 map-group=  given OLD=NEW, restore OLD group as NEW group
@@ -155,8 +158,74 @@ def write_file_content_sparsely(repo, dest_path, vfs_file):
         finally:
             os.close(outfd)
             
+class ParallelWriter:
+    """Write the content of regular files, and then apply their
+    metadata, on a pool of threads, each with its own repository
+    (from open_repo()).  Since writing into a directory may not be
+    possible after its metadata has been applied, and would change
+    its mtime anyway, apply_dir_metadata() is deferred until all of
+    the files submitted before it have been written."""
+    def __init__(self, jobs, open_repo, sparse, numeric_ids, owner_map):
+        self._pool = WorkerPool(jobs, 4 * jobs)
+        self._open_repo = open_repo
+        self._repos = []
+        self._repos_lock = threading.Lock()
+        self._local = threading.local()
+        self._write = write_file_content_sparsely if sparse \
+                      else write_file_content
+        self._numeric_ids = numeric_ids
+        self._owner_map = owner_map
+        self._jobs = deque()
+        self._submitted = self._finished = 0
+        self._dirs = deque()
+
+    def _repo(self):
+        repo = getattr(self._local, 'repo', None)
+        if not repo:
+            repo = self._local.repo = self._open_repo()
+            with self._repos_lock:
+                self._repos.append(repo)
+        return repo
+
+    def _reap(self, wait=False):
+        # Collect the finished jobs in order (re-raising any errors),
+        # and then apply the metadata for any directories that no
+        # longer have anything pending.
+        jobs = self._jobs
+        while jobs and (wait or jobs[0].done.is_set()):
+            jobs.popleft().wait()
+            self._finished += 1
+        dirs = self._dirs
+        while dirs and dirs[0][0] <= self._finished:
+            _, path, meta = dirs.popleft()
+            apply_metadata(meta, path, self._numeric_ids, self._owner_map)
+
+    def write_file(self, path, item, meta):
+        """Write item's content to the (already created) path, and then
+        apply meta to it."""
+        def write():
+            self._write(self._repo(), path, item)
+            apply_metadata(meta, path, self._numeric_ids, self._owner_map)
+        self._jobs.append(self._pool.submit(write, 1))
+        self._submitted += 1
+        self._reap()
+
+    def apply_dir_metadata(self, path, meta):
+        self._dirs.append((self._submitted, path, meta))
+        self._reap()
+
+    def finish(self):
+        """Wait for everything submitted so far to be written and applied."""
+        self._reap(wait=True)
+
+    def close(self):
+        self._pool.close()
+        for repo in self._repos:
+            repo.close()
+        self._repos = []
+
 def restore(repo, parent_path, name, item, top, sparse, numeric_ids, owner_map,
-            exclude_rxs, verbosity, hardlinks):
+            exclude_rxs, verbosity, hardlinks, writer=None):
     global total_restored
     mode = vfs.item_mode(item)
     treeish = S_ISDIR(mode)
@@ -197,20 +266,34 @@ def restore(repo, parent_path, name, item, top, sparse, numeric_ids, owner_map,
             total_restored += 1
             if verbosity >= 0:
                 qprogress('Restoring: %d\r' % total_restored)
+            if not writer:
+                # Ask for all of the (unchunked) file content at once,
+                # since it's about to be read one file at a time.
+                sub_items = list(sub_items)
+                repo.prefetch([x.oid for _, x in sub_items
+                               if type(x) == vfs.Item
+                               and not S_ISDIR(vfs.item_mode(x))])
             for sub_name, sub_item in sub_items:
                 restore(repo, fullname, sub_name, sub_item, top, sparse,
                         numeric_ids, owner_map, exclude_rxs, verbosity,
-                        hardlinks)
+                        hardlinks, writer)
             os.chdir(b'..')
-            apply_metadata(meta, name, numeric_ids, owner_map)
+            if writer:
+                writer.apply_dir_metadata(top + fullname, meta)
+            else:
+                apply_metadata(meta, name, numeric_ids, owner_map)
         else:
             created_hardlink = False
             if meta.hardlink_target:
                 created_hardlink = hardlink_if_possible(fullname, item, top,
                                                         hardlinks)
+            written_by_writer = False
             if not created_hardlink:
                 meta.create_path(name)
-                if stat.S_ISREG(meta.mode):
+                if writer and stat.S_ISREG(meta.mode):
+                    writer.write_file(top + fullname, item, meta)
+                    written_by_writer = True
+                elif stat.S_ISREG(meta.mode):
                     if sparse:
                         write_file_content_sparsely(repo, name, item)
                     else:
@@ -218,7 +301,7 @@ def restore(repo, parent_path, name, item, top, sparse, numeric_ids, owner_map,
             total_restored += 1
             if verbosity >= 0:
                 qprogress('Restoring: %d\r' % total_restored)
-            if not created_hardlink:
+            if not (created_hardlink or written_by_writer):
                 apply_metadata(meta, name, numeric_ids, owner_map)
     finally:
         os.chdir(orig_cwd)
@@ -237,6 +320,9 @@ def main():
     if not extra:
         o.fatal('must specify at least one filename to restore')
 
+    if opt.jobs < 1:
+        o.fatal('jobs must be a positive integer')
+
     exclude_rxs = parse_rx_excludes(flags, o.fatal)
 
     owner_map = {}
@@ -252,7 +338,27 @@ def main():
     repo = from_opts(opt, reverse=False)
     top = fsencode(os.getcwd())
     hardlinks = {}
-    for path in [argv_bytes(x) for x in extra]:
+    writer = None
+    if opt.jobs > 1:
+        writer = ParallelWriter(opt.jobs,
+                                lambda: from_opts(opt, reverse=False),
+                                opt.sparse, opt.numeric_ids, owner_map)
+    try:
+        restore_paths(repo, [argv_bytes(x) for x in extra], top, opt,
+                      owner_map, exclude_rxs, verbosity, hardlinks, writer)
+        if writer:
+            writer.finish()
+    finally:
+        if writer:
+            writer.close()
+
+    if verbosity >= 0:
+        progress('Restoring: %d, done.\n' % total_restored)
+    die_if_errors()
+
+def restore_paths(repo, paths, top, opt, owner_map, exclude_rxs, verbosity,
+                  hardlinks, writer):
+    for path in paths:
         if not valid_restore_path(path):
             add_error("path %r doesn't include a branch and revision" % path)
             continue
@@ -294,8 +400,10 @@ def main():
                 for sub_name, sub_item in items:
                     restore(repo, b'', sub_name, sub_item, top,
                             opt.sparse, opt.numeric_ids, owner_map,
-                            exclude_rxs, verbosity, hardlinks)
+                            exclude_rxs, verbosity, hardlinks, writer)
                 if path_name == b'.':
+                    if writer:
+                        writer.finish()
                     leaf_item = vfs.augment_item_meta(repo, leaf_item,
                                                       include_size=True)
                     apply_metadata(leaf_item.meta, b'.',
@@ -303,10 +411,6 @@ def main():
         else:
             restore(repo, b'', leaf_name, leaf_item, top,
                     opt.sparse, opt.numeric_ids, owner_map,
-                    exclude_rxs, verbosity, hardlinks)
-
-    if verbosity >= 0:
-        progress('Restoring: %d, done.\n' % total_restored)
-    die_if_errors()
+                    exclude_rxs, verbosity, hardlinks, writer)
 
 wrap_main(main)
@@ -40,6 +40,7 @@ strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
 graft=     a graft point *old_path*=*new_path* (can be used more than once)
 #,compress=  set compression level to # (0-9, 9 is highest)
+j,jobs=    number of threads hashing and compressing file data
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -66,6 +67,14 @@ opt.smaller = parse_num(opt.smaller or 0)
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
 
+if opt.jobs is not None:
+    try:
+        opt.jobs = int(opt.jobs)
+    except ValueError:
+        o.fatal('jobs must be a positive integer')
+    if opt.jobs < 1:
+        o.fatal('jobs must be a positive integer')
+
 if opt.date:
     date = parse_date_or_fatal(opt.date, o.fatal)
 else:
@@ -102,6 +111,16 @@ refname = name and b'refs/heads/%s' % name or None
 repo = repo.from_opts(opt)
 use_treesplit = repo.config(b'bup.treesplit', opttype='bool')
 blobbits = repo.config(b'bup.blobbits', opttype='int')
+splitter = repo.config(b'bup.splitter')
+if splitter is not None and splitter not in hashsplit.SPLITTERS:
+    o.fatal('unknown bup.splitter %r' % splitter.decode('utf-8', 'replace'))
+jobs = opt.jobs or repo.config(b'bup.saveJobs', opttype='int') or 1
+if jobs > 1:
+    split_kwargs = dict(prepare=repo.prepare_data, jobs=jobs)
+    write_blob = repo.write_prepared_many
+else:
+    split_kwargs = {}
+    write_blob = repo.write_data
 
 oldref = refname and repo.read_ref(refname) or None
 
@@ -338,10 +357,12 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
             try:
                 with hashsplit.open_noatime(ent.name) as f:
                     (mode, id) = hashsplit.split_to_blob_or_tree(
-                                            repo.write_data,
+                                            write_blob,
                                             repo.write_tree, [f],
                                             keep_boundaries=False,
-                                            blobbits=blobbits)
+                                            blobbits=blobbits,
+                                            splitter=splitter,
+                                            **split_kwargs)
             except (IOError, OSError) as e:
                 add_error('%s: %s' % (ent.name, e))
                 lastskip_name = ent.name
@@ -46,12 +46,12 @@ def _restrict(server, commands):
 # always allow these - even if set-dir may actually be
 # a no-op (if --force-repo is given)
 permitted = set([b'quit', b'help', b'set-dir', b'list-indexes',
-                 b'send-index', b'config'])
+                 b'send-index', b'config', b'compress'])
 
-read_cmds = set([b'read-ref', b'join', b'cat-batch',
-                 b'refs', b'rev-list', b'resolve'])
+read_cmds = set([b'read-ref', b'join', b'cat-batch', b'cat-stream',
+                 b'refs', b'rev-list', b'resolve', b'bloom', b'exists'])
 append_cmds = set([b'receive-objects-v2', b'read-ref', b'update-ref',
-                   b'init-dir'])
+                   b'init-dir', b'bloom', b'exists'])
 
 if opt.mode is None or opt.mode == 'unrestricted':
     permitted = None # all commands permitted
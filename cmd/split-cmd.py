@@ -104,6 +104,7 @@ if opt.name and not valid_save_name(opt.name):
     o.fatal("'%r' is not a valid branch name." % opt.name)
 refname = opt.name and b'refs/heads/%s' % opt.name or None
 
+splitter = None
 if opt.noop or opt.copy:
     repo = oldref = None
 else:
@@ -114,6 +115,10 @@ else:
         blobbits = repobits
     else:
         print("overriding repo blobbits %d from cmdline with %d" % (repobits, blobbits))
+    splitter = repo.config(b'bup.splitter')
+    if splitter is not None and splitter not in hashsplit.SPLITTERS:
+        o.fatal('unknown bup.splitter %r'
+                % splitter.decode('utf-8', 'replace'))
 
 input = byte_stream(sys.stdin)
 
@@ -166,7 +171,8 @@ out = byte_stream(sys.stdout)
 if opt.blobs:
     shalist = hashsplit.split_to_blobs(write_data, files,
                                        keep_boundaries=opt.keep_boundaries,
-                                       progress=prog, blobbits=blobbits)
+                                       progress=prog, blobbits=blobbits,
+                                       splitter=splitter)
     for (sha, size, level) in shalist:
         out.write(hexlify(sha) + b'\n')
         reprogress()
@@ -176,7 +182,8 @@ elif opt.tree or opt.commit or opt.name:
             hashsplit.split_to_blob_or_tree(write_data, write_tree, files,
                                             keep_boundaries=opt.keep_boundaries,
                                             progress=prog, fanout=fanout,
-                                            blobbits=blobbits)
+                                            blobbits=blobbits,
+                                            splitter=splitter)
         splitfile_name = git.mangle_name(b'data', hashsplit.GIT_MODE_FILE, mode)
         shalist = [(mode, splitfile_name, sha)]
     else:
@@ -184,14 +191,14 @@ elif opt.tree or opt.commit or opt.name:
                       write_data, write_tree, files,
                       keep_boundaries=opt.keep_boundaries,
                       progress=prog, fanout=fanout,
-                      blobbits=blobbits)
+                      blobbits=blobbits, splitter=splitter)
     tree = write_tree(shalist)
 else:
     last = 0
     it = hashsplit.hashsplit_iter(files,
                                   keep_boundaries=opt.keep_boundaries,
                                   progress=prog, fanout=fanout,
-                                  blobbits=blobbits)
+                                  blobbits=blobbits, splitter=splitter)
     for (blob, level) in it:
         hashsplit.total_split += len(blob)
         if opt.copy:
@@ -7,12 +7,13 @@ exec "$bup_python" "$0" ${1+"$@"}
 
 from __future__ import absolute_import, print_function
 from collections import namedtuple
-import mimetypes, os, posixpath, signal, stat, sys, time, urllib, webbrowser
+import mimetypes, os, posixpath, signal, stat, sys, threading, time, urllib
+import webbrowser
 from binascii import hexlify
 
 from bup import options, git, vfs
-from bup.helpers import (chunkyreader, debug1, format_filesize, handle_ctrl_c,
-                         log, saved_errors)
+from bup.helpers import (debug1, format_filesize, handle_ctrl_c, log, parse_num,
+                         saved_errors)
 from bup.metadata import Metadata
 from bup.path import resource_path
 from bup.repo import from_opts
@@ -23,12 +24,20 @@ try:
     from tornado import gen
     from tornado.httpserver import HTTPServer
     from tornado.ioloop import IOLoop
+    from tornado.iostream import StreamClosedError
     from tornado.netutil import bind_unix_socket
     import tornado.web
 except ImportError:
     log('error: cannot find the python "tornado" module; please install it\n')
     sys.exit(1)
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    log('error: cannot find the python "concurrent.futures" module;'
+        ' please install it (e.g. python-futures)\n')
+    sys.exit(1)
+
 
 # FIXME: right now the way hidden files are handled causes every
 # directory to be traversed twice.
@@ -37,7 +46,52 @@ except ImportError:
 handle_ctrl_c()
 
 def http_date_from_utc_ns(utc_ns):
-    return time.strftime('%a, %d %b %Y %H:%M:%S', time.gmtime(utc_ns / 10**9))
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                         time.gmtime(utc_ns // 10**9))
+
+def parse_byte_ranges(value, size):
+    """Return the list of (start, end) offsets (end exclusive) selected
+    from a file of size bytes by the Range header value, sorted, and
+    with any overlapping or adjacent ranges merged.  Return None if the
+    value isn't a valid bytes range, i.e. if the header should be
+    ignored, and an empty list if none of the ranges can be satisfied.
+    """
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    valid = False
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) \
+           or (last and not last.isdigit()) or not (first or last):
+            return None
+        if not first:
+            # suffix range, i.e. the last N bytes
+            start, end = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            end = size if not last else int(last) + 1
+            if last and end <= start:
+                return None
+        valid = True
+        end = min(end, size)
+        if start < end:
+            ranges.append((start, end))
+    if not valid:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
 
 optspec = """
 bup web [[hostname]:port]
@@ -46,6 +100,8 @@ bup web unix://path
 r,remote=         remote repository path
 human-readable    display human readable file sizes (i.e. 3.9K, 4.7M)
 browser           show repository in default browser (incompatible with unix://)
+vfs-cache-size=   approximate size of the repository metadata cache [32M]
+j,jobs=           number of threads reading file data from the repository [4]
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -189,10 +245,57 @@ def _dir_contents(repo, resolution, args):
         yield display_info(name, item, res_item)
 
 
+# Amount of file data to read (and then send) at a time
+_read_size = 256 * 1024
+
+class PerThreadRepo(object):
+    """Forward everything to a repository (from open_repo()) of the
+    calling thread's own, since a repository can't be shared by
+    several threads."""
+    def __init__(self, open_repo):
+        self._open_repo = open_repo
+        self._local = threading.local()
+        self._repos = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        repo = getattr(self._local, 'repo', None)
+        if repo is None:
+            repo = self._local.repo = self._open_repo()
+            with self._lock:
+                self._repos.append(repo)
+        return getattr(repo, name)
+
+    def close_all(self):
+        with self._lock:
+            for repo in self._repos:
+                repo.close()
+            self._repos = []
+
+def _read_at(f, ofs, count):
+    f.seek(ofs)
+    data = f.read(count)
+    if not data:
+        raise IOError('EOF with %d bytes remaining' % count)
+    return data
+
+
+class CacheStatsHandler(tornado.web.RequestHandler):
+    """Report the vfs cache statistics as JSON."""
+
+    def get(self):
+        stats = {}
+        for tag, st in vfs.cache_stats().items():
+            stats[tag[:3].decode('ascii')] = st._asdict()
+        self.write(stats)
+
+
 class BupRequestHandler(tornado.web.RequestHandler):
 
-    def initialize(self, repo=None):
+    def initialize(self, repo=None, read_repo=None, read_pool=None):
         self.repo = repo
+        self.read_repo = read_repo
+        self.read_pool = read_pool
 
     def decode_argument(self, value, name=None):
         if name == 'path':
@@ -217,9 +320,9 @@ class BupRequestHandler(tornado.web.RequestHandler):
             return
         mode = vfs.item_mode(leaf_item)
         if stat.S_ISDIR(mode):
-            self._list_directory(path, res)
+            return self._list_directory(path, res)
         else:
-            self._get_file(self.repo, path, res)
+            return self._get_file(self.repo, path, res)
 
     def _list_directory(self, path, resolution):
         """Helper to produce a directory listing.
@@ -241,14 +344,69 @@ class BupRequestHandler(tornado.web.RequestHandler):
             args=args,
             dir_contents=_dir_contents(self.repo, resolution, args))
 
-    def _set_header(self, path, file_item):
+    def _etag(self, file_item):
+        assert len(file_item.oid) == 20
+        return '"%s"' % hexlify(file_item.oid).decode('ascii')
+
+    def _set_header(self, path, file_item, ranges=None, boundary=None):
+        """Set the headers for a response containing the whole file, or
+        the given ranges of it (as a multipart/byteranges response if
+        there's more than one)."""
         meta = file_item.meta
         ctype = self._guess_type(path)
-        assert len(file_item.oid) == 20
         self.set_header("Last-Modified", http_date_from_utc_ns(meta.mtime))
-        self.set_header("Content-Type", ctype)
-        self.set_header("Etag", hexlify(file_item.oid))
-        self.set_header("Content-Length", str(meta.size))
+        self.set_header("Etag", self._etag(file_item))
+        self.set_header("Accept-Ranges", "bytes")
+        if not ranges:
+            self.set_header("Content-Type", ctype)
+            self.set_header("Content-Length", str(meta.size))
+            return
+        self.set_status(206)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.set_header("Content-Type", ctype)
+            self.set_header("Content-Range",
+                            'bytes %d-%d/%d' % (start, end - 1, meta.size))
+            self.set_header("Content-Length", str(end - start))
+            return
+        self.set_header("Content-Type",
+                        'multipart/byteranges; boundary=%s' % boundary)
+        length = len(self._multipart_end(boundary))
+        for start, end in ranges:
+            length += len(self._multipart_header(boundary, ctype, start, end,
+                                                 meta.size))
+            length += end - start
+        self.set_header("Content-Length", str(length))
+
+    def _multipart_header(self, boundary, ctype, start, end, size):
+        return ('\r\n--%s\r\nContent-Type: %s\r\n'
+                'Content-Range: bytes %d-%d/%d\r\n\r\n'
+                % (boundary, ctype, start, end - 1, size)).encode('ascii')
+
+    def _multipart_end(self, boundary):
+        return ('\r\n--%s--\r\n' % boundary).encode('ascii')
+
+    def _if_range_matches(self, file_item):
+        """Return true unless an If-Range header says that the client's
+        copy of the file is out of date (so it needs all of it)."""
+        if_range = self.request.headers.get('If-Range')
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return if_range == self._etag(file_item)
+        if if_range.startswith('W/'):
+            return False  # weak tags can't be used with If-Range
+        return if_range == http_date_from_utc_ns(file_item.meta.mtime)
+
+    def _requested_ranges(self, file_item):
+        """Return None if the whole file should be sent, or the list of
+        ranges that should be sent (possibly empty, if none of the
+        requested ranges can be satisfied)."""
+        range_hdr = self.request.headers.get('Range')
+        if not range_hdr or not self._if_range_matches(file_item):
+            return None
+        return parse_byte_ranges(range_hdr, file_item.meta.size)
 
     @gen.coroutine
     def _get_file(self, repo, path, resolved):
@@ -257,24 +415,67 @@ class BupRequestHandler(tornado.web.RequestHandler):
         Return value is either a file object, or None (indicating an error).
         In either case, the headers are sent.
         """
+        flushed = False
         try:
             file_item = resolved[-1][1]
             file_item = vfs.augment_item_meta(repo, file_item, include_size=True)
-
-            # we defer the set_header() calls until after we start writing
-            # so we can still generate a 500 failure if something fails ...
-            if self.request.method != 'HEAD':
-                set_header = False
-                with vfs.fopen(self.repo, file_item) as f:
-                    it = chunkyreader(f)
-                    for blob in chunkyreader(f):
+            size = file_item.meta.size
+
+            self.set_header("Etag", self._etag(file_item))
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+            ranges = self._requested_ranges(file_item)
+            if ranges == []:
+                self.set_status(416)
+                self.set_header("Content-Range", 'bytes */%d' % size)
+                return
+            boundary = None
+            if ranges and len(ranges) > 1:
+                boundary = hexlify(os.urandom(16)).decode('ascii')
+
+            if self.request.method == 'HEAD':
+                self._set_header(path, file_item, ranges, boundary)
+                return
+
+            # The repository reads happen on the read_pool, so that
+            # other requests can be handled in the meantime, and we
+            # only read more once the previous data has been sent, so
+            # that each request only holds on to about _read_size
+            # bytes.  We defer the set_header() calls until the first
+            # read succeeds so we can still generate a 500 failure if
+            # something fails...
+            set_header = False
+            with vfs.fopen(self.read_repo, file_item) as f:
+                ctype = self._guess_type(path)
+                for start, end in (ranges or ((0, size),)):
+                    ofs = start
+                    while ofs < end or not set_header:
+                        count = min(end - ofs, _read_size)
+                        blob = b''
+                        if count:
+                            blob = yield self.read_pool.submit(_read_at, f,
+                                                               ofs, count)
                         if not set_header:
-                            self._set_header(path, file_item)
+                            self._set_header(path, file_item, ranges,
+                                             boundary)
                             set_header = True
+                        if boundary and ofs == start:
+                            self.write(self._multipart_header(boundary, ctype,
+                                                              start, end,
+                                                              size))
                         self.write(blob)
-            else:
-                self._set_header(path, file_item)
+                        ofs += len(blob)
+                        flushed = True
+                        yield self.flush()
+                if boundary:
+                    self.write(self._multipart_end(boundary))
+        except StreamClosedError:
+            pass  # the client went away
         except Exception as e:
+            if flushed:
+                raise  # too late to report it to the client
+            self.clear()
             self.set_status(500)
             self.write("<h1>Server Error</h1>\n")
             self.write("%s: %s\n" % (e.__class__.__name__, str(e)))
@@ -351,7 +552,14 @@ else:
             o.fatal('port must be an integer, not %r' % port)
         address = InetAddress(host=host, port=port)
 
+vfs_cache_size = parse_num(opt.vfs_cache_size)
+if vfs_cache_size < 0:
+    o.fatal('--vfs-cache-size must not be negative')
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+
 git.check_repo_or_die()
+vfs.set_cache_limits(max_bytes=vfs_cache_size)
 
 settings = dict(
     debug = 1,
@@ -368,9 +576,13 @@ except AttributeError:
 if opt.remote:
     opt.remote = argv_bytes(opt.remote)
 repo = from_opts(opt, reverse=False)
+read_repo = PerThreadRepo(lambda: from_opts(opt, reverse=False))
+read_pool = ThreadPoolExecutor(opt.jobs)
 
 application = tornado.web.Application([
-    (r"(?P<path>/.*)", BupRequestHandler, dict(repo=repo)),
+    (r"/\.vfs-cache-stats", CacheStatsHandler),
+    (r"(?P<path>/.*)", BupRequestHandler,
+     dict(repo=repo, read_repo=read_repo, read_pool=read_pool)),
 ], **settings)
 
 http_server = HTTPServer(application)
@@ -393,6 +605,8 @@ else:
 
 io_loop = io_loop_pending
 io_loop.start()
+read_pool.shutdown()
+read_repo.close_all()
 
 if saved_errors:
     log('WARNING: %d errors encountered while saving.\n' % len(saved_errors))
@@ -0,0 +1,3 @@
+COMMIT='66552e1e3a6515d01814074fcd423235284f11cc'
+NAMES='(tag: 66552e1)'
+DATE='2026-10-16 23:57:19 +0000'
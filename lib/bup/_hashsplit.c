@@ -52,6 +52,17 @@ static size_t fmincore_chunk_size;
 static unsigned int advise_chunk;
 static unsigned int max_bits;
 
+/* the split algorithms, see hashsplit.SPLITTERS */
+#define HASHSPLIT_ROLLSUM 0
+#define HASHSPLIT_FASTCDC 1
+
+/*
+ * The gear hash table for FastCDC. It's generated by splitmix64 from
+ * a fixed seed at module init; it determines the chunk boundaries and
+ * must therefore never change.
+ */
+static uint64_t gear[256];
+
 /*
  * A HashSplitter is fed a file-like object and will determine
  * how the accumulated record stream should be split.
@@ -60,6 +71,7 @@ typedef struct {
     PyObject_HEAD
     PyObject *files, *fobj;
     unsigned int bits;
+    int mode;
     int filenum;
     int max_blob;
     int fd;
@@ -212,6 +224,7 @@ static int HashSplitter_init(HashSplitter *self, PyObject *args, PyObject *kwds)
         "progress",
         "keep_boundaries",
         "fanbits",
+        "mode",
         NULL
     };
     PyObject *files, *boundaries = NULL;
@@ -223,11 +236,12 @@ static int HashSplitter_init(HashSplitter *self, PyObject *args, PyObject *kwds)
     self->fobj = NULL;
     self->boundaries = 1;
     self->fanbits = 4;
+    self->mode = HASHSPLIT_ROLLSUM;
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Oi|OOi", argnames,
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Oi|OOii", argnames,
                                      &files, &self->bits,
                                      &self->progress, &boundaries,
-                                     &self->fanbits))
+                                     &self->fanbits, &self->mode))
         goto error;
 
     if (boundaries)
@@ -256,6 +270,11 @@ static int HashSplitter_init(HashSplitter *self, PyObject *args, PyObject *kwds)
         goto error;
     }
 
+    if (self->mode != HASHSPLIT_ROLLSUM && self->mode != HASHSPLIT_FASTCDC) {
+        PyErr_Format(PyExc_ValueError, "invalid mode %d", self->mode);
+        goto error;
+    }
+
     self->max_blob = 1 << (self->bits + 2);
     self->bufsz = advise_chunk;
 
@@ -325,10 +344,13 @@ static int HashSplitter_read(HashSplitter *self)
         return 0;
 
     if (self->fd != -1) {
+        char *dest = PyBytes_AS_STRING(self->buf) + self->end;
+        size_t avail = self->bufsz - self->end;
+
         /* this better be the common case ... */
-        len = read(self->fd,
-                   PyBytes_AS_STRING(self->buf) + self->end,
-                   self->bufsz - self->end);
+        Py_BEGIN_ALLOW_THREADS
+        len = read(self->fd, dest, avail);
+        Py_END_ALLOW_THREADS
 
         if (len < 0) {
             PyErr_SetFromErrno(PyExc_IOError);
@@ -454,6 +476,51 @@ static int HashSplitter_find_offs(unsigned int nbits, const unsigned char *buf,
     return HashSplitter_roll(&r, nbits, buf, len, extrabits);
 }
 
+/*
+ * FastCDC (Xia et al., USENIX ATC '16): a gear hash over the bytes
+ * since the chunk start, skipping the first quarter of the expected
+ * chunk size (the minimum chunk size), and "normalized chunking": up
+ * to the expected size (1 << nbits) a boundary needs two more zero
+ * bits than after it, so the chunk sizes cluster around it.  The mask
+ * covers the top bits of the hash, which depend on the most bytes.
+ * The zero bits following the mask determine the fanout level, like
+ * the extra one bits of the rollsum do.  The maximum size is enforced
+ * by the caller.
+ */
+static int HashSplitter_find_offs_fastcdc(unsigned int nbits,
+                                          const unsigned char *buf, int len,
+                                          int *extrabits)
+{
+    int minsz = 1 << (nbits - 2), normsz = 1 << nbits;
+    unsigned int mbits = nbits + 2;
+    uint64_t mask = ~0ULL << (64 - mbits);
+    uint64_t h = 0;
+    int count;
+
+    for (count = minsz; count < len; count++) {
+        h = (h << 1) + gear[buf[count]];
+
+        if (count == normsz) {
+            mbits = nbits - 2;
+            mask = ~0ULL << (64 - mbits);
+        }
+
+        if (!(h & mask)) {
+            uint64_t rest = h << mbits;
+
+            *extrabits = 0;
+            while (*extrabits < (int)(64 - mbits) && !(rest >> 63)) {
+                (*extrabits)++;
+                rest <<= 1;
+            }
+
+            return count + 1;
+        }
+    }
+
+    return 0;
+}
+
 static PyObject *HashSplitter_iternext(HashSplitter *self)
 {
     unsigned int nbits = self->bits;
@@ -495,8 +562,18 @@ static PyObject *HashSplitter_iternext(HashSplitter *self)
         buf = (void *)PyBytes_AS_STRING(self->buf);
         maxlen = min(self->end - self->start, self->max_blob);
 
-        ofs = HashSplitter_find_offs(nbits, buf + self->start, maxlen,
-                                     &extrabits);
+        /*
+         * Nothing else touches our buffer, so let other threads run
+         * while we scan it (e.g. those compressing earlier chunks).
+         */
+        Py_BEGIN_ALLOW_THREADS
+        if (self->mode == HASHSPLIT_FASTCDC)
+            ofs = HashSplitter_find_offs_fastcdc(nbits, buf + self->start,
+                                                 maxlen, &extrabits);
+        else
+            ofs = HashSplitter_find_offs(nbits, buf + self->start, maxlen,
+                                         &extrabits);
+        Py_END_ALLOW_THREADS
 
         if (ofs) {
             level = extrabits / self->fanbits;
@@ -642,10 +719,26 @@ PyTypeObject RecordHashSplitterType = {
     .tp_methods = RecordHashSplitter_methods,
 };
 
+static void gear_init(void)
+{
+    uint64_t x = 0x6275702d63646321ULL; /* "bup-cdc!" */
+    int i;
+
+    for (i = 0; i < 256; i++) {
+        uint64_t z = (x += 0x9e3779b97f4a7c15ULL);
+
+        z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+        z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+        gear[i] = z ^ (z >> 31);
+    }
+}
+
 int hashsplit_init(void)
 {
     size_t pref_chunk_size = 64 * 1024 * 1024;
 
+    gear_init();
+
     page_size = sysconf(_SC_PAGESIZE);
 
     if (page_size < 0) {
@@ -719,8 +719,10 @@ static PyObject *bloom_add(PyObject *self, PyObject *args)
             goto clean_and_return;
         unsigned char *cur = sha.buf;
         unsigned char *end;
+        Py_BEGIN_ALLOW_THREADS
         for (end = cur + sha.len; cur < end; cur += 20/k)
             bloom_set_bit5(bloom.buf, cur, nbits);
+        Py_END_ALLOW_THREADS
     }
     else if (k == 4)
     {
@@ -728,8 +730,10 @@ static PyObject *bloom_add(PyObject *self, PyObject *args)
             goto clean_and_return;
         unsigned char *cur = sha.buf;
         unsigned char *end = cur + sha.len;
+        Py_BEGIN_ALLOW_THREADS
         for (; cur < end; cur += 20/k)
             bloom_set_bit4(bloom.buf, cur, nbits);
+        Py_END_ALLOW_THREADS
     }
     else
         goto clean_and_return;
@@ -793,6 +797,75 @@ static PyObject *bloom_contains(PyObject *self, PyObject *args)
     return result;
 }
 
+static PyObject *bloom_contains_many(PyObject *self, PyObject *args)
+{
+    // Test each of the 20-byte shas concatenated in "shas" (e.g. the
+    // sha table of a PackIdxV2), returning (bitmap, count), where bit
+    // i & 7 of byte i >> 3 of the bitmap is set if sha i is probably
+    // in the filter, and count is the number of bits set.
+    Py_buffer bloom, shas;
+    int nbits = 0, k = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf wbuf_argf "ii",
+                          &bloom, &shas, &nbits, &k))
+        return NULL;
+
+    PyObject *result = NULL, *bitmap = NULL;
+    const Py_ssize_t n = shas.len / 20;
+
+    if (shas.len % 20 != 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "shas length not a multiple of 20");
+        goto clean_and_return;
+    }
+    if (!((k == 5 && nbits >= 0 && nbits <= 29)
+          || (k == 4 && nbits >= 0 && nbits <= 37))
+        || bloom.len < BLOOM2_HEADERLEN + ((Py_ssize_t) 1 << nbits))
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid bloom geometry");
+        goto clean_and_return;
+    }
+    if (!(bitmap = PyBytes_FromStringAndSize(NULL, (n + 7) / 8)))
+        goto clean_and_return;
+
+    // Nothing else can see the new bitmap yet, so it's safe to fill
+    // without the GIL.
+    unsigned char *bits = (unsigned char *) PyBytes_AS_STRING(bitmap);
+    Py_ssize_t i, count = 0;
+    Py_BEGIN_ALLOW_THREADS
+    memset(bits, 0, (n + 7) / 8);
+    for (i = 0; i < n; i++)
+    {
+        const unsigned char *sha = (const unsigned char *) shas.buf + i * 20;
+        const unsigned char *end = sha + 20;
+        if (k == 5)
+        {
+            for (; sha < end; sha += 4)
+                if (!bloom_get_bit5(bloom.buf, sha, nbits))
+                    break;
+        }
+        else
+        {
+            for (; sha < end; sha += 5)
+                if (!bloom_get_bit4(bloom.buf, sha, nbits))
+                    break;
+        }
+        if (sha >= end)
+        {
+            bits[i >> 3] |= 1 << (i & 7);
+            count++;
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    result = Py_BuildValue("On", bitmap, count);
+
+ clean_and_return:
+    Py_XDECREF(bitmap);
+    PyBuffer_Release(&bloom);
+    PyBuffer_Release(&shas);
+    return result;
+}
+
 
 static uint32_t _extract_bits(unsigned char *buf, int nbits)
 {
@@ -821,6 +894,123 @@ static PyObject *extract_bits(PyObject *self, PyObject *args)
 }
 
 
+static PyObject *find_shas(PyObject *self, PyObject *args)
+{
+    // Look up each of the (ideally sorted) 20-byte shas concatenated
+    // in "wanted" in the sha table of an mmapped (m)idx whose
+    // 2^nbits entry fanout table and sha table begin at fanout_ofs
+    // and sha_ofs (with entries stride bytes apart), returning a list
+    // of the matching table indexes (or None).  Since the table is
+    // sorted, a sorted "wanted" is handled in one merge-style pass,
+    // only ever searching between the previous match and the end of
+    // the current fanout bucket.
+    Py_buffer map, wanted;
+    Py_ssize_t fanout_ofs = 0, sha_ofs = 0, stride = 0;
+    int nbits = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf "nin" "n" wbuf_argf,
+                          &map, &fanout_ofs, &nbits, &sha_ofs, &stride,
+                          &wanted))
+        return NULL;
+
+    PyObject *result = NULL;
+    Py_ssize_t *found = NULL;
+    const Py_ssize_t n = wanted.len / 20;
+    const unsigned char *base = map.buf;
+
+    if (wanted.len % 20 != 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "wanted length not a multiple of 20");
+        goto clean_and_return;
+    }
+    if (nbits < 0 || nbits > 31 || stride < 20 || fanout_ofs < 0
+        || sha_ofs < 0
+        || fanout_ofs + ((Py_ssize_t) 4 << nbits) > map.len)
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid index geometry");
+        goto clean_and_return;
+    }
+    const uint32_t *fanout = (const uint32_t *) (base + fanout_ofs);
+    const Py_ssize_t nsha = ntohl(fanout[((Py_ssize_t) 1 << nbits) - 1]);
+    if (nsha && sha_ofs + (nsha - 1) * stride + 20 > map.len)
+    {
+        PyErr_SetString(PyExc_ValueError, "index sha table truncated");
+        goto clean_and_return;
+    }
+    if (!(found = checked_malloc(n ? n : 1, sizeof(Py_ssize_t))))
+        goto clean_and_return;
+
+    Py_ssize_t i;
+    int bad_fanout = 0;
+    Py_BEGIN_ALLOW_THREADS
+    Py_ssize_t cur = 0;
+    const unsigned char *prev = NULL;
+    for (i = 0; i < n; i++)
+    {
+        const unsigned char *want = (const unsigned char *) wanted.buf + i * 20;
+        const uint32_t bucket = nbits ? _extract_bits((unsigned char *) want,
+                                                      nbits) : 0;
+        Py_ssize_t lo = bucket ? ntohl(fanout[bucket - 1]) : 0;
+        Py_ssize_t hi = ntohl(fanout[bucket]);
+        if (lo > hi || hi > nsha)
+        {
+            bad_fanout = 1;
+            break;
+        }
+        if (prev && memcmp(prev, want, 20) < 0 && cur > lo)
+            lo = cur;  // everything before the last match is smaller
+        prev = want;
+        found[i] = -1;
+        while (lo < hi)
+        {
+            const Py_ssize_t mid = lo + (hi - lo) / 2;
+            const int c = memcmp(base + sha_ofs + mid * stride, want, 20);
+            if (c < 0)
+                lo = mid + 1;
+            else if (c > 0)
+                hi = mid;
+            else
+            {
+                found[i] = lo = mid;
+                break;
+            }
+        }
+        cur = lo;
+    }
+    Py_END_ALLOW_THREADS
+    if (bad_fanout)
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid index fanout table");
+        goto clean_and_return;
+    }
+
+    result = PyList_New(n);
+    if (!result)
+        goto clean_and_return;
+    for (i = 0; i < n; i++)
+    {
+        PyObject *item;
+        if (found[i] < 0)
+        {
+            Py_INCREF(Py_None);
+            item = Py_None;
+        }
+        else if (!(item = PyLong_FromSsize_t(found[i])))
+        {
+            Py_DECREF(result);
+            result = NULL;
+            goto clean_and_return;
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+
+ clean_and_return:
+    free(found);
+    PyBuffer_Release(&map);
+    PyBuffer_Release(&wanted);
+    return result;
+}
+
+
 struct sha {
     unsigned char bytes[20];
 };
@@ -1806,8 +1996,12 @@ static PyMethodDef helper_methods[] = {
 	"Check if a bloom filter of 2^nbits bytes contains an object" },
     { "bloom_add", bloom_add, METH_VARARGS,
 	"Add an object to a bloom filter of 2^nbits bytes" },
+    { "bloom_contains_many", bloom_contains_many, METH_VARARGS,
+	"Return a (bitmap, count) of which of a buffer of shas are in a bloom." },
     { "extract_bits", extract_bits, METH_VARARGS,
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
+    { "find_shas", find_shas, METH_VARARGS,
+	"Return the (m)idx sha table indexes of a buffer of sorted shas." },
     { "merge_into", merge_into, METH_VARARGS,
 	"Merges a bunch of idx and midx files into a single midx." },
     { "write_idx", write_idx, METH_VARARGS,
@@ -81,11 +81,14 @@ Brandon Low <lostlogic@lostlogicx.com> 2011-02-04
 """
 
 from __future__ import absolute_import
-import sys, os, math, mmap, struct
+import errno, sys, os, math, mmap, struct
 
 from bup import _helpers
-from bup.helpers import (debug1, debug2, log, mmap_read, mmap_readwrite,
-                         mmap_readwrite_private, unlink)
+from bup.compat import byte_int, range
+from bup.helpers import (atomically_replaced_file, debug1, debug2, log,
+                         mmap_read, mmap_readwrite, mmap_readwrite_private,
+                         unlink)
+from bup.io import path_msg
 
 
 BLOOM_VERSION = 2
@@ -98,6 +101,12 @@ _total_steps = 0
 
 bloom_contains = _helpers.bloom_contains
 bloom_add = _helpers.bloom_add
+bloom_contains_many = _helpers.bloom_contains_many
+
+
+def bitmap_get(bitmap, i):
+    """Return true if bit i of a bitmap from exists_bitmap() is set."""
+    return byte_int(bitmap[i >> 3]) & (1 << (i & 7))
 
 # FIXME: check bloom create() and ShaBloom handling/ownership of "f".
 # The ownership semantics should be clarified since the caller needs
@@ -224,6 +233,26 @@ class ShaBloom:
         _total_steps += steps
         return found
 
+    def exists_bitmap(self, shas):
+        """Return (bitmap, count) for shas, a buffer of concatenated
+        20-byte hashes (e.g. the shatable of a PackIdxV2), where
+        bitmap_get(bitmap, i) is true if the i'th hash probably exists
+        (cf. exists()), and count is the number of those that do.
+        This is much cheaper than calling exists() for each of them,
+        and doesn't hold the GIL while the filter is consulted."""
+        global _total_searches
+        n = len(shas) // 20
+        _total_searches += n
+        if not self.map:
+            return bytes(bytearray((n + 7) // 8)), 0
+        return bloom_contains_many(self.map, shas, self.bits, self.k)
+
+    def exists_many(self, shas):
+        """Return a list containing the exists() result for each of shas."""
+        bitmap = self.exists_bitmap(b''.join(shas))[0]
+        return [True if bitmap_get(bitmap, i) else None
+                for i in range(len(shas))]
+
     def __len__(self):
         return int(self.entries)
 
@@ -250,5 +279,101 @@ def create(name, expected, delaywrite=None, f=None, k=None):
     return ShaBloom(name, f=f, readwrite=True, expected=expected)
 
 
+# Bits per entry (at least half, at most all of them) for a
+# MemoryBloom, which is meant to be sent over the network, so it's
+# allowed a higher false positive rate (up to about 2%) than a
+# bup.bloom.
+MEMORY_BITS_EACH = 16
+MEMORY_MIN_BITS_EACH = 8
+# Don't hold (or send) more than 2^MEMORY_MAX_BITS bytes.
+MEMORY_MAX_BITS = 25
+
+class MemoryBloom:
+    """A bloom filter in the same format as a bup.bloom (without the
+    idx names), but held in memory, e.g. to be sent to a bup client
+    (as data) so that it can tell which objects the server definitely
+    doesn't have."""
+    def __init__(self, data):
+        if data[0:4] != b'BLOM':
+            raise Exception('invalid BLOM header %r' % bytes(data[0:4]))
+        ver, self.bits, self.k, self.entries \
+            = struct.unpack('!IHHI', bytes(data[4:16]))
+        if ver != BLOOM_VERSION:
+            raise Exception('unexpected bloom version %d' % ver)
+        if len(data) != 16 + 2**self.bits:
+            raise Exception('bloom has %d bytes, not %d'
+                            % (len(data), 16 + 2**self.bits))
+        # bloom_contains() needs a writable buffer
+        self.data = data if isinstance(data, bytearray) else bytearray(data)
+
+    def add(self, ids):
+        """Add the hashes in ids (packed binary 20-bytes) to the filter."""
+        self.entries += bloom_add(self.data, ids, self.bits, self.k)
+        self.data[12:16] = struct.pack('!I', self.entries)
+
+    def exists(self, sha):
+        """Return nonempty if the object probably exists (cf. ShaBloom)."""
+        return bloom_contains(self.data, sha, self.bits, self.k)[0]
+
+    def exists_bitmap(self, shas):
+        """Return (bitmap, count) for a buffer of hashes (cf. ShaBloom)."""
+        return bloom_contains_many(self.data, shas, self.bits, self.k)
+
+    def has_room(self, additional):
+        """Return true if the filter can hold `additional` more entries
+        (at MEMORY_MIN_BITS_EACH or more bits each)."""
+        return (self.entries + additional) * MEMORY_MIN_BITS_EACH \
+            <= 8 * 2**self.bits
+
+    def __len__(self):
+        return int(self.entries)
+
+
+def create_in_memory(expected):
+    """Create and return an empty MemoryBloom for `expected` entries,
+    or None if that many won't fit in 2^MEMORY_MAX_BITS bytes."""
+    if expected * MEMORY_MIN_BITS_EACH > 8 * 2**MEMORY_MAX_BITS:
+        return None
+    bits = int(math.floor(math.log(max(1, expected) * MEMORY_BITS_EACH // 8,
+                                   2)))
+    bits = min(max(bits, 10), MEMORY_MAX_BITS)
+    k = (bits <= MAX_BLOOM_BITS[5]) and 5 or 4
+    bits = min(bits, MAX_BLOOM_BITS[k])
+    data = bytearray(16 + 2**bits)
+    data[0:16] = b'BLOM' + struct.pack('!IHHI', BLOOM_VERSION, bits, k, 0)
+    return MemoryBloom(data)
+
+
+def read_memory_bloom(path):
+    """Return (bloom, idxnames) as saved by write_memory_bloom(), or
+    None if path doesn't exist or isn't valid."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    if len(data) < 16 or data[0:4] != b'BLOM':
+        return None
+    bits = struct.unpack('!H', data[8:10])[0]
+    end = 16 + 2**bits
+    try:
+        b = MemoryBloom(bytearray(data[:end]))
+    except Exception as e:
+        debug1('bloom: ignoring %s: %s\n' % (path_msg(path), e))
+        return None
+    idxnames = data[end:].split(b'\0') if len(data) > end else []
+    return b, idxnames
+
+
+def write_memory_bloom(path, b, idxnames):
+    """Save the MemoryBloom b, which covers idxnames, to path (in the
+    same format as a bup.bloom)."""
+    with atomically_replaced_file(path, 'wb') as f:
+        f.write(b.data)
+        f.write(b'\0'.join(idxnames))
+
+
 def clear_bloom(dir):
     unlink(os.path.join(dir, b'bup.bloom'))
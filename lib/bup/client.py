@@ -6,7 +6,7 @@ from binascii import hexlify, unhexlify
 import errno, os, re, struct, sys, time, zlib
 import socket
 
-from bup import git, ssh, vfs, protocol
+from bup import bloom, git, ssh, vfs, protocol
 from bup.compat import environ, range, reraise
 from bup.helpers import (Conn, atomically_replaced_file, chunkyreader, debug1,
                          debug2, linereader, lines_until_sentinel,
@@ -17,6 +17,16 @@ from bup.vint import read_bvec, read_vuint, write_bvec
 
 bwlimit = None
 
+# Number of refs Client.cat_stream() may send ahead of the server's
+# answers.  Keep the refs (41 bytes each) well below the size of a
+# pipe buffer, so that writing them can never block.
+CAT_STREAM_WINDOW = 256
+
+# Number (and total size) of objects that the server's bloom filter
+# says it may have to collect before asking whether it actually does.
+MAYBE_PRESENT_BATCH = 256
+MAYBE_PRESENT_MAX_BYTES = 8 * 1024 * 1024
+
 
 class ClientError(Exception):
     pass
@@ -80,8 +90,14 @@ def parse_remote(remote):
 
 
 class Client:
-    def __init__(self, remote, create=False):
+    def __init__(self, remote, create=False, wire_compression=None,
+                 server_bloom=True):
         self._busy = self.conn = None
+        self._wire_compression = None
+        self._server_bloom = server_bloom
+        self._bloom = None  # False once we know we won't use one
+        self._uncached_indexes = None
+        self._dumb_server = False
         self.sock = self.p = self.pout = self.pin = None
         (self.protocol, self.host, self.port, self.dir) = parse_remote(remote)
         # The b'None' here matches python2's behavior of b'%s' % None == 'None',
@@ -121,6 +137,15 @@ class Client:
             else:
                 self.conn.write(b'set-dir %s\n' % self.dir)
             self.check_ok()
+        if wire_compression is None:
+            # Not worth the trouble when the server is on this machine.
+            wire_compression = 0 if self.protocol == b'file' else 1
+        if wire_compression and b'compress' in self._available_commands:
+            self.conn.write(b'compress %d\n' % wire_compression)
+            not_ok = self.check_ok()
+            if not_ok:
+                raise not_ok
+            self._wire_compression = wire_compression
         self.sync_indexes()
 
     def __del__(self):
@@ -154,14 +179,14 @@ class Client:
         self.conn = None
         self.sock = self.p = self.pin = self.pout = None
 
-    def check_ok(self):
+    def check_ok(self, conn=None):
         if self.p:
             rv = self.p.poll()
             if rv != None:
                 raise ClientError('server exited unexpectedly with code %r'
                                   % rv)
         try:
-            return self.conn.check_ok()
+            return (conn or self.conn).check_ok()
         except Exception as e:
             reraise(ClientError(e))
 
@@ -202,6 +227,15 @@ class Client:
         self._not_busy()
         return frozenset(result)
 
+    def _reply_conn(self):
+        """Return the conn from which to read the reply to the current
+        command (which must be one the server compresses, cf.
+        protocol._compressed_reply_commands), and to pass to
+        check_ok()."""
+        if self._wire_compression:
+            return protocol.DecompressingConn(self.conn)
+        return self.conn
+
     def _require_command(self, name):
         if name not in self._available_commands:
             raise ClientError('server does not appear to provide %s command'
@@ -210,8 +244,9 @@ class Client:
     def _list_indexes(self):
         self._require_command(b'list-indexes')
         self.check_busy()
-        self.conn.write(b'list-indexes\n')
-        for line in linereader(self.conn):
+        conn = self._reply_conn()
+        conn.write(b'list-indexes\n')
+        for line in linereader(conn):
             if not line:
                 break
             assert(line.find(b'/') < 0)
@@ -219,7 +254,7 @@ class Client:
             idx = parts[0]
             load = len(parts) == 2 and parts[1] == b'load'
             yield idx, load
-        self.check_ok()
+        self.check_ok(conn)
 
     def list_indexes(self):
         for idx, load in self._list_indexes():
@@ -235,13 +270,16 @@ class Client:
             if f.endswith(b'.idx'):
                 extra.add(f)
         needed = set()
+        server_indexes = set()
         for idx, load in self._list_indexes():
+            server_indexes.add(idx)
             if load:
                 # If the server requests that we load an idx and we don't
                 # already have a copy of it, it is needed
                 needed.add(idx)
             # Any idx that the server has heard of is proven not extra
             extra.discard(idx)
+            self._dumb_server = self._dumb_server or load
 
         debug1('client: removing extra indexes: %s\n' % extra)
         for idx in extra:
@@ -250,25 +288,30 @@ class Client:
         for idx in needed:
             self.sync_index(idx)
         git.auto_midx(self.cachedir)
+        self._uncached_indexes = set(idx for idx in server_indexes
+                                     if idx.endswith(b'.idx')
+                                     and not os.path.exists(
+                                         os.path.join(self.cachedir, idx)))
 
     def send_index(self, name, f, send_size):
         self._require_command(b'send-index')
         #debug1('requesting %r\n' % name)
         self.check_busy()
-        self.conn.write(b'send-index %s\n' % name)
-        n = struct.unpack('!I', self.conn.read(4))[0]
+        conn = self._reply_conn()
+        conn.write(b'send-index %s\n' % name)
+        n = struct.unpack('!I', conn.read(4))[0]
         assert(n)
 
         send_size(n)
 
         count = 0
         progress('Receiving index from server: %d/%d\r' % (count, n))
-        for b in chunkyreader(self.conn, n):
+        for b in chunkyreader(conn, n):
             f.write(b)
             count += len(b)
             qprogress('Receiving index from server: %d/%d\r' % (count, n))
         progress('Receiving index from server: %d/%d, done.\n' % (count, n))
-        self.check_ok()
+        self.check_ok(conn)
 
     def sync_index(self, name):
         mkdirp(self.cachedir)
@@ -283,7 +326,66 @@ class Client:
     def _make_objcache(self, repo_dir):
         return git.PackIdxList(self.cachedir)
 
-    def _suggest_packs(self):
+    def _get_bloom(self):
+        """Return the server's bloom.MemoryBloom of its objects, or
+        None if it can't provide one (or we shouldn't use it).  It's
+        only fetched (once) if the index cache is missing some of the
+        server's indexes, since otherwise the cache already says
+        everything the filter could."""
+        if self._bloom is None:
+            self._bloom = False
+            if not (self._server_bloom
+                    and b'bloom' in self._available_commands
+                    and b'exists' in self._available_commands):
+                return None
+            # A dumb server has us load all of its indexes anyway.
+            if self._dumb_server or not self._uncached_indexes:
+                return None
+            self.check_busy()
+            conn = self._reply_conn()
+            conn.write(b'bloom\n')
+            n = struct.unpack('!Q', conn.read(8))[0]
+            data = bytearray()
+            progress('Receiving object filter from server: %d/%d\r'
+                     % (len(data), n))
+            for b in chunkyreader(conn, n):
+                data += b
+                qprogress('Receiving object filter from server: %d/%d\r'
+                          % (len(data), n))
+            progress('Receiving object filter from server: %d/%d, done.\n'
+                     % (len(data), n))
+            not_ok = self.check_ok(conn)
+            if not_ok:
+                raise not_ok
+            # The server has too many objects for a useful filter.
+            if data:
+                self._bloom = bloom.MemoryBloom(data)
+        return self._bloom if self._bloom is not False else None
+
+    def _exists(self, oids):
+        """Return a list of whether the server has each of the objects
+        in oids, suspending receive-objects-v2 if need be."""
+        result = []
+        def query():
+            self.check_busy()
+            self.conn.write(b'exists\n')
+            for oid in oids:
+                self.conn.write(b'%s\n' % hexlify(oid))
+            self.conn.write(b'\n')
+            found = self.conn.readline()
+            not_ok = self.check_ok()
+            if not_ok:
+                raise not_ok
+            if len(found) != len(oids) + 1 or found.strip(b'01') != b'\n':
+                raise ClientError('unexpected exists response %r' % found)
+            result.extend(x == ord(b'1') for x in bytearray(found[:-1]))
+        if self._busy:
+            self._suggest_packs(while_suspended=query)
+        else:
+            query()
+        return result
+
+    def _suggest_packs(self, while_suspended=None):
         ob = self._busy
         if ob:
             assert(ob == b'receive-objects-v2')
@@ -310,6 +412,8 @@ class Client:
         for idx in suggested:
             self.sync_index(idx)
         git.auto_midx(self.cachedir)
+        if while_suspended:
+            while_suspended()
         if ob:
             self._busy = ob
             self.conn.write(b'%s\n' % ob)
@@ -325,6 +429,8 @@ class Client:
             self.conn.write(b'receive-objects-v2\n')
         objcache_maker = objcache_maker or self._make_objcache
         return PackWriter_Remote(self.conn,
+                                 get_bloom=self._get_bloom,
+                                 exists=self._exists,
                                  objcache_maker = objcache_maker,
                                  suggest_packs = self._suggest_packs,
                                  onopen = _set_busy,
@@ -358,18 +464,43 @@ class Client:
         self._require_command(b'join')
         self.check_busy()
         self._busy = b'join'
+        conn = self._reply_conn()
         # Send 'cat' so we'll work fine with older versions
-        self.conn.write(b'cat %s\n' % re.sub(br'[\n\r]', b'_', id))
+        conn.write(b'cat %s\n' % re.sub(br'[\n\r]', b'_', id))
         while 1:
-            sz = struct.unpack('!I', self.conn.read(4))[0]
+            sz = struct.unpack('!I', conn.read(4))[0]
             if not sz: break
-            yield self.conn.read(sz)
+            yield conn.read(sz)
         # FIXME: ok to assume the only NotOk is a KeyError? (it is true atm)
-        e = self.check_ok()
+        e = self.check_ok(conn)
         self._not_busy()
         if e:
             raise KeyError(str(e))
 
+    def _read_object_info(self):
+        # Read one object of a cat-batch or cat-stream reply (cf.
+        # BupProtocolServer._write_object()) and return (oidx, type,
+        # size, reader), or all None if the object is missing.
+        info = self.conn.readline()
+        if info == b'missing\n':
+            return None, None, None, None
+        if not (info and info.endswith(b'\n')):
+            raise ClientError('Hit EOF while looking for object info: %r'
+                              % info)
+        fields = info[:-1].split(b' ')
+        if len(fields) == 4:
+            oidx, oid_t, size, zsize = fields
+            size = int(size)
+            data = zlib.decompress(b''.join(chunkyreader(self.conn,
+                                                         int(zsize))))
+            if len(data) != size:
+                raise ClientError('object %s has size %d, not %d'
+                                  % (oidx, len(data), size))
+            return oidx, oid_t, size, iter((data,))
+        oidx, oid_t, size = fields
+        size = int(size)
+        return oidx, oid_t, size, chunkyreader(self.conn, size)
+
     def cat_batch(self, refs):
         self._require_command(b'cat-batch')
         self.check_busy()
@@ -384,20 +515,62 @@ class Client:
             conn.write(b'\n')
         conn.write(b'\n')
         for ref in refs:
-            info = conn.readline()
-            if info == b'missing\n':
-                yield None, None, None, None
-                continue
-            if not (info and info.endswith(b'\n')):
-                raise ClientError('Hit EOF while looking for object info: %r'
-                                  % info)
-            oidx, oid_t, size = info.split(b' ')
-            size = int(size)
-            cr = chunkyreader(conn, size)
-            yield oidx, oid_t, size, cr
-            detritus = next(cr, None)
-            if detritus:
-                raise ClientError('unexpected leftover data ' + repr(detritus))
+            info = self._read_object_info()
+            yield info
+            if info[0]:
+                detritus = next(info[3], None)
+                if detritus:
+                    raise ClientError('unexpected leftover data '
+                                      + repr(detritus))
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+
+    def has_cat_stream(self):
+        return b'cat-stream' in self._available_commands
+
+    def cat_stream(self, refs, window=CAT_STREAM_WINDOW):
+        """Yield (oidx, type, size, reader) for each ref in refs like
+        cat_batch(), but send the refs to the server while the answers
+        arrive, with up to window refs outstanding, so that fetching
+        many objects doesn't cost one round trip each.  The next ref
+        is only taken from refs after the previous item's reader has
+        been consumed, so refs may be a generator that decides when to
+        stop.
+
+        """
+        self._require_command(b'cat-stream')
+        self.check_busy()
+        self._busy = b'cat-stream'
+        conn = self.conn
+        conn.write(b'cat-stream\n')
+        refs = iter(refs)
+        outstanding = 0
+        more = True
+        while True:
+            while more and outstanding < window:
+                ref = next(refs, None)
+                if ref is None:
+                    more = False
+                    conn.write(b'\n')
+                    break
+                assert ref
+                assert b'\n' not in ref
+                conn.write(ref)
+                conn.write(b'\n')
+                outstanding += 1
+            if not outstanding:
+                break
+            info = self._read_object_info()
+            outstanding -= 1
+            yield info
+            if info[0]:
+                detritus = next(info[3], None)
+                if detritus:
+                    raise ClientError('unexpected leftover data '
+                                      + repr(detritus))
         # FIXME: confusing
         not_ok = self.check_ok()
         if not_ok:
@@ -409,7 +582,7 @@ class Client:
         self._require_command(b'refs')
         self.check_busy()
         self._busy = b'refs'
-        conn = self.conn
+        conn = self._reply_conn()
         conn.write(b'refs %d %d\n' % (1 if limit_to_heads else 0,
                                       1 if limit_to_tags else 0))
         for pattern in patterns:
@@ -426,7 +599,7 @@ class Client:
                 raise ClientError('Invalid reference name in %r' % line)
             yield name, unhexlify(oidx)
         # FIXME: confusing
-        not_ok = self.check_ok()
+        not_ok = self.check_ok(conn)
         if not_ok:
             raise not_ok
         self._not_busy()
@@ -448,7 +621,7 @@ class Client:
             assert b'\n' not in ref
         self.check_busy()
         self._busy = b'rev-list'
-        conn = self.conn
+        conn = self._reply_conn()
         conn.write(b'rev-list\n')
         conn.write(b'\n')
         if format:
@@ -471,7 +644,7 @@ class Client:
                 assert len(cmt_oidx) == 40
                 yield cmt_oidx, parse(conn)
         # FIXME: confusing
-        not_ok = self.check_ok()
+        not_ok = self.check_ok(conn)
         if not_ok:
             raise not_ok
         self._not_busy()
@@ -480,7 +653,7 @@ class Client:
         self._require_command(b'resolve')
         self.check_busy()
         self._busy = b'resolve'
-        conn = self.conn
+        conn = self._reply_conn()
         conn.write(b'resolve %d\n' % ((1 if want_meta else 0)
                                       | (2 if follow else 0)
                                       | (4 if parent else 0)))
@@ -494,7 +667,7 @@ class Client:
         else:
             result = protocol.read_ioerror(conn)
         # FIXME: confusing
-        not_ok = self.check_ok()
+        not_ok = self.check_ok(conn)
         if not_ok:
             raise not_ok
         self._not_busy()
@@ -529,7 +702,8 @@ class PackWriter_Remote(git.PackWriter):
                  ensure_busy,
                  compression_level=None,
                  max_pack_size=None,
-                 max_pack_objects=None):
+                 max_pack_objects=None,
+                 get_bloom=None, exists=None):
         git.PackWriter.__init__(self,
                                 objcache_maker=objcache_maker,
                                 compression_level=compression_level,
@@ -544,14 +718,55 @@ class PackWriter_Remote(git.PackWriter):
         self._packopen = False
         self._bwcount = 0
         self._bwtime = time.time()
+        # With the server's bloom filter (fetched when the first
+        # object is written), only send the objects it definitely
+        # doesn't have right away, and collect the others until we
+        # can ask (via exists) about a whole batch of them.
+        self._get_bloom = get_bloom
+        self._bloom = None
+        self._exists = exists
+        self._maybe_present = []
+        self._maybe_present_bytes = 0
+        self.skipped = 0
 
     def _open(self):
         if not self._packopen:
             self.onopen()
             self._packopen = True
 
+    def _write_encoded(self, sha, datalist):
+        if self._get_bloom:
+            self._bloom = self._get_bloom()
+            self._get_bloom = None
+        if self._bloom and self._bloom.exists(sha):
+            data = b''.join(datalist)
+            self._maybe_present.append((sha, data))
+            self._maybe_present_bytes += len(data)
+            if len(self._maybe_present) >= MAYBE_PRESENT_BATCH \
+               or self._maybe_present_bytes >= MAYBE_PRESENT_MAX_BYTES:
+                self._write_maybe_present()
+            return sha
+        return git.PackWriter._write_encoded(self, sha, datalist)
+
+    def _write_maybe_present(self):
+        objs = self._maybe_present
+        if not objs:
+            return
+        self._maybe_present = []
+        self._maybe_present_bytes = 0
+        found = self._exists([sha for sha, data in objs])
+        for (sha, data), present in zip(objs, found):
+            if present:
+                self.skipped += 1
+            else:
+                git.PackWriter._write_encoded(self, sha, (data,))
+        debug1('client: server had %d of %d probable objects\n'
+               % (sum(found), len(objs)))
+
     def _end(self, run_midx=True):
         assert(run_midx)  # We don't support this via remote yet
+        if self.file:
+            self._write_maybe_present()
         if self._packopen and self.file:
             self.file.write(b'\0\0\0\0')
             self._packopen = False
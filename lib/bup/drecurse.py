@@ -1,8 +1,13 @@
 
 from __future__ import absolute_import
-import stat, os
+from collections import deque
+from functools import partial
+import errno, stat, os
 
-from bup.helpers import add_error, should_rx_exclude_path, debug1, resolve_parent
+from bup import journal
+from bup.compat import fsencode
+from bup.helpers import (WorkerPool, add_error, should_rx_exclude_path, debug1,
+                         resolve_parent)
 from bup.io import path_msg
 import bup.xstat as xstat
 
@@ -16,6 +21,14 @@ try:
 except AttributeError:
     O_NOFOLLOW = 0
 
+# The parallel scanner can't fchdir() (the cwd is shared by all the
+# threads), so it needs scandir() on a directory fd, and the fstatat()
+# that then comes with the entries (python 3.7+).
+try:
+    parallel_scan_supported = os.scandir in os.supports_fd
+except AttributeError:
+    parallel_scan_supported = False
+
 
 # the use of fchdir() and lstat() is for two reasons:
 #  - help out the kernel by not making it repeatedly look up the absolute path
@@ -54,23 +67,29 @@ def _dirlist():
     return l
 
 
+def _excluded(path, bup_dir, excluded_paths, exclude_rxs):
+    if excluded_paths:
+        if os.path.normpath(path) in excluded_paths:
+            debug1('Skipping %r: excluded.\n' % path_msg(path))
+            return True
+    if exclude_rxs and should_rx_exclude_path(path, exclude_rxs):
+        return True
+    if bup_dir != None and path.endswith(b'/'):
+        if os.path.normpath(path) == bup_dir:
+            debug1('Skipping BUP_DIR.\n')
+            return True
+    return False
+
+
 def _recursive_dirlist(prepend, xdev, bup_dir=None,
                        excluded_paths=None,
                        exclude_rxs=None,
                        xdev_exceptions=frozenset()):
     for (name,pst) in _dirlist():
         path = prepend + name
-        if excluded_paths:
-            if os.path.normpath(path) in excluded_paths:
-                debug1('Skipping %r: excluded.\n' % path_msg(path))
-                continue
-        if exclude_rxs and should_rx_exclude_path(path, exclude_rxs):
+        if _excluded(path, bup_dir, excluded_paths, exclude_rxs):
             continue
         if name.endswith(b'/'):
-            if bup_dir != None:
-                if os.path.normpath(path) == bup_dir:
-                    debug1('Skipping BUP_DIR.\n')
-                    continue
             if xdev != None and pst.st_dev != xdev \
                and path not in xdev_exceptions:
                 debug1('Skipping contents of %r: different filesystem.\n'
@@ -91,10 +110,190 @@ def _recursive_dirlist(prepend, xdev, bup_dir=None,
         yield (path, pst)
 
 
+def _scan_dir(path, dir_st, bup_dir, excluded_paths, exclude_rxs):
+    """Return (entries, errors) for the directory at path (ending in
+    /), which must still be the directory described by dir_st, with
+    entries as from _dirlist(), but without the excluded paths, or
+    return (None, error) if the directory can't be opened.  Since
+    the type of each entry usually comes with the listing (d_type),
+    excluded entries normally aren't stat'ed at all, and the rest
+    are stat'ed relative to the directory's fd, without any lookup
+    of the full path."""
+    try:
+        fd = os.open(path, os.O_RDONLY|O_LARGEFILE|O_NOFOLLOW|os.O_NDELAY)
+    except OSError as e:
+        return None, e
+    try:
+        st = xstat.fstat(fd)
+        if st.st_dev != dir_st.st_dev or st.st_ino != dir_st.st_ino:
+            return None, Exception('directory changed while scanning')
+        entries = []
+        errors = []
+        with os.scandir(fd) as dir_entries:
+            for ent in dir_entries:
+                name = fsencode(ent.name)
+                try:
+                    is_dir = ent.is_dir(follow_symlinks=False)
+                    if is_dir:
+                        name += b'/'
+                    if _excluded(path + name, bup_dir, excluded_paths,
+                                 exclude_rxs):
+                        continue
+                    st = xstat.stat_result.from_os_stat(
+                        ent.stat(follow_symlinks=False))
+                except OSError as e:
+                    errors.append(Exception('%s: %s'
+                                            % (resolve_parent(path + name),
+                                               str(e))))
+                    continue
+                if ((st.st_mode & _IFMT) == stat.S_IFDIR) != is_dir:
+                    # Replaced since it was listed
+                    name = name[:-1] if is_dir else name + b'/'
+                    if _excluded(path + name, bup_dir, excluded_paths,
+                                 exclude_rxs):
+                        continue
+                entries.append((name, st))
+        entries.sort(reverse=True)
+        return entries, errors
+    except OSError as e:
+        return None, e
+    finally:
+        os.close(fd)
+
+
+class _DirScanner:
+    """Scan directories (via _scan_dir()) on up to 'jobs' threads, in
+    the order walk() will need them, and at most 'window' ahead of
+    it."""
+    def __init__(self, jobs, window, bup_dir, excluded_paths, exclude_rxs):
+        self._pool = WorkerPool(jobs, window)
+        self._window = window
+        self._scan = partial(_scan_dir, bup_dir=bup_dir,
+                             excluded_paths=excluded_paths,
+                             exclude_rxs=exclude_rxs)
+        # One deque per directory being walked (innermost last), of
+        # the [path, st, job] of its subdirectories that haven't been
+        # submitted yet.
+        self._levels = []
+        self._pending = 0
+
+    def _submit(self, subdir):
+        path, st, _ = subdir
+        subdir[2] = self._pool.submit(partial(self._scan, path, st), 1)
+        self._pending += 1
+
+    def _fill(self):
+        # The innermost directory's subdirectories are walked first.
+        for level in reversed(self._levels):
+            while level:
+                if self._pending >= self._window:
+                    return
+                self._submit(level.popleft())
+
+    def _take(self, subdir):
+        if not subdir[2]:
+            # Not submitted yet, so it must be next in its level
+            level = self._levels[-1]
+            assert level[0] is subdir
+            self._submit(level.popleft())
+        job = subdir[2]
+        subdir[2] = None
+        result = job.wait()
+        self._pending -= 1
+        self._fill()
+        return result
+
+    def scan(self, path, st):
+        return self._scan(path, st)
+
+    def walk(self, prepend, entries, xdev, xdev_exceptions):
+        """Yield the same (path, stat) pairs as _recursive_dirlist()
+        for the directory prepend, given its entries from scan()."""
+        subdirs = []
+        for name, st in entries:
+            if name.endswith(b'/'):
+                path = prepend + name
+                if xdev == None or st.st_dev == xdev \
+                   or path in xdev_exceptions:
+                    subdirs.append([path, st, None])
+        self._levels.append(deque(subdirs))
+        self._fill()
+        subdirs = iter(subdirs)
+        for name, st in entries:
+            path = prepend + name
+            if name.endswith(b'/'):
+                if xdev != None and st.st_dev != xdev \
+                   and path not in xdev_exceptions:
+                    debug1('Skipping contents of %r: different filesystem.\n'
+                           % path_msg(path))
+                else:
+                    sub_entries, errors = self._take(next(subdirs))
+                    if sub_entries is None:
+                        add_error('%s: %s' % (prepend, errors))
+                    else:
+                        for e in errors:
+                            add_error(e)
+                        for i in self.walk(path, sub_entries, xdev,
+                                           xdev_exceptions):
+                            yield i
+            yield (path, st)
+        self._levels.pop()
+
+    def close(self):
+        self._pool.close()
+
+
+def _parallel_recursive_dirlist(paths, xdev, jobs, bup_dir=None,
+                                excluded_paths=None,
+                                exclude_rxs=None,
+                                xdev_exceptions=frozenset()):
+    scanner = _DirScanner(jobs, 16 * jobs, bup_dir, excluded_paths,
+                          exclude_rxs)
+    try:
+        for path in paths:
+            try:
+                pst = xstat.lstat(path)
+            except OSError as e:
+                add_error('recursive_dirlist: %s' % e)
+                continue
+            if not stat.S_ISDIR(pst.st_mode):
+                yield (path, pst)
+                continue
+            prepend = os.path.join(path, b'')
+            entries, errors = scanner.scan(prepend, pst)
+            if entries is None:
+                add_error(errors)
+                continue
+            for e in errors:
+                add_error(e)
+            if xdev:
+                xdev = pst.st_dev
+            else:
+                xdev = None
+            for i in scanner.walk(prepend, entries, xdev, xdev_exceptions):
+                yield i
+            yield (prepend, pst)
+    finally:
+        scanner.close()
+
+
 def recursive_dirlist(paths, xdev, bup_dir=None,
                       excluded_paths=None,
                       exclude_rxs=None,
-                      xdev_exceptions=frozenset()):
+                      xdev_exceptions=frozenset(),
+                      jobs=1):
+    """Yield (path, stat) for everything under each of the paths
+    (post-order, each directory's contents in reverse name order, and
+    directory paths ending in /).  If jobs is greater than 1 (and
+    parallel_scan_supported), scan directories on that many threads."""
+    if jobs > 1 and parallel_scan_supported:
+        for i in _parallel_recursive_dirlist(paths, xdev, jobs,
+                                             bup_dir=bup_dir,
+                                             excluded_paths=excluded_paths,
+                                             exclude_rxs=exclude_rxs,
+                                             xdev_exceptions=xdev_exceptions):
+            yield i
+        return
     startdir = OsFile(b'.')
     try:
         assert(type(paths) != type(''))
@@ -136,3 +335,187 @@ def recursive_dirlist(paths, xdev, bup_dir=None,
         except:
             pass
         raise
+
+
+def _parent_dir(path):
+    return path[:path.rindex(b'/', 0, len(path) - 1) + 1]
+
+
+class DirtyWalk:
+    """Walk just the parts of the directory top (an absolute path
+    ending in /) that have changed according to the journal records
+    (see bup.journal), yielding what recursive_dirlist([top]) would
+    for them: the entries of the DIR directories, everything under
+    the TREE directories, and the directories above them."""
+    def __init__(self, top, records, xdev, bup_dir=None,
+                 excluded_paths=None,
+                 exclude_rxs=None,
+                 xdev_exceptions=frozenset()):
+        self.top = top
+        self._xdev = xdev
+        self._bup_dir = bup_dir
+        self._excluded_paths = excluded_paths
+        self._exclude_rxs = exclude_rxs
+        self._xdev_exceptions = xdev_exceptions
+        # A [kind, subdirs] node (kind None for the directories that
+        # are only above changes) for top and each directory below
+        # it that the walk visits, by name (ending in /).
+        self._root = [None, {}]
+        for kind, path in records:
+            if path.startswith(top):
+                self._add(kind, path)
+        self._listings = {}
+        self._gone = set()
+
+    def _add(self, kind, path):
+        node = self._root
+        for name in path[len(self.top):].split(b'/')[:-1]:
+            if node[0] == journal.TREE:
+                return
+            node = node[1].setdefault(name + b'/', [None, {}])
+        if kind == journal.TREE or node[0] is None:
+            node[0] = kind
+
+    def _lookup(self, path):
+        # Return the node for path (a directory under top), if any,
+        # and whether it's under (or is) a TREE directory.
+        node = self._root
+        if node[0] == journal.TREE:
+            return node, True
+        for name in path[len(self.top):].split(b'/')[:-1]:
+            node = node[1].get(name + b'/')
+            if node is None:
+                return None, False
+            if node[0] == journal.TREE:
+                return node, True
+        return node, False
+
+    def _listing(self, prepend):
+        # Return the entries of the DIR directory prepend as from
+        # _dirlist(), without the excluded ones, and a set of their
+        # names.  These are cached, since wantrecurse() may need them
+        # before the walk gets there.
+        result = self._listings.get(prepend)
+        if result:
+            return result
+        entries = []
+        try:
+            names = os.listdir(prepend)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                add_error('%s: %s' % (prepend, e))
+            names = ()
+        for name in names:
+            try:
+                st = xstat.lstat(prepend + name)
+            except OSError as e:
+                add_error(Exception('%s: %s' % (resolve_parent(prepend + name),
+                                                str(e))))
+                continue
+            if (st.st_mode & _IFMT) == stat.S_IFDIR:
+                name += b'/'
+            if not _excluded(prepend + name, self._bup_dir,
+                             self._excluded_paths, self._exclude_rxs):
+                entries.append((name, st))
+        entries.sort(reverse=True)
+        result = self._listings[prepend] = entries, set(n for n, _ in entries)
+        return result
+
+    def _walk(self, prepend, node, xdev):
+        kind, subdirs = node
+        if kind == journal.TREE:
+            try:
+                OsFile(prepend).fchdir()
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    add_error('%s: %s' % (prepend, e))
+                return
+            for i in _recursive_dirlist(prepend=prepend, xdev=xdev,
+                                        bup_dir=self._bup_dir,
+                                        excluded_paths=self._excluded_paths,
+                                        exclude_rxs=self._exclude_rxs,
+                                        xdev_exceptions=self._xdev_exceptions):
+                yield i
+            return
+        if kind == journal.DIR:
+            entries = self._listing(prepend)[0]
+        else:
+            entries = []
+            for name in sorted(subdirs, reverse=True):
+                path = prepend + name
+                if _excluded(path, self._bup_dir, self._excluded_paths,
+                             self._exclude_rxs):
+                    continue
+                try:
+                    st = xstat.lstat(path)
+                except OSError as e:
+                    if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        add_error('%s: %s' % (path, e))
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    entries.append((name, st))
+        for name, st in entries:
+            path = prepend + name
+            sub = subdirs.get(name)
+            if sub:
+                if xdev != None and st.st_dev != xdev \
+                   and path not in self._xdev_exceptions:
+                    debug1('Skipping contents of %r: different filesystem.\n'
+                           % path_msg(path))
+                else:
+                    for i in self._walk(path, sub, xdev):
+                        yield i
+            yield (path, st)
+
+    def __iter__(self):
+        try:
+            pst = xstat.lstat(self.top)
+        except OSError as e:
+            add_error('recursive_dirlist: %s' % e)
+            return
+        xdev = pst.st_dev if self._xdev else None
+        startdir = OsFile(b'.')
+        try:
+            for i in self._walk(self.top, self._root, xdev):
+                yield i
+        finally:
+            startdir.fchdir()
+        yield (self.top, pst)
+
+    def wantrecurse(self, ent):
+        """Return true if the walk may need the index entries under
+        ent, i.e. for index.Reader.iter()."""
+        name = ent.name
+        if not name.startswith(self.top):
+            return self.top.startswith(name)
+        if not name.endswith(b'/'):
+            return False
+        node, in_tree = self._lookup(name)
+        if node or in_tree:
+            return True
+        # Everything under a deleted directory is deleted too.
+        parent = _parent_dir(name)
+        if parent not in self._gone:
+            parent_node = self._lookup(parent)[0]
+            if not parent_node or parent_node[0] != journal.DIR \
+               or name[len(parent):] in self._listing(parent)[1]:
+                return False
+        self._gone.add(name)
+        return True
+
+    def covers(self, name):
+        """Return true if the walk yields name (under top), or would
+        have if it still existed, i.e. if it's been deleted if it
+        wasn't yielded."""
+        if name == self.top:
+            return True
+        parent = _parent_dir(name)
+        if parent in self._gone:
+            return True
+        node, in_tree = self._lookup(parent)
+        if in_tree:
+            return True
+        if not node:
+            return False
+        # Above the changes, only the dirty subdirectories are visited.
+        return node[0] == journal.DIR or name[len(parent):] in node[1]
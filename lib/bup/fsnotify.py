@@ -0,0 +1,425 @@
+"""Filesystem change notification (Linux) for bup watch.
+
+Both watchers below report changes as a set of journal records (see
+bup.journal): a DIR record for each directory whose entries changed,
+and a TREE record for each directory that appeared (or for each root,
+when events were lost).  FanotifyWatch needs CAP_SYS_ADMIN and Linux
+5.9 or newer, but only needs one mark per filesystem, while
+InotifyWatch needs a watch for every directory (see
+fs.inotify.max_user_watches).
+
+"""
+
+from __future__ import absolute_import
+import ctypes, errno, os, re, stat, struct
+
+from bup import journal
+from bup.compat import bytes_from_uint
+from bup.helpers import add_error, debug1
+
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def _check(result, path=None):
+    if result < 0:
+        err = ctypes.get_errno()
+        if path is None:
+            raise OSError(err, os.strerror(err))
+        raise OSError(err, os.strerror(err), path)
+    return result
+
+
+def _under(path, dirs):
+    return any(path.startswith(d) for d in dirs)
+
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_EXCL_UNLINK = 0x4000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC if hasattr(os, 'O_CLOEXEC') else 0o2000000
+IN_NONBLOCK = os.O_NONBLOCK
+
+_in_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+            | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+            | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+_in_event = struct.Struct('=iIII')
+_detached = -1
+
+
+class InotifyWatch:
+    def __init__(self, roots, xdev, skip):
+        self.roots = roots
+        self._xdev = xdev
+        self._skip = skip
+        self.fd = _check(_libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK))
+        # Each watched directory (by watch descriptor) is known by
+        # its name (the full path for the roots, otherwise ending in
+        # /) within its parent, so that renaming a directory doesn't
+        # require changing anything below it.
+        self._parent = {}
+        self._name = {}
+        self._children = {}
+        self._dev = {}
+        try:
+            for root in roots:
+                self._watch_tree(root, None, root)
+        except:
+            os.close(self.fd)
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def __len__(self):
+        return len(self._name)
+
+    def _path(self, wd):
+        names = []
+        while wd is not None:
+            if wd == _detached:
+                return None
+            names.append(self._name[wd])
+            wd = self._parent[wd]
+        return b''.join(reversed(names))
+
+    def _attach(self, wd, parent, name):
+        self._parent[wd] = parent
+        self._name[wd] = name
+        if parent is not None:
+            self._children[parent][name] = wd
+
+    def _detach(self, wd):
+        parent = self._parent[wd]
+        if parent not in (None, _detached):
+            siblings = self._children[parent]
+            if siblings.get(self._name[wd]) == wd:
+                del siblings[self._name[wd]]
+        self._parent[wd] = _detached
+
+    def _forget(self, wd):
+        if wd in self._name:
+            self._detach(wd)
+            for child in list(self._children[wd].values()):
+                self._parent[child] = _detached
+            del self._parent[wd], self._name[wd], self._children[wd]
+            self._dev.pop(wd, None)
+
+    def _unwatch_tree(self, wd):
+        for child in list(self._children[wd].values()):
+            self._unwatch_tree(child)
+        _libc.inotify_rm_watch(self.fd, wd)
+        self._forget(wd)
+
+    def _add_watch(self, path, parent, name):
+        wd = _libc.inotify_add_watch(self.fd, path, _in_mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):  # already gone
+                return None
+            if err == errno.ENOSPC:
+                raise OSError(err, 'out of inotify watches (see '
+                              'fs.inotify.max_user_watches)', path)
+            if err == errno.EACCES:
+                add_error('%s: %s' % (path, os.strerror(err)))
+                return None
+            raise OSError(err, os.strerror(err), path)
+        if wd in self._name:  # the same directory, e.g. moved
+            self._detach(wd)
+        else:
+            self._children[wd] = {}
+        self._attach(wd, parent, name)
+        return wd
+
+    def _watch_tree(self, path, parent, name, dev=None):
+        # With xdev, dev is the device the directory must be on (if
+        # known), i.e. its parent's.
+        todo = [(path, parent, name, dev)]
+        while todo:
+            path, parent, name, dev = todo.pop()
+            if _under(path, self._skip):
+                continue
+            if self._xdev:
+                try:
+                    st = os.lstat(path)
+                except OSError as e:
+                    if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        add_error('%s: %s' % (path, e))
+                    continue
+                if dev is not None and st.st_dev != dev:
+                    continue
+                dev = st.st_dev
+            # Watch before listing, so that nothing created in
+            # between can be missed.
+            wd = self._add_watch(path, parent, name)
+            if wd is None:
+                continue
+            if self._xdev:
+                self._dev[wd] = dev
+            try:
+                entries = os.listdir(path)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    add_error('%s: %s' % (path, e))
+                continue
+            for entry in entries:
+                sub = path + entry
+                try:
+                    st = os.lstat(sub)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        add_error('%s: %s' % (sub, e))
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    todo.append((sub + b'/', wd, entry + b'/', dev))
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+        records = set()
+        moved = {}
+        ofs = 0
+        while ofs < len(data):
+            wd, mask, cookie, name_len = _in_event.unpack_from(data, ofs)
+            ofs += _in_event.size
+            name = data[ofs:ofs + name_len].rstrip(b'\0')
+            ofs += name_len
+            if mask & IN_Q_OVERFLOW:
+                debug1('watch: inotify queue overflowed\n')
+                records.update((journal.TREE, root) for root in self.roots)
+                continue
+            if mask & IN_IGNORED:
+                self._forget(wd)
+                continue
+            if wd not in self._name:
+                continue
+            path = self._path(wd)
+            if path is None:
+                continue
+            records.add((journal.DIR, path))
+            if not name or not mask & IN_ISDIR:  # not a subdirectory
+                continue
+            sub = name + b'/'
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                child = self._children[wd].get(sub)
+                if child is not None:
+                    self._detach(child)
+                    if mask & IN_MOVED_FROM:
+                        moved[cookie] = child
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                records.add((journal.TREE, path + sub))
+                child = moved.pop(cookie, None) if mask & IN_MOVED_TO else None
+                if child is not None and child in self._name:
+                    self._attach(child, wd, sub)
+                else:
+                    self._watch_tree(path + sub, wd, sub, self._dev.get(wd))
+        # Directories moved out of view
+        for child in moved.values():
+            if child in self._name:
+                self._unwatch_tree(child)
+        return records
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+FAN_MODIFY = 0x2
+FAN_ATTRIB = 0x4
+FAN_MOVED_FROM = 0x40
+FAN_MOVED_TO = 0x80
+FAN_CREATE = 0x100
+FAN_DELETE = 0x200
+FAN_Q_OVERFLOW = 0x4000
+FAN_ONDIR = 0x40000000
+FAN_CLOEXEC = 0x1
+FAN_NONBLOCK = 0x2
+FAN_CLASS_NOTIF = 0
+FAN_REPORT_DFID_NAME = 0xc00
+FAN_MARK_ADD = 0x1
+FAN_MARK_FILESYSTEM = 0x100
+FAN_EVENT_INFO_TYPE_FID = 1
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+FAN_EVENT_INFO_TYPE_DFID = 3
+AT_FDCWD = -100
+O_PATH = getattr(os, 'O_PATH', 0o10000000)
+
+_fan_mask = (FAN_MODIFY | FAN_ATTRIB | FAN_MOVED_FROM | FAN_MOVED_TO
+             | FAN_CREATE | FAN_DELETE | FAN_ONDIR)
+_fan_event = struct.Struct('=IBBHQii')
+_fan_info_hdr = struct.Struct('=BBHii')
+_fan_handle_hdr = struct.Struct('=Ii')
+
+try:
+    _libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint,
+                                    ctypes.c_uint64, ctypes.c_int,
+                                    ctypes.c_char_p]
+    _libc.open_by_handle_at.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                        ctypes.c_int]
+except AttributeError:  # not Linux
+    pass
+
+
+def _mount_points():
+    with open(b'/proc/self/mountinfo', 'rb') as f:
+        for line in f:
+            mnt = line.split(b' ')[4]
+            yield re.sub(br'\\([0-7]{3})',
+                         lambda m: bytes_from_uint(int(m.group(1), 8)),
+                         mnt)
+
+
+class FanotifyWatch:
+    def __init__(self, roots, xdev, skip):
+        self.roots = roots
+        self._skip = skip
+        self.fd = _check(_libc.fanotify_init(FAN_CLASS_NOTIF
+                                             | FAN_REPORT_DFID_NAME
+                                             | FAN_CLOEXEC | FAN_NONBLOCK,
+                                             os.O_RDONLY))
+        # A directory on each marked filesystem (by fsid), needed to
+        # resolve the file handles in the events.
+        self._mount_fds = {}
+        self._paths = {}
+        try:
+            marks = list(roots)
+            if not xdev:
+                marks.extend(mnt + b'/' for mnt in _mount_points()
+                             if _under(mnt + b'/', roots)
+                             and not _under(mnt + b'/', skip))
+            for path in marks:
+                _check(_libc.fanotify_mark(self.fd,
+                                           FAN_MARK_ADD | FAN_MARK_FILESYSTEM,
+                                           _fan_mask, AT_FDCWD, path),
+                       path)
+                fsid = os.statvfs(path).f_fsid
+                if fsid not in self._mount_fds:
+                    self._mount_fds[fsid] = os.open(path, os.O_RDONLY)
+        except:
+            self.close()
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def __len__(self):
+        return len(self._mount_fds)
+
+    def _resolve(self, fsid, handle):
+        # Return the current path of the directory, b'' if it's gone,
+        # or None if it can't be determined.
+        key = fsid, handle
+        path = self._paths.get(key)
+        if path is not None:
+            return path
+        mount_fd = self._mount_fds.get(fsid)
+        if mount_fd is None:
+            return None
+        fd = _libc.open_by_handle_at(mount_fd, handle, O_PATH)
+        if fd < 0:
+            if ctypes.get_errno() in (errno.ESTALE, errno.ENOENT):
+                return b''
+            return None
+        try:
+            path = os.readlink(b'/proc/self/fd/%d' % fd)
+        finally:
+            os.close(fd)
+        if path.endswith(b' (deleted)'):
+            return b''
+        if path != b'/':
+            path += b'/'
+        if len(self._paths) > 100000:
+            self._paths.clear()
+        self._paths[key] = path
+        return path
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+        records = set()
+        lost = False
+        ofs = 0
+        while ofs < len(data):
+            event_len, _, _, meta_len, mask, _, _ = \
+                _fan_event.unpack_from(data, ofs)
+            info, end = ofs + meta_len, ofs + event_len
+            ofs = end
+            if mask & FAN_Q_OVERFLOW:
+                debug1('watch: fanotify queue overflowed\n')
+                lost = True
+                continue
+            while info < end:
+                info_type, _, info_len, fsid_0, fsid_1 = \
+                    _fan_info_hdr.unpack_from(data, info)
+                if info_type not in (FAN_EVENT_INFO_TYPE_FID,
+                                     FAN_EVENT_INFO_TYPE_DFID_NAME,
+                                     FAN_EVENT_INFO_TYPE_DFID):
+                    info += info_len
+                    continue
+                fsid = (fsid_0 & 0xffffffff) | ((fsid_1 & 0xffffffff) << 32)
+                handle_ofs = info + _fan_info_hdr.size
+                handle_len = _fan_handle_hdr.size \
+                             + _fan_handle_hdr.unpack_from(data, handle_ofs)[0]
+                handle = data[handle_ofs:handle_ofs + handle_len]
+                name = data[handle_ofs + handle_len:info + info_len]
+                name = name.split(b'\0', 1)[0]
+                info += info_len
+                path = self._resolve(fsid, handle)
+                if path is None:
+                    lost = True
+                    continue
+                if not path or not _under(path, self.roots) \
+                   or _under(path, self._skip):
+                    continue
+                records.add((journal.DIR, path))
+                if name and name != b'.' and mask & FAN_ONDIR:
+                    if mask & (FAN_MOVED_FROM | FAN_MOVED_TO):
+                        # Cached paths below it are now wrong
+                        self._paths.clear()
+                    if mask & (FAN_CREATE | FAN_MOVED_TO):
+                        records.add((journal.TREE, path + name + b'/'))
+        if lost:
+            records.update((journal.TREE, root) for root in self.roots)
+        return records
+
+    def close(self):
+        for fd in self._mount_fds.values():
+            os.close(fd)
+        self._mount_fds = {}
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def open_watch(roots, xdev, skip, backend=None):
+    """Return a watch (with fileno(), read() and close()) of everything
+    under the roots (paths ending in /), except the paths under skip.
+    Use fanotify where permitted, otherwise inotify, unless backend
+    is b'fanotify' or b'inotify'."""
+    if backend in (None, b'fanotify'):
+        try:
+            return FanotifyWatch(roots, xdev, skip)
+        except (OSError, AttributeError) as e:
+            if backend:
+                raise
+            debug1('watch: not using fanotify (%s)\n' % e)
+    return InotifyWatch(roots, xdev, skip)
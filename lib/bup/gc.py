@@ -96,6 +96,10 @@ def report_live_item(n, total, ref_name, ref_id, item, verbosity):
         log('%s %s:%s%s\n' % (status, hex_id, path_msg(ps), path_msg(dirslash)))
 
 
+# The number of live ids to hand to the bloom filter at once.
+_add_batch_size = 4096
+
+
 def find_live_objects(existing_count, cat_pipe, verbosity=0):
     prune_visited_trees = True # In case we want a command line option later
     pack_dir = git.repo(b'objects/pack')
@@ -111,10 +115,10 @@ def find_live_objects(existing_count, cat_pipe, verbosity=0):
         trees_visited = set()
         stop_at = lambda x: unhexlify(x) in trees_visited
     approx_live_count = 0
+    pending = []
     for ref_name, ref_id in git.list_refs():
         for item in walk_object(cat_pipe.get, hexlify(ref_id), stop_at=stop_at,
                                 include_data=None):
-            # FIXME: batch ids
             if verbosity:
                 report_live_item(approx_live_count, existing_count,
                                  ref_name, ref_id, item, verbosity)
@@ -125,7 +129,12 @@ def find_live_objects(existing_count, cat_pipe, verbosity=0):
                     live_objs.add(item.oid)
                     approx_live_count += 1
             else:
-                live_objs.add(item.oid)
+                pending.append(item.oid)
+                if len(pending) >= _add_batch_size:
+                    live_objs.add(b''.join(pending))
+                    pending = []
+    if pending:
+        live_objs.add(b''.join(pending))
     trees_visited = None
     if verbosity:
         log('expecting to retain about %.2f%% unnecessary objects\n'
@@ -133,6 +142,14 @@ def find_live_objects(existing_count, cat_pipe, verbosity=0):
     return live_objs
 
 
+def _idx_shas(idx):
+    """Return the concatenated hashes of idx, preferring its shatable
+    when that's already in the right form."""
+    if isinstance(idx, git.PackIdxV2):
+        return idx.shatable
+    return b''.join(idx)
+
+
 def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
           verbosity):
     # Traverse all the packs, saving the (probably) live data.
@@ -165,10 +182,7 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
                       % ((float(collect_count) / existing_count) * 100))
         idx = git.open_idx(idx_name)
 
-        idx_live_count = 0
-        for sha in idx:
-            if live_objects.exists(sha):
-                idx_live_count += 1
+        live, idx_live_count = live_objects.exists_bitmap(_idx_shas(idx))
 
         collect_count += idx_live_count
         if idx_live_count == 0:
@@ -189,8 +203,8 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
         if verbosity:
             log('rewriting %s (%.2f%% live)\n' % (basename(idx_name),
                                                   live_frac * 100))
-        for sha in idx:
-            if live_objects.exists(sha):
+        for i, sha in enumerate(idx):
+            if bloom.bitmap_get(live, i):
                 item_it = cat_pipe.get(hexlify(sha))
                 _, typ, _ = next(item_it)
                 writer.just_write(sha, typ, b''.join(item_it))
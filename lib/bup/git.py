@@ -5,6 +5,7 @@ interact with the Git data structures.
 
 from __future__ import absolute_import, print_function
 import errno, os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
+import threading
 from array import array
 from binascii import hexlify, unhexlify
 from collections import namedtuple
@@ -30,6 +31,7 @@ from bup.helpers import (Sha1, add_error, chunkyreader, debug1, debug2,
                          progress, qprogress, stat_if_exists,
                          unlink,
                          utc_offset_str,
+                         find_in_sha_table,
                          ExistsResult, ObjectExists)
 from bup.pwdgrp import username, userfullname
 
@@ -236,8 +238,7 @@ def all_packdirs():
     return paths
 
 
-def auto_midx(objdir):
-    args = [path.exe(), b'midx', b'--auto', b'--dir', objdir]
+def _call_quietly(args):
     try:
         rv = subprocess.call(args, stdout=open(os.devnull, 'w'))
     except OSError as e:
@@ -247,15 +248,22 @@ def auto_midx(objdir):
     if rv:
         add_error('%r: returned %d' % (args, rv))
 
-    args = [path.exe(), b'bloom', b'--dir', objdir]
-    try:
-        rv = subprocess.call(args, stdout=open(os.devnull, 'w'))
-    except OSError as e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+
+def auto_midx(objdir):
+    _call_quietly([path.exe(), b'midx', b'--auto', b'--dir', objdir])
+    _call_quietly([path.exe(), b'bloom', b'--dir', objdir])
+
+
+def update_midx(objdir, idxnames):
+    """Like auto_midx(), but only cover the given (new) idx files in
+    objdir, leaving all the existing midx files alone."""
+    # (in batches, to keep the command line reasonably short)
+    for i in range(0, len(idxnames), 256):
+        batch = idxnames[i:i + 256]
+        if len(batch) > 1:
+            _call_quietly([path.exe(), b'midx', b'--dir', objdir]
+                          + [os.path.join(objdir, n) for n in batch])
+    _call_quietly([path.exe(), b'bloom', b'--dir', objdir])
 
 
 def mangle_name(name, mode, gitmode):
@@ -364,6 +372,23 @@ def _encode_packobj(type, content, compression_level=1):
     yield z.flush()
 
 
+PreparedObject = namedtuple('PreparedObject', ['oid', 'encoded'])
+
+
+def prepare_object(type, content, compression_level=None):
+    """Return a PreparedObject for PackWriter.write_prepared().
+
+    This does the hashing and the compression for the object up front.
+    It doesn't touch any shared state, so it may be called from any
+    thread.
+    """
+    if compression_level is None:
+        compression_level = 1
+    return PreparedObject(calc_hash(type, content),
+                          b''.join(_encode_packobj(type, content,
+                                                   compression_level)))
+
+
 def _decode_packobj(buf):
     tp, offs, sz = _helpers.decode_hdr(buf)
     yield (tp, sz)
@@ -381,6 +406,44 @@ def _decode_packobj(buf):
         yield d
 
 
+def read_stored_object(pack, ofs):
+    """Return (type, size, zdata) for the object at offset ofs in pack
+    (e.g. an mmap of a .pack file), where zdata is the object's zlib
+    compressed content exactly as it's stored there, or None if the
+    object is stored as a delta.
+
+    """
+    c = ord(pack[ofs:ofs + 1])
+    typ = (c >> 4) & 7
+    size = c & 0x0f
+    shift = 4
+    ofs += 1
+    while c & 0x80:
+        c = ord(pack[ofs:ofs + 1])
+        size |= (c & 0x7f) << shift
+        shift += 7
+        ofs += 1
+    if typ not in _typermap:
+        return None
+    # The zlib stream doesn't record its own length, so find its end
+    # by inflating it, which (unlike deflating it again) is cheap.
+    # There's always at least the pack's trailing checksum after it.
+    z = zlib.decompressobj()
+    start = ofs
+    total = 0
+    while not z.unused_data:
+        buf = pack[ofs:ofs + 16 * 1024]
+        if not buf:
+            raise GitError('pack object at offset %d is truncated' % start)
+        total += len(z.decompress(buf))
+        ofs += len(buf)
+    total += len(z.flush())
+    if total != size:
+        raise GitError('pack object at offset %d has size %d, not %d'
+                       % (start, total, size))
+    return _typermap[typ], size, pack[start:ofs - len(z.unused_data)]
+
+
 class PackIdx:
     def __init__(self):
         assert(0)
@@ -399,16 +462,29 @@ class PackIdx:
             return None
         idx = self._idx_from_hash(hash)
         if idx is not None:
-            if want_source or want_offs:
-                ret = ExistsResult(None, None)
-                if want_source:
-                    ret.pack = os.path.basename(self.name)
-                if want_offs:
-                    ret.offset = self._ofs_from_idx(idx)
-                return ret
-            return ObjectExists
+            return self._exists_result(idx, want_source, want_offs)
         return None
 
+    def exists_many(self, hashes, want_source=False, want_offs=False):
+        """Return a list containing the exists() result for each of the
+           hashes, looking them all up in a single pass over the index."""
+        global _total_searches, _total_steps
+        _total_searches += len(hashes)
+        _total_steps += len(hashes)
+        return [None if idx is None
+                else self._exists_result(idx, want_source, want_offs)
+                for idx in self._idxes_from_hashes(hashes)]
+
+    def _exists_result(self, idx, want_source, want_offs):
+        if want_source or want_offs:
+            ret = ExistsResult(None, None)
+            if want_source:
+                ret.pack = os.path.basename(self.name)
+            if want_offs:
+                ret.offset = self._ofs_from_idx(idx)
+            return ret
+        return ObjectExists
+
     def _idx_from_hash(self, hash):
         global _total_searches, _total_steps
         _total_searches += 1
@@ -438,7 +514,7 @@ class PackIdxV1(PackIdx):
         self.idxnames = [self.name]
         self.map = mmap_read(f)
         # Min size for 'L' is 4, which is sufficient for struct's '!I'
-        self.fanout = array('L', struct.unpack('!256I', self.map))
+        self.fanout = array('L', struct.unpack_from('!256I', self.map))
         self.fanout.append(0)  # entry "-1"
         self.nsha = self.fanout[255]
         self.sha_ofs = 256 * 4
@@ -460,6 +536,9 @@ class PackIdxV1(PackIdx):
         ofs = self.sha_ofs + idx * 24 + 4
         return self.map[ofs : ofs + 20]
 
+    def _idxes_from_hashes(self, hashes):
+        return find_in_sha_table(self.map, 0, 8, self.sha_ofs + 4, 24, hashes)
+
     def __iter__(self):
         start = self.sha_ofs + 4
         for ofs in range(start, start + 24 * self.nsha, 24):
@@ -503,6 +582,9 @@ class PackIdxV2(PackIdx):
         ofs = self.sha_ofs + idx * 20
         return self.map[ofs : ofs + 20]
 
+    def _idxes_from_hashes(self, hashes):
+        return find_in_sha_table(self.map, 8, 8, self.sha_ofs, 20, hashes)
+
     def __iter__(self):
         start = self.sha_ofs
         for ofs in range(start, start + 20 * self.nsha, 20):
@@ -569,6 +651,72 @@ class PackIdxList:
         self.do_bloom = True
         return None
 
+    def exists_many(self, hashes, want_source=False, want_offs=False):
+        """Return a list containing the exists() result for each of the
+           hashes.  This is much cheaper than calling exists() for each
+           of them, since every index is only consulted once for the
+           whole batch."""
+        global _total_searches
+        _total_searches += len(hashes)
+        result = [None] * len(hashes)
+        todo = []
+        for i, hash in enumerate(hashes):
+            if hash in self.also:
+                result[i] = True
+            else:
+                todo.append(i)
+        if todo and self.bloom:
+            maybe = self.bloom.exists_many([hashes[i] for i in todo])
+            passed = [i for i, m in zip(todo, maybe) if m]
+            _total_searches -= len(todo) - len(passed)  # were counted by bloom
+            todo = passed
+        hit_packs = []
+        other_packs = []
+        for p in self.packs:
+            if not todo:
+                other_packs.append(p)
+                continue
+            if want_offs and isinstance(p, midx.PackMidx):
+                get_src = True
+                get_offs = False
+            else:
+                get_src = want_source
+                get_offs = want_offs
+            _total_searches -= len(todo)  # will be incremented by sub-pack
+            found = p.exists_many([hashes[i] for i in todo],
+                                  want_source=get_src, want_offs=get_offs)
+            missing = []
+            for i, ret in zip(todo, found):
+                if ret:
+                    result[i] = ret
+                else:
+                    missing.append(i)
+            if len(missing) < len(todo):
+                hit_packs.append(p)
+            else:
+                other_packs.append(p)
+            todo = missing
+        # reorder so the packs that were useful are searched first
+        self.packs = hit_packs + other_packs
+        if want_offs:
+            self._resolve_midx_offsets(hashes, result, want_source)
+        return result
+
+    def _resolve_midx_offsets(self, hashes, result, want_source):
+        # midx results only name the idx, so look the offsets up there
+        by_pack = {}
+        for i, ret in enumerate(result):
+            if ret and ret is not True and ret.offset is None:
+                by_pack.setdefault(ret.pack, []).append(i)
+        for pack, todo in items(by_pack):
+            np = open_idx(os.path.join(self.dir, pack))
+            found = np.exists_many([hashes[i] for i in todo],
+                                   want_source=want_source, want_offs=True)
+            del np
+            for i, ret in zip(todo, found):
+                assert ret
+                result[i] = ret
+
     def close_temps(self):
         '''
         Close all the temporary files (bloom/midx) so that you can safely call
@@ -705,6 +853,24 @@ def open_idx(filename):
         raise GitError('idx filenames must end with .idx or .midx')
 
 
+def idx_object_count(filename):
+    """Return the number of objects in the .idx filename, reading
+    only its fanout table."""
+    with open(filename, 'rb') as f:
+        header = f.read(8 + 256 * 4)
+    if header[0:4] == b'\377tOc':
+        version = struct.unpack('!I', header[4:8])[0]
+        if version != 2:
+            raise GitError('%s: expected idx file version 2, got %d'
+                           % (path_msg(filename), version))
+        ofs = 8 + 255 * 4
+    else:
+        ofs = 255 * 4
+    if len(header) < ofs + 4:
+        raise GitError('%s: truncated idx file' % path_msg(filename))
+    return struct.unpack_from('!I', header, ofs)[0]
+
+
 def idxmerge(idxlist, final_progress=True):
     """Generate a list of all the objects reachable in a PackIdxList."""
     def pfunc(count, total):
@@ -832,13 +998,15 @@ class PackWriter:
             self.idx.add(sha, crc, self.file.tell() - size)
 
     def _write(self, sha, type, content):
-        if verbose:
-            log('>')
         if not sha:
             sha = calc_hash(type, content)
-        size, crc = self._raw_write(_encode_packobj(type, content,
-                                                    self.compression_level),
-                                    sha=sha)
+        return self._write_encoded(sha, _encode_packobj(type, content,
+                                                        self.compression_level))
+
+    def _write_encoded(self, sha, datalist):
+        if verbose:
+            log('>')
+        size, crc = self._raw_write(datalist, sha=sha)
         if self.outbytes >= self.max_pack_size \
            or self.count >= self.max_pack_objects:
             self.breakpoint()
@@ -862,6 +1030,11 @@ class PackWriter:
         self._require_objcache()
         return self.objcache.exists(id, want_source=want_source)
 
+    def exists_many(self, ids, want_source=False):
+        """Return a list containing the exists() result for each of ids."""
+        self._require_objcache()
+        return self.objcache.exists_many(ids, want_source=want_source)
+
     def just_write(self, sha, type, content):
         """Write an object to the pack file without checking for duplication."""
         self._write(sha, type, content)
@@ -869,6 +1042,32 @@ class PackWriter:
         if self.objcache is not None:
             self.objcache.add(sha)
 
+    def write_prepared(self, obj):
+        """Write a PreparedObject (see prepare_object()) to the pack file
+        if not present and return its id."""
+        if not self.exists(obj.oid):
+            self._require_objcache()
+            self._write_encoded(obj.oid, (obj.encoded,))
+            if self.objcache is not None:
+                self.objcache.add(obj.oid)
+        return obj.oid
+
+    def write_prepared_many(self, objs):
+        """Write each of the PreparedObjects in objs that's not already
+        present to the pack file (checking for all of them at once),
+        and return the list of their ids."""
+        objs = list(objs)
+        oids = [obj.oid for obj in objs]
+        found = self.exists_many(oids)
+        written = set()
+        for obj, present in zip(objs, found):
+            if not present and obj.oid not in written:
+                self._write_encoded(obj.oid, (obj.encoded,))
+                written.add(obj.oid)
+                if self.objcache is not None:
+                    self.objcache.add(obj.oid)
+        return oids
+
     def maybe_write(self, type, content):
         """Write an object to the pack file if not present and return its id."""
         sha = calc_hash(type, content)
@@ -1380,18 +1579,23 @@ class CatPipe:
             raise
 
 
-_cp = {}
+_cp = threading.local()
 
 def cp(repo_dir=None):
-    """Create a CatPipe object or reuse the already existing one."""
-    global _cp, repodir
+    """Create a CatPipe object or reuse the already existing one.  A
+    CatPipe can only handle one request at a time, so each thread gets
+    its own."""
+    global repodir
     if not repo_dir:
         repo_dir = repodir or repo()
     repo_dir = os.path.abspath(repo_dir)
-    cp = _cp.get(repo_dir)
+    pipes = getattr(_cp, 'pipes', None)
+    if pipes is None:
+        pipes = _cp.pipes = {}
+    cp = pipes.get(repo_dir)
     if not cp:
         cp = CatPipe(repo_dir)
-        _cp[repo_dir] = cp
+        pipes[repo_dir] = cp
     return cp
 
 
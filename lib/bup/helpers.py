@@ -8,11 +8,18 @@ from math import floor
 from os import environ
 from subprocess import PIPE, Popen
 import sys, os, pwd, subprocess, errno, socket, select, mmap, stat, re, struct
-import hashlib, heapq, math, operator, time, grp, tempfile
+import hashlib, heapq, math, operator, time, grp, tempfile, threading
+
+try:
+    # python 3
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
 
 from bup import _helpers
 from bup import compat
-from bup.compat import argv_bytes, byte_int
+from bup.compat import argv_bytes, byte_int, reraise
 from bup.io import byte_stream, path_msg
 # This function should really be in helpers, not in bup.options.  But we
 # want options.py to be standalone so people can include it in other projects.
@@ -36,6 +43,22 @@ class ExistsResult:
 ObjectExists = ExistsResult(None, None)
 
 
+def find_in_sha_table(map, fanout_ofs, bits, sha_ofs, stride, shas):
+    """Return a list with the sha table index of each of the 20-byte
+    shas (or None if it's missing) in the (m)idx data in map.  The
+    fanout table (2**bits entries) and sha table (entries stride bytes
+    apart) start at fanout_ofs and sha_ofs respectively."""
+    order = sorted(range(len(shas)), key=shas.__getitem__)
+    wanted = b''.join([shas[i] for i in order])
+    if len(wanted) != 20 * len(shas):
+        raise ValueError('find_in_sha_table: all shas must be 20 bytes')
+    found = _helpers.find_shas(map, fanout_ofs, bits, sha_ofs, stride, wanted)
+    result = [None] * len(shas)
+    for i, idx in zip(order, found):
+        result[i] = idx
+    return result
+
+
 sc_arg_max = os.sysconf('SC_ARG_MAX')
 if sc_arg_max == -1:  # "no definite limit" - let's choose 2M
     sc_arg_max = 2 * 1024 * 1024
@@ -263,6 +286,177 @@ def merge_iter(iters, pfreq, pfunc, pfinal, key=None):
     pfinal(count, total)
 
 
+class _PoolJob:
+    __slots__ = ('fn', 'size', 'result', 'exc', 'done')
+
+    def __init__(self, fn, size):
+        self.fn = fn
+        self.size = size
+        self.result = self.exc = None
+        self.done = threading.Event()
+
+    def wait(self):
+        """Wait for the job to complete and return its result (or
+        raise its exception)."""
+        self.done.wait()
+        if self.exc:
+            reraise(self.exc[1], self.exc[2])
+        return self.result
+
+
+class WorkerPool:
+    """
+    Bounded pool of up to 'threads' threads (started on demand), that
+    keeps at most max_bytes (as given to submit()) of work queued or
+    in flight.  It can be shared by several users.
+    """
+    def __init__(self, threads, max_bytes):
+        assert threads > 0
+        self.max_threads = threads
+        self.max_bytes = max_bytes
+        self._threads = []
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        self._bytes = 0
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                job.result = job.fn()
+            except BaseException:
+                job.exc = sys.exc_info()
+            job.fn = None
+            with self._cond:
+                self._bytes -= job.size
+                self._cond.notify_all()
+            job.done.set()
+
+    def submit(self, fn, size):
+        """
+        Queue fn() to run on one of the threads and return a job whose
+        wait() returns its result.  Blocks while that would exceed the
+        memory limit, but a single job is always admitted so a size
+        above max_bytes can't deadlock.
+        """
+        with self._cond:
+            while self._bytes and self._bytes + size > self.max_bytes:
+                self._cond.wait()
+            self._bytes += size
+        if len(self._threads) < self.max_threads:
+            t = threading.Thread(target=self._run)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+        job = _PoolJob(fn, size)
+        self._queue.put(job)
+        return job
+
+    def close(self):
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
+class _ParallelJob:
+    __slots__ = ('item', 'result', 'exc', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = self.exc = None
+        self.done = threading.Event()
+
+
+def parallel_imap(fn, iterable, jobs, window=None):
+    """Yield fn(x) for each x in iterable, in the original order.
+
+    Up to 'jobs' threads call fn() concurrently, so this only helps
+    when fn() spends most of its time in code that releases the GIL
+    (zlib, hashlib, I/O, ...).  The iterable is consumed by yet
+    another thread, which stays at most 'window' items (4 * jobs by
+    default) ahead of the caller.  An exception raised by fn() or by
+    the iterable is re-raised here when its position is reached.  If
+    jobs is less than 2, just map fn over the iterable in the calling
+    thread.
+    """
+    if jobs < 2:
+        for x in iterable:
+            yield fn(x)
+        return
+    window = window or 4 * jobs
+    room = threading.Semaphore(window)
+    pending = queue.Queue()
+    todo = queue.Queue()
+    stop = threading.Event()
+
+    def feed():
+        it = iter(iterable)
+        while True:
+            room.acquire()
+            if stop.is_set():
+                break
+            try:
+                x = next(it)
+            except StopIteration:
+                break
+            except BaseException:
+                job = _ParallelJob(None)
+                job.exc = sys.exc_info()
+                job.done.set()
+                pending.put(job)
+                break
+            job = _ParallelJob(x)
+            pending.put(job)
+            todo.put(job)
+        pending.put(None)
+        for i in range(jobs):
+            todo.put(None)
+
+    def work():
+        while True:
+            job = todo.get()
+            if job is None:
+                return
+            if not stop.is_set():
+                try:
+                    job.result = fn(job.item)
+                except BaseException:
+                    job.exc = sys.exc_info()
+            job.item = None
+            job.done.set()
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for i in range(jobs))
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        while True:
+            job = pending.get()
+            if job is None:
+                break
+            job.done.wait()
+            if job.exc:
+                reraise(job.exc[1], job.exc[2])
+            room.release()
+            yield job.result
+    except BaseException:
+        # Don't return (and e.g. let the caller close files the
+        # iterable is reading) before all the threads have stopped.
+        stop.set()
+        for i in range(window):
+            room.release()
+        for t in threads:
+            t.join()
+        raise
+    for t in threads:
+        t.join()
+
+
 def unlink(f):
     """Delete a file at path 'f' if it currently exists.
 
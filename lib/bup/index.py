@@ -1,12 +1,15 @@
 
 from __future__ import absolute_import, print_function
-import errno, os, stat, struct, tempfile
+from hashlib import sha1
+import errno, os, shutil, stat, struct, tempfile
 
 from bup import compat, metadata, xstat
 from bup._helpers import UINT_MAX, bytescmp
-from bup.compat import range
-from bup.helpers import (add_error, log, merge_iter, mmap_readwrite,
-                         progress, qprogress, resolve_parent, slashappend)
+from bup.compat import byte_int, range
+from bup.helpers import (add_error, atomically_replaced_file,
+                         find_in_sha_table, log, merge_iter, mmap_read,
+                         mmap_readwrite, progress, qprogress, resolve_parent,
+                         slashappend, unlink)
 
 EMPTY_SHA = b'\0' * 20
 FAKE_SHA = b'\x01' * 20
@@ -66,27 +69,158 @@ class MetaStoreReader:
         return metadata.Metadata.read(self._file)
 
 
+# The .meta.idx file next to a .meta file maps the sha1 of each of
+# the records in the .meta file to its offset, so that the writer
+# doesn't have to read the whole .meta file to find out what's there.
+# It begins with the size of the part of the .meta file it describes,
+# and the sha1 of the (up to) _META_IDX_TAIL bytes just before that
+# point, so that it's ignored if the .meta file has been replaced or
+# truncated.  That's followed by a 256 entry fanout table, the sorted
+# record sha1s, and their offsets.
+META_IDX_HDR = b'BMIX\0\0\0\1'
+_META_IDX_SIG = '!Q20s'
+_META_IDX_TAIL = 4096
+_META_IDX_FANOUT_OFS = len(META_IDX_HDR) + struct.calcsize(_META_IDX_SIG)
+_META_IDX_SHA_OFS = _META_IDX_FANOUT_OFS + 256 * 4
+
+
+def _meta_tail_sum(f, end):
+    start = max(0, end - _META_IDX_TAIL)
+    f.seek(start)
+    data = f.read(end - start)
+    if len(data) != end - start:
+        return None
+    return sha1(data).digest()
+
+
+class _MetaIdx:
+    def __init__(self, m=b'', covered=0):
+        self.map = m
+        self.covered = covered
+        if m:
+            self.fanout = struct.unpack_from('!256I', m, _META_IDX_FANOUT_OFS)
+        else:
+            self.fanout = (0,) * 256
+        self.count = self.fanout[255]
+        self.ofs_ofs = _META_IDX_SHA_OFS + self.count * 20
+
+    def find(self, sha):
+        """Return the offset of the record whose sha1 is sha, or None."""
+        if not self.count:
+            return None
+        idx = find_in_sha_table(self.map, _META_IDX_FANOUT_OFS, 8,
+                                _META_IDX_SHA_OFS, 20, [sha])[0]
+        if idx is None:
+            return None
+        return struct.unpack_from('!Q', self.map, self.ofs_ofs + idx * 8)[0]
+
+    def position(self, sha):
+        """Return the index at which sha belongs in the sha table."""
+        b1 = byte_int(sha[0])
+        start = self.fanout[b1 - 1] if b1 else 0
+        end = self.fanout[b1]
+        while start < end:
+            mid = start + (end - start) // 2
+            ofs = _META_IDX_SHA_OFS + mid * 20
+            if self.map[ofs : ofs + 20] < sha:
+                start = mid + 1
+            else:
+                end = mid
+        return start
+
+    def shas(self, start, end):
+        return self.map[_META_IDX_SHA_OFS + start * 20
+                        : _META_IDX_SHA_OFS + end * 20]
+
+    def offsets(self, start, end):
+        return self.map[self.ofs_ofs + start * 8 : self.ofs_ofs + end * 8]
+
+
+def _read_meta_idx(filename, meta_file):
+    """Return the _MetaIdx in filename, or None if there isn't one, or
+    if it doesn't describe the content of meta_file."""
+    try:
+        f = open(filename, 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    m = mmap_read(f)
+    if len(m) < _META_IDX_SHA_OFS or m[:len(META_IDX_HDR)] != META_IDX_HDR:
+        return None
+    covered, tail_sum = struct.unpack_from(_META_IDX_SIG, m,
+                                           len(META_IDX_HDR))
+    idx = _MetaIdx(m, covered)
+    if len(m) != idx.ofs_ofs + idx.count * 8:
+        return None
+    if _meta_tail_sum(meta_file, covered) != tail_sum:
+        return None
+    return idx
+
+
+def _write_meta_idx(filename, idx, added, covered, tail_sum):
+    # Merge the (sha, ofs) pairs in added into the table in idx,
+    # copying the runs of the existing table between them wholesale.
+    added = sorted(added)
+    counts = [0] * 256
+    for sha, ofs in added:
+        counts[byte_int(sha[0])] += 1
+    fanout = []
+    total = 0
+    for b1 in range(256):
+        total += counts[b1]
+        fanout.append(idx.fanout[b1] + total)
+    shas = []
+    offsets = []
+    pos = 0
+    for sha, ofs in added:
+        end = idx.position(sha)
+        shas.append(idx.shas(pos, end))
+        offsets.append(idx.offsets(pos, end))
+        shas.append(sha)
+        offsets.append(struct.pack('!Q', ofs))
+        pos = end
+    shas.append(idx.shas(pos, idx.count))
+    offsets.append(idx.offsets(pos, idx.count))
+    with atomically_replaced_file(filename, 'wb') as f:
+        f.write(META_IDX_HDR)
+        f.write(struct.pack(_META_IDX_SIG, covered, tail_sum))
+        f.write(struct.pack('!256I', *fanout))
+        for data in shas:
+            f.write(data)
+        for data in offsets:
+            f.write(data)
+
+
 class MetaStoreWriter:
     # For now, we just append to the file, and try to handle any
     # truncation or corruption somewhat sensibly.
 
     def __init__(self, filename):
-        # Map metadata hashes to bupindex.meta offsets.
-        self._offsets = {}
         self._filename = filename
+        self._idx_filename = filename + b'.idx'
         self._file = None
-        # FIXME: see how slow this is; does it matter?
+        # Map metadata hashes to bupindex.meta offsets, for the records
+        # found or added since the .idx was written.
+        self._offsets = {}
+        self._added = []
         m_file = open(filename, 'ab+')
         try:
-            m_file.seek(0)
+            self._idx = _read_meta_idx(self._idx_filename, m_file)
+            if not self._idx:
+                self._idx = _MetaIdx()
+            # Only read the records the .idx doesn't know about.
+            m_file.seek(self._idx.covered)
             try:
-                m_off = m_file.tell()
-                m = metadata.Metadata.read(m_file)
-                while m:
-                    m_encoded = m.encode()
-                    self._offsets[m_encoded] = m_off
+                while True:
                     m_off = m_file.tell()
-                    m = metadata.Metadata.read(m_file)
+                    # None is an empty record, e.g. the default Metadata()
+                    m = metadata.Metadata.read(m_file) or metadata.Metadata()
+                    sha = sha1(m.encode(include_path=False)).digest()
+                    if sha not in self._offsets \
+                       and self._idx.find(sha) is None:
+                        self._offsets[sha] = m_off
+                        self._added.append((sha, m_off))
             except EOFError:
                 pass
             except:
@@ -97,25 +231,86 @@ class MetaStoreWriter:
         self._file = open(filename, 'ab')
 
     def close(self):
-        if self._file:
-            self._file.close()
+        """Close the store, and add any new records to its .idx."""
+        f = self._file
+        if f:
             self._file = None
+            end = f.tell()
+            f.close()
+            if self._added:
+                with open(self._filename, 'rb') as m_file:
+                    tail_sum = _meta_tail_sum(m_file, end)
+                _write_meta_idx(self._idx_filename, self._idx, self._added,
+                                end, tail_sum)
+                self._added = []
 
     def __del__(self):
-        # Be optimistic.
-        self.close()
+        # Be optimistic, but leave the .idx alone, since whatever was
+        # written will be found by the next writer anyway.
+        if self._file:
+            self._file.close()
+            self._file = None
 
     def store(self, metadata):
         meta_encoded = metadata.encode(include_path=False)
-        ofs = self._offsets.get(meta_encoded)
-        if ofs:
+        sha = sha1(meta_encoded).digest()
+        ofs = self._offsets.get(sha)
+        if ofs is not None:
             return ofs
-        ofs = self._file.tell()
-        self._file.write(meta_encoded)
-        self._offsets[meta_encoded] = ofs
+        ofs = self._idx.find(sha)
+        if ofs is None:
+            ofs = self._file.tell()
+            self._file.write(meta_encoded)
+            self._added.append((sha, ofs))
+        self._offsets[sha] = ofs
         return ofs
 
 
+def compact_meta(indexfile):
+    """Rewrite the metadata store of indexfile (indexfile.meta) so that
+    it only contains the records the index refers to (once each), and
+    update the index to match.  Return the size of the store before
+    and after.  Nothing else may be using the index meanwhile."""
+    meta_name = indexfile + b'.meta'
+    dir = os.path.dirname(indexfile)
+    ffd, tmp_index = tempfile.mkstemp(b'.tmp', indexfile, dir)
+    ffd2, tmp_meta = tempfile.mkstemp(b'.tmp', meta_name, dir)
+    os.close(ffd2)
+    try:
+        with os.fdopen(ffd, 'wb') as f, open(indexfile, 'rb') as src:
+            shutil.copyfileobj(src, f)
+        old_size = os.path.getsize(meta_name)
+        ri = Reader(tmp_index)
+        msr = MetaStoreReader(meta_name)
+        msw = MetaStoreWriter(tmp_meta)
+        try:
+            # Copy the records in their original order, reading the
+            # store sequentially, and then point the index at them.
+            new_ofs = {}
+            for ofs in sorted(set(e.meta_ofs for e in ri.forward_iter())):
+                meta = msr.metadata_at(ofs) or metadata.Metadata()
+                new_ofs[ofs] = msw.store(meta)
+            for e in ri.forward_iter():
+                if new_ofs[e.meta_ofs] != e.meta_ofs:
+                    e.meta_ofs = new_ofs[e.meta_ofs]
+                    e.repack()
+        finally:
+            msw.close()
+            msr.close()
+            ri.close()
+        new_size = os.path.getsize(tmp_meta)
+        unlink(meta_name + b'.idx')
+        os.rename(tmp_meta, meta_name)
+        if os.path.exists(tmp_meta + b'.idx'):
+            os.rename(tmp_meta + b'.idx', meta_name + b'.idx')
+        os.rename(tmp_index, indexfile)
+    finally:
+        unlink(tmp_index)
+        unlink(tmp_meta)
+        unlink(tmp_meta + b'.idx')
+    return old_size, new_size
+
+
 class Level:
     def __init__(self, ename, parent):
         self.parent = parent
@@ -0,0 +1,242 @@
+"""Journal of the directories that have changed since the last index.
+
+While it runs, bup watch appends a record to the journal (the index
+file name plus .journal) for every directory whose entries change (a
+DIR record), and for every directory that appears, e.g. via mkdir or
+rename, or whose content is otherwise unknown, e.g. when the kernel's
+event queue overflowed (a TREE record).  Each record is the kind byte
+followed by the absolute path of the directory (ending in /) and a
+NUL.
+
+bup index --from-journal moves the records to the .journal.pending
+file before it starts, and only removes them from there once the
+index has been updated, so that the changes aren't lost if it fails.
+It only trusts the journal while a watcher is running, which is
+determined by the lock the watcher holds on the .journal.watch file,
+and which also holds the watcher's pid and lists the roots it's
+watching.
+
+Since the watcher holds on to records for a moment before appending
+them (to coalesce bursts of events), and the kernel may not have
+handed it the latest events yet, take() first asks it to sync: it
+bumps the requested count in the .journal.sync file and sends the
+watcher a SIGUSR1, and the watcher then reads the requested count,
+appends everything the kernel has queued so far, and sets the done
+count to it.  If the watcher doesn't answer in time, take() returns
+TREE records for all of the watched roots instead.
+
+"""
+
+from __future__ import absolute_import
+from contextlib import contextmanager
+import errno, fcntl, os, signal, struct, time
+
+from bup.helpers import atomically_replaced_file
+
+
+DIR = b'D'
+TREE = b'R'
+
+# How long take() waits for the watcher to sync.
+SYNC_TIMEOUT_SECS = 2
+
+
+def _journal_path(indexfile):
+    return indexfile + b'.journal'
+
+def _pending_path(indexfile):
+    return indexfile + b'.journal.pending'
+
+def _watch_path(indexfile):
+    return indexfile + b'.journal.watch'
+
+def _sync_path(indexfile):
+    return indexfile + b'.journal.sync'
+
+
+def encode_records(records):
+    return b''.join(kind + path + b'\0' for kind, path in records)
+
+
+def decode_records(data):
+    """Return the set of (kind, path) records in data."""
+    return set((rec[:1], rec[1:]) for rec in data.split(b'\0') if rec)
+
+
+class JournalWriter:
+    """Append records (a set) to the journal of indexfile, skipping
+    any that are already there."""
+    def __init__(self, indexfile):
+        self.path = _journal_path(indexfile)
+        self._written = set()
+        self._size = 0
+
+    def append(self, records):
+        with open(self.path, 'ab') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_size < self._size:
+                # The journal has been taken (see take()).
+                self._written = set()
+            data = encode_records(r for r in records if r not in self._written)
+            if data:
+                f.write(data)
+                f.flush()
+                self._written.update(records)
+            self._size = f.tell()
+
+
+@contextmanager
+def watching(indexfile):
+    """Hold the lock that tells bup index that the journal of
+    indexfile is being maintained, and yield a function that must be
+    called with the roots being watched once they're all watched.
+    Raise an IOError with errno EWOULDBLOCK if another watcher holds
+    the lock."""
+    fd = os.open(_watch_path(indexfile), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.ftruncate(fd, 0)
+        def publish(roots):
+            # Terminated by an empty record, so that a reader can
+            # tell a complete list from a partial one.
+            os.write(fd, b'%d\0' % os.getpid()
+                     + b''.join(root + b'\0' for root in roots) + b'\0')
+        yield publish
+        os.ftruncate(fd, 0)
+    finally:
+        os.close(fd)
+
+
+def _read_watch(indexfile):
+    """Return (pid, roots) for the watcher of indexfile, or None if
+    no watcher is (yet) running."""
+    try:
+        f = open(_watch_path(indexfile), 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    with f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        else:
+            return None
+        data = f.read()
+    if not data.endswith(b'\0\0'):
+        return None
+    records = data[:-2].split(b'\0')
+    return int(records[0]), records[1:]
+
+
+def watched_roots(indexfile):
+    """Return the roots being watched for indexfile, or None if no
+    watcher is (yet) running."""
+    watch = _read_watch(indexfile)
+    return watch[1] if watch else None
+
+
+def _update_sync_counts(indexfile, update):
+    """Replace the (requested, done) sync counts of indexfile with
+    update(requested, done), while holding the lock on the sync file,
+    and return the result."""
+    fd = os.open(_sync_path(indexfile), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = os.read(fd, 16)
+        counts = struct.unpack('!QQ', data) if len(data) == 16 else (0, 0)
+        result = update(*counts)
+        if result != counts:
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, struct.pack('!QQ', *result))
+        return result
+    finally:
+        os.close(fd)
+
+
+def sync_requested(indexfile):
+    """Return the number of the latest sync requested of the watcher
+    of indexfile, which should be passed to sync_done() once all of
+    the changes the kernel has reported so far are in the journal."""
+    return _update_sync_counts(indexfile, lambda req, done: (req, done))[0]
+
+
+def sync_done(indexfile, requested):
+    _update_sync_counts(indexfile,
+                        lambda req, done: (req, max(done, requested)))
+
+
+def _sync(indexfile, timeout):
+    """Ask the watcher of indexfile (if any) to append everything it
+    knows about to the journal, and return the watched roots if it
+    didn't in time, otherwise None."""
+    watch = _read_watch(indexfile)
+    if not watch:
+        return None
+    pid, roots = watch
+    requested = _update_sync_counts(indexfile,
+                                    lambda req, done: (req + 1, done))[0]
+    try:
+        os.kill(pid, signal.SIGUSR1)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        return None  # it's gone, so the journal won't be trusted
+    deadline = time.time() + timeout
+    while True:
+        if _update_sync_counts(indexfile, lambda req, done: (req, done))[1] \
+           >= requested:
+            return None
+        if time.time() >= deadline:
+            return roots
+        time.sleep(0.01)
+
+
+def take(indexfile, sync_timeout=SYNC_TIMEOUT_SECS):
+    """Move the records in the journal of indexfile to its pending
+    file, and return the set of all the pending records, including
+    any left there by a run that didn't finish().  A running watcher
+    is given sync_timeout seconds to add what it's seen so far, and if
+    it doesn't, TREE records for all of its roots are included."""
+    unsynced = _sync(indexfile, sync_timeout)
+    try:
+        f = open(_journal_path(indexfile), 'r+b')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        with f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            data = f.read()
+            if data:
+                with open(_pending_path(indexfile), 'ab') as pending:
+                    pending.write(data)
+                    pending.flush()
+                    os.fsync(pending.fileno())
+                f.truncate(0)
+    records = set((TREE, root) for root in unsynced or ())
+    try:
+        with open(_pending_path(indexfile), 'rb') as pending:
+            records.update(decode_records(pending.read()))
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return records
+
+
+def finish(indexfile, remaining):
+    """Replace the pending records of indexfile with remaining, i.e.
+    the ones that weren't handled."""
+    path = _pending_path(indexfile)
+    if remaining:
+        with atomically_replaced_file(path, 'wb') as f:
+            f.write(encode_records(remaining))
+    else:
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
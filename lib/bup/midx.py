@@ -4,7 +4,8 @@ import glob, mmap, os, struct
 
 from bup import _helpers
 from bup.compat import range
-from bup.helpers import log, mmap_read, ExistsResult, ObjectExists
+from bup.helpers import (log, mmap_read, find_in_sha_table,
+                         ExistsResult, ObjectExists)
 from bup.io import path_msg
 
 
@@ -127,6 +128,20 @@ class PackMidx:
                 return ObjectExists
         return None
 
+    def exists_many(self, hashes, want_source=False, want_offs=False):
+        """Return a list containing the exists() result for each of the
+        hashes, looking them all up in a single pass over the midx."""
+        assert want_offs == False, "returning offset is not supported in midx"
+        global _total_searches, _total_steps
+        _total_searches += len(hashes)
+        _total_steps += len(hashes)
+        idxes = find_in_sha_table(self.map, self.fanout_ofs, self.bits,
+                                  self.sha_ofs, 20, hashes)
+        if not want_source:
+            return [None if i is None else ObjectExists for i in idxes]
+        return [None if i is None else ExistsResult(self._get_idxname(i), None)
+                for i in idxes]
+
     def __iter__(self):
         start = self.sha_ofs
         for ofs in range(start, start + self.nsha * 20, 20):
@@ -1,5 +1,5 @@
 from __future__ import absolute_import
-import os, struct
+import os, re, struct, zlib
 from binascii import hexlify, unhexlify
 
 from bup import git, vfs, vint
@@ -120,6 +120,132 @@ def read_resolution(port):
         result.append((name, item))
     return tuple(result)
 
+class CompressingConn:
+    """Wrap conn so that everything written is sent as a zlib stream,
+    in frames of a 32-bit length followed by that much compressed
+    data, up to an empty frame written by ok() or error(), which then
+    go to conn as usual.  The pending data is flushed whenever we're
+    about to wait for the other side (cf. BaseConn.read()).
+
+    """
+    def __init__(self, conn, level):
+        self.conn = conn
+        self._z = zlib.compressobj(level)
+
+    def _send(self, data):
+        if data:
+            self.conn.write(struct.pack('!I', len(data)))
+            self.conn.write(data)
+
+    def write(self, data):
+        # Keep each call's output (and so each frame) reasonably small.
+        for i in range(0, len(data), 1024 * 1024):
+            self._send(self._z.compress(data[i:i + 1024 * 1024]))
+
+    def flush(self):
+        self._send(self._z.flush(zlib.Z_SYNC_FLUSH))
+
+    def read(self, size):
+        self.flush()
+        return self.conn.read(size)
+
+    def readline(self):
+        self.flush()
+        return self.conn.readline()
+
+    def has_input(self):
+        return self.conn.has_input()
+
+    def _finish(self):
+        self._send(self._z.flush())
+        self.conn.write(struct.pack('!I', 0))
+
+    def ok(self):
+        self._finish()
+        self.conn.ok()
+
+    def error(self, s):
+        self._finish()
+        self.conn.error(s)
+
+
+class DecompressingConn:
+    """Read the frames written by a CompressingConn from conn, and
+    provide their content via read() and readline()."""
+    def __init__(self, conn):
+        self.conn = conn
+        self._z = zlib.decompressobj()
+        self._buf = b''
+        self._done = False
+
+    def _fill(self):
+        if self._done:
+            return False
+        n = struct.unpack('!I', self.conn.read(4))[0]
+        if not n:
+            self._buf += self._z.flush()
+            self._done = True
+            return True
+        data = self.conn.read(n)
+        if len(data) != n:
+            raise Exception('expected %d bytes of compressed data, got %d'
+                            % (n, len(data)))
+        self._buf += self._z.decompress(data)
+        return True
+
+    def read(self, size):
+        while len(self._buf) < size and self._fill():
+            pass
+        result, self._buf = self._buf[:size], self._buf[size:]
+        return result
+
+    def readline(self):
+        while b'\n' not in self._buf and self._fill():
+            pass
+        i = self._buf.find(b'\n') + 1 or len(self._buf)
+        result, self._buf = self._buf[:i], self._buf[i:]
+        return result
+
+    def write(self, data):
+        self.conn.write(data)
+
+    def has_input(self):
+        return bool(self._buf) or self.conn.has_input()
+
+    def _drain(self, onextra):
+        while self._fill():
+            pass
+        if self._buf:
+            onextra(self._buf)
+            self._buf = b''
+
+    def drain_and_check_ok(self):
+        self._drain(lambda data: None)
+        return self.conn.drain_and_check_ok()
+
+    def check_ok(self):
+        def onextra(data):
+            raise Exception('expected "ok", got %r' % data)
+        self._drain(onextra)
+        return self.conn.check_ok()
+
+
+# When the client asks for compression (see compress()), the replies
+# to these commands are compressed as a whole via a CompressingConn.
+# cat-batch and cat-stream instead send each object compressed on its
+# own, so that an object that's already stored compressed can be sent
+# as is (cf. _write_object()), and the other commands' replies are too
+# small to bother.
+_compressed_reply_commands = frozenset([b'list-indexes', b'send-index',
+                                        b'bloom', b'refs', b'rev-list',
+                                        b'resolve', b'join', b'cat'])
+
+# Objects bigger than this are sent uncompressed (unless they're
+# stored compressed) rather than compressing them in memory.
+_max_compressed_object = 16 * 1024 * 1024
+
+_oidx_rx = re.compile(br'^[0-9a-fA-F]{40}$')
+
 def _command(fn):
     fn.bup_server_command = True
     return fn
@@ -131,6 +257,7 @@ class BupProtocolServer:
         self._commands = self._get_commands(permitted_commands)
         self.suspended = False
         self.repo = None
+        self._compression = None
 
     def _get_commands(self, permitted_commands):
         commands = []
@@ -165,6 +292,14 @@ class BupProtocolServer:
             debug1('bup server: serving in %s mode\n'
                    % (self.repo.dumb_server_mode and 'dumb' or 'smart'))
 
+    @_command
+    def compress(self, args):
+        level = int(args)
+        if not 0 <= level <= 9:
+            raise Exception('invalid compression level %r' % args)
+        self._compression = level or None
+        self.conn.ok()
+
     @_command
     def init_dir(self, arg):
         self._backend.create(arg)
@@ -199,6 +334,25 @@ class BupProtocolServer:
         self.repo.send_index(name, self.conn, self._send_size)
         self.conn.ok()
 
+    @_command
+    def bloom(self, args):
+        self.init_session()
+        b = self.repo.make_bloom()
+        data = b.data if b else b''  # empty if there are too many objects
+        self.conn.write(struct.pack('!Q', len(data)))
+        self.conn.write(data)
+        self.conn.ok()
+
+    @_command
+    def exists(self, args):
+        self.init_session()
+        oids = [unhexlify(x[:-1])
+                for x in lines_until_sentinel(self.conn, b'\n', Exception)]
+        found = self.repo.exists_many(oids)
+        self.conn.write(b''.join(b'1' if x else b'0' for x in found))
+        self.conn.write(b'\n')
+        self.conn.ok()
+
     def _check(self, expected, actual, msg):
         if expected != actual:
             self.repo.abort_writing()
@@ -300,20 +454,51 @@ class BupProtocolServer:
 
     cat = join # apocryphal alias
 
+    def _write_object(self, ref):
+        # Write "missing", or "oidx type size", followed by the data,
+        # or with compression, "oidx type size zsize", followed by the
+        # zsize bytes of the compressed data.
+        level = self._compression
+        if level is not None and _oidx_rx.match(ref):
+            stored = self.repo.stored_object(unhexlify(ref))
+            if stored:
+                obj_t, size, zdata = stored
+                self.conn.write(b'%s %s %d %d\n'
+                                % (ref.lower(), obj_t, size, len(zdata)))
+                self.conn.write(zdata)
+                return
+        it = self.repo.cat(ref)
+        info = next(it)
+        if not info[0]:
+            self.conn.write(b'missing\n')
+            return
+        if level is not None and info[2] <= _max_compressed_object:
+            zdata = zlib.compress(b''.join(it), level)
+            self.conn.write(b'%s %s %d %d\n' % (info + (len(zdata),)))
+            self.conn.write(zdata)
+            return
+        self.conn.write(b'%s %s %d\n' % info)
+        for buf in it:
+            self.conn.write(buf)
+
     @_command
     def cat_batch(self, dummy):
         self.init_session()
         # For now, avoid potential deadlock by just reading them all
         for ref in tuple(lines_until_sentinel(self.conn, b'\n', Exception)):
-            ref = ref[:-1]
-            it = self.repo.cat(ref)
-            info = next(it)
-            if not info[0]:
-                self.conn.write(b'missing\n')
-                continue
-            self.conn.write(b'%s %s %d\n' % info)
-            for buf in it:
-                self.conn.write(buf)
+            self._write_object(ref[:-1])
+        self.conn.ok()
+
+    @_command
+    def cat_stream(self, dummy):
+        self.init_session()
+        # Unlike cat-batch, answer each ref as soon as it arrives, so
+        # that the client can keep sending refs while it reads the
+        # answers.  The client limits the number of outstanding refs
+        # (cf. Client.cat_stream()) so that neither side can block
+        # the other by filling up the pipes.
+        for ref in lines_until_sentinel(self.conn, b'\n', Exception):
+            self._write_object(ref[:-1])
         self.conn.ok()
 
     @_command
@@ -417,6 +602,15 @@ class BupProtocolServer:
                 break
 
             cmdattr = cmd.replace(b'-', b'_').decode('ascii', errors='replace')
-            getattr(self, cmdattr)(rest)
+            if (self._compression is not None
+                and cmd in _compressed_reply_commands):
+                conn = self.conn
+                self.conn = CompressingConn(conn, self._compression)
+                try:
+                    getattr(self, cmdattr)(rest)
+                finally:
+                    self.conn = conn
+            else:
+                getattr(self, cmdattr)(rest)
 
         debug1('bup server: done\n')
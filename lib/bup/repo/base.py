@@ -2,6 +2,7 @@
 from __future__ import absolute_import
 
 from bup import vfs
+from bup.treecache import TreeCache
 
 
 _next_repo_id = 0
@@ -16,6 +17,13 @@ def _repo_id(key):
     _repo_ids[key] = next_id
     return next_id
 
+def tree_cache_from_config(config):
+    path = config(b'bup.treecache', opttype='path')
+    if not path:
+        return None
+    max_bytes = config(b'bup.treecachesize', opttype='int')
+    return TreeCache(path, max_bytes or 256 * 1024 * 1024)
+
 def notimplemented(fn):
     def newfn(obj, *args, **kwargs):
         raise NotImplementedError("%s::%s must be implemented" % (
@@ -43,6 +51,12 @@ class BaseRepo(object):
         # the local (otherwise unused) repo's config
         self.max_pack_size = max_pack_size
         self.max_pack_objects = max_pack_objects
+        self.tree_cache = self._make_tree_cache()
+
+    def _make_tree_cache(self):
+        """Return the TreeCache (see bup.treecache) that the vfs should
+        use for this repository, or None."""
+        return tree_cache_from_config(self.config)
 
     def __del__(self):
         self.close()
@@ -113,6 +127,24 @@ class BaseRepo(object):
         (oidx, type, size), and then all of the data associated with ref.
         """
 
+    def stored_object(self, oid):
+        """
+        Return (type, size, zdata) if the object with the given oid
+        (binary format) is stored as plain zlib compressed data, where
+        zdata is that data, so that it can be sent elsewhere without
+        compressing it again.  Otherwise (e.g. if it's not stored that
+        way, or doesn't exist), return None.
+        """
+        return None
+
+    def prefetch(self, oids):
+        """
+        Hint that the objects with the given oids (binary format) are
+        about to be read with cat(), in that order, so that the
+        repository may fetch them in bulk.
+        """
+        pass
+
     @notimplemented
     def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
         """
@@ -129,6 +161,15 @@ class BaseRepo(object):
         (optional, used only by bup server)
         """
 
+    @notimplemented
+    def make_bloom(self):
+        """
+        Return a bloom.MemoryBloom containing all of the objects in
+        the repository's packs, or None if there are too many of them
+        (cf. bloom.create_in_memory()).
+        (optional, used only by bup server)
+        """
+
     @notimplemented
     def rev_list_raw(self, refs, count, fmt):
         """
@@ -162,6 +203,29 @@ class BaseRepo(object):
         Return the new object's oid.
         """
 
+    def prepare_data(self, data):
+        """
+        Do as much of the work needed to write the given data as possible
+        (e.g. hashing and compression) without writing anything, and
+        return an object to be passed to write_prepared().  This may be
+        called concurrently from several threads.
+        """
+        return data
+
+    def write_prepared(self, prepared):
+        """
+        Tentatively write the data previously passed to prepare_data().
+        Return the new object's oid.
+        """
+        return self.write_data(prepared)
+
+    def write_prepared_many(self, prepared):
+        """
+        Tentatively write each of the given prepare_data() results.
+        Return the list of the new objects' oids.
+        """
+        return [self.write_prepared(x) for x in prepared]
+
     def write_symlink(self, target):
         """
         Tentatively write the given symlink target into the repository.
@@ -204,3 +268,11 @@ class BaseRepo(object):
         None if not, True if it exists, or the idx name if want_source
         is True and it exists.
         """
+
+    def exists_many(self, oids, want_source=False):
+        """
+        Return a list containing the exists() result for each of the
+        given oids.  Repositories may answer the whole batch at once,
+        which is much cheaper than calling exists() for each oid.
+        """
+        return [self.exists(oid, want_source=want_source) for oid in oids]
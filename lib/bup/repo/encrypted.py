@@ -140,6 +140,8 @@ restored data.
 #  * address TODOs below in the code
 
 from __future__ import absolute_import
+import bisect
+import weakref
 import os
 import struct
 import zlib
@@ -148,6 +150,8 @@ import glob
 import fnmatch
 from io import BytesIO
 from binascii import hexlify, unhexlify
+from collections import OrderedDict, deque
+from functools import partial
 from itertools import islice
 
 try:
@@ -157,10 +161,10 @@ except ImportError:
     libnacl = None
 
 from bup import compat, git, vfs
-from bup.helpers import mkdirp
+from bup.helpers import (atomically_replaced_file, mkdirp, parallel_imap,
+                         progress, qprogress, WorkerPool)
 from bup.vint import read_vuint, pack
 from bup.storage import get_storage, FileNotFound, Kind
-from bup.compat import bytes_from_uint, byte_int
 from bup.repo import ConfigRepo
 from bup import hashsplit
 
@@ -172,36 +176,40 @@ MAX_ENC_BLOB_VUINT_LEN = len(pack('V', MAX_ENC_BLOB))
 
 NONCE_DATA, NONCE_LEN = 0, 0x80
 
-class EncryptedVuintReader:
-    def __init__(self, file, vuint_cs, szhint):
-        self.file = file
-        self.vuint_cs = [byte_int(x) for x in vuint_cs]
-        self.offs = 0
-        self.szhint = szhint
-
-    def read(self, sz):
-        assert sz == 1
-        v = byte_int(self.file.read(1, szhint=self.szhint)[0])
-        self.szhint -= 1
-        ret = bytes_from_uint(v ^ self.vuint_cs[self.offs])
-        self.offs += 1
-        assert self.offs < len(self.vuint_cs)
-        return ret
+# When reading several objects, read the gap between two of them along
+# with them rather than issuing another request if it's at most this
+# big, but don't read more than READ_MAX_SPAN bytes in one request.
+READ_MAX_GAP = 64 * 1024
+READ_MAX_SPAN = 8 * 1024 * 1024
+# Amount of object data prefetch() may keep in memory
+PREFETCH_MAX_BYTES = 32 * 1024 * 1024
+# Number of packs for which to keep the sorted object offsets around
+PACK_OFFSETS_CACHE = 16
+# With bup.cryptjobs > 1, the amount of object data being compressed
+# or encrypted by the worker threads at any given time
+WRITE_MAX_BYTES = 64 * 1024 * 1024
 
 class EncryptedContainer(object):
     HEADER, OBJ = range(2)
 
     def __init__(self, repo, storage, name, mode, kind, compression=None,
-                 key=None, idxwriter=None, overwrite=None):
+                 key=None, idxwriter=None, overwrite=None, pool=None):
         self.file = None # for __del__ in case of exceptions
         assert mode in ('r', 'w')
         assert compression in range(-1, 10) or mode == 'r'
         self.mode = mode
         self.compression = compression
         self.idxwriter = idxwriter
-        self._used_nonces = set()
+        self.pool = pool
+        # objects being compressed, and objects being encrypted (with
+        # their offset already assigned), in the order of write()
+        self._compressing = deque()
+        self._sealing = deque()
+        # the last offset a nonce of each kind was used for
+        self._last_nonce_offset = {NONCE_DATA: -1, NONCE_LEN: -1}
         self._blobbits_cache = None
-        self.repo = repo
+        # the repo caches its containers, don't keep it alive from here
+        self.repo = weakref.proxy(repo)
 
         if kind == Kind.DATA or kind == Kind.METADATA:
             self.filetype = 1
@@ -274,35 +282,42 @@ class EncryptedContainer(object):
         else:
             self.close()
 
-    def nonce(self, kind, write=True):
+    def nonce(self, kind, write=True, offset=None):
         assert kind in (NONCE_DATA, NONCE_LEN)
-        nonce = struct.pack('>B15xQ', kind, self.offset)
+        if offset is None:
+            offset = self.offset
+        nonce = struct.pack('>B15xQ', kind, offset)
         if write:
-            # safety check for nonce reuse
-            assert nonce not in self._used_nonces, "nonce reuse!"
-            self._used_nonces.add(nonce)
+            # safety check for nonce reuse - offsets only ever grow, so
+            # it's enough to remember the last one used for each kind
+            assert offset > self._last_nonce_offset[kind], "nonce reuse!"
+            self._last_nonce_offset[kind] = offset
         return nonce
 
+    def _compress(self, objtype, data):
+        z = zlib.compressobj(self.compression)
+        objtypeb = struct.pack('B', objtype)
+        return z.compress(objtypeb) + z.compress(data) + z.flush()
+
+    @staticmethod
+    def _seal(box, data, nonce_data, nonce_len):
+        data = box.encrypt(data, nonce_data, pack_nonce=False)[1]
+        assert len(data) <= MAX_ENC_BLOB
+        vuint = pack('V', len(data))
+        encvuint = libnacl.crypto_stream_xor(vuint, nonce_len, box.sk)
+        return encvuint + data
+
     def _write(self, data, dtype, objtype=None):
         assert self.mode == 'w'
         if dtype == self.OBJ:
-            z = zlib.compressobj(self.compression)
-            objtypeb = struct.pack('B', objtype)
-            data = z.compress(objtypeb) + z.compress(data) + z.flush()
-            data = self.box.encrypt(data, self.nonce(NONCE_DATA),
-                                    pack_nonce=False)[1]
-            assert len(data) <= MAX_ENC_BLOB
-            vuint = pack('V', len(data))
-            encvuint = libnacl.crypto_stream_xor(vuint, self.nonce(NONCE_LEN),
-                                                 self.box.sk)
-            data = encvuint + data
+            data = self._seal(self.box, self._compress(objtype, data),
+                              self.nonce(NONCE_DATA), self.nonce(NONCE_LEN))
         self.file.write(data)
         retval = self.offset
         self.offset += len(data)
         return retval
 
-    def write(self, objtype, sha, data):
-        offs = self._write(data, self.OBJ, objtype)
+    def _add_idx(self, sha, objtype, offs):
         if self.idxwriter:
             # Set the crc to the objtype - we cannot copy any objects
             # from one pack file to another without decrypting anyway
@@ -311,10 +326,60 @@ class EncryptedContainer(object):
             # be useful to have the objtype in case we need to e.g.
             # attempt to recover all commits (if refs are lost) etc.
             self.idxwriter.add(sha, objtype, offs)
-        return offs
+
+    def write(self, objtype, sha, data):
+        """
+        Write the object and return its offset in the file, or, if
+        the container has a worker pool, queue it to be compressed and
+        encrypted there and return None.
+        """
+        if self.pool is None:
+            offs = self._write(data, self.OBJ, objtype)
+            self._add_idx(sha, objtype, offs)
+            return offs
+        job = self.pool.submit(partial(self._compress, objtype, data),
+                               len(data))
+        self._compressing.append((objtype, sha, job))
+        self._append(4 * self.pool.max_threads)
+        return None
+
+    def _pending(self):
+        return len(self._compressing) + len(self._sealing)
+
+    def _append(self, max_pending):
+        # The single appender: offsets, and thus nonces, are assigned
+        # here in the order the objects were written (as soon as their
+        # compressed size is known), and the encrypted objects are
+        # appended to the file in that same order.  Blocks until at
+        # most max_pending objects are still being worked on.
+        while True:
+            if self._compressing and (self._compressing[0][2].done.is_set() or
+                                      (not self._sealing and
+                                       self._pending() > max_pending)):
+                objtype, sha, job = self._compressing.popleft()
+                data = job.wait()
+                offs = self.offset
+                sealed_len = len(data) + libnacl.crypto_secretbox_MACBYTES
+                size = len(pack('V', sealed_len)) + sealed_len
+                self.offset += size
+                job = self.pool.submit(partial(self._seal, self.box, data,
+                                               self.nonce(NONCE_DATA, offset=offs),
+                                               self.nonce(NONCE_LEN, offset=offs)),
+                                       len(data))
+                self._sealing.append((objtype, sha, offs, size, job))
+            elif self._sealing and (self._sealing[0][4].done.is_set() or
+                                    self._pending() > max_pending):
+                objtype, sha, offs, size, job = self._sealing.popleft()
+                data = job.wait()
+                assert len(data) == size
+                self.file.write(data)
+                self._add_idx(sha, objtype, offs)
+            else:
+                break
 
     def finish(self):
         assert self.mode == 'w'
+        self._append(0)
         self.file.close()
         self.file = None
         self._cleanup()
@@ -335,6 +400,9 @@ class EncryptedContainer(object):
 
     def _cleanup(self):
         if self.mode == 'w':
+            # anything still in the pool is just dropped
+            self._compressing.clear()
+            self._sealing.clear()
             del self.box
         elif self.file is not None:
             self.file.close()
@@ -347,22 +415,69 @@ class EncryptedContainer(object):
             self._blobbits_cache = bb or hashsplit.BUP_BLOBBITS
         return 1 << self._blobbits_cache
 
-    def read(self, offset=None):
-        assert self.mode == 'r'
-        self.offset = offset or self.headerlen
-        self.file.seek(self.offset)
-        vuint_cs = libnacl.crypto_stream(MAX_ENC_BLOB_VUINT_LEN,
+    def _decrypt_size(self, offset, encvuint):
+        # return the object size and the length of its vuint
+        self.offset = offset
+        vuint_cs = libnacl.crypto_stream(len(encvuint),
                                          self.nonce(NONCE_LEN, write=False),
                                          self.box.sk)
-        sz = read_vuint(EncryptedVuintReader(self.file, vuint_cs, self._blobsize))
+        vuint = BytesIO(bytes(bytearray(a ^ b for a, b in
+                                        zip(bytearray(encvuint),
+                                            bytearray(vuint_cs)))))
+        sz = read_vuint(vuint)
         assert sz <= MAX_ENC_BLOB
-        data = self.file.read(sz)
-        assert len(data) == sz
+        return sz, vuint.tell()
+
+    def _decrypt_object(self, offset, data):
+        self.offset = offset
         data = self.box.decrypt(data, self.nonce(NONCE_DATA, write=False))
         data = zlib.decompress(data)
         objtype = struct.unpack('B', data[:1])[0]
         return objtype, data[1:]
 
+    def read(self, offset=None):
+        assert self.mode == 'r'
+        offset = offset or self.headerlen
+        self.file.seek(offset)
+        buf = self.file.read(MAX_ENC_BLOB_VUINT_LEN, szhint=self._blobsize)
+        sz, vlen = self._decrypt_size(offset, buf)
+        data = buf[vlen:vlen + sz]
+        if len(data) < sz:
+            data += self.file.read(sz - len(data))
+        assert len(data) == sz
+        return self._decrypt_object(offset, data)
+
+    def read_many(self, extents):
+        """
+        Yield (offset, objtype, data) for each object given by its
+        (offset, end) extent in extents (sorted by offset), reading
+        nearby objects with a single request.
+        """
+        assert self.mode == 'r'
+        extents = list(extents)
+        i = 0
+        while i < len(extents):
+            start, end = extents[i]
+            j = i + 1
+            while j < len(extents):
+                nstart, nend = extents[j]
+                if nstart - end > READ_MAX_GAP or nend - start > READ_MAX_SPAN:
+                    break
+                end = nend
+                j += 1
+            self.file.seek(start)
+            buf = self.file.read(end - start)
+            assert len(buf) == end - start
+            for offset, objend in extents[i:j]:
+                pos = offset - start
+                sz, vlen = self._decrypt_size(
+                    offset, buf[pos:pos + MAX_ENC_BLOB_VUINT_LEN])
+                pos += vlen
+                assert pos + sz <= objend - start
+                objtype, data = self._decrypt_object(offset, buf[pos:pos + sz])
+                yield offset, objtype, data
+            i = j
+
     def close(self):
         assert self.mode == 'r'
         if self.file is None:
@@ -382,8 +497,12 @@ class EncryptedRepo(ConfigRepo):
         self.storage = None
         self.data_writer = None
         self.meta_writer = None
+        self.write_pool = None
         self.cfg_file = cfg_file
         self.ec_cache = {}
+        self._prefetched = OrderedDict()
+        self._prefetched_bytes = 0
+        self._pack_offsets = OrderedDict()
 
         if libnacl is None:
             raise Exception("Encrypted repositories require libnacl")
@@ -424,6 +543,9 @@ class EncryptedRepo(ConfigRepo):
         if self.compression is None:
             self.compression = -1
         self.separatemeta = self.config(b'bup.separatemeta', opttype='bool')
+        jobs = self.config(b'bup.cryptjobs', opttype='int') or 1
+        if jobs > 1:
+            self.write_pool = WorkerPool(jobs, WRITE_MAX_BYTES)
         self.data_written_objs = set()
         if self.separatemeta:
             self.meta_written_objs = set()
@@ -433,24 +555,47 @@ class EncryptedRepo(ConfigRepo):
         self._synchronize_idxes()
         self.idxlist = git.PackIdxList(self.cachedir)
 
+    def _fetch_idx(self, remote_idx):
+        # called from several threads, so don't use the ec_cache
+        local_idx = remote_idx.replace(b'.encidx', b'.idx')
+        ec = EncryptedContainer(self, self.storage, remote_idx, 'r',
+                                Kind.IDX, key=self.repokey)
+        try:
+            data = ec.read()[1]
+        finally:
+            ec.close()
+        with atomically_replaced_file(os.path.join(self.cachedir, local_idx),
+                                      'wb') as f:
+            f.write(data)
+        return local_idx
+
     def _synchronize_idxes(self):
-        changes = False
         local_idxes = set(fnmatch.filter(os.listdir(self.cachedir), b'*.idx'))
+        missing = []
         for remote_idx in self.storage.list(b'*.encidx'):
             local_idx = remote_idx.replace(b'.encidx', b'.idx')
             if local_idx in local_idxes:
                 local_idxes.remove(local_idx)
             else:
-                ec = self._open_read(remote_idx, Kind.IDX)
-                with open(os.path.join(self.cachedir, local_idx), 'wb') as f:
-                    f.write(ec.read()[1])
-                changes = True
+                missing.append(remote_idx)
         for local_idx in local_idxes:
-            changes = True
             os.unlink(os.path.join(self.cachedir, local_idx))
 
-        if changes:
+        new_idxes = []
+        if missing:
+            jobs = self.config(b'bup.syncjobs', opttype='int') or 4
+            for local_idx in parallel_imap(self._fetch_idx, missing, jobs):
+                new_idxes.append(local_idx)
+                qprogress('Synchronizing idx files: %d/%d\r'
+                          % (len(new_idxes), len(missing)))
+            progress('Synchronizing idx files: %d/%d, done.\n'
+                     % (len(new_idxes), len(missing)))
+
+        if local_idxes:
+            # existing midx files may cover the removed ones
             git.auto_midx(self.cachedir)
+        elif new_idxes:
+            git.update_midx(self.cachedir, new_idxes)
 
     def _create_new_pack(self, kind):
         fakesha = libnacl.randombytes(20)
@@ -459,7 +604,8 @@ class EncryptedRepo(ConfigRepo):
                                            b'pack-%s.encpack' % hexsha, 'w',
                                            kind, self.compression,
                                            key=self.writekey,
-                                           idxwriter=git.PackIdxV2Writer())
+                                           idxwriter=git.PackIdxV2Writer(),
+                                           pool=self.write_pool)
 
     def _ensure_data_writer(self):
         if self.data_writer is not None and self.data_writer.size > self.max_pack_size:
@@ -488,6 +634,9 @@ class EncryptedRepo(ConfigRepo):
 
     def close(self):
         self.abort_writing()
+        if self.write_pool is not None:
+            self.write_pool.close()
+            self.write_pool = None
         for ec in self.ec_cache.values():
             ec.close()
         self.ec_cache = {}
@@ -630,6 +779,13 @@ class EncryptedRepo(ConfigRepo):
             if oid is None:
                 raise Exception("ref %r not found in repo" % ref)
         oidx = hexlify(oid)
+        prefetched = self._prefetched.pop(oid, None)
+        if prefetched is not None:
+            objtype, data = prefetched
+            self._prefetched_bytes -= len(data)
+            yield (oidx, git._typermap[objtype], len(data))
+            yield data
+            return
         res = self.idxlist.exists(oid,
                                   want_source=True,
                                   want_offs=True)
@@ -646,6 +802,57 @@ class EncryptedRepo(ConfigRepo):
         yield (oidx, git._typermap[objtype], len(data))
         yield data
 
+    def _sorted_offsets(self, idxname):
+        offsets = self._pack_offsets.pop(idxname, None)
+        if offsets is None:
+            ix = git.open_idx(os.path.join(self.cachedir, idxname))
+            offsets = struct.unpack_from('!%dI' % ix.nsha, ix.map,
+                                         ix.ofstable_ofs)
+            offsets = sorted([ix._ofs_from_idx(i) if ofs & 0x80000000 else ofs
+                              for i, ofs in enumerate(offsets)])
+            del ix
+            if len(self._pack_offsets) >= PACK_OFFSETS_CACHE:
+                self._pack_offsets.popitem(last=False)
+        self._pack_offsets[idxname] = offsets
+        return offsets
+
+    def prefetch(self, oids):
+        # Look up where the objects are, and read each pack's objects
+        # in order, with as few requests as possible (see read_many()),
+        # keeping them in memory until cat() asks for them.
+        oids = [oid for oid in oids if oid not in self._prefetched]
+        found = self.idxlist.exists_many(oids, want_source=True,
+                                         want_offs=True)
+        by_pack = {}
+        for oid, res in zip(oids, found):
+            if res:
+                by_pack.setdefault(res.pack, {})[res.offset] = oid
+        budget = PREFETCH_MAX_BYTES - self._prefetched_bytes
+        for idxname, objs in compat.items(by_pack):
+            offsets = self._sorted_offsets(idxname)
+            extents = []
+            for offset in sorted(objs):
+                i = bisect.bisect_right(offsets, offset)
+                if i == len(offsets):
+                    break # the last object's size isn't known
+                end = offsets[i]
+                budget -= end - offset
+                if budget < 0:
+                    break
+                extents.append((offset, end))
+            if not extents:
+                continue
+            packname = idxname.replace(b'.idx', b'.encpack')
+            # Kind.DATA / Kind.METADATA are equivalent here
+            ec = self._open_read(packname, Kind.DATA, cache=True)
+            for offset, objtype, data in ec.read_many(extents):
+                self._prefetched[objs[offset]] = objtype, data
+                self._prefetched_bytes += len(data)
+        # drop the oldest objects nobody asked for
+        while self._prefetched_bytes > PREFETCH_MAX_BYTES:
+            objtype, data = self._prefetched.popitem(last=False)[1]
+            self._prefetched_bytes -= len(data)
+
     def join(self, ref):
         return vfs.join(self, ref)
 
@@ -700,6 +907,22 @@ class EncryptedRepo(ConfigRepo):
             return True
         return self.idxlist.exists(sha, want_source=want_source)
 
+    def exists_many(self, shas, want_source=False):
+        result = [None] * len(shas)
+        todo = []
+        for i, sha in enumerate(shas):
+            if sha in self.data_written_objs:
+                result[i] = True
+            elif self.separatemeta and sha in self.meta_written_objs:
+                result[i] = True
+            else:
+                todo.append(i)
+        found = self.idxlist.exists_many([shas[i] for i in todo],
+                                         want_source=want_source)
+        for i, ret in zip(todo, found):
+            result[i] = ret
+        return result
+
     def _finish(self, writer, fakesha, meta=False):
         hexsha = hexlify(fakesha)
         idxname = os.path.join(self.cachedir, b'pack-%s.idx' % hexsha)
@@ -1,13 +1,18 @@
 
 from __future__ import absolute_import
-import os, subprocess
+from collections import OrderedDict
+import errno, os, subprocess
 from os.path import realpath
 from functools import partial
 
-from bup import git, vfs
+from bup import bloom, git, vfs
+from bup.helpers import mmap_read
 from bup.repo.base import BaseRepo
 
 
+# Number of packs (and their idxes) stored_object() keeps open
+STORED_PACKS_OPEN = 16
+
 class LocalRepo(BaseRepo):
     def __init__(self, repo_dir=None, compression_level=None,
                  max_pack_size=None, max_pack_objects=None,
@@ -24,6 +29,8 @@ class LocalRepo(BaseRepo):
         self._dumb_server_mode = None
         self._packwriter = None
         self.objcache_maker = objcache_maker
+        self._stored_idxlist = None
+        self._stored_packs = OrderedDict()
 
     @classmethod
     def create(self, repo_dir=None):
@@ -68,6 +75,54 @@ class LocalRepo(BaseRepo):
                 yield data
         assert not next(it, None)
 
+    def _stored_location(self, oid):
+        """Return the name of the pack that has oid, or None."""
+        if not self._stored_idxlist:
+            self._stored_idxlist = git.PackIdxList(
+                git.repo(b'objects/pack', repo_dir=self.repo_dir))
+        # Only ask for the source, since a midx would have to open the
+        # idx to find the offset, and stored_object() keeps that open.
+        res = self._stored_idxlist.exists(oid, want_source=True)
+        if not res:
+            # Perhaps it's in a pack written since the list was made.
+            self._stored_idxlist.refresh()
+            res = self._stored_idxlist.exists(oid, want_source=True)
+            if not res:
+                return None  # e.g. a loose object
+        return os.path.basename(res.pack)[:-4] + b'.pack'
+
+    def stored_object(self, oid):
+        packname = self._stored_location(oid)
+        if not packname:
+            return None
+        stored = self._stored_packs.pop(packname, None)
+        if stored is None:
+            path = git.repo(b'objects/pack/' + packname,
+                            repo_dir=self.repo_dir)
+            try:
+                ix = git.open_idx(path[:-5] + b'.idx')
+                pack = mmap_read(open(path, 'rb'))
+            except (IOError, OSError) as ex:
+                if ex.errno == errno.ENOENT:  # e.g. removed by gc
+                    return None
+                raise
+            stored = ix, pack
+            # Each map holds on to a file descriptor.
+            if len(self._stored_packs) >= STORED_PACKS_OPEN:
+                self._stored_packs.popitem(last=False)[1][1].close()
+        self._stored_packs[packname] = stored
+        ix, pack = stored
+        ofs = ix.find_offset(oid)
+        if ofs is None:
+            return None
+        return git.read_stored_object(pack, ofs)
+
+    def close(self):
+        super(LocalRepo, self).close()
+        while self._stored_packs:
+            self._stored_packs.popitem()[1][1].close()
+        self._stored_idxlist = None
+
     def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
         for ref in git.list_refs(patterns=patterns,
                                  limit_to_heads=limit_to_heads,
@@ -81,6 +136,45 @@ class LocalRepo(BaseRepo):
         send_size(len(data))
         conn.write(data)
 
+    def make_bloom(self):
+        # The filter is saved along with the names of the indexes it
+        # covers, and only updated (with the new ones) when there are
+        # new indexes, or rebuilt when any have gone, e.g. after a gc,
+        # or it's too full.
+        cache_path = git.repo(b'server.bloom', repo_dir=self.repo_dir)
+        names = set(name for name in self.list_indexes()
+                    if name.endswith(b'.idx'))
+        path = lambda name: git.repo(b'objects/pack/' + name,
+                                     repo_dir=self.repo_dir)
+        cached = bloom.read_memory_bloom(cache_path)
+        result = None
+        if cached and set(cached[1]) <= names:
+            result, covered = cached
+            new = names.difference(covered)
+            if not new:
+                return result
+            if not result.has_room(sum(git.idx_object_count(path(name))
+                                       for name in new)):
+                result = None
+        if result is None:
+            new = names
+            count = sum(git.idx_object_count(path(name)) for name in names)
+            # Leave some room for the indexes to come.
+            result = bloom.create_in_memory(count + count // 4)
+            if result is None:
+                result = bloom.create_in_memory(count)
+                if result is None:
+                    return None
+        for name in sorted(new):
+            ix = git.open_idx(path(name))
+            if isinstance(ix, git.PackIdxV2):
+                result.add(ix.shatable)
+            else:
+                result.add(b''.join(ix))
+            del ix
+        bloom.write_memory_bloom(cache_path, result, sorted(names))
+        return result
+
     def rev_list_raw(self, refs, fmt):
         args = git.rev_list_invocation(refs, format=fmt)
         p = subprocess.Popen(args, env=git._gitenv(self.repo_dir),
@@ -112,6 +206,17 @@ class LocalRepo(BaseRepo):
         self._ensure_packwriter()
         return self._packwriter.new_blob(data)
 
+    def prepare_data(self, data):
+        return git.prepare_object(b'blob', data, self.compression_level)
+
+    def write_prepared(self, prepared):
+        self._ensure_packwriter()
+        return self._packwriter.write_prepared(prepared)
+
+    def write_prepared_many(self, prepared):
+        self._ensure_packwriter()
+        return self._packwriter.write_prepared_many(prepared)
+
     def just_write(self, sha, type, content, metadata=False):
         self._ensure_packwriter()
         return self._packwriter.just_write(sha, type, content)
@@ -120,6 +225,10 @@ class LocalRepo(BaseRepo):
         self._ensure_packwriter()
         return self._packwriter.exists(sha, want_source=want_source)
 
+    def exists_many(self, shas, want_source=False):
+        self._ensure_packwriter()
+        return self._packwriter.exists_many(shas, want_source=want_source)
+
     def finish_writing(self, run_midx=True):
         if self._packwriter:
             w = self._packwriter
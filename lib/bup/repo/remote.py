@@ -1,9 +1,16 @@
 
 from __future__ import absolute_import
 
-from bup.repo.base import BaseRepo
-from bup import client
+from binascii import hexlify
+from collections import OrderedDict
+from functools import partial
 
+from bup.repo.base import BaseRepo, tree_cache_from_config
+from bup import client, git
+
+
+# Amount of object data prefetch() may keep in memory
+PREFETCH_MAX_BYTES = 32 * 1024 * 1024
 
 class RemoteRepo(BaseRepo):
     def __init__(self, address, create=False, compression_level=None,
@@ -11,7 +18,13 @@ class RemoteRepo(BaseRepo):
         # if client.Client() raises an exception, have a client
         # anyway to avoid follow-up exceptions from __del__
         self.client = None
-        self.client = client.Client(address)
+        # Like the tree cache, these are about the local side of things.
+        local_config = partial(git.git_config_get, repo_dir=git.repo())
+        server_bloom = local_config(b'bup.serverbloom', opttype='bool')
+        self.client = client.Client(address,
+                                    wire_compression=local_config(
+                                        b'bup.wirecompression', opttype='int'),
+                                    server_bloom=server_bloom is not False)
         self.config = self.client.config
         # init the superclass only afterwards so it can access self.config()
         super(RemoteRepo, self).__init__(address,
@@ -26,12 +39,22 @@ class RemoteRepo(BaseRepo):
         self.refs = self.client.refs
         self.resolve = self.client.resolve
         self._packwriter = None
+        self._prefetched = OrderedDict()
+        self._prefetched_bytes = 0
+
+    def _make_tree_cache(self):
+        # A bup.treecache path from the server's config would refer to
+        # the server's filesystem, so use the local repository's.
+        return tree_cache_from_config(partial(git.git_config_get,
+                                              repo_dir=git.repo()))
 
     def close(self):
         super(RemoteRepo, self).close()
         if self.client:
             self.client.close()
             self.client = None
+        self._prefetched.clear()
+        self._prefetched_bytes = 0
 
     def update_ref(self, refname, newval, oldval):
         self.finish_writing()
@@ -48,6 +71,16 @@ class RemoteRepo(BaseRepo):
         return True
 
     def cat(self, ref):
+        prefetched = self._prefetched.pop(ref, None)
+        if prefetched is not None:
+            # Keep it (as the most recently used) since callers
+            # often cat the same object more than once, e.g. for a
+            # file's size and then its content.
+            self._prefetched[ref] = prefetched
+            typ, data = prefetched
+            yield ref, typ, len(data)
+            yield data
+            return
         # Yield all the data here so that we don't finish the
         # cat_batch iterator (triggering its cleanup) until all of the
         # data has been read.  Otherwise we'd be out of sync with the
@@ -60,6 +93,33 @@ class RemoteRepo(BaseRepo):
                 yield data
         assert not next(items, None)
 
+    def prefetch(self, oids):
+        # Fetch the objects with a single (pipelined) cat-stream, and
+        # keep them in memory until cat() asks for them.
+        if not self.client.has_cat_stream():
+            return
+        refs = [hexlify(oid) for oid in oids]
+        refs = [ref for ref in refs if ref not in self._prefetched]
+        def wanted():
+            for ref in refs:
+                if self._prefetched_bytes >= PREFETCH_MAX_BYTES:
+                    return
+                yield ref
+        # cat_stream() must come first so that zip() lets it finish
+        # (and check the server's response) before noticing that refs
+        # has been exhausted.
+        items = self.client.cat_stream(wanted())
+        for (oidx, typ, size, it), ref in zip(items, refs):
+            if not oidx:
+                continue  # let cat() report it
+            data = b''.join(it)
+            self._prefetched[ref] = typ, data
+            self._prefetched_bytes += len(data)
+        # drop the least recently used objects
+        while self._prefetched_bytes > PREFETCH_MAX_BYTES:
+            typ, data = self._prefetched.popitem(last=False)[1]
+            self._prefetched_bytes -= len(data)
+
     def write_commit(self, tree, parent,
                      author, adate_sec, adate_tz,
                      committer, cdate_sec, cdate_tz,
@@ -78,6 +138,17 @@ class RemoteRepo(BaseRepo):
         self._ensure_packwriter()
         return self._packwriter.new_blob(data)
 
+    def prepare_data(self, data):
+        return git.prepare_object(b'blob', data, self.compression_level)
+
+    def write_prepared(self, prepared):
+        self._ensure_packwriter()
+        return self._packwriter.write_prepared(prepared)
+
+    def write_prepared_many(self, prepared):
+        self._ensure_packwriter()
+        return self._packwriter.write_prepared_many(prepared)
+
     def just_write(self, sha, type, content, metadata=False):
         self._ensure_packwriter()
         return self._packwriter.just_write(sha, type, content)
@@ -86,6 +157,10 @@ class RemoteRepo(BaseRepo):
         self._ensure_packwriter()
         return self._packwriter.exists(sha, want_source=want_source)
 
+    def exists_many(self, shas, want_source=False):
+        self._ensure_packwriter()
+        return self._packwriter.exists_many(shas, want_source=want_source)
+
     def finish_writing(self, run_midx=True):
         if self._packwriter:
             w = self._packwriter
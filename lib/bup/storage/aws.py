@@ -8,9 +8,11 @@ Uses the following AWS products:
 from __future__ import absolute_import
 import os
 import sys
+import bisect
 import fnmatch
 import datetime
 import base64
+import hashlib
 import threading
 
 try:
@@ -22,6 +24,7 @@ except ImportError:
 
 from bup.storage import BupStorage, FileAlreadyExists, FileNotFound, Kind, FileModified
 from bup.compat import reraise
+from bup.helpers import atomically_replaced_file, WorkerPool
 
 try:
     import boto3
@@ -35,43 +38,122 @@ MIN_AWS_CHUNK_SIZE = 1024 * 1024 * 5
 DEFAULT_AWS_CHUNK_SIZE = MIN_AWS_CHUNK_SIZE * 10
 
 
-class UploadThread(threading.Thread):
-    def __init__(self, write):
-        super(UploadThread, self).__init__()
-        self.exc = None
-        self.write = write
-        self._queue = queue.Queue(maxsize=1)
-        self.setDaemon(True)
-
-    def run(self):
+# name of the table item holding the listing generation counter
+GENERATION_ITEM = '.bup-generation'
+
+
+def _pattern_filter(pattern):
+    """Return a DynamoDB filter expression (and its values) selecting
+    complete files whose name could match the given fnmatch pattern,
+    using its literal prefix and suffix (the caller must still check
+    the names with fnmatch)."""
+    conds = ['attribute_not_exists(tentative)']
+    values = {}
+    wild = [i for i, c in enumerate(pattern) if c in '*?[']
+    if not wild:
+        conds.append('filename = :name')
+        values[':name'] = { 'S': pattern, }
+    else:
+        if wild[0]:
+            conds.append('begins_with(filename, :prefix)')
+            values[':prefix'] = { 'S': pattern[:wild[0]], }
+        suffix = pattern[max(i for i, c in enumerate(pattern)
+                             if c in '*?]') + 1:]
+        if suffix:
+            conds.append('contains(filename, :suffix)')
+            values[':suffix'] = { 'S': suffix, }
+    return ' AND '.join(conds), values
+
+
+class DynamoListing:
+    """
+    Listing of the files in the DynamoDB table, optionally cached in
+    local files (one per pattern).  Writers bump a generation counter
+    (an extra item in the table) after adding a file, and a cached
+    listing is only used while the counter still has the value it had
+    before that listing was made, so it costs a single read instead of
+    a scan of the whole table.
+    """
+    def __init__(self, dynamo, table, cachedir=None):
+        self.dynamo = dynamo
+        self.table = table
+        self.cachedir = cachedir
+
+    def bump(self):
+        """Invalidate all cached listings (of any client)."""
+        self.dynamo.update_item(TableName=self.table,
+                                Key={ 'filename': { 'S': GENERATION_ITEM } },
+                                UpdateExpression='ADD generation :one',
+                                ExpressionAttributeValues={
+                                    ':one': { 'N': '1' },
+                                })
+
+    def _generation(self):
+        response = self.dynamo.get_item(TableName=self.table,
+                                        Key={
+                                            'filename': {
+                                                'S': GENERATION_ITEM,
+                                            },
+                                        },
+                                        ConsistentRead=True)
+        if not 'Item' in response:
+            return None
+        return int(response['Item']['generation']['N'])
+
+    def _scan(self, pattern):
+        expr, values = _pattern_filter(pattern)
+        kwargs = dict(TableName=self.table,
+                      ProjectionExpression='filename',
+                      FilterExpression=expr,
+                      ConsistentRead=True)
+        if values:
+            kwargs['ExpressionAttributeValues'] = values
+        while True:
+            response = self.dynamo.scan(**kwargs)
+            for item in response['Items']:
+                name = item['filename']['S']
+                if name != GENERATION_ITEM:
+                    yield name
+            if not 'LastEvaluatedKey' in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _cachefile(self, pattern):
+        key = hashlib.sha1(('%s\0%s' % (self.table, pattern))
+                           .encode('utf-8')).hexdigest()
+        return os.path.join(self.cachedir, 'listing-%s' % key)
+
+    def _load(self, fn, generation, pattern):
         try:
-            while True:
-                try:
-                    buf = self._queue.get()
-                    if buf is None:
-                        return
-                    self.write(buf)
-                finally:
-                    self._queue.task_done()
-        except:
-            self.exc = sys.exc_info()
-
-    def _join_queue_check(self):
-        self._queue.join()
-        if self.exc:
-            self.join() # clean up the thread
-            reraise(Exception(self.exc[1]), self.exc[2])
-
-    def put(self, buf):
-        assert self.write is not None
-        self._join_queue_check()
-        self._queue.put(buf)
+            with open(fn, 'rb') as f:
+                lines = f.read().decode('utf-8').split('\n')
+        except IOError:
+            return None
+        if lines[:2] != ['%d' % generation, pattern]:
+            return None
+        return [name for name in lines[2:] if name]
+
+    def _save(self, fn, generation, pattern, names):
+        with atomically_replaced_file(fn, 'wb') as f:
+            f.write('\n'.join(['%d' % generation, pattern] + names)
+                    .encode('utf-8'))
 
-    def finish(self):
-        self.put(None)
-        self._join_queue_check()
-        self.join()
-        self.write = None
+    def list(self, pattern=None):
+        """Return the names of the complete files matching pattern."""
+        if pattern is None:
+            pattern = '*'
+        generation = None
+        if self.cachedir:
+            generation = self._generation()
+        if generation is None:
+            names = list(self._scan(pattern))
+        else:
+            fn = self._cachefile(pattern)
+            names = self._load(fn, generation, pattern)
+            if names is None:
+                names = list(self._scan(pattern))
+                self._save(fn, generation, pattern, names)
+        return [name for name in names if fnmatch.fnmatch(name, pattern)]
 
 
 def _nowstr():
@@ -127,9 +209,101 @@ class S3Reader:
     def seek(self, offs):
         self.offs = offs
 
+class CacheRanges:
+    """
+    Index of the (inclusive) byte ranges of an object present in its
+    cache file, kept merged in sorted arrays for bisect lookups, and
+    persisted in a journal file with one "start - end" line appended
+    for each range added.  The journal is rewritten (compacted) when
+    it's loaded or closed with many more lines than distinct ranges.
+    Thread-safe, and multiple instances (e.g. processes) may share
+    the same journal, but then may not immediately see each other's
+    ranges.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._starts = []
+        self._ends = []
+        self._lock = threading.Lock()
+        self._journal = None
+        self._lines = 0
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith(b'#'):
+                        continue
+                    start, end = line.split(b'-')
+                    self._add(int(start.strip()), int(end.strip()))
+                    self._lines += 1
+            self._maybe_compact()
+
+    def __len__(self):
+        return len(self._starts)
+
+    def _add(self, start, end):
+        starts, ends = self._starts, self._ends
+        # merge with all the ranges that overlap or are adjacent
+        lo = bisect.bisect_left(ends, start - 1)
+        hi = bisect.bisect_right(starts, end + 1)
+        if lo < hi:
+            start = min(start, starts[lo])
+            end = max(end, ends[hi - 1])
+        starts[lo:hi] = [start]
+        ends[lo:hi] = [end]
+
+    def _maybe_compact(self):
+        if self._lines <= 2 * len(self._starts) + 16:
+            return
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            for start, end in zip(self._starts, self._ends):
+                f.write(b'%d - %d\n' % (start, end))
+        os.rename(tmpname, self.filename)
+        self._lines = len(self._starts)
+
+    def add(self, start, end):
+        """Record that the bytes from start to end (inclusive) are present."""
+        assert start <= end
+        with self._lock:
+            self._add(start, end)
+            if self._journal is None:
+                self._journal = open(self.filename, 'ab')
+            self._journal.write(b'%d - %d\n' % (start, end))
+            self._journal.flush()
+            self._lines += 1
+
+    def find(self, offs):
+        """Return the end of the range containing offs, or None."""
+        with self._lock:
+            i = bisect.bisect_right(self._starts, offs) - 1
+            if i >= 0 and self._ends[i] >= offs:
+                return self._ends[i]
+            return None
+
+    def next_start(self, offs):
+        """Return the start of the first range beginning after offs,
+        or None."""
+        with self._lock:
+            i = bisect.bisect_right(self._starts, offs)
+            if i < len(self._starts):
+                return self._starts[i]
+            return None
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self._maybe_compact()
+
+
 class S3CacheReader:
-    # TODO: this class is not concurrency safe
     # TODO: this class sort of relies on sparse files (at least for efficiency)
+    # Note: only read_at() may be used concurrently by multiple threads
     def __init__(self, reader, cachedir, blksize):
         self.reader = reader
         self.name = reader.name
@@ -138,121 +312,92 @@ class S3CacheReader:
         self.fn_data = os.path.join(cachedir, self.name + '.data')
         self.offs = 0
         self.blksize = blksize
+        # protects f_data's file position and the underlying reader
+        self._lock = threading.Lock()
 
         if not os.path.exists(self.fn_rngs):
             # unlink data if present, we don't know how valid it is
             # without having the validity ranges
             if os.path.exists(self.fn_data):
                 os.unlink(self.fn_data)
-            self.f_data = None
-            self.ranges = []
+            self.f_data = open(self.fn_data, 'w+b')
         else:
-            f_rngs = open(self.fn_rngs, 'r+b')
             self.f_data = open(self.fn_data, 'r+b')
-            ranges = []
-            for line in f_rngs.readlines():
-                line = line.strip()
-                if not line or line.startswith(b'#'):
-                    continue
-                start, end = line.split(b'-')
-                start = int(start.strip())
-                end = int(end.strip())
-                ranges.append((start, end))
-            self.ranges = ranges
-            # some things we do rely on ordering
-            self.ranges.sort()
-
-            f_rngs.close()
-
-    def _compress_ranges(self):
-        ranges = []
-        if not self.ranges:
-            return
-        self.ranges.sort()
-        new_start, new_end = None, None
-        for start, end in self.ranges:
-            if new_start is None:
-                new_start, new_end = start, end
-                continue
-            if new_end + 1 == start:
-                new_end = end
-                continue
-            ranges.append((new_start, new_end))
-            new_start, new_end = start, end
-        if new_start is not None:
-            ranges.append((new_start, new_end))
-        self.ranges = ranges
+        self.ranges = CacheRanges(self.fn_rngs)
 
     def _write_data(self, offset, data):
         assert len(data) > 0
-
-        if self.f_data is None:
-            self.f_data = open(self.fn_data, 'w+b')
-        self.f_data.seek(offset)
-        self.f_data.write(data)
-
-        # update ranges file
-        sz = len(data)
-        self.ranges.append((offset, offset + sz - 1))
-        self._compress_ranges()
-        f_rngs = open(self.fn_rngs, 'w+b')
-        f_rngs.write(b'\n'.join((b'%d - %d' % i for i in self.ranges)))
-        f_rngs.write(b'\n')
-        f_rngs.close()
+        with self._lock:
+            self.f_data.seek(offset)
+            self.f_data.write(data)
+            # make sure the data is there before claiming it is
+            self.f_data.flush()
+        self.ranges.add(offset, offset + len(data) - 1)
+
+    def _download(self, offs, toread):
+        with self._lock:
+            self.reader.seek(offs)
+            return self.reader.read(toread)
 
     def read(self, sz=None, szhint=None):
+        ret = self.read_at(self.offs, sz, szhint)
+        self.offs += len(ret)
+        return ret
+
+    def read_at(self, offs, sz=None, szhint=None):
+        """Like seek(offs) followed by read(sz, szhint), but without
+        using or changing the current position, so that threads can
+        share the reader."""
         data = []
-        beginoffs = self.offs
-        if szhint is None:
-            szhint = sz
-        if szhint > self.size - self.offs:
-            szhint = self.size - self.offs
+        beginoffs = offs
         if sz is None:
-            sz = self.size - self.offs
+            sz = self.size - offs
+        if szhint is None or szhint < sz:
+            szhint = sz
+        if szhint > self.size - offs:
+            szhint = self.size - offs
         origsz = sz
         while sz:
             # find a range that overlaps the start of the needed data (if any)
-            gotcached = False
-            for start, end in self.ranges:
-                if start <= self.offs and self.offs <= end:
-                    self.f_data.seek(self.offs)
-                    rsz = sz
-                    avail = end - self.offs + 1
-                    if rsz > avail:
-                        rsz = avail
+            end = self.ranges.find(offs)
+            if end is not None:
+                rsz = min(sz, end - offs + 1)
+                with self._lock:
+                    self.f_data.seek(offs)
                     rdata = self.f_data.read(rsz)
-                    assert len(rdata) == rsz
-                    data.append(rdata)
-                    sz -= rsz
-                    self.offs += rsz
-                    gotcached = True
-                    break
-            if gotcached:
+                assert len(rdata) == rsz
+                data.append(rdata)
+                sz -= rsz
+                offs += rsz
                 continue
 
-            # read up to szhint from original offset
-            offs = self.offs
             # round the offset down to a download block
             blksize = self.blksize
-            offs = blksize * (offs // blksize)
+            dloffs = blksize * (offs // blksize)
+            # but don't download the end of a cached range again
+            end = self.ranges.find(dloffs)
+            if end is not None:
+                if end >= offs:
+                    # another thread just cached it, start over
+                    continue
+                dloffs = end + 1
             # calculate how much was requested (including hint)
-            toread = szhint - (offs - beginoffs)
+            toread = szhint - (dloffs - beginoffs)
             # and round that up to the next blksize too (subject to EOF limit)
             toread = blksize * ((toread + blksize - 1) // blksize)
-            if offs + toread > self.size:
-                toread = self.size - offs
+            if dloffs + toread > self.size:
+                toread = self.size - dloffs
             # and download what we calculated, unless we find overlap
-            for start, end in self.ranges:
-                if offs <= start and start < offs + toread:
-                    toread = start - offs
-                    break
-            # grab it from the reader
-            self.reader.seek(offs)
-            rdata = self.reader.read(toread)
+            nxt = self.ranges.next_start(dloffs)
+            if nxt is not None and nxt < dloffs + toread:
+                toread = nxt - dloffs
+            if toread <= 0:
+                continue
+            rdata = self._download(dloffs, toread)
             assert len(rdata) == toread
             # and store it in the cache - next loop iteration will find it
             # (this avoids having to worry about szhint specifically here)
-            self._write_data(offs, rdata)
+            self._write_data(dloffs, rdata)
 
         ret = b''.join(data)
         assert len(ret) == origsz
@@ -263,8 +408,8 @@ class S3CacheReader:
         self.offs = offs
 
     def close(self):
-        if self.f_data is not None:
-            self.f_data.close()
+        self.ranges.close()
+        self.f_data.close()
         self.reader.close()
 
 def _check_exc(e, *codes):
@@ -331,8 +476,8 @@ class S3Writer:
         self.size = 0
         self.kind = kind
         self.etags = []
+        self.jobs = []
         self.upload_id = None
-        self.upload_thread = None
         self.chunk_size = storage.chunk_size
         item = {
             'filename': {
@@ -355,24 +500,21 @@ class S3Writer:
         # assign this late, so we don't accidentally delete
         # the item again while from __del__.
         self.storage = storage
-        self.upload_thread = UploadThread(self._bg_upload)
-        self.upload_thread.start()
 
     def __del__(self):
-        self._end_thread()
         if self.storage:
             self.abort()
 
-    def _bg_upload(self, buf):
-        ret = self.storage.s3.upload_part(
+    def _bg_upload(self, storage, part, buf):
+        ret = storage.s3.upload_part(
             Body=buf,
-            Bucket=self.storage.bucket,
+            Bucket=storage.bucket,
             ContentLength=len(buf),
             Key=self.objname,
             UploadId=self.upload_id,
-            PartNumber=len(self.etags) + 1,
+            PartNumber=part,
         )
-        self.etags.append(ret['ETag'])
+        return ret['ETag']
 
     def _start_upload(self):
         if self.upload_id is not None:
@@ -387,9 +529,27 @@ class S3Writer:
 
     def _upload_buf(self):
         self._start_upload()
-        self.buf.finish()
-        self.upload_thread.put(self.buf)
-        self.buf = UploadFile()
+        # report failures of earlier parts as soon as possible
+        while self.jobs and self.jobs[0].done.is_set():
+            self.jobs[0].wait()
+            self.etags.append(self.jobs.pop(0).result)
+        buf, self.buf = self.buf, UploadFile()
+        buf.finish()
+        part = len(self.etags) + len(self.jobs) + 1
+        storage = self.storage
+        self.jobs.append(storage.upload_pool.submit(
+            lambda: self._bg_upload(storage, part, buf), len(buf)))
+
+    def _wait_uploads(self):
+        jobs, self.jobs = self.jobs, []
+        exc = None
+        for job in jobs:
+            try:
+                self.etags.append(job.wait())
+            except Exception as ex:
+                exc = exc or ex
+        if exc:
+            raise exc
 
     def write(self, data):
         sz = len(data)
@@ -408,17 +568,11 @@ class S3Writer:
         self.buf.write(data)
         self.size += sz
 
-    def _end_thread(self):
-        if self.upload_thread:
-            self.upload_thread.finish()
-            self.upload_thread = None
-
     def close(self):
         if self.storage is None:
-            self._end_thread()
             return
         self._upload_buf()
-        self._end_thread()
+        self._wait_uploads()
         storage = self.storage
         storage.s3.complete_multipart_upload(
             Bucket=storage.bucket,
@@ -446,13 +600,17 @@ class S3Writer:
             },
         }
         storage.dynamo.put_item(Item=item, TableName=storage.table)
+        storage.listing.bump()
         self.storage = None
         self.etags = None
 
     def abort(self):
         storage = self.storage
         self.storage = None
-        self._end_thread()
+        try:
+            self._wait_uploads()
+        except Exception:
+            pass # we're aborting anyway
         if self.upload_id is not None:
             storage.s3.abort_multipart_upload(Bucket=storage.bucket,
                                               Key=self.objname,
@@ -562,12 +720,14 @@ class DynamoWriter:
             except BotoClientError as e:
                 _check_exc(e, 'ConditionalCheckFailedException')
                 raise Exception("Failed to create '%s', it was created by someone else." % self.name)
+            storage.listing.bump()
 
     def abort(self):
         self.data = None
 
 class AWSStorage(BupStorage):
     def __init__(self, repo, create=False):
+        self.upload_pool = None
         if boto3 is None:
             raise Exception("AWSStorage: missing boto3 module")
 
@@ -611,6 +771,24 @@ class AWSStorage(BupStorage):
         if self.chunk_size < MIN_AWS_CHUNK_SIZE:
             raise Exception('chunkSize must be >= 5 MiB')
 
+        concurrency = repo.config(b'bup.aws.uploadConcurrency', opttype='int')
+        if concurrency is None:
+            concurrency = 1
+        if concurrency < 1:
+            raise Exception('uploadConcurrency must be at least 1')
+        upload_mem = repo.config(b'bup.aws.uploadMemoryLimit', opttype='int')
+        if upload_mem is None:
+            upload_mem = concurrency * self.chunk_size
+        if upload_mem < self.chunk_size:
+            raise Exception('uploadMemoryLimit must be >= chunkSize')
+        self.upload_pool = WorkerPool(concurrency, upload_mem)
+
+        listcache = repo.config(b'bup.aws.cacheListing', opttype='bool')
+        if listcache is None:
+            listcache = True
+        self.listing = DynamoListing(self.dynamo, self.table,
+                                     listcache and self.cachedir or None)
+
         self.down_blksize = repo.config(b'bup.aws.downloadBlockSize', opttype='int')
         if self.down_blksize is None:
             self.down_blksize = 8 * 1024
@@ -699,19 +877,11 @@ class AWSStorage(BupStorage):
         return S3CacheReader(reader, self.cachedir, self.down_blksize)
 
     def list(self, pattern=None):
-        # TODO: filter this somehow based on the pattern?
-        # TODO: implement pagination!
-        response = self.dynamo.scan(TableName=self.table,
-                                    Select='SPECIFIC_ATTRIBUTES',
-                                    AttributesToGet=['filename', 'tentative'],
-                                    ConsistentRead=True)
-        assert not 'LastEvaluatedKey' in response
-        for item in response['Items']:
-            if 'tentative' in item:
-                continue
-            name = item['filename']['S'].encode('ascii')
-            if fnmatch.fnmatch(name, pattern):
-                yield name
+        if pattern is not None:
+            pattern = pattern.decode('utf-8')
+        for name in self.listing.list(pattern):
+            yield name.encode('utf-8')
 
     def close(self):
-        pass
+        if self.upload_pool is not None:
+            self.upload_pool.close()
@@ -34,6 +34,19 @@ def test_bloom():
                     if b.exists(h):
                         false_positives += 1
                 WVPASSLT(false_positives, 5)
+                others = [os.urandom(20) for i in range(1000)]
+                bitmap, count = b.exists_bitmap(b''.join(hashes + others))
+                WVPASSEQ(len(bitmap), (len(hashes) + len(others) + 7) // 8)
+                WVPASS(all(bloom.bitmap_get(bitmap, i)
+                           for i in range(len(hashes))))
+                found = [i for i in range(len(hashes) + len(others))
+                         if bloom.bitmap_get(bitmap, i)]
+                WVPASSEQ(count, len(found))
+                WVPASSEQ(found, [i for i, h in enumerate(hashes + others)
+                                 if b.exists(h)])
+                WVPASSEQ(b.exists_many(hashes[:3]), [True] * 3)
+                WVPASSEQ(b.exists_bitmap(b''), (b'', 0))
+                WVEXCEPT(ValueError, b.exists_bitmap, b'short')
                 os.unlink(tmpdir + b'/pybuptest.bloom')
 
             tf = tempfile.TemporaryFile(dir=tmpdir)
@@ -59,3 +72,32 @@ def test_bloom():
                     raise
             if not skip_test:
                 WVPASSEQ(b.k, 4)
+
+
+@wvtest
+def test_memory_bloom():
+    with no_lingering_errors():
+        hashes = [os.urandom(20) for i in range(1000)]
+        b = bloom.create_in_memory(len(hashes))
+        WVPASSEQ(b.k, 5)
+        WVPASSEQ(len(b.data), 16 + 2**b.bits)
+        b.add(b''.join(hashes))
+        WVPASSEQ(len(b), 1000)
+        # Round trip it, as if it were sent over the network
+        b = bloom.MemoryBloom(bytes(b.data))
+        WVPASSEQ(len(b), 1000)
+        WVPASS(all(b.exists(h) for h in hashes))
+        false_positives = sum(1 for i in range(1000)
+                              if b.exists(os.urandom(20)))
+        WVPASSLT(false_positives, 50)
+        bitmap, count = b.exists_bitmap(b''.join(hashes))
+        WVPASSEQ(count, len(hashes))
+        WVPASSEQ(bitmap, b'\xff' * (len(hashes) // 8))
+        WVEXCEPT(Exception, bloom.MemoryBloom, b'BLOM' + bytes(b.data[4:-1]))
+        WVEXCEPT(Exception, bloom.MemoryBloom, b'MOLB' + bytes(b.data[4:]))
+        WVPASSEQ(len(bloom.create_in_memory(0).data), 16 + 2**10)
+        WVPASSEQ(len(bloom.create_in_memory(2**25).data),
+                 16 + 2**bloom.MEMORY_MAX_BITS)
+        WVPASSEQ(bloom.create_in_memory(2**25 + 1), None)
+        WVPASS(b.has_room(0))
+        WVFAIL(b.has_room(2**b.bits))
@@ -1,12 +1,14 @@
 
 from __future__ import absolute_import
-import sys, os, stat, time, random, subprocess, glob
+from binascii import hexlify, unhexlify
+import sys, os, stat, time, random, subprocess, glob, zlib
 
 from wvtest import *
 
-from bup import client, git, path
+from bup import bloom, client, git, midx, path
 from bup.compat import bytes_from_uint, environ, range
 from bup.helpers import mkdirp
+from bup.repo import LocalRepo, RemoteRepo
 from buptest import no_lingering_errors, test_tempdir
 
 
@@ -58,7 +60,9 @@ def test_multiple_suggestions():
             lw.close()
             WVPASSEQ(len(glob.glob(git.repo(b'objects/pack'+IDX_PAT))), 2)
 
-            c = client.Client(bupdir, create=True)
+            # Suggestions are only sent for objects the client writes
+            # unconditionally, i.e. without asking the server first.
+            c = client.Client(bupdir, create=True, server_bloom=False)
             WVPASSEQ(len(glob.glob(c.cachedir+IDX_PAT)), 0)
             rw = c.new_packwriter()
             s1sha = rw.new_blob(s1)
@@ -100,6 +104,232 @@ def test_dumb_client_server():
             WVPASSEQ(len(glob.glob(c.cachedir+IDX_PAT)), 2)
 
 
+@wvtest
+def test_cat_stream():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tclient-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            lw = git.PackWriter()
+            blobs = [randbytes(random.randrange(0, 3000)) for i in range(50)]
+            oids = [lw.new_blob(blob) for blob in blobs]
+            lw.close()
+
+            c = client.Client(bupdir, create=True)
+            WVPASS(c.has_cat_stream())
+            missing = b'0' * 40
+            refs = [hexlify(oid) for oid in oids]
+            refs.insert(7, missing)
+            # A window smaller than the number of refs, so that the
+            # refs are sent while the answers are read.
+            result = []
+            for oidx, typ, size, it in c.cat_stream(refs, window=4):
+                if oidx:
+                    result.append((oidx, typ, size, b''.join(it)))
+                else:
+                    result.append(None)
+            WVPASSEQ(result[7], None)
+            del result[7]
+            WVPASSEQ(result, [(hexlify(oid), b'blob', len(blob), blob)
+                              for oid, blob in zip(oids, blobs)])
+
+            # The refs are only taken as needed, so a generator can stop
+            # early, and the client can be used again afterward.
+            def first_three():
+                for ref in refs[:3]:
+                    yield ref
+            WVPASSEQ([b''.join(it) for _, _, _, it
+                      in c.cat_stream(first_three(), window=2)],
+                     blobs[:3])
+            WVPASSEQ(list(c.cat_stream([])), [])
+            WVPASSEQ(b''.join(c.join(refs[0])), blobs[0])
+            c.close()
+
+            repo = RemoteRepo(bupdir)
+            repo.prefetch(oids[:10])
+            # Nothing else may talk to the server now.
+            conn, repo.client.conn = repo.client.conn, None
+            for oid, blob in zip(oids[:10], blobs[:10]):
+                for i in range(2):
+                    it = repo.cat(hexlify(oid))
+                    WVPASSEQ(next(it), (hexlify(oid), b'blob', len(blob)))
+                    WVPASSEQ(b''.join(it), blob)
+            repo.client.conn = conn
+            it = repo.cat(hexlify(oids[10]))
+            next(it)
+            WVPASSEQ(b''.join(it), blobs[10])
+            repo.close()
+
+
+@wvtest
+def test_wire_compression():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tclient-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            lw = git.PackWriter()
+            # one incompressible, and one very compressible blob
+            blobs = [s1, b'x' * 100000]
+            oids = [lw.new_blob(blob) for blob in blobs]
+            tree = lw.new_tree([(0o100644, b'a', oids[0]),
+                                (0o100644, b'b', oids[1])])
+            lw.close()
+            # and a loose object, which isn't stored in a pack
+            p = subprocess.Popen([b'git', b'hash-object', b'-w', b'--stdin'],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 env=git._gitenv(bupdir))
+            loose_oidx = p.communicate(s2)[0].strip()
+            WVPASSEQ(p.returncode, 0)
+
+            repo = LocalRepo(bupdir)
+            obj_t, size, zdata = repo.stored_object(oids[1])
+            WVPASSEQ((obj_t, size), (b'blob', len(blobs[1])))
+            WVPASSEQ(zlib.decompress(zdata), blobs[1])
+            WVPASSEQ(repo.stored_object(unhexlify(loose_oidx)), None)
+            WVPASSEQ(repo.stored_object(b'\0' * 20), None)
+            repo.close()
+
+            for level in (0, 6):
+                c = client.Client(bupdir, wire_compression=level)
+                WVPASSEQ(c._wire_compression, level or None)
+                refs = [hexlify(oid) for oid in oids]
+                refs += [loose_oidx, b'0' * 40, hexlify(tree)]
+                for cat in (c.cat_batch, c.cat_stream):
+                    result = [(oidx, typ, size, it and b''.join(it))
+                              for oidx, typ, size, it in cat(refs)]
+                    WVPASSEQ(result[:4],
+                             [(refs[0], b'blob', len(s1), s1),
+                              (refs[1], b'blob', len(blobs[1]), blobs[1]),
+                              (loose_oidx, b'blob', len(s2), s2),
+                              (None, None, None, None)])
+                    WVPASSEQ(result[4][:2], (hexlify(tree), b'tree'))
+                WVPASSEQ(b''.join(c.join(refs[1])), blobs[1])
+                WVPASSEQ(b''.join(c.join(hexlify(tree))), s1 + blobs[1])
+                WVPASSEQ(list(c.refs()), [])
+                idxs = list(c.list_indexes())
+                WVPASSEQ(len(idxs), 1)
+                sent = []
+                with open(git.repo(b'objects/pack/' + idxs[0]), 'rb') as f:
+                    idx_data = f.read()
+                class Out:
+                    def write(self, data):
+                        sent.append(data)
+                c.send_index(idxs[0], Out(), lambda size: None)
+                WVPASSEQ(b''.join(sent), idx_data)
+                c.close()
+
+
+@wvtest
+def test_stored_object_lookup():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tclient-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            blobs = [b'x' * 10000, b'y' * 10000]
+            lw = git.PackWriter()
+            oids = [lw.new_blob(blobs[0])]
+            lw.close()
+            repo = LocalRepo(bupdir)
+            WVPASS(repo.stored_object(oids[0]))
+            # A pack written afterward (and a midx covering both)
+            p = subprocess.Popen([path.exe(), b'split', b'-b'],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            split_oids = p.communicate(blobs[1])[0].split()
+            WVPASSEQ(p.returncode, 0)
+            WVPASSEQ(split_oids, [hexlify(git.calc_hash(b'blob', blobs[1]))])
+            oids.append(unhexlify(split_oids[0]))
+            WVPASSEQ(subprocess.call([path.exe(), b'midx', b'-f']), 0)
+            # Each idx is only opened once.
+            opened = []
+            open_idx = git.open_idx
+            def counting_open_idx(name):
+                opened.append(name)
+                return open_idx(name)
+            git.open_idx = counting_open_idx
+            try:
+                for i in (1, 0, 1, 0):
+                    obj_t, size, zdata = repo.stored_object(oids[i])
+                    WVPASS(zlib.decompress(zdata) == blobs[i])
+            finally:
+                git.open_idx = open_idx
+            # The first pack's idx was already open
+            WVPASSEQ(len([x for x in opened if x.endswith(b'.idx')]), 1)
+            WVPASS(any(isinstance(ix, midx.PackMidx)
+                       for ix in repo._stored_idxlist.packs))
+            repo.close()
+
+
+@wvtest
+def test_server_bloom():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tclient-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            lw = git.PackWriter()
+            lw.new_blob(s1)
+            lw.new_blob(s2)
+            lw.close()
+
+            # Without the bloom filter, the duplicate is uploaded, and
+            # the server suggests the index, which is then downloaded.
+            c = client.Client(bupdir, server_bloom=False)
+            rw = c.new_packwriter()
+            rw.new_blob(s1)
+            rw.new_blob(s3)
+            rw.close()
+            WVPASSEQ(rw.skipped, 0)
+            WVPASSEQ(len(glob.glob(c.cachedir + IDX_PAT)), 2)
+            c.close()
+
+            # The cache covers the server, so the filter isn't fetched.
+            c = client.Client(bupdir)
+            WVPASSEQ(c._get_bloom(), None)
+            c.close()
+            WVPASS(not os.path.exists(git.repo(b'server.bloom')))
+            for idx in glob.glob(c.cachedir + IDX_PAT):
+                os.unlink(idx)
+
+            c = client.Client(bupdir)
+            WVPASSEQ(len(c._get_bloom()), 3)
+            WVPASS(os.path.exists(git.repo(b'server.bloom')))
+            rw = c.new_packwriter()
+            s4 = randbytes(10000)
+            rw.new_blob(s2)
+            rw.new_blob(s4)
+            rw.new_blob(s1)
+            rw.close()
+            # Only s4 was sent, and no existing index was needed.
+            WVPASSEQ(rw.skipped, 2)
+            WVPASSEQ(rw.count, 1)
+            WVPASSEQ(len(glob.glob(c.cachedir + IDX_PAT)), 1)
+            WVPASSEQ(c._exists([git.calc_hash(b'blob', x)
+                                for x in (s1, s4, b'nope')]),
+                     [True, True, False])
+            c.close()
+            sizes = [len(git.open_idx(x))
+                     for x in glob.glob(git.repo(b'objects/pack' + IDX_PAT))]
+            WVPASSEQ(sorted(sizes), [1, 1, 2])
+
+            # The saved filter is updated with the new index.
+            repo = LocalRepo(bupdir)
+            b = repo.make_bloom()
+            WVPASSEQ(len(b), 4)
+            WVPASS(b.exists(git.calc_hash(b'blob', s4)))
+            WVPASSEQ(sorted(bloom.read_memory_bloom(git.repo(b'server.bloom'))[1]),
+                     sorted(os.path.basename(x) for x in
+                            glob.glob(git.repo(b'objects/pack' + IDX_PAT))))
+            WVPASSEQ(len(repo.make_bloom()), 4)
+            # Too many objects for the size limit
+            max_bits = bloom.MEMORY_MAX_BITS
+            try:
+                bloom.MEMORY_MAX_BITS = 0
+                os.unlink(git.repo(b'server.bloom'))
+                WVPASSEQ(repo.make_bloom(), None)
+            finally:
+                bloom.MEMORY_MAX_BITS = max_bits
+            repo.close()
+
+
 @wvtest
 def test_midx_refreshing():
     with no_lingering_errors():
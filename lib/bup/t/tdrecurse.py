@@ -0,0 +1,34 @@
+from __future__ import absolute_import, print_function
+import os
+
+from wvtest import *
+
+from bup import journal
+from bup.drecurse import DirtyWalk
+from buptest import no_lingering_errors, test_tempdir
+
+
+@wvtest
+def test_dirty_walk():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tdrecurse-') as tmpdir:
+            top = tmpdir + b'/'
+            os.makedirs(top + b'a/b')
+            os.makedirs(top + b'keep')
+            open(top + b'a/b/1', 'wb').close()
+            open(top + b'keep/2', 'wb').close()
+            # gone/f/ (and gone/) were deleted, but (e.g. because
+            # the watcher couldn't resolve the path of gone/) only the
+            # change to gone/f/ was recorded.
+            records = set([(journal.DIR, top + b'a/b/'),
+                           (journal.DIR, top + b'gone/f/')])
+            walk = DirtyWalk(top, records, xdev=False)
+            wvpasseq([top + b'a/b/1', top + b'a/b/', top + b'a/', top],
+                     [path for path, st in walk])
+            wvpass(walk.covers(top + b'a/b/1'))
+            wvpass(walk.covers(top + b'gone/f/5'))
+            wvpass(walk.covers(top + b'gone/f/'))
+            wvpass(walk.covers(top + b'gone/'))
+            wvfail(walk.covers(top + b'keep/'))
+            wvfail(walk.covers(top + b'keep/2'))
+            wvfail(walk.covers(top + b'a/3'))
@@ -16,6 +16,7 @@ except ImportError:
 
 from buptest import no_lingering_errors, test_tempdir
 from bup import storage, git
+from bup.helpers import WorkerPool
 from bup.storage import Kind
 from bup.repo import ConfigRepo, encrypted
 
@@ -33,22 +34,22 @@ def create_test_config():
         class DummyRepo(ConfigRepo):
             def finish_writing(self):
                 pass
-        yield tmpdir, storage.get_storage(DummyRepo(cfg_file=cfgfile),
-                                          create=True)
+        repo = DummyRepo(cfg_file=cfgfile)
+        yield tmpdir, repo, storage.get_storage(repo, create=True)
 
 @wvtest
 def test_encrypted_container():
-    with no_lingering_errors(), create_test_config() as (tmpdir, store):
+    with no_lingering_errors(), create_test_config() as (tmpdir, repo, store):
         secret = libnacl.public.SecretKey()
 
-        p = encrypted.EncryptedContainer(store, b'test.pack', 'w', Kind.DATA,
+        p = encrypted.EncryptedContainer(repo, store, b'test.pack', 'w', Kind.DATA,
                                          compression=9, key=secret.pk)
         p.finish()
         pfile = open(os.path.join(tmpdir, b'repo', b'test.pack'), 'rb')
         # minimum file size with header and footer
         wvpasseq(len(pfile.read()), 92)
 
-        p = encrypted.EncryptedContainer(store, b'test2.pack', 'w', Kind.DATA,
+        p = encrypted.EncryptedContainer(repo, store, b'test2.pack', 'w', Kind.DATA,
                                          compression=9, key=secret.pk)
         offsets = {}
         offsets[b'A'] = p.write(3, None, b'A'* 1000)
@@ -73,7 +74,7 @@ def test_encrypted_container():
         wvpasseq(sk, eh[4:])
 
         # read the objects and check if they're fine
-        p = encrypted.EncryptedContainer(store, b'test2.pack', 'r', Kind.DATA,
+        p = encrypted.EncryptedContainer(repo, store, b'test2.pack', 'r', Kind.DATA,
                                          key=secret)
         for k in sorted(offsets.keys()):
             wvpasseq(p.read(offsets[k]), (3, k * (1000 // len(k))))
@@ -82,9 +83,102 @@ def test_encrypted_container():
         # this does some extra checks - do it explicitly
         store.close()
 
+@wvtest
+def test_encrypted_container_nonce_reuse():
+    with no_lingering_errors(), create_test_config() as (tmpdir, repo, store):
+        secret = libnacl.public.SecretKey()
+        p = encrypted.EncryptedContainer(repo, store, b'test.pack', 'w',
+                                         Kind.DATA, compression=1,
+                                         key=secret.pk)
+        offs = p.write(3, None, b'data')
+        for kind in (encrypted.NONCE_DATA, encrypted.NONCE_LEN):
+            wvexcept(AssertionError, p.nonce, kind, offset=offs)
+            wvexcept(AssertionError, p.nonce, kind, offset=offs - 1)
+            wvpass(p.nonce(kind, offset=offs, write=False))
+        wvpass(p.write(3, None, b'more') > offs)
+        wvexcept(AssertionError, p.nonce, encrypted.NONCE_DATA, offset=offs)
+        p.abort()
+        store.close()
+
+@wvtest
+def test_encrypted_container_read_many():
+    with no_lingering_errors(), create_test_config() as (tmpdir, repo, store):
+        secret = libnacl.public.SecretKey()
+        p = encrypted.EncryptedContainer(repo, store, b'test.pack', 'w',
+                                         Kind.DATA, compression=1,
+                                         key=secret.pk)
+        objs = [os.urandom(n) for n in (1, 100, 200, 5000, 30, 100000, 7)]
+        offsets = [p.write(3, None, obj) for obj in objs]
+        end = p.offset
+        p.finish()
+
+        extents = list(zip(offsets, offsets[1:] + [end]))
+        p = encrypted.EncryptedContainer(repo, store, b'test.pack', 'r',
+                                         Kind.DATA, key=secret)
+        wvpasseq(list(p.read_many(extents)),
+                 [(o, 3, obj) for o, obj in zip(offsets, objs)])
+        wvpasseq(list(p.read_many(extents[1::2])),
+                 [(o, 3, obj) for o, obj in zip(offsets[1::2], objs[1::2])])
+        wvpasseq(list(p.read_many([])), [])
+
+        # split into multiple reads (all but the 100k object fit a span)
+        reads = []
+        orig_read = p.file.read
+        def read(sz=None, szhint=None):
+            reads.append(sz)
+            return orig_read(sz, szhint)
+        p.file.read = read
+        orig_span = encrypted.READ_MAX_SPAN
+        try:
+            encrypted.READ_MAX_SPAN = 10000
+            wvpasseq(list(p.read_many(extents)),
+                     [(o, 3, obj) for o, obj in zip(offsets, objs)])
+        finally:
+            encrypted.READ_MAX_SPAN = orig_span
+        wvpasseq(len(reads), 3)
+        wvpasseq(sum(reads), end - offsets[0])
+        for o, obj in zip(offsets, objs):
+            wvpasseq(p.read(o), (3, obj))
+        p.close()
+        store.close()
+
+@wvtest
+def test_encrypted_container_pool():
+    with no_lingering_errors(), create_test_config() as (tmpdir, repo, store):
+        secret = libnacl.public.SecretKey()
+        pool = WorkerPool(3, 100000)
+        idx = git.PackIdxV2Writer()
+        p = encrypted.EncryptedContainer(repo, store, b'test.pack', 'w',
+                                         Kind.DATA, compression=1,
+                                         key=secret.pk, idxwriter=idx,
+                                         pool=pool)
+        objs = [os.urandom(n) for n in range(0, 300000, 7919)]
+        shas = [git.calc_hash(b'blob', obj) for obj in objs]
+        for sha, obj in zip(shas, objs):
+            wvpasseq(p.write(3, sha, obj), None)
+        p.finish()
+        pool.close()
+        end = p.offset
+        wvpasseq(os.path.getsize(os.path.join(tmpdir, b'repo', b'test.pack')),
+                 end)
+
+        # the objects were appended in order, and are in the idx
+        entries = {}
+        for bucket in idx.idx:
+            for sha, crc, offs in bucket:
+                entries[sha] = offs
+        offsets = [entries[sha] for sha in shas]
+        wvpass(offsets == sorted(offsets))
+        p = encrypted.EncryptedContainer(repo, store, b'test.pack', 'r',
+                                         Kind.DATA, key=secret)
+        for sha, obj in zip(shas, objs):
+            wvpasseq(p.read(entries[sha]), (3, obj))
+        p.close()
+        store.close()
+
 @wvtest
 def test_basic_encrypted_repo():
-    with no_lingering_errors(), create_test_config() as (tmpdir, store):
+    with no_lingering_errors(), create_test_config() as (tmpdir, repo, store):
         src = os.path.join(tmpdir, b'src')
         os.mkdir(src)
 
@@ -164,6 +164,33 @@ def testpacks():
             WVFAIL(r.exists(b'\0'*20))
 
 
+@wvtest
+def test_write_prepared():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            blobs = [b'%d' % (i % 70) for i in range(100)]
+
+            w = git.PackWriter()
+            hashes = [w.new_blob(b) for b in blobs]
+            plain = w.close()
+
+            # separate repo so nothing is deduplicated against the above
+            git.init_repo(tmpdir + b'/bup2')
+            w = git.PackWriter(repo_dir=tmpdir + b'/bup2')
+            prepared = [git.prepare_object(b'blob', b) for b in blobs]
+            WVPASSEQ([p.oid for p in prepared], hashes)
+            WVPASSEQ([w.write_prepared(p) for p in prepared], hashes)
+            WVPASSEQ(w.count, 70)
+            from_prepared = w.close()
+
+            WVPASSEQ(os.path.basename(plain), os.path.basename(from_prepared))
+            with open(plain + b'.pack', 'rb') as f1, \
+                 open(from_prepared + b'.pack', 'rb') as f2:
+                WVPASSEQ(f1.read(), f2.read())
+
+
 @wvtest
 def test_pack_name_lookup():
     with no_lingering_errors():
@@ -191,6 +218,76 @@ def test_pack_name_lookup():
                              r.exists(hashes[i], want_source=True).pack)
 
 
+@wvtest
+def test_exists_many():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            git.verbose = 1
+            packdir = git.repo(b'objects/pack')
+
+            hashes = []
+            packs = []
+            for start in range(0, 300, 20):
+                w = git.PackWriter()
+                for i in range(start, start + 20):
+                    hashes.append(w.new_blob(b'%d' % i))
+                packs.append(w.close())
+            missing = [struct.pack('!I', i) + b'\xff' * 16
+                       for i in (0, 0x7fffffff, 0xffffffff)]
+            wanted = missing[:1] + hashes[::-1] + missing[1:] + hashes[:5]
+
+            ix = git.open_idx(packs[3] + b'.idx')
+            found = ix.exists_many(wanted, want_offs=True)
+            WVPASSEQ([f and f.offset for f in found],
+                     [ix.find_offset(h) for h in wanted])
+
+            # the same pack with a version 1 index
+            exc(b'git', b'index-pack', b'--index-version=1',
+                b'-o', tmpdir + b'/v1.idx', packs[3] + b'.pack')
+            ix1 = git.open_idx(tmpdir + b'/v1.idx')
+            WVPASS(isinstance(ix1, git.PackIdxV1))
+            WVPASSEQ([f and f.offset
+                      for f in ix1.exists_many(wanted, want_offs=True)],
+                     [ix.find_offset(h) for h in wanted])
+
+            r = git.PackIdxList(packdir)
+            WVPASS(len(r.packs) < len(packs))  # midx and bloom in use
+            WVPASSEQ(r.exists_many([]), [])
+            for kwargs in ({}, {'want_source': True}, {'want_offs': True},
+                           {'want_source': True, 'want_offs': True}):
+                single = [r.exists(h, **kwargs) for h in wanted]
+                batch = r.exists_many(wanted, **kwargs)
+                WVPASSEQ([bool(x) for x in batch], [bool(x) for x in single])
+                WVPASSEQ([x and (x.pack, x.offset) for x in batch],
+                         [x and (x.pack, x.offset) for x in single])
+            WVPASSEQ(r.exists_many(missing), [None] * len(missing))
+            r.add(missing[1])
+            WVPASSEQ(r.exists_many(missing), [None, True, None])
+            # also hashes with pack hashes, wanting the offsets
+            found = r.exists_many([missing[1], hashes[0], missing[2]],
+                                  want_offs=True)
+            WVPASSEQ(found[0], True)
+            WVPASSEQ(found[1].offset, r.exists(hashes[0], want_offs=True).offset)
+            WVPASSEQ(found[2], None)
+
+            # each hash is only counted as one search, as with exists()
+            del r
+            r = git.PackIdxList(packdir)
+            r.refresh(skip_midx=True)
+            r.bloom.close()
+            r.bloom = None
+            before = git._total_searches
+            r.exists_many(wanted)
+            WVPASSEQ(git._total_searches - before, len(wanted))
+            before = git._total_searches
+            for h in wanted:
+                r.exists(h)
+            WVPASSEQ(git._total_searches - before, len(wanted))
+            WVEXCEPT(ValueError, ix.exists_many, [b'short'])
+
+
 @wvtest
 def test_long_index():
     with no_lingering_errors():
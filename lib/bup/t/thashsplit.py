@@ -1,13 +1,13 @@
 
 from __future__ import absolute_import
 from io import BytesIO
-import math
+import hashlib, math
 from binascii import unhexlify
 import binascii
 
 from wvtest import *
 
-from bup import hashsplit, _helpers
+from bup import git, hashsplit, _helpers
 from bup.hashsplit import HashSplitter, RecordHashSplitter, BUP_BLOBBITS
 from buptest import no_lingering_errors, test_tempdir
 
@@ -237,3 +237,64 @@ def test_hashsplitter_object():
         data = b''.join([b'%.10x\n' % x for x in range(10000)])
         WVPASSEQ([x for x in _splitbuf(data)],
                  [x for x in _splitbufHS(data)])
+
+@wvtest
+def test_prepared_split():
+    with no_lingering_errors():
+        data = b''.join([b'%.10x\n' % x for x in range(100000)])
+        def blob_oid(blob):
+            return git.calc_hash(b'blob', blob)
+        def split(makeblob, **kwargs):
+            trees = []
+            def maketree(shalist):
+                trees.append(shalist)
+                return git.calc_hash(b'tree', git.tree_encode(shalist))
+            res = hashsplit.split_to_blob_or_tree(makeblob, maketree,
+                                                  [BytesIO(data)],
+                                                  keep_boundaries=False,
+                                                  **kwargs)
+            return res, trees
+        serial = split(blob_oid)
+        WVPASSEQ(serial[0][0], hashsplit.GIT_MODE_TREE)
+        for jobs in (1, 2, 5):
+            WVPASSEQ(split(list, prepare=blob_oid, jobs=jobs), serial)
+        res = hashsplit.split_to_blob_or_tree(list, None,
+                                              [BytesIO(b'')],
+                                              keep_boundaries=False,
+                                              prepare=blob_oid, jobs=3)
+        WVPASSEQ(res, (hashsplit.GIT_MODE_FILE, blob_oid(b'')))
+
+@wvtest
+def test_fastcdc():
+    with no_lingering_errors():
+        data = b''.join(hashlib.sha512(b'%d' % i).digest()
+                        for i in range(1 << 14))
+        def split(data, bits=BUP_BLOBBITS, fanbits=4):
+            mode = hashsplit.SPLITTERS[b'fastcdc']
+            return list(HashSplitter([BytesIO(data)], bits=bits,
+                                     fanbits=fanbits, mode=mode))
+        for bits in (13, 16):
+            blobs = split(data, bits)
+            WVPASSEQ(b''.join(blob for blob, level in blobs), data)
+            sizes = [len(blob) for blob, level in blobs]
+            WVPASS(min(sizes[:-1]) > 1 << (bits - 2))
+            WVPASS(max(sizes) <= 4 << bits)
+            avg = len(data) / len(blobs)
+            WVPASS((1 << bits) * 0.8 < avg < (1 << bits) * 1.6)
+            # the sizes are normalized, unlike with the rollsum
+            WVPASS(len([sz for sz in sizes if sz < 1 << (bits - 1)])
+                   < len(sizes) / 10)
+        # some chunks are on higher levels
+        levels = [level for blob, level in split(data)]
+        WVPASS(0 < len([l for l in levels if l]) < len(levels) / 4)
+        # changing the data only affects the chunks around the change
+        blobs = set(bytes(blob) for blob, level in split(data))
+        changed = split(data[:100000] + b'x' + data[100000:])
+        WVPASS(len([b for b, l in changed if bytes(b) not in blobs]) <= 3)
+        # the boundaries must not change with new versions
+        WVPASSEQ([len(blob) for blob, level in split(data)][:5],
+                 [3216, 9027, 14427, 8991, 9958])
+        WVEXCEPT(ValueError, HashSplitter, [BytesIO(data)], bits=13, mode=7)
+        # and the default is the rollsum
+        WVPASSEQ(list(hashsplit.hashsplit_iter([BytesIO(data)], False, None)),
+                 list(HashSplitter([BytesIO(data)], bits=BUP_BLOBBITS)))
@@ -1,7 +1,7 @@
 
 from __future__ import absolute_import
 from time import tzset
-import helpers, math, os, os.path, re, subprocess
+import helpers, math, os, os.path, re, subprocess, threading, time
 
 from wvtest import *
 
@@ -14,10 +14,11 @@ except ImportError:
 
 from bup.compat import bytes_from_byte, bytes_from_uint, environ
 from bup.helpers import (atomically_replaced_file, batchpipe, detect_fakeroot,
-                         grafted_path_components, mkdirp, parse_num,
+                         grafted_path_components, mkdirp, parallel_imap,
+                         parse_num,
                          path_components, readpipe, stripped_path_components,
                          shstr,
-                         utc_offset_str)
+                         utc_offset_str, WorkerPool)
 from buptest import no_lingering_errors, test_tempdir
 import bup._helpers as _helpers
 
@@ -265,6 +266,81 @@ def test_valid_save_name():
         WVFAIL(valid(b'.bar/baz'))
         WVFAIL(valid(b'foo/.bar/baz'))
 
+@wvtest
+def test_parallel_imap():
+    with no_lingering_errors():
+        sq = lambda x: x * x
+        for jobs in (1, 2, 7):
+            WVPASSEQ(list(parallel_imap(sq, range(100), jobs)),
+                     [x * x for x in range(100)])
+            WVPASSEQ(list(parallel_imap(sq, [], jobs)), [])
+        def fail_at_13(x):
+            if x == 13:
+                raise ValueError(x)
+            return x
+        seen = []
+        try:
+            for x in parallel_imap(fail_at_13, range(100), 4, window=2):
+                seen.append(x)
+        except ValueError as ex:
+            WVPASSEQ(ex.args, (13,))
+        WVPASSEQ(seen, list(range(13)))
+        def broken_iter():
+            for x in range(5):
+                yield x
+            raise KeyError('broken')
+        seen = []
+        try:
+            for x in parallel_imap(sq, broken_iter(), 3):
+                seen.append(x)
+        except KeyError as ex:
+            WVPASSEQ(ex.args, ('broken',))
+        WVPASSEQ(seen, [x * x for x in range(5)])
+        # abandoning the generator early must not hang
+        it = parallel_imap(sq, range(1000), 3, window=1)
+        WVPASSEQ(next(it), 0)
+        it.close()
+
+@wvtest
+def test_worker_pool():
+    with no_lingering_errors():
+        lock = threading.Lock()
+        running = [0, 0]
+        release = threading.Event()
+        def work(n):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            release.wait()
+            with lock:
+                running[0] -= 1
+            if n == 3:
+                raise Exception('job %d failed' % n)
+            return n
+
+        pool = WorkerPool(3, 100)
+        jobs = [pool.submit(lambda n=n: work(n), 40) for n in range(2)]
+        WVPASSEQ(pool._bytes, 80)
+        def submit_more():
+            jobs.extend(pool.submit(lambda n=n: work(n), 40)
+                        for n in range(2, 5))
+        t = threading.Thread(target=submit_more)
+        t.start()
+        time.sleep(0.1)
+        # the memory limit holds back the third job
+        WVPASSEQ(len(jobs), 2)
+        release.set()
+        t.join()
+        WVPASSEQ([job.wait() for job in jobs[:3]], [0, 1, 2])
+        WVEXCEPT(Exception, jobs[3].wait)
+        WVPASSEQ(jobs[4].wait(), 4)
+        WVPASS(running[1] <= 3)
+        WVPASSEQ(pool._bytes, 0)
+
+        # oversized jobs don't deadlock
+        WVPASSEQ(pool.submit(lambda: 42, 1000).wait(), 42)
+        pool.close()
+
 _echopath = os.path.join(os.path.dirname(__file__), 'echo.sh')
 
 if hypothesis:
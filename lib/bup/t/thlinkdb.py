@@ -0,0 +1,89 @@
+from __future__ import absolute_import, print_function
+import os, pickle
+
+from wvtest import *
+
+from bup.hlinkdb import HLinkDB
+from buptest import no_lingering_errors, test_tempdir
+
+
+def commit(db):
+    db.prepare_save()
+    db.commit_save()
+
+def node_paths(db, dev, ino):
+    try:
+        return sorted(db.node_paths(dev, ino))
+    except KeyError:
+        return None
+
+@wvtest
+def test_hlinkdb():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-thlinkdb-') as tmpdir:
+            name = tmpdir + b'/hlink'
+            db = HLinkDB(name)
+            db.add_path(b'/a/x', 1, 10)
+            db.add_path(b'/b/x', 1, 10)
+            db.add_path(b'/c', 2, 10)
+            db.add_path(b'/d', 2, 10)
+            wvpasseq([b'/a/x', b'/b/x'], node_paths(db, 1, 10))
+            commit(db)
+
+            db = HLinkDB(name)
+            wvpasseq([b'/a/x', b'/b/x'], node_paths(db, 1, 10))
+            wvpasseq([b'/c', b'/d'], node_paths(db, 2, 10))
+            wvpasseq(None, node_paths(db, 2, 11))
+            db.del_path(b'/a/x')
+            db.del_path(b'/nowhere')
+            db.change_path(b'/d', 3, 1)
+            db.add_path(b'/e', 3, 1)
+            db.add_path(b'/0', 0, 5)
+            db.add_path(b'/1', 0, 5)
+            wvpasseq([b'/b/x'], node_paths(db, 1, 10))
+            wvpasseq([b'/c'], node_paths(db, 2, 10))
+            commit(db)
+
+            db = HLinkDB(name)
+            wvpasseq([b'/0', b'/1'], node_paths(db, 0, 5))
+            wvpasseq([b'/b/x'], node_paths(db, 1, 10))
+            wvpasseq([b'/c'], node_paths(db, 2, 10))
+            wvpasseq([b'/d', b'/e'], node_paths(db, 3, 1))
+            # Nothing to do, and the file's left alone
+            st = os.stat(name)
+            commit(db)
+            wvpasseq(st.st_ino, os.stat(name).st_ino)
+
+            # Enough churn to rebuild the heap, and more than one
+            # path per node after that
+            for i in range(100):
+                db = HLinkDB(name)
+                db.del_path(b'/c')
+                db.add_path(b'/c', 2, 10 + i % 2)
+                commit(db)
+            wvpass(os.path.getsize(name) < 4096)
+            db = HLinkDB(name)
+            wvpasseq(None, node_paths(db, 2, 10))
+            wvpasseq([b'/c'], node_paths(db, 2, 11))
+            wvpasseq([b'/d', b'/e'], node_paths(db, 3, 1))
+            for path in (b'/0', b'/1', b'/b/x', b'/d', b'/e'):
+                db.del_path(path)
+            db.del_path(b'/c')
+            commit(db)
+            wvpass(not os.path.exists(name))
+
+@wvtest
+def test_hlinkdb_legacy():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-thlinkdb-') as tmpdir:
+            name = tmpdir + b'/hlink'
+            with open(name, 'wb') as f:
+                pickle.dump({'1:10': [b'/a', b'/b'], '2:3': [b'/c', b'/d']},
+                            f, 2)
+            db = HLinkDB(name)
+            wvpasseq([b'/a', b'/b'], node_paths(db, 1, 10))
+            db.del_path(b'/c')
+            commit(db)
+            db = HLinkDB(name)
+            wvpasseq([b'/a', b'/b'], node_paths(db, 1, 10))
+            wvpasseq([b'/d'], node_paths(db, 2, 3))
@@ -182,3 +182,100 @@ def index_dirty():
                 w3.close()
             finally:
                 os.chdir(orig_cwd)
+
+
+def _test_meta(path, mode):
+    os.chmod(path, mode)
+    meta = metadata.from_path(path)
+    meta.atime = meta.mtime = meta.ctime = 0
+    return meta
+
+@wvtest
+def index_metastore_idx():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tindex-') as tmpdir:
+            path = tmpdir + b'/f'
+            open(path, 'wb').close()
+            meta_name = tmpdir + b'/index.meta'
+            metas = [_test_meta(path, mode) for mode in (0o600, 0o640, 0o644)]
+
+            ms = index.MetaStoreWriter(meta_name)
+            ofs = [ms.store(m) for m in metas]
+            WVPASSEQ(ofs[0], 0)
+            WVPASSEQ(ms.store(metas[0]), 0)
+            WVPASSEQ(len(set(ofs)), 3)
+            ms.close()
+            WVPASS(os.path.exists(meta_name + b'.idx'))
+            size = os.path.getsize(meta_name)
+
+            # Reopening finds the records via the .idx.
+            ms = index.MetaStoreWriter(meta_name)
+            WVPASSEQ([ms.store(m) for m in metas], ofs)
+            new_ofs = ms.store(_test_meta(path, 0o400))
+            WVPASSEQ(new_ofs, size)
+            ms.close()
+            ms = index.MetaStoreWriter(meta_name)
+            WVPASSEQ(ms.store(_test_meta(path, 0o400)), new_ofs)
+            WVPASSEQ([ms.store(m) for m in metas], ofs)
+
+            # Records added by a writer that wasn't closed are found by
+            # reading the part of the store the .idx doesn't cover.
+            empty_ofs = ms.store(metadata.Metadata())
+            unclosed_ofs = ms.store(_test_meta(path, 0o444))
+            del ms
+            ms = index.MetaStoreWriter(meta_name)
+            WVPASSEQ(ms.store(_test_meta(path, 0o444)), unclosed_ofs)
+            WVPASSEQ(ms.store(metadata.Metadata()), empty_ofs)
+            ms.close()
+
+            # The .idx of some other store is ignored.
+            os.unlink(meta_name)
+            ms = index.MetaStoreWriter(meta_name)
+            WVPASSEQ(ms.store(metas[2]), 0)
+            WVPASSEQ(ms.store(metas[0]),
+                     len(metas[2].encode(include_path=False)))
+            ms.close()
+            msr = index.MetaStoreReader(meta_name)
+            WVPASSEQ(msr.metadata_at(0).mode, metas[2].mode)
+            msr.close()
+
+
+@wvtest
+def index_compact_meta():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tindex-') as tmpdir:
+            path = tmpdir + b'/f'
+            open(path, 'wb').close()
+            indexfile = tmpdir + b'/index'
+            fs = xstat.stat(path)
+            ds = xstat.stat(tmpdir)
+            tmax = (time.time() - 1) * 10**9
+            ms = index.MetaStoreWriter(indexfile + b'.meta')
+            unused = ms.store(_test_meta(path, 0o600))
+            file_ofs = ms.store(_test_meta(path, 0o644))
+            dir_ofs = ms.store(_test_meta(path, 0o755))
+            w = index.Writer(indexfile, ms, tmax)
+            w.add(b'/a/f', fs, file_ofs)
+            w.add(b'/a/', ds, dir_ofs)
+            w.add(b'/', ds, dir_ofs)
+            w.close()
+            ms.close()
+            before = os.path.getsize(indexfile + b'.meta')
+
+            WVPASSEQ(index.compact_meta(indexfile),
+                     (before, os.path.getsize(indexfile + b'.meta')))
+            WVPASS(os.path.getsize(indexfile + b'.meta') < before)
+            WVPASSEQ(sorted(os.listdir(tmpdir)),
+                     [b'f', b'index', b'index.meta', b'index.meta.idx'])
+            r = index.Reader(indexfile)
+            msr = index.MetaStoreReader(indexfile + b'.meta')
+            modes = dict((e.name, msr.metadata_at(e.meta_ofs).mode)
+                         for e in r)
+            msr.close()
+            r.close()
+            WVPASSEQ(modes[b'/a/f'] & 0o777, 0o644)
+            WVPASSEQ(modes[b'/a/'] & 0o777, 0o755)
+            ms = index.MetaStoreWriter(indexfile + b'.meta')
+            WVPASS(ms.store(_test_meta(path, 0o600)) != unused)
+            WVPASSEQ(ms.store(_test_meta(path, 0o644)), 0)
+            ms.close()
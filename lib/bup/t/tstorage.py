@@ -2,6 +2,7 @@
 from __future__ import absolute_import, print_function
 import os
 import struct
+import threading
 from contextlib import contextmanager
 
 import hashlib
@@ -10,6 +11,8 @@ from wvtest import *
 
 from buptest import no_lingering_errors, test_tempdir
 from bup.storage import Kind, FileAlreadyExists, FileNotFound, get_storage
+from bup.storage.aws import (CacheRanges, DynamoListing, S3CacheReader,
+                              _pattern_filter)
 from bup.repo import ConfigRepo
 
 
@@ -115,3 +118,173 @@ def test_storage_packs():
             rd = store.get_reader(filename, kind)
             wvpasseq(rd.read(), b'a' * 100)
             rd.close()
+
+@wvtest
+def test_cache_ranges():
+    with no_lingering_errors(), test_tempdir(b'bup-tstorage-') as tmpdir:
+        fn = os.path.join(tmpdir, b'x.rngs').decode('ascii')
+        r = CacheRanges(fn)
+        for start, end in ((10, 19), (40, 49), (20, 29), (60, 69), (0, 4)):
+            r.add(start, end)
+        wvpasseq(len(r), 4)
+        wvpasseq([r.find(o) for o in (0, 4, 5, 10, 29, 30, 45, 70)],
+                 [4, 4, None, 29, 29, None, 49, None])
+        wvpasseq([r.next_start(o) for o in (0, 5, 40, 69)],
+                 [10, 10, 60, None])
+        r.add(25, 65)
+        wvpasseq(len(r), 2)
+        wvpasseq(r.find(10), 69)
+        r.close()
+
+        # the journal is appended to, and merged when loading
+        with open(fn, 'rb') as f:
+            wvpasseq(len(f.readlines()), 6)
+        r = CacheRanges(fn)
+        wvpasseq((len(r), r.find(0), r.find(30)), (2, 4, 69))
+        for i in range(100):
+            r.add(100 + 10 * i, 109 + 10 * i)
+        r.close()
+        # ... and compacted when it has too many redundant entries
+        with open(fn, 'rb') as f:
+            wvpasseq(f.read(), b'0 - 4\n10 - 69\n100 - 1099\n')
+
+
+class FakeReader:
+    def __init__(self, data):
+        self.name = 'pack-test'
+        self.size = len(data)
+        self.data = data
+        self.offs = 0
+        self.reads = []
+
+    def seek(self, offs):
+        self.offs = offs
+
+    def read(self, sz):
+        self.reads.append((self.offs, sz))
+        self.offs += sz
+        return self.data[self.offs - sz:self.offs]
+
+    def close(self):
+        pass
+
+@wvtest
+def test_s3_cache_reader():
+    with no_lingering_errors(), test_tempdir(b'bup-tstorage-') as tmpdir:
+        cachedir = tmpdir.decode('ascii')
+        data = os.urandom(1000)
+        fake = FakeReader(data)
+        rd = S3CacheReader(fake, cachedir, 64)
+        rd.seek(100)
+        wvpasseq(rd.read(10), data[100:110])
+        wvpasseq(fake.reads, [(64, 64)])
+        wvpasseq(rd.read(100, szhint=200), data[110:210])
+        wvpasseq(fake.reads[1:], [(128, 192)])
+        rd.seek(0)
+        wvpasseq(rd.read(), data)
+        wvpasseq(fake.reads[2:], [(0, 64), (320, 680)])
+        rd.close()
+
+        # the cache is persistent
+        fake = FakeReader(data)
+        rd = S3CacheReader(fake, cachedir, 64)
+        wvpasseq(rd.read_at(990, 10), data[990:])
+        wvpasseq(fake.reads, [])
+        rd.close()
+
+        # and can be filled from multiple threads at once
+        os.unlink(os.path.join(tmpdir, b'pack-test.rngs'))
+        fake = FakeReader(data)
+        rd = S3CacheReader(fake, cachedir, 16)
+        results = {}
+        def read_some(offs):
+            results[offs] = [rd.read_at(o, 8) for o in range(offs, 1000, 80)]
+        threads = [threading.Thread(target=read_some, args=(o,))
+                   for o in range(0, 80, 8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for offs, res in results.items():
+            wvpasseq(res, [data[o:o + 8] for o in range(offs, 1000, 80)])
+        rd.seek(0)
+        wvpasseq(rd.read(), data)
+        rd.close()
+
+
+class FakeDynamo:
+    # just enough of the client for DynamoListing, returning pages of
+    # 3 items (ignoring the filter, which the caller checks anyway)
+    def __init__(self, names):
+        self.items = [{ 'filename': { 'S': n } } for n in names]
+        self.items.append({ 'filename': { 'S': 'pack-t.encpack' },
+                            'tentative': { 'N': '1' } })
+        self.generation = None
+        self.scans = []
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        if self.generation is None:
+            return {}
+        return { 'Item': { 'generation': { 'N': str(self.generation) } } }
+
+    def update_item(self, TableName, Key, UpdateExpression,
+                    ExpressionAttributeValues):
+        self.generation = (self.generation or 0) + 1
+
+    def scan(self, **kwargs):
+        self.scans.append(kwargs)
+        start = kwargs.get('ExclusiveStartKey', 0)
+        items = [item for item in self.items if 'tentative' not in item]
+        ret = { 'Items': items[start:start + 3] }
+        if start + 3 < len(items):
+            ret['LastEvaluatedKey'] = start + 3
+        return ret
+
+@wvtest
+def test_pattern_filter():
+    wvpasseq(_pattern_filter('*'), ('attribute_not_exists(tentative)', {}))
+    wvpasseq(_pattern_filter('refs'),
+             ('attribute_not_exists(tentative) AND filename = :name',
+              { ':name': { 'S': 'refs' } }))
+    wvpasseq(_pattern_filter('pack-*.encidx'),
+             ('attribute_not_exists(tentative) AND '
+              'begins_with(filename, :prefix) AND '
+              'contains(filename, :suffix)',
+              { ':prefix': { 'S': 'pack-' }, ':suffix': { 'S': '.encidx' } }))
+    wvpasseq(_pattern_filter('p?[ab]x')[1], { ':prefix': { 'S': 'p' },
+                                              ':suffix': { 'S': 'x' } })
+
+@wvtest
+def test_dynamo_listing():
+    with no_lingering_errors(), test_tempdir(b'bup-tstorage-') as tmpdir:
+        names = ['pack-%d.encpack' % i for i in range(5)]
+        names += ['pack-%d.encidx' % i for i in range(5)]
+        fake = FakeDynamo(names + ['refs'])
+        listing = DynamoListing(fake, 'table', tmpdir.decode('ascii'))
+        # pages are all read, and without a generation nothing is cached
+        for i in range(2):
+            wvpasseq(sorted(listing.list('*.encidx')), sorted(names[5:]))
+        wvpasseq(len(fake.scans), 8)
+        wvpasseq(fake.scans[0]['ExpressionAttributeValues'],
+                 { ':suffix': { 'S': '.encidx' } })
+        wvpasseq(sorted(listing.list()), sorted(names + ['refs']))
+
+        del fake.scans[:]
+        listing.bump()
+        wvpasseq(sorted(listing.list('*.encidx')), sorted(names[5:]))
+        wvpasseq(len(fake.scans), 4)
+        # now it's cached until the generation changes
+        wvpasseq(sorted(listing.list('*.encidx')), sorted(names[5:]))
+        wvpasseq(len(fake.scans), 4)
+        wvpasseq(listing.list('refs'), ['refs'])
+        wvpasseq(len(fake.scans), 8)
+        fake.items.append({ 'filename': { 'S': 'pack-5.encidx' } })
+        listing.bump()
+        wvpasseq(sorted(listing.list('*.encidx')),
+                 sorted(names[5:] + ['pack-5.encidx']))
+        wvpasseq(len(fake.scans), 12)
+
+        # without a cachedir, nothing is cached
+        listing = DynamoListing(fake, 'table')
+        wvpasseq(listing.list('refs'), ['refs'])
+        wvpasseq(len(fake.scans), 16)
@@ -0,0 +1,64 @@
+
+from __future__ import absolute_import, print_function
+import os
+
+from wvtest import *
+
+from bup.treecache import TreeCache
+from buptest import no_lingering_errors, test_tempdir
+
+
+def entry_paths(cache_dir):
+    return sorted(os.path.join(d, name)
+                  for d, _, names in os.walk(cache_dir) for name in names)
+
+@wvtest
+def test_tree_cache():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-ttreecache-') as tmpdir:
+            cache_dir = tmpdir + b'/cache'
+            oid_0, oid_1 = b'\0' * 20, b'\1' * 20
+            cache = TreeCache(cache_dir, 1024 * 1024)
+            wvpasseq(None, cache.get(oid_0))
+            cache.put(oid_0, b'tree', b'bupm')
+            cache.put(oid_1, b'another tree', None)
+            wvpasseq((b'tree', b'bupm'), cache.get(oid_0))
+            wvpasseq((b'another tree', None), cache.get(oid_1))
+
+            # Shared with other instances (processes)
+            other = TreeCache(cache_dir, 1024 * 1024)
+            wvpasseq((b'tree', b'bupm'), other.get(oid_0))
+            wvpasseq((b'another tree', None), other.get(oid_1))
+
+            # Damaged entries are ignored
+            path = entry_paths(cache_dir)[0]
+            with open(path, 'r+b') as f:
+                f.truncate(os.path.getsize(path) - 1)
+            other = TreeCache(cache_dir, 1024 * 1024)
+            wvpasseq(None, other.get(oid_0))
+
+@wvtest
+def test_tree_cache_eviction():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-ttreecache-') as tmpdir:
+            cache_dir = tmpdir + b'/cache'
+            data = b'x' * 1000
+            cache = TreeCache(cache_dir, 10 * 1024)
+            oids = [(b'%02d' % i) * 10 for i in range(10)]
+            for i, oid in enumerate(oids):
+                cache.put(oid, data, None)
+                # make sure the mtimes differ, oldest first
+                os.utime(cache._entry_path(oid), (i, i))
+            wvpasseq(10, len(entry_paths(cache_dir)))
+            # Reading an entry makes it the most recently used
+            cache._last = None
+            wvpass(cache.get(oids[0]))
+            for i, oid in enumerate(oids[1:], 1):
+                os.utime(cache._entry_path(oid), (i, i))
+            cache.put(b'\0' * 20, data, None)
+            wvpasseq(cache._size,
+                     sum(os.path.getsize(x) for x in entry_paths(cache_dir)))
+            wvpass(cache._size <= 10 * 1024 * 3 // 4)
+            wvpass(os.path.exists(cache._entry_path(oids[0])))
+            wvpass(os.path.exists(cache._entry_path(b'\0' * 20)))
+            wvfail(os.path.exists(cache._entry_path(oids[1])))
@@ -44,33 +44,78 @@ def test_cache_behavior():
         vfs._cache_max_items = 2
         vfs.clear_cache()
         wvpasseq({}, vfs._cache)
-        wvpasseq([], vfs._cache_keys)
-        wvfail(vfs._cache_keys)
+        wvpasseq({}, vfs._cache_sizes)
+        wvpasseq(0, vfs._cache_size)
         wvexcept(Exception, vfs.cache_notice, b'x', 1)
         key_0 = b'itm:' + b'\0' * 20
         key_1 = b'itm:' + b'\1' * 20
         key_2 = b'itm:' + b'\2' * 20
         vfs.cache_notice(key_0, b'something')
         wvpasseq({key_0 : b'something'}, vfs._cache)
-        wvpasseq([key_0], vfs._cache_keys)
         vfs.cache_notice(key_1, b'something else')
         wvpasseq({key_0 : b'something', key_1 : b'something else'}, vfs._cache)
-        wvpasseq(frozenset([key_0, key_1]), frozenset(vfs._cache_keys))
+        # Touch key_0 so that key_1 is the least recently used
+        wvpasseq(b'something', vfs.cache_get(key_0))
         vfs.cache_notice(key_2, b'and also')
-        wvpasseq(2, len(vfs._cache))
-        wvpass(frozenset(items(vfs._cache))
-               < frozenset(items({key_0 : b'something',
-                                  key_1 : b'something else',
-                                  key_2 : b'and also'})))
-        wvpasseq(2, len(vfs._cache_keys))
-        wvpass(frozenset(vfs._cache_keys) < frozenset([key_0, key_1, key_2]))
+        wvpasseq({key_0 : b'something', key_2 : b'and also'}, vfs._cache)
+        wvpasseq(frozenset([key_0, key_2]), frozenset(vfs._cache_sizes))
+        wvpasseq(sum(vfs._cache_sizes.values()), vfs._cache_size)
         vfs.clear_cache()
         wvpasseq({}, vfs._cache)
-        wvpasseq([], vfs._cache_keys)
+        wvpasseq({}, vfs._cache_sizes)
+        wvpasseq(0, vfs._cache_size)
     finally:
         vfs._cache_max_items = orig_max
         vfs.clear_cache()
 
+@wvtest
+def test_cache_size_limit_and_stats():
+    orig_max_items, orig_max_bytes = vfs._cache_max_items, vfs._cache_max_bytes
+    try:
+        vfs.clear_cache()
+        vfs.cache_stats(reset=True)
+        small = b'itm:' + b'\0' * 20
+        big = b'rvl:' + b'\1' * 20
+        big_value = dict((b'%d' % i, vfs.Item(meta=vfs.default_file_mode,
+                                              oid=b'\0' * 20))
+                         for i in range(100))
+        vfs.cache_notice(small, b'x')
+        small_size = vfs._cache_size
+        vfs.cache_notice(big, big_value)
+        big_size = vfs._cache_size - small_size
+        wvpass(big_size > 50 * small_size)
+
+        # Too big to fit at all, so it shouldn't evict anything
+        vfs.clear_cache()
+        vfs.set_cache_limits(max_bytes=big_size - 1)
+        vfs.cache_notice(small, b'x')
+        vfs.cache_notice(big, big_value)
+        wvpasseq([small], list(vfs._cache))
+
+        vfs.set_cache_limits(max_bytes=big_size + small_size)
+        vfs.cache_notice(big, big_value)
+        wvpasseq([small, big], list(vfs._cache))
+        vfs.cache_notice(b'res:foo', ())
+        wvpasseq([big, b'res:foo'], list(vfs._cache))
+
+        wvpasseq(big_value, vfs.cache_get(big))
+        wvpasseq(None, vfs.cache_get(small))
+        stats = vfs.cache_stats(reset=True)
+        wvpasseq(vfs.CacheStats(hits=0, misses=1, evictions=1,
+                                items=0, bytes=0),
+                 stats[b'itm:'])
+        wvpasseq(vfs.CacheStats(hits=1, misses=0, evictions=1,
+                                items=1, bytes=big_size),
+                 stats[b'rvl:'])
+        wvpasseq(1, stats[b'res:'].items)
+        wvpasseq(0, stats[b'lat:'].items)
+        wvpasseq(4, len(vfs.cache_stats_summary()))
+        wvpasseq(0, vfs.cache_stats()[b'rvl:'].hits)
+    finally:
+        vfs.set_cache_limits(max_items=orig_max_items,
+                             max_bytes=orig_max_bytes)
+        vfs.clear_cache()
+
 ## The clear_cache() calls below are to make sure that the test starts
 ## from a known state since at the moment the cache entry for a given
 ## item (like a commit) can change.  For example, its meta value might
@@ -311,6 +356,127 @@ def test_read_and_seek():
                                           b'%s/%d' % (data_path, size),
                                           read_sizes)
 
+class _CountingRepo(object):
+    def __init__(self, repo):
+        self.repo = repo
+        self.cats = 0
+    def cat(self, ref):
+        self.cats += 1
+        return self.repo.cat(ref)
+    def __getattr__(self, name):
+        return getattr(self.repo, name)
+
+@wvtest
+def test_random_access_read():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tvfs-rread-') as tmpdir:
+            bup_dir = tmpdir + b'/bup'
+            environ[b'GIT_DIR'] = bup_dir
+            environ[b'BUP_DIR'] = bup_dir
+            git.repodir = bup_dir
+            data_path = tmpdir + b'/src'
+            seed = randint(-(1 << 31), (1 << 31) - 1)
+            print('test_random_access_read seed:', seed, file=sys.stderr)
+            rand = Random()
+            rand.seed(seed)
+            size = 1024 * 1024
+            with open(data_path, 'wb') as f:
+                write_random(f.fileno(), size, seed, 0)
+            with open(data_path, 'rb') as f:
+                data = f.read()
+            ex((bup_path, b'init'))
+            # A small fanout gives a deep chunk tree
+            oid = exo((bup_path, b'split', b'--fanout', b'2', b'-t',
+                       data_path)).out.strip()
+            repo = _CountingRepo(LocalRepo())
+            with vfs._FileReader(repo, unhexlify(oid)) as f:
+                wvpass(f.read(1) == data[:1])
+                # Every read after the seek must only need the blobs
+                # once the trees on the path have been decoded.
+                for ofs in [size - 1, 0, size // 2] \
+                    + [rand.randint(0, size - 1) for _ in range(50)]:
+                    count = rand.randint(1, 64 * 1024)
+                    f.seek(ofs)
+                    wvpass(f.read(count) == data[ofs:ofs + count])
+                for ofs in [size - 1, 0, size // 2]:
+                    f.seek(ofs)
+                    cats = repo.cats
+                    wvpass(f.read(1) == data[ofs:ofs + 1])
+                    wvpasseq(cats + 1, repo.cats)
+                f.seek(size // 3)
+                wvpass(f.read() == data[size // 3:])
+            # With a big enough chunk cache, nothing is read twice
+            cache = vfs.ChunkCache(2 * size)
+            with vfs._FileReader(repo, unhexlify(oid),
+                                 chunk_cache=cache) as f:
+                wvpass(f.read() == data)
+                cats = repo.cats
+                f.seek(size // 2)
+                wvpass(f.read() == data[size // 2:])
+                wvpasseq(cats, repo.cats)
+
+@wvtest
+def test_chunk_cache():
+    with no_lingering_errors():
+        cache = vfs.ChunkCache(10)
+        cache.put(b'a', b'1234')
+        cache.put(b'b', b'1234')
+        wvpasseq(b'1234', cache.get(b'a'))
+        cache.put(b'c', b'1234')
+        # b was the least recently used
+        wvpasseq(None, cache.get(b'b'))
+        wvpasseq(b'1234', cache.get(b'a'))
+        wvpasseq(b'1234', cache.get(b'c'))
+        cache.put(b'd', b'12345678901')
+        wvpasseq(None, cache.get(b'a'))
+        wvpasseq(None, cache.get(b'd'))
+
+@wvtest
+def test_tree_cache():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tvfs-') as tmpdir:
+            bup_dir = tmpdir + b'/bup'
+            environ[b'GIT_DIR'] = bup_dir
+            environ[b'BUP_DIR'] = bup_dir
+            git.repodir = bup_dir
+            data_path = tmpdir + b'/src'
+            os.mkdir(data_path)
+            os.mkdir(data_path + b'/dir')
+            for name in (b'file', b'dir/file'):
+                with open(data_path + b'/' + name, 'wb') as f:
+                    f.write(name + b'\n')
+            ex((bup_path, b'init'))
+            ex((bup_path, b'index', b'-v', data_path))
+            ex((bup_path, b'save', b'-tvvn', b'test', b'--strip', data_path))
+            ex((b'git', b'config', b'bup.treecache', b'tree-cache'))
+
+            def listings(repo):
+                vfs.clear_cache()
+                result = []
+                for path in (b'/test/latest/', b'/test/latest/dir/'):
+                    _, item = vfs.resolve(repo, path)[-1]
+                    result.append(tuple(vfs.contents(repo, item)))
+                return result
+
+            repo = LocalRepo()
+            wvpasseq(bup_dir + b'/tree-cache', repo.tree_cache.path)
+            expected = listings(repo)
+            wvpass(isinstance(expected[1][0][1].meta, Metadata))
+            wvpasseq(b'file', expected[1][1][0])
+
+            # A new repo (process) shouldn't need any of the trees
+            repo = LocalRepo()
+            cat = repo.cat
+            catted = []
+            def logging_cat(ref):
+                catted.append(ref)
+                return cat(ref)
+            repo.cat = logging_cat
+            wvpasseq(expected, listings(repo))
+            for ref in catted:
+                _, kind, _ = next(cat(ref))
+                wvpassne(b'tree', kind)
+
 @wvtest
 def test_contents_with_mismatched_bupm_git_ordering():
     with no_lingering_errors():
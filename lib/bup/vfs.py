@@ -48,13 +48,14 @@ item.coid.
 
 from __future__ import absolute_import, print_function
 from binascii import hexlify, unhexlify
-from collections import namedtuple
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
 from errno import EINVAL, ELOOP, ENOENT, ENOTDIR
-from itertools import chain, dropwhile, groupby, tee
-from random import randrange
+from io import BytesIO
+from itertools import dropwhile, groupby, tee
 from stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR, S_ISLNK, S_ISREG
 from time import localtime, strftime
-import re, sys
+import re, sys, threading
 
 from bup import git, metadata, vint
 from bup.compat import hexstr, range, int_types
@@ -105,52 +106,142 @@ def _normal_or_chunked_file_size(repo, oid):
         _, obj_t, size = next(it)
     return ofs + sum(len(b) for b in it)
 
-def _skip_chunks_before_offset(tree, offset):
-    prev_ent = next(tree, None)
-    if not prev_ent:
+# Number of chunks to ask the repository to prefetch at a time
+_prefetch_chunks = 32
+
+# Number of decoded chunk trees each _ChunkIndex keeps around
+_chunk_index_max_trees = 1024
+
+class ChunkCache(object):
+    """Thread-safe LRU cache of file chunk data, keyed by blob oid, and
+    holding at most max_bytes of data.  It can be shared by any number
+    of readers (see fopen())."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, oid):
+        with self._lock:
+            data = self._chunks.pop(oid, None)
+            if data is not None:
+                self._chunks[oid] = data
+            return data
+
+    def put(self, oid, data):
+        with self._lock:
+            old = self._chunks.pop(oid, None)
+            if old is not None:
+                self._size -= len(old)
+            self._chunks[oid] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, old = self._chunks.popitem(last=False)
+                self._size -= len(old)
+
+class _ChunkIndex(object):
+    """Offset index for the normal or chunked file indicated by oid.
+
+    Each tree of the chunk tree is decoded at most once (as long as it
+    stays in the bounded cache) into bisectable lists of the entry
+    offsets, modes, and oids, so finding the chunk that contains an
+    offset only touches the trees along one path from the root.
+
+    """
+    def __init__(self, repo, oid, chunk_cache=None):
+        self._repo = repo
+        self.oid = oid
+        self._chunk_cache = chunk_cache
+        self._root_is_tree = None
+        self._trees = OrderedDict()
+
+    def _decode(self, data):
+        offs, modes, oids = [], [], []
+        for mode, name, oid in tree_decode(data):
+            # name is the chunk's hex offset in the original file
+            offs.append(int(name, 16))
+            modes.append(mode)
+            oids.append(oid)
+        return offs, modes, oids
+
+    def _tree(self, oid):
+        tree = self._trees.pop(oid, None)
+        if tree is None:
+            it = self._repo.cat(hexlify(oid))
+            _, obj_t, size = next(it)
+            assert obj_t == b'tree'
+            tree = self._decode(b''.join(it))
+            if len(self._trees) >= _chunk_index_max_trees:
+                self._trees.popitem(last=False)
+        self._trees[oid] = tree
         return tree
-    ent = None
-    for ent in tree:
-        ent_ofs = int(ent[1], 16)
-        if ent_ofs > offset:
-            return chain([prev_ent, ent], tree)
-        if ent_ofs == offset:
-            return chain([ent], tree)
-        prev_ent = ent
-    return [prev_ent]
-
-def _tree_chunks(repo, tree, startofs):
-    "Tree should be a sequence of (name, mode, hash) as per tree_decode()."
-    assert(startofs >= 0)
-    # name is the chunk's hex offset in the original file
-    for mode, name, oid in _skip_chunks_before_offset(tree, startofs):
-        ofs = int(name, 16)
-        skipmore = startofs - ofs
-        if skipmore < 0:
-            skipmore = 0
-        it = repo.cat(hexlify(oid))
+
+    def _blob(self, oid):
+        cache = self._chunk_cache
+        if cache:
+            data = cache.get(oid)
+            if data is not None:
+                return data
+        it = self._repo.cat(hexlify(oid))
         _, obj_t, size = next(it)
+        assert obj_t == b'blob'
         data = b''.join(it)
-        if S_ISDIR(mode):
-            assert obj_t == b'tree'
-            for b in _tree_chunks(repo, tree_decode(data), skipmore):
-                yield b
-        else:
-            assert obj_t == b'blob'
-            yield data[skipmore:]
+        if cache:
+            cache.put(oid, data)
+        return data
+
+    def chunks(self, startofs):
+        """Yield the file's data, starting at startofs, one (possibly
+        partial) chunk at a time."""
+        assert startofs >= 0
+        if not self._root_is_tree:
+            it = self._repo.cat(hexlify(self.oid))
+            _, obj_t, size = next(it)
+            data = b''.join(it)
+            self._root_is_tree = obj_t == b'tree'
+            if not self._root_is_tree:
+                assert obj_t == b'blob'
+                yield data[startofs:]
+                return
+            self._trees[self.oid] = self._decode(data)
+        # Each frame is [tree, next index, prefetched up to index]
+        stack = []
+        tree = self._tree(self.oid)
+        skip = startofs
+        while True:
+            offs, modes, oids = tree
+            if not offs:
+                return
+            i = max(0, bisect_right(offs, skip) - 1)
+            stack.append([tree, i, i])
+            skip = max(0, skip - offs[i])
+            if not S_ISDIR(modes[i]):
+                break
+            tree = self._tree(oids[i])
+        while stack:
+            frame = stack[-1]
+            (offs, modes, oids), i, prefetched = frame
+            if i >= len(oids):
+                stack.pop()
+                if stack:
+                    stack[-1][1] += 1
+                continue
+            if i >= prefetched:
+                frame[2] = i + _prefetch_chunks
+                self._repo.prefetch(oids[i:frame[2]])
+            if S_ISDIR(modes[i]):
+                stack.append([self._tree(oids[i]), 0, 0])
+                continue
+            data = self._blob(oids[i])
+            frame[1] += 1
+            yield data[skip:] if skip else data
+            skip = 0
 
 class _ChunkReader:
-    def __init__(self, repo, oid, startofs):
-        it = repo.cat(hexlify(oid))
-        _, obj_t, size = next(it)
-        isdir = obj_t == b'tree'
-        data = b''.join(it)
-        if isdir:
-            self.it = _tree_chunks(repo, tree_decode(data), startofs)
-            self.blob = None
-        else:
-            self.it = None
-            self.blob = data[startofs:]
+    def __init__(self, index, startofs):
+        self.it = index.chunks(startofs)
+        self.blob = None
         self.ofs = startofs
 
     def next(self, size):
@@ -172,13 +263,15 @@ class _ChunkReader:
         return out
 
 class _FileReader(object):
-    def __init__(self, repo, oid, known_size=None):
+    def __init__(self, repo, oid, known_size=None, chunk_cache=None):
         assert len(oid) == 20
         self.oid = oid
         self.ofs = 0
         self.reader = None
         self._repo = repo
         self._size = known_size
+        self._index = None
+        self._chunk_cache = chunk_cache
 
     def _compute_size(self):
         if not self._size:
@@ -200,7 +293,10 @@ class _FileReader(object):
         if count < 0:
             count = size - self.ofs
         if not self.reader or self.reader.ofs != self.ofs:
-            self.reader = _ChunkReader(self._repo, self.oid, self.ofs)
+            if not self._index:
+                self._index = _ChunkIndex(self._repo, self.oid,
+                                          self._chunk_cache)
+            self.reader = _ChunkReader(self._index, self.ofs)
         try:
             buf = self.reader.next(count)
         except:
@@ -263,19 +359,81 @@ _tags = Tags(meta=default_dir_mode)
 
 ### vfs cache
 
-### A general purpose shared cache with (currently) cheap random
-### eviction.  At the moment there is no weighting so a single commit
-### item is just as likely to be evicted as an entire "rev-list".  See
+### A general purpose shared LRU cache, bounded both by its number of
+### entries and by an estimate of their total size, so that a few
+### large rev-lists can't crowd out everything else.  See
 ### is_valid_cache_key for a description of the expected content.
 
-_cache = {}
-_cache_keys = []
+_cache = OrderedDict()
+_cache_sizes = {}
+_cache_size = 0
 _cache_max_items = 30000
+_cache_max_bytes = 32 * 1024 * 1024
+
+CacheStats = namedtuple('CacheStats',
+                        ('hits', 'misses', 'evictions', 'items', 'bytes'))
+
+_cache_tags = (b'res:', b'itm:', b'rvl:', b'lat:')
+_cache_stats = {}
+
+def _reset_cache_stats():
+    global _cache_stats
+    _cache_stats = dict((tag, [0, 0, 0]) for tag in _cache_tags)
+
+_reset_cache_stats()
 
 def clear_cache():
-    global _cache, _cache_keys
-    _cache = {}
-    _cache_keys = []
+    """Drop all of the cache entries (but not the statistics; see
+    cache_stats())."""
+    global _cache, _cache_sizes, _cache_size
+    _cache = OrderedDict()
+    _cache_sizes = {}
+    _cache_size = 0
+
+def set_cache_limits(max_items=None, max_bytes=None):
+    """Change the maximum number of cache entries and/or their maximum
+    (estimated) total size, evicting entries as needed."""
+    global _cache_max_items, _cache_max_bytes
+    if max_items is not None:
+        _cache_max_items = max_items
+    if max_bytes is not None:
+        _cache_max_bytes = max_bytes
+    _cache_shrink()
+
+def cache_stats(reset=False):
+    """Return a dict mapping each cache key tag (e.g. b'rvl:') to the
+    CacheStats for that kind of entry.  The hit, miss, and eviction
+    counts cover the time since the start (or the last reset), and
+    items and bytes describe the current content of the cache.  If
+    reset is true, zero the counts after collecting them."""
+    items = dict((tag, 0) for tag in _cache_tags)
+    sizes = dict((tag, 0) for tag in _cache_tags)
+    for key, size in _cache_sizes.items():
+        tag = key[:4]
+        items[tag] += 1
+        sizes[tag] += size
+    result = {}
+    for tag in _cache_tags:
+        hits, misses, evictions = _cache_stats[tag]
+        result[tag] = CacheStats(hits=hits, misses=misses,
+                                 evictions=evictions,
+                                 items=items[tag], bytes=sizes[tag])
+    if reset:
+        _reset_cache_stats()
+    return result
+
+def cache_stats_summary():
+    """Return a list of lines (without newlines) describing the
+    current cache_stats()."""
+    lines = []
+    for tag, st in sorted(cache_stats().items()):
+        lookups = st.hits + st.misses
+        rate = (100.0 * st.hits / lookups) if lookups else 0.0
+        lines.append('%s %d hits, %d misses (%.1f%%), %d evictions, '
+                     '%d items, %d bytes'
+                     % (tag[:3].decode('ascii'), st.hits, st.misses, rate,
+                        st.evictions, st.items, st.bytes))
+    return lines
 
 def is_valid_cache_key(x):
     """Return logically true if x looks like it could be a valid cache key
@@ -294,29 +452,73 @@ def is_valid_cache_key(x):
         if tag == b'res:':
             return True
 
+# Rough per-object overheads used to estimate the size of cache
+# entries.  They don't need to be exact, just proportional.
+_cache_entry_overhead = 128
+_cache_item_overhead = 128
+_cache_meta_overhead = 512
+
+def _cache_item_size(item):
+    # Rev-lists also hold a few non-item markers, e.g. _HAS_META_ENTRY
+    if not hasattr(item, 'meta'):
+        return 0
+    size = _cache_item_overhead
+    if isinstance(item.meta, Metadata):
+        size += _cache_meta_overhead
+    return size
+
+def _cache_value_size(value):
+    if isinstance(value, bytes):
+        return len(value)
+    if type(value) in item_types:
+        return _cache_item_size(value)
+    if isinstance(value, dict):
+        value = value.items()
+    size = 0
+    for name, item in value:
+        if isinstance(name, bytes):
+            size += len(name)
+        size += _cache_item_size(item)
+    return size
+
+def _cache_shrink():
+    global _cache_size
+    while _cache and (len(_cache) > _cache_max_items
+                      or _cache_size > _cache_max_bytes):
+        victim, _ = _cache.popitem(last=False)
+        _cache_size -= _cache_sizes.pop(victim)
+        _cache_stats[victim[:4]][2] += 1
+
 def cache_get(key):
-    global _cache
     if not is_valid_cache_key(key):
         raise Exception('invalid cache key: ' + repr(key))
-    return _cache.get(key)
+    value = _cache.pop(key, None)
+    stats = _cache_stats[key[:4]]
+    if value is None:
+        stats[1] += 1
+        return None
+    stats[0] += 1
+    _cache[key] = value
+    return value
 
 def cache_notice(key, value, overwrite=False):
-    global _cache, _cache_keys, _cache_max_items
+    global _cache_size
     if not is_valid_cache_key(key):
         raise Exception('invalid cache key: ' + repr(key))
     if key in _cache:
-        if overwrite:
-            _cache[key] = value
-        return
-    if len(_cache) < _cache_max_items:
-        _cache_keys.append(key)
-        _cache[key] = value
+        if not overwrite:
+            return
+        del _cache[key]
+        _cache_size -= _cache_sizes.pop(key)
+    size = len(key) + _cache_entry_overhead + _cache_value_size(value)
+    if size > _cache_max_bytes:
+        # Don't flush everything else for an entry that can't fit.
+        _cache_stats[key[:4]][2] += 1
         return
-    victim_i = randrange(0, len(_cache_keys))
-    victim = _cache_keys[victim_i]
-    del _cache[victim]
-    _cache_keys[victim_i] = key
     _cache[key] = value
+    _cache_sizes[key] = size
+    _cache_size += size
+    _cache_shrink()
 
 def _has_metadata_if_needed(item, need_meta):
     if not need_meta:
@@ -394,11 +596,45 @@ def tree_data_and_bupm(repo, oid):
             break
     return data, None
 
+def _tree_cache(repo):
+    return getattr(repo, 'tree_cache', None)
+
+def _cached_tree_data_and_bupm_data(repo, tree_cache, oid):
+    """Return (tree_bytes, bupm_bytes) for the tree or commit oid, where
+    bupm_bytes will be None if the tree has no metadata, fetching it
+    from the repository and adding it to the tree_cache if needed.
+
+    """
+    entry = tree_cache.get(oid)
+    if entry:
+        return entry
+    tree_data, bupm_oid = tree_data_and_bupm(repo, oid)
+    bupm_data = None
+    if bupm_oid:
+        with _FileReader(repo, bupm_oid) as meta_stream:
+            bupm_data = meta_stream.read()
+    tree_cache.put(oid, tree_data, bupm_data)
+    return tree_data, bupm_data
+
+def _open_bupm(repo, tree_oid, bupm_oid):
+    tree_cache = _tree_cache(repo)
+    if tree_cache:
+        _, bupm_data = _cached_tree_data_and_bupm_data(repo, tree_cache,
+                                                       tree_oid)
+        return BytesIO(bupm_data)
+    return _FileReader(repo, bupm_oid)
+
 def _find_treeish_oid_metadata(repo, oid):
     """Return the metadata for the tree or commit oid, or None if the tree
     has no metadata (i.e. older bup save, or non-bup tree).
 
     """
+    tree_cache = _tree_cache(repo)
+    if tree_cache:
+        _, bupm_data = _cached_tree_data_and_bupm_data(repo, tree_cache, oid)
+        if bupm_data is not None:
+            return _read_dir_meta(BytesIO(bupm_data))
+        return None
     tree_data, bupm_oid = tree_data_and_bupm(repo, oid)
     if bupm_oid:
         with _FileReader(repo, bupm_oid) as meta_stream:
@@ -439,15 +675,18 @@ def item_size(repo, item):
         return m.size
     return _compute_item_size(repo, item)
 
-def tree_data_reader(repo, oid):
+def tree_data_reader(repo, oid, chunk_cache=None):
     """Return an open reader for all of the data contained within oid.  If
-    oid refers to a tree, recursively concatenate all of its contents."""
-    return _FileReader(repo, oid)
-
-def fopen(repo, item):
-    """Return an open reader for the given file item."""
+    oid refers to a tree, recursively concatenate all of its contents.
+    If chunk_cache is a ChunkCache, look for the file's chunks there
+    first, and add the ones that have to be read from the repo."""
+    return _FileReader(repo, oid, chunk_cache=chunk_cache)
+
+def fopen(repo, item, chunk_cache=None):
+    """Return an open reader for the given file item (see
+    tree_data_reader() for chunk_cache)."""
     assert S_ISREG(item_mode(item))
-    return tree_data_reader(repo, item.oid)
+    return tree_data_reader(repo, item.oid, chunk_cache=chunk_cache)
 
 def _commit_item_from_data(oid, data):
     info = parse_commit(data)
@@ -588,6 +827,9 @@ def _tree_items(oid, tree_data, names=frozenset(), bupm=None):
         remaining -= 1
 
 def _get_tree_object(repo, oid):
+    tree_cache = _tree_cache(repo)
+    if tree_cache:
+        return _cached_tree_data_and_bupm_data(repo, tree_cache, oid)[0]
     res = repo.cat(hexlify(oid))
     _, kind, _ = next(res)
     assert kind == b'tree', 'expected oid %r to be tree, not %r' % (hexlify(oid), kind)
@@ -606,7 +848,7 @@ def tree_items(repo, oid, tree_data, names, metadata, level=None):
                 level = int(mangled_name[:-5], 10)
                 break
             if metadata and mangled_name == b'.bupm':
-                bupm = _FileReader(repo, sub_oid)
+                bupm = _open_bupm(repo, oid, sub_oid)
             if level is not None and mangled_name >= b'.bupm':
                 break
     if orig_level is None and (not names or b'.' in names):
@@ -618,6 +860,11 @@ def tree_items(repo, oid, tree_data, names, metadata, level=None):
             if not names:
                 return
     if level:
+        if not _tree_cache(repo):
+            repo.prefetch([sub_oid
+                           for _, mangled_name, sub_oid in tree_decode(tree_data)
+                           if not (mangled_name.endswith(b'.bupd')
+                                   or mangled_name == b'.bupm')])
         for _, mangled_name, sub_oid in tree_decode(tree_data):
             if mangled_name.endswith(b'.bupd'):
                 assert level and orig_level is None
@@ -637,6 +884,12 @@ def tree_items(repo, oid, tree_data, names, metadata, level=None):
             if bupm is not None:
                 m = _read_dir_meta(bupm)
                 assert isinstance(m, int_types), m
+        if not names and not _tree_cache(repo):
+            # Anyone listing everything is likely to descend into the
+            # subtrees (directories and chunked files) next.
+            repo.prefetch([sub_oid
+                           for gitmode, _, sub_oid in tree_decode(tree_data)
+                           if S_ISDIR(gitmode)])
         for item in _tree_items(oid, tree_data, names, bupm):
             yield item
 
@@ -859,14 +1112,17 @@ def contents(repo, item, names=None, want_meta=True):
     assert S_ISDIR(item_mode(item))
     item_t = type(item)
     if item_t in real_tree_types:
-        it = repo.cat(hexlify(item.oid))
-        _, obj_t, size = next(it)
-        data = b''.join(it)
-        if obj_t != b'tree':
-            for _ in it: pass
-            # Note: it shouldn't be possible to see an Item with type
-            # 'commit' since a 'commit' should always produce a Commit.
-            raise Exception('unexpected git ' + obj_t.decode('ascii'))
+        if _tree_cache(repo):
+            data = _get_tree_object(repo, item.oid)
+        else:
+            it = repo.cat(hexlify(item.oid))
+            _, obj_t, size = next(it)
+            data = b''.join(it)
+            if obj_t != b'tree':
+                for _ in it: pass
+                # Note: it shouldn't be possible to see an Item with type
+                # 'commit' since a 'commit' should always produce a Commit.
+                raise Exception('unexpected git ' + obj_t.decode('ascii'))
         item_gen = tree_items(repo, item.oid, data, names, want_meta)
     elif item_t == RevList:
         item_gen = revlist_items(repo, item.oid, names,
@@ -1141,7 +1397,9 @@ def join(repo, ref):
                 yield blob
         elif typ == b'tree':
             treefile = b''.join(it)
-            for (mode, name, sha) in git.tree_decode(treefile):
+            ents = list(git.tree_decode(treefile))
+            repo.prefetch([sha for mode, name, sha in ents])
+            for (mode, name, sha) in ents:
                 for blob in join(repo, hexlify(sha)):
                     yield blob
         elif typ == b'commit':
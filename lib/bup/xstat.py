@@ -117,6 +117,22 @@ class stat_result:
             result.st_gid = _fix_cygwin_id(result.st_gid)
         return result
 
+    @staticmethod
+    def from_os_stat(st):
+        """Return the stat_result for st, an os.stat_result (which
+        must have the *_ns times, i.e. python 3)."""
+        return stat_result.from_xstat_rep((st.st_mode,
+                                           st.st_ino,
+                                           st.st_dev,
+                                           st.st_nlink,
+                                           st.st_uid,
+                                           st.st_gid,
+                                           st.st_rdev,
+                                           st.st_size,
+                                           divmod(st.st_atime_ns, 10**9),
+                                           divmod(st.st_mtime_ns, 10**9),
+                                           divmod(st.st_ctime_ns, 10**9)))
+
 
 def stat(path):
     return stat_result.from_xstat_rep(_helpers.stat(path))
@@ -0,0 +1,100 @@
+#!/bin/sh
+"""": # -*-python-*-
+bup_python="$(dirname "$0")/bup-python" || exit $?
+exec "$bup_python" "$0" ${1+"$@"}
+"""
+# end of bup preamble
+
+from __future__ import absolute_import
+import errno, os, select, signal, sys, time
+
+from bup import fsnotify, git, index, journal, options
+from bup.compat import argv_bytes
+from bup.helpers import handle_ctrl_c, log, saved_errors, slashappend
+from bup.io import path_msg
+
+
+optspec = """
+bup watch [-f indexfile] [-x] [--inotify|--fanotify] <paths...>
+--
+f,indexfile=  the name of the index file (normally BUP_DIR/bupindex)
+x,xdev,one-file-system  don't watch other filesystems
+inotify    use inotify, even if fanotify is permitted
+fanotify   use fanotify, or fail
+v,verbose  print the journal records as they're added
+"""
+o = options.Options(optspec)
+opt, flags, extra = o.parse(sys.argv[1:])
+
+if not extra:
+    o.fatal('no paths to watch given')
+if opt.inotify and opt.fanotify:
+    o.fatal('--inotify is incompatible with --fanotify')
+
+git.check_repo_or_die()
+handle_ctrl_c()
+
+def terminate(signum, frame):
+    sys.exit(0)
+signal.signal(signal.SIGTERM, terminate)
+
+if opt.indexfile:
+    indexfile = argv_bytes(opt.indexfile)
+else:
+    indexfile = git.repo(b'bupindex')
+
+roots = [rp for rp, path in index.reduce_paths([argv_bytes(x) for x in extra])]
+for root in roots:
+    if not root.endswith(b'/'):
+        o.fatal('%s is not a directory' % path_msg(root))
+if saved_errors:
+    sys.exit(1)
+skip = [slashappend(os.path.realpath(git.repo()))]
+backend = b'inotify' if opt.inotify else b'fanotify' if opt.fanotify else None
+
+# After no events for this long (or this long after the first of the
+# pending records) add the pending records to the journal.
+quiet_secs = 0.1
+max_delay_secs = 1
+
+journal_writer = journal.JournalWriter(indexfile)
+try:
+    with journal.watching(indexfile) as publish:
+        watch = fsnotify.open_watch(roots, opt.xdev, skip, backend)
+        try:
+            log('watch: watching %d %s with %s\n'
+                % (len(watch),
+                   'filesystems' if isinstance(watch, fsnotify.FanotifyWatch)
+                   else 'directories',
+                   'fanotify' if isinstance(watch, fsnotify.FanotifyWatch)
+                   else 'inotify'))
+            # Whatever happened before now is unknown.
+            journal_writer.append(set((journal.TREE, root) for root in roots))
+            publish(roots)
+            pending = set()
+            deadline = None
+            while True:
+                timeout = None
+                if pending:
+                    timeout = max(0, min(quiet_secs, deadline - time.time()))
+                if select.select([watch], [], [], timeout)[0]:
+                    records = watch.read()
+                    if records and not pending:
+                        deadline = time.time() + max_delay_secs
+                    pending.update(records)
+                    if not pending or time.time() < deadline:
+                        continue
+                if opt.verbose:
+                    for kind, path in sorted(pending):
+                        log('%s %s\n' % (kind.decode('ascii'), path_msg(path)))
+                journal_writer.append(pending)
+                pending = set()
+        finally:
+            watch.close()
+except (IOError, OSError) as e:
+    if e.errno == errno.EAGAIN and e.filename is None:
+        log('error: bup watch is already running for %s\n'
+            % path_msg(indexfile))
+    else:
+        log('error: %s\n' % e)
+    sys.exit(1)
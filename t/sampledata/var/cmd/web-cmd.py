@@ -0,0 +1,613 @@
+#!/bin/sh
+"""": # -*-python-*-
+bup_python="$(dirname "$0")/bup-python" || exit $?
+exec "$bup_python" "$0" ${1+"$@"}
+"""
+# end of bup preamble
+
+from __future__ import absolute_import, print_function
+from collections import namedtuple
+import mimetypes, os, posixpath, signal, stat, sys, threading, time, urllib
+import webbrowser
+from binascii import hexlify
+
+from bup import options, git, vfs
+from bup.helpers import (debug1, format_filesize, handle_ctrl_c, log, parse_num,
+                         saved_errors)
+from bup.metadata import Metadata
+from bup.path import resource_path
+from bup.repo import from_opts
+from bup.compat import argv_bytes
+from bup.io import path_msg
+
+try:
+    from tornado import gen
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.iostream import StreamClosedError
+    from tornado.netutil import bind_unix_socket
+    import tornado.web
+except ImportError:
+    log('error: cannot find the python "tornado" module; please install it\n')
+    sys.exit(1)
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    log('error: cannot find the python "concurrent.futures" module;'
+        ' please install it (e.g. python-futures)\n')
+    sys.exit(1)
+
+
+# FIXME: right now the way hidden files are handled causes every
+# directory to be traversed twice.
+
+
+handle_ctrl_c()
+
+def http_date_from_utc_ns(utc_ns):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                         time.gmtime(utc_ns // 10**9))
+
+def parse_byte_ranges(value, size):
+    """Return the list of (start, end) offsets (end exclusive) selected
+    from a file of size bytes by the Range header value, sorted, and
+    with any overlapping or adjacent ranges merged.  Return None if the
+    value isn't a valid bytes range, i.e. if the header should be
+    ignored, and an empty list if none of the ranges can be satisfied.
+    """
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    valid = False
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) \
+           or (last and not last.isdigit()) or not (first or last):
+            return None
+        if not first:
+            # suffix range, i.e. the last N bytes
+            start, end = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            end = size if not last else int(last) + 1
+            if last and end <= start:
+                return None
+        valid = True
+        end = min(end, size)
+        if start < end:
+            ranges.append((start, end))
+    if not valid:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+optspec = """
+bup web [[hostname]:port]
+bup web unix://path
+--
+r,remote=         remote repository path
+human-readable    display human readable file sizes (i.e. 3.9K, 4.7M)
+browser           show repository in default browser (incompatible with unix://)
+vfs-cache-size=   approximate size of the repository metadata cache [32M]
+j,jobs=           number of threads reading file data from the repository [4]
+"""
+o = options.Options(optspec)
+(opt, flags, extra) = o.parse(sys.argv[1:])
+
+
+class QueryArgs:
+    args = (
+        ('hidden', int, 0),
+        ('meta', int, 0),
+        ('hashes', int, 0),
+        ('hsizes', int, 1 if opt.human_readable else 0),
+    )
+    __slots__ = (a[0] for a in args)
+
+    def __init__(self, **kw):
+        for name, tp, default in self.args:
+            if name in kw:
+                setattr(self, name, tp(kw[name]))
+            else:
+                setattr(self, name, default)
+
+    @classmethod
+    def from_args(cls, args):
+        new = QueryArgs()
+        for name, tp, default in cls.args:
+            try:
+                setattr(new, name, tp(args.get(name, [default])[-1]))
+            except ValueError:
+                pass
+        return new
+
+    def change(self, **kw):
+        new= QueryArgs()
+        for name, tp, default in self.args:
+            if name in kw:
+                setattr(new, name, tp(kw[name]))
+            else:
+                setattr(new, name, getattr(self, name))
+        return new
+
+    def __radd__(self, v):
+        return v + bytes(self)
+
+    def __bytes__(self):
+        vals = []
+        fmts = {
+            int: b'%d',
+        }
+        for name, tp, default in self.args:
+            val = getattr(self, name)
+            if val != default:
+                fmt = fmts[tp]
+                n = name.encode('ascii')
+                vals.append(n + b'=' + fmt % val)
+        if not vals:
+            return b''
+        return b'?' + b'&'.join(vals)
+
+    def __str__(self):
+        return self.__bytes__().decode('ascii')
+
+
+def _compute_breadcrumbs(path, args):
+    """Returns a list of breadcrumb objects for a path."""
+    breadcrumbs = []
+    breadcrumbs.append((b'[root]', b'/' + args))
+    path_parts = path.split(b'/')[1:-1]
+    full_path = b'/'
+    for part in path_parts:
+        full_path += part + b"/"
+        url_append = b""
+        breadcrumbs.append((part, full_path + args))
+    return breadcrumbs
+
+
+def _contains_hidden_files(repo, dir_item):
+    """Return true if the directory contains items with names other than
+    '.' and '..' that begin with '.'
+
+    """
+    for name, item in vfs.contents(repo, dir_item, want_meta=False):
+        if name in (b'.', b'..'):
+            continue
+        if name.startswith(b'.'):
+            return True
+    return False
+
+
+def _dir_contents(repo, resolution, args):
+    """Yield the display information for the contents of dir_item."""
+
+    def display_info(name, item, resolved_item, display_name=None, omitsize=False):
+        # link should be based on fully resolved type to avoid extra
+        # HTTP redirect.
+        link = tornado.escape.url_escape(name, plus=False)
+        if stat.S_ISDIR(vfs.item_mode(resolved_item)):
+            link += '/'
+        link = link.encode('ascii')
+
+        if not omitsize:
+            size = vfs.item_size(repo, item)
+            if args.hsizes:
+                display_size = format_filesize(size)
+            else:
+                display_size = size
+        else:
+            display_size = None
+
+        if not display_name:
+            mode = vfs.item_mode(item)
+            if stat.S_ISDIR(mode):
+                display_name = name + b'/'
+                display_size = None
+            elif stat.S_ISLNK(mode):
+                display_name = name + b'@'
+                display_size = None
+            else:
+                display_name = name
+
+        meta = resolved_item.meta
+        if not isinstance(meta, Metadata):
+            meta = None
+        try:
+            oidx = hexlify(resolved_item.oid)
+        except AttributeError:
+            oidx = ''
+        return display_name, link + args, display_size, meta, oidx
+
+    dir_item = resolution[-1][1]    
+    for name, item in vfs.contents(repo, dir_item):
+        if not args.hidden:
+            if (name not in (b'.', b'..')) and name.startswith(b'.'):
+                continue
+        if name == b'.':
+            if len(resolution) > 1:
+                parent_item = resolution[-2][1] if len(resolution) > 1 else dir_item
+                yield display_info(b'..', parent_item, parent_item, b'..', omitsize=True)
+            continue
+        res = vfs.try_resolve(repo, name, parent=resolution, want_meta=args.meta)
+        res_name, res_item = res[-1]
+        yield display_info(name, item, res_item)
+
+
+# Amount of file data to read (and then send) at a time
+_read_size = 256 * 1024
+
+class PerThreadRepo(object):
+    """Forward everything to a repository (from open_repo()) of the
+    calling thread's own, since a repository can't be shared by
+    several threads."""
+    def __init__(self, open_repo):
+        self._open_repo = open_repo
+        self._local = threading.local()
+        self._repos = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        repo = getattr(self._local, 'repo', None)
+        if repo is None:
+            repo = self._local.repo = self._open_repo()
+            with self._lock:
+                self._repos.append(repo)
+        return getattr(repo, name)
+
+    def close_all(self):
+        with self._lock:
+            for repo in self._repos:
+                repo.close()
+            self._repos = []
+
+def _read_at(f, ofs, count):
+    f.seek(ofs)
+    data = f.read(count)
+    if not data:
+        raise IOError('EOF with %d bytes remaining' % count)
+    return data
+
+
+class CacheStatsHandler(tornado.web.RequestHandler):
+    """Report the vfs cache statistics as JSON."""
+
+    def get(self):
+        stats = {}
+        for tag, st in vfs.cache_stats().items():
+            stats[tag[:3].decode('ascii')] = st._asdict()
+        self.write(stats)
+
+
+class BupRequestHandler(tornado.web.RequestHandler):
+
+    def initialize(self, repo=None, read_repo=None, read_pool=None):
+        self.repo = repo
+        self.read_repo = read_repo
+        self.read_pool = read_pool
+
+    def decode_argument(self, value, name=None):
+        if name == 'path':
+            return value
+        return super(BupRequestHandler, self).decode_argument(value, name)
+
+    def get(self, path):
+        return self._process_request(path)
+
+    def head(self, path):
+        return self._process_request(path)
+    
+    def _process_request(self, path):
+        print('Handling request for %s' % path)
+        sys.stdout.flush()
+        # Set want_meta because dir metadata won't be fetched, and if
+        # it's not a dir, then we're going to want the metadata.
+        res = vfs.resolve(self.repo, path, want_meta=True)
+        leaf_name, leaf_item = res[-1]
+        if not leaf_item:
+            self.send_error(404)
+            return
+        mode = vfs.item_mode(leaf_item)
+        if stat.S_ISDIR(mode):
+            return self._list_directory(path, res)
+        else:
+            return self._get_file(self.repo, path, res)
+
+    def _list_directory(self, path, resolution):
+        """Helper to produce a directory listing.
+
+        Return value is either a file object, or None (indicating an
+        error).  In either case, the headers are sent.
+        """
+        if not path.endswith(b'/') and len(path) > 0:
+            print('Redirecting from %s to %s' % (path_msg(path), path_msg(path + b'/')))
+            return self.redirect(path + b'/', permanent=True)
+
+        args = QueryArgs.from_args(self.request.arguments)
+
+        self.render(
+            'list-directory.html',
+            path=path,
+            breadcrumbs=_compute_breadcrumbs(path, args),
+            files_hidden=_contains_hidden_files(self.repo, resolution[-1][1]),
+            args=args,
+            dir_contents=_dir_contents(self.repo, resolution, args))
+
+    def _etag(self, file_item):
+        assert len(file_item.oid) == 20
+        return '"%s"' % hexlify(file_item.oid).decode('ascii')
+
+    def _set_header(self, path, file_item, ranges=None, boundary=None):
+        """Set the headers for a response containing the whole file, or
+        the given ranges of it (as a multipart/byteranges response if
+        there's more than one)."""
+        meta = file_item.meta
+        ctype = self._guess_type(path)
+        self.set_header("Last-Modified", http_date_from_utc_ns(meta.mtime))
+        self.set_header("Etag", self._etag(file_item))
+        self.set_header("Accept-Ranges", "bytes")
+        if not ranges:
+            self.set_header("Content-Type", ctype)
+            self.set_header("Content-Length", str(meta.size))
+            return
+        self.set_status(206)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.set_header("Content-Type", ctype)
+            self.set_header("Content-Range",
+                            'bytes %d-%d/%d' % (start, end - 1, meta.size))
+            self.set_header("Content-Length", str(end - start))
+            return
+        self.set_header("Content-Type",
+                        'multipart/byteranges; boundary=%s' % boundary)
+        length = len(self._multipart_end(boundary))
+        for start, end in ranges:
+            length += len(self._multipart_header(boundary, ctype, start, end,
+                                                 meta.size))
+            length += end - start
+        self.set_header("Content-Length", str(length))
+
+    def _multipart_header(self, boundary, ctype, start, end, size):
+        return ('\r\n--%s\r\nContent-Type: %s\r\n'
+                'Content-Range: bytes %d-%d/%d\r\n\r\n'
+                % (boundary, ctype, start, end - 1, size)).encode('ascii')
+
+    def _multipart_end(self, boundary):
+        return ('\r\n--%s--\r\n' % boundary).encode('ascii')
+
+    def _if_range_matches(self, file_item):
+        """Return true unless an If-Range header says that the client's
+        copy of the file is out of date (so it needs all of it)."""
+        if_range = self.request.headers.get('If-Range')
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return if_range == self._etag(file_item)
+        if if_range.startswith('W/'):
+            return False  # weak tags can't be used with If-Range
+        return if_range == http_date_from_utc_ns(file_item.meta.mtime)
+
+    def _requested_ranges(self, file_item):
+        """Return None if the whole file should be sent, or the list of
+        ranges that should be sent (possibly empty, if none of the
+        requested ranges can be satisfied)."""
+        range_hdr = self.request.headers.get('Range')
+        if not range_hdr or not self._if_range_matches(file_item):
+            return None
+        return parse_byte_ranges(range_hdr, file_item.meta.size)
+
+    @gen.coroutine
+    def _get_file(self, repo, path, resolved):
+        """Process a request on a file.
+
+        Return value is either a file object, or None (indicating an error).
+        In either case, the headers are sent.
+        """
+        flushed = False
+        try:
+            file_item = resolved[-1][1]
+            file_item = vfs.augment_item_meta(repo, file_item, include_size=True)
+            size = file_item.meta.size
+
+            self.set_header("Etag", self._etag(file_item))
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+            ranges = self._requested_ranges(file_item)
+            if ranges == []:
+                self.set_status(416)
+                self.set_header("Content-Range", 'bytes */%d' % size)
+                return
+            boundary = None
+            if ranges and len(ranges) > 1:
+                boundary = hexlify(os.urandom(16)).decode('ascii')
+
+            if self.request.method == 'HEAD':
+                self._set_header(path, file_item, ranges, boundary)
+                return
+
+            # The repository reads happen on the read_pool, so that
+            # other requests can be handled in the meantime, and we
+            # only read more once the previous data has been sent, so
+            # that each request only holds on to about _read_size
+            # bytes.  We defer the set_header() calls until the first
+            # read succeeds so we can still generate a 500 failure if
+            # something fails...
+            set_header = False
+            with vfs.fopen(self.read_repo, file_item) as f:
+                ctype = self._guess_type(path)
+                for start, end in (ranges or ((0, size),)):
+                    ofs = start
+                    while ofs < end or not set_header:
+                        count = min(end - ofs, _read_size)
+                        blob = b''
+                        if count:
+                            blob = yield self.read_pool.submit(_read_at, f,
+                                                               ofs, count)
+                        if not set_header:
+                            self._set_header(path, file_item, ranges,
+                                             boundary)
+                            set_header = True
+                        if boundary and ofs == start:
+                            self.write(self._multipart_header(boundary, ctype,
+                                                              start, end,
+                                                              size))
+                        self.write(blob)
+                        ofs += len(blob)
+                        flushed = True
+                        yield self.flush()
+                if boundary:
+                    self.write(self._multipart_end(boundary))
+        except StreamClosedError:
+            pass  # the client went away
+        except Exception as e:
+            if flushed:
+                raise  # too late to report it to the client
+            self.clear()
+            self.set_status(500)
+            self.write("<h1>Server Error</h1>\n")
+            self.write("%s: %s\n" % (e.__class__.__name__, str(e)))
+        raise gen.Return()
+
+    def _guess_type(self, path):
+        """Guess the type of a file.
+
+        Argument is a PATH (a filename).
+
+        Return value is a string of the form type/subtype,
+        usable for a MIME Content-type header.
+
+        The default implementation looks the file's extension
+        up in the table self.extensions_map, using application/octet-stream
+        as a default; however it would be permissible (if
+        slow) to look inside the data to make a better guess.
+        """
+        base, ext = posixpath.splitext(path)
+        if ext in self.extensions_map:
+            return self.extensions_map[ext]
+        ext = ext.lower()
+        if ext in self.extensions_map:
+            return self.extensions_map[ext]
+        else:
+            return self.extensions_map['']
+
+    if not mimetypes.inited:
+        mimetypes.init() # try to read system mime.types
+    extensions_map = mimetypes.types_map.copy()
+    extensions_map.update({
+        '': 'text/plain', # Default
+        '.py': 'text/plain',
+        '.c': 'text/plain',
+        '.h': 'text/plain',
+        })
+
+
+io_loop = None
+
+def handle_sigterm(signum, frame):
+    global io_loop
+    debug1('\nbup-web: signal %d received\n' % signum)
+    log('Shutdown requested\n')
+    if not io_loop:
+        sys.exit(0)
+    io_loop.stop()
+
+
+signal.signal(signal.SIGTERM, handle_sigterm)
+
+UnixAddress = namedtuple('UnixAddress', ['path'])
+InetAddress = namedtuple('InetAddress', ['host', 'port'])
+
+if len(extra) > 1:
+    o.fatal("at most one argument expected")
+
+if len(extra) == 0:
+    address = InetAddress(host='127.0.0.1', port=8080)
+else:
+    bind_url = extra[0]
+    if bind_url.startswith('unix://'):
+        address = UnixAddress(path=bind_url[len('unix://'):])
+    else:
+        addr_parts = extra[0].split(':', 1)
+        if len(addr_parts) == 1:
+            host = '127.0.0.1'
+            port = addr_parts[0]
+        else:
+            host, port = addr_parts
+        try:
+            port = int(port)
+        except (TypeError, ValueError) as ex:
+            o.fatal('port must be an integer, not %r' % port)
+        address = InetAddress(host=host, port=port)
+
+vfs_cache_size = parse_num(opt.vfs_cache_size)
+if vfs_cache_size < 0:
+    o.fatal('--vfs-cache-size must not be negative')
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+
+git.check_repo_or_die()
+vfs.set_cache_limits(max_bytes=vfs_cache_size)
+
+settings = dict(
+    debug = 1,
+    template_path = resource_path(b'web').decode('utf-8'),
+    static_path = resource_path(b'web/static').decode('utf-8'),
+)
+
+# Disable buffering on stdout, for debug messages
+try:
+    sys.stdout._line_buffering = True
+except AttributeError:
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+
+if opt.remote:
+    opt.remote = argv_bytes(opt.remote)
+repo = from_opts(opt, reverse=False)
+read_repo = PerThreadRepo(lambda: from_opts(opt, reverse=False))
+read_pool = ThreadPoolExecutor(opt.jobs)
+
+application = tornado.web.Application([
+    (r"/\.vfs-cache-stats", CacheStatsHandler),
+    (r"(?P<path>/.*)", BupRequestHandler,
+     dict(repo=repo, read_repo=read_repo, read_pool=read_pool)),
+], **settings)
+
+http_server = HTTPServer(application)
+io_loop_pending = IOLoop.instance()
+
+if isinstance(address, InetAddress):
+    sockets = tornado.netutil.bind_sockets(address.port, address.host)
+    http_server.add_sockets(sockets)
+    print('Serving HTTP on %s:%d...' % sockets[0].getsockname())
+    if opt.browser:
+        browser_addr = 'http://' + address[0] + ':' + str(address[1])
+        io_loop_pending.add_callback(lambda : webbrowser.open(browser_addr))
+elif isinstance(address, UnixAddress):
+    unix_socket = bind_unix_socket(address.path)
+    http_server.add_socket(unix_socket)
+    print('Serving HTTP on filesystem socket %r' % address.path)
+else:
+    log('error: unexpected address %r', address)
+    sys.exit(1)
+
+io_loop = io_loop_pending
+io_loop.start()
+read_pool.shutdown()
+read_repo.close_all()
+
+if saved_errors:
+    log('WARNING: %d errors encountered while saving.\n' % len(saved_errors))
+    sys.exit(1)
@@ -0,0 +1,3 @@
+COMMIT='53c0ba914a1fcba8dd40f4db45bfe23240dfe485'
+NAMES='(tag: 53c0ba9)'
+DATE='2026-10-16 23:53:28 +0000'
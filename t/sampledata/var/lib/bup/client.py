@@ -0,0 +1,793 @@
+
+from __future__ import print_function
+
+from __future__ import absolute_import
+from binascii import hexlify, unhexlify
+import errno, os, re, struct, sys, time, zlib
+import socket
+
+from bup import bloom, git, ssh, vfs, protocol
+from bup.compat import environ, range, reraise
+from bup.helpers import (Conn, atomically_replaced_file, chunkyreader, debug1,
+                         debug2, linereader, lines_until_sentinel,
+                         mkdirp, progress, qprogress, DemuxConn, atoi)
+from bup.io import path_msg
+from bup.vint import read_bvec, read_vuint, write_bvec
+
+
+bwlimit = None
+
+# Number of refs Client.cat_stream() may send ahead of the server's
+# answers.  Keep the refs (41 bytes each) well below the size of a
+# pipe buffer, so that writing them can never block.
+CAT_STREAM_WINDOW = 256
+
+# Number (and total size) of objects that the server's bloom filter
+# says it may have to collect before asking whether it actually does.
+MAYBE_PRESENT_BATCH = 256
+MAYBE_PRESENT_MAX_BYTES = 8 * 1024 * 1024
+
+
+class ClientError(Exception):
+    pass
+
+
+def _raw_write_bwlimit(f, buf, bwcount, bwtime):
+    if not bwlimit:
+        f.write(buf)
+        return (len(buf), time.time())
+    else:
+        # We want to write in reasonably large blocks, but not so large that
+        # they're likely to overflow a router's queue.  So our bwlimit timing
+        # has to be pretty granular.  Also, if it takes too long from one
+        # transmit to the next, we can't just make up for lost time to bring
+        # the average back up to bwlimit - that will risk overflowing the
+        # outbound queue, which defeats the purpose.  So if we fall behind
+        # by more than one block delay, we shouldn't ever try to catch up.
+        for i in range(0,len(buf),4096):
+            now = time.time()
+            next = max(now, bwtime + 1.0*bwcount/bwlimit)
+            time.sleep(next-now)
+            sub = buf[i:i+4096]
+            f.write(sub)
+            bwcount = len(sub)  # might be less than 4096
+            bwtime = next
+        return (bwcount, bwtime)
+
+
+_protocol_rs = br'([a-z]+)://'
+_host_rs = br'(?P<sb>\[)?((?(sb)[0-9a-f:]+|[^:/]+))(?(sb)\])'
+_port_rs = br'(?::(\d+))?'
+_path_rs = br'(/.*)?'
+_url_rx = re.compile(br'%s(?:%s%s)?%s' % (_protocol_rs, _host_rs, _port_rs, _path_rs),
+                     re.I)
+
+def parse_remote(remote):
+    assert remote is not None
+    url_match = _url_rx.match(remote)
+    if url_match:
+        # Backward compatibility: version of bup prior to this patch
+        # passed "hostname:" to parse_remote, which wasn't url_match
+        # and thus went into the else, where the ssh version was then
+        # returned, and thus the dir (last component) was the empty
+        # string instead of None from the regex.
+        # This empty string was then put into the name of the index-
+        # cache directory, so we need to preserve that to avoid the
+        # index-cache being in a different location after updates.
+        if url_match.group(1) == b'reverse':
+            if url_match.group(5) is None:
+                return url_match.group(1, 3, 4) + (b'', )
+        elif not url_match.group(1) in (b'ssh', b'bup', b'file', b'config'):
+            raise ClientError('unexpected protocol: %s'
+                              % url_match.group(1).decode('ascii'))
+        return url_match.group(1,3,4,5)
+    else:
+        rs = remote.split(b':', 1)
+        if len(rs) == 1 or rs[0] in (b'', b'-'):
+            return b'file', None, None, rs[-1]
+        else:
+            return b'ssh', rs[0], None, rs[1]
+
+
+class Client:
+    def __init__(self, remote, create=False, wire_compression=None,
+                 server_bloom=True):
+        self._busy = self.conn = None
+        self._wire_compression = None
+        self._server_bloom = server_bloom
+        self._bloom = None
+        self._dumb_server = False
+        self.sock = self.p = self.pout = self.pin = None
+        (self.protocol, self.host, self.port, self.dir) = parse_remote(remote)
+        # The b'None' here matches python2's behavior of b'%s' % None == 'None',
+        # python3 will (as of version 3.7.5) do the same for str ('%s' % None),
+        # but crashes instead when doing b'%s' % None.
+        cachehost = b'None' if self.host is None else self.host
+        cachedir = b'None' if self.dir is None else self.dir
+        self.cachedir = git.repo(b'index-cache/%s'
+                                 % re.sub(br'[^@\w]',
+                                          b'_',
+                                          b'%s:%s' % (cachehost, cachedir)))
+        if self.protocol == b'reverse':
+            self.pout = os.fdopen(3, 'rb')
+            self.pin = os.fdopen(4, 'wb')
+            self.conn = Conn(self.pout, self.pin)
+        if self.protocol in (b'ssh', b'file'):
+            try:
+                # FIXME: ssh and file shouldn't use the same module
+                self.p = ssh.connect(self.host, self.port, b'server')
+                self.pout = self.p.stdout
+                self.pin = self.p.stdin
+                self.conn = Conn(self.pout, self.pin)
+            except OSError as e:
+                reraise(ClientError('connect: %s' % e))
+        elif self.protocol == b'bup':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.connect((self.host, atoi(self.port) or 1982))
+            self.sockw = self.sock.makefile('wb')
+            self.conn = DemuxConn(self.sock.fileno(), self.sockw)
+        self._available_commands = self._get_available_commands()
+        self._require_command(b'init-dir')
+        self._require_command(b'set-dir')
+        if self.dir:
+            self.dir = re.sub(br'[\r\n]', ' ', self.dir)
+            if create:
+                self.conn.write(b'init-dir %s\n' % self.dir)
+            else:
+                self.conn.write(b'set-dir %s\n' % self.dir)
+            self.check_ok()
+        if wire_compression is None:
+            # Not worth the trouble when the server is on this machine.
+            wire_compression = 0 if self.protocol == b'file' else 1
+        if wire_compression and b'compress' in self._available_commands:
+            self.conn.write(b'compress %d\n' % wire_compression)
+            not_ok = self.check_ok()
+            if not_ok:
+                raise not_ok
+            self._wire_compression = wire_compression
+        self.sync_indexes()
+
+    def __del__(self):
+        try:
+            self.close()
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                pass
+            else:
+                raise
+
+    def close(self):
+        if self.conn and not self._busy:
+            self.conn.write(b'quit\n')
+        if self.pin:
+            self.pin.close()
+        if self.sock and self.sockw:
+            self.sockw.close()
+            self.sock.shutdown(socket.SHUT_WR)
+        if self.conn:
+            self.conn.close()
+        if self.pout:
+            self.pout.close()
+        if self.sock:
+            self.sock.close()
+        if self.p:
+            self.p.wait()
+            rv = self.p.wait()
+            if rv:
+                raise ClientError('server tunnel returned exit code %d' % rv)
+        self.conn = None
+        self.sock = self.p = self.pin = self.pout = None
+
+    def check_ok(self, conn=None):
+        if self.p:
+            rv = self.p.poll()
+            if rv != None:
+                raise ClientError('server exited unexpectedly with code %r'
+                                  % rv)
+        try:
+            return (conn or self.conn).check_ok()
+        except Exception as e:
+            reraise(ClientError(e))
+
+    def check_busy(self):
+        if self._busy:
+            raise ClientError('already busy with command %r' % self._busy)
+        
+    def ensure_busy(self):
+        if not self._busy:
+            raise ClientError('expected to be busy, but not busy?!')
+        
+    def _not_busy(self):
+        self._busy = None
+
+    def _get_available_commands(self):
+        self.check_busy()
+        self._busy = b'help'
+        conn = self.conn
+        conn.write(b'help\n')
+        result = set()
+        line = self.conn.readline()
+        if not line == b'Commands:\n':
+            raise ClientError('unexpected help header ' + repr(line))
+        while True:
+            line = self.conn.readline()
+            if line == b'\n':
+                break
+            if not line.startswith(b'    '):
+                raise ClientError('unexpected help line ' + repr(line))
+            cmd = line.strip()
+            if not cmd:
+                raise ClientError('unexpected help line ' + repr(line))
+            result.add(cmd)
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+        return frozenset(result)
+
+    def _reply_conn(self):
+        """Return the conn from which to read the reply to the current
+        command (which must be one the server compresses, cf.
+        protocol._compressed_reply_commands), and to pass to
+        check_ok()."""
+        if self._wire_compression:
+            return protocol.DecompressingConn(self.conn)
+        return self.conn
+
+    def _require_command(self, name):
+        if name not in self._available_commands:
+            raise ClientError('server does not appear to provide %s command'
+                              % name.encode('ascii'))
+
+    def _list_indexes(self):
+        self._require_command(b'list-indexes')
+        self.check_busy()
+        conn = self._reply_conn()
+        conn.write(b'list-indexes\n')
+        for line in linereader(conn):
+            if not line:
+                break
+            assert(line.find(b'/') < 0)
+            parts = line.split(b' ')
+            idx = parts[0]
+            load = len(parts) == 2 and parts[1] == b'load'
+            yield idx, load
+        self.check_ok(conn)
+
+    def list_indexes(self):
+        for idx, load in self._list_indexes():
+            yield idx
+
+    def sync_indexes(self):
+        conn = self.conn
+        mkdirp(self.cachedir)
+        # All cached idxs are extra until proven otherwise
+        extra = set()
+        for f in os.listdir(self.cachedir):
+            debug1(path_msg(f) + '\n')
+            if f.endswith(b'.idx'):
+                extra.add(f)
+        needed = set()
+        for idx, load in self._list_indexes():
+            if load:
+                # If the server requests that we load an idx and we don't
+                # already have a copy of it, it is needed
+                needed.add(idx)
+            # Any idx that the server has heard of is proven not extra
+            extra.discard(idx)
+            self._dumb_server = self._dumb_server or load
+
+        debug1('client: removing extra indexes: %s\n' % extra)
+        for idx in extra:
+            os.unlink(os.path.join(self.cachedir, idx))
+        debug1('client: server requested load of: %s\n' % needed)
+        for idx in needed:
+            self.sync_index(idx)
+        git.auto_midx(self.cachedir)
+
+    def send_index(self, name, f, send_size):
+        self._require_command(b'send-index')
+        #debug1('requesting %r\n' % name)
+        self.check_busy()
+        conn = self._reply_conn()
+        conn.write(b'send-index %s\n' % name)
+        n = struct.unpack('!I', conn.read(4))[0]
+        assert(n)
+
+        send_size(n)
+
+        count = 0
+        progress('Receiving index from server: %d/%d\r' % (count, n))
+        for b in chunkyreader(conn, n):
+            f.write(b)
+            count += len(b)
+            qprogress('Receiving index from server: %d/%d\r' % (count, n))
+        progress('Receiving index from server: %d/%d, done.\n' % (count, n))
+        self.check_ok(conn)
+
+    def sync_index(self, name):
+        mkdirp(self.cachedir)
+        fn = os.path.join(self.cachedir, name)
+        if os.path.exists(fn):
+            msg = ("won't request existing .idx, try `bup bloom --check %s`"
+                   % path_msg(fn))
+            raise ClientError(msg)
+        with atomically_replaced_file(fn, 'wb') as f:
+            self.send_index(name, f, lambda size: None)
+
+    def _make_objcache(self, repo_dir):
+        return git.PackIdxList(self.cachedir)
+
+    def _get_bloom(self):
+        """Return the server's bloom.MemoryBloom of its objects, or
+        None if it can't provide one (or we shouldn't use it)."""
+        if not (self._server_bloom
+                and b'bloom' in self._available_commands
+                and b'exists' in self._available_commands):
+            return None
+        # A dumb server has us load all of its indexes anyway.
+        if self._dumb_server:
+            return None
+        if not self._bloom:
+            self.check_busy()
+            conn = self._reply_conn()
+            conn.write(b'bloom\n')
+            n = struct.unpack('!Q', conn.read(8))[0]
+            data = bytearray()
+            progress('Receiving object filter from server: %d/%d\r'
+                     % (len(data), n))
+            for b in chunkyreader(conn, n):
+                data += b
+                qprogress('Receiving object filter from server: %d/%d\r'
+                          % (len(data), n))
+            progress('Receiving object filter from server: %d/%d, done.\n'
+                     % (len(data), n))
+            not_ok = self.check_ok(conn)
+            if not_ok:
+                raise not_ok
+            self._bloom = bloom.MemoryBloom(data)
+        return self._bloom
+
+    def _exists(self, oids):
+        """Return a list of whether the server has each of the objects
+        in oids, suspending receive-objects-v2 if need be."""
+        result = []
+        def query():
+            self.check_busy()
+            self.conn.write(b'exists\n')
+            for oid in oids:
+                self.conn.write(b'%s\n' % hexlify(oid))
+            self.conn.write(b'\n')
+            found = self.conn.readline()
+            not_ok = self.check_ok()
+            if not_ok:
+                raise not_ok
+            if len(found) != len(oids) + 1 or found.strip(b'01') != b'\n':
+                raise ClientError('unexpected exists response %r' % found)
+            result.extend(x == ord(b'1') for x in bytearray(found[:-1]))
+        if self._busy:
+            self._suggest_packs(while_suspended=query)
+        else:
+            query()
+        return result
+
+    def _suggest_packs(self, while_suspended=None):
+        ob = self._busy
+        if ob:
+            assert(ob == b'receive-objects-v2')
+            self.conn.write(b'\xff\xff\xff\xff')  # suspend receive-objects-v2
+        suggested = []
+        for line in linereader(self.conn):
+            if not line:
+                break
+            debug2('%r\n' % line)
+            if line.startswith(b'index '):
+                idx = line[6:]
+                debug1('client: received index suggestion: %s\n'
+                       % git.shorten_hash(idx).decode('ascii'))
+                suggested.append(idx)
+            else:
+                assert(line.endswith(b'.idx'))
+                debug1('client: completed writing pack, idx: %s\n'
+                       % git.shorten_hash(line).decode('ascii'))
+                suggested.append(line)
+        self.check_ok()
+        if ob:
+            self._busy = None
+        idx = None
+        for idx in suggested:
+            self.sync_index(idx)
+        git.auto_midx(self.cachedir)
+        if while_suspended:
+            while_suspended()
+        if ob:
+            self._busy = ob
+            self.conn.write(b'%s\n' % ob)
+        return idx
+
+    def new_packwriter(self, compression_level=None,
+                       max_pack_size=None, max_pack_objects=None,
+                       objcache_maker=None):
+        self._require_command(b'receive-objects-v2')
+        self.check_busy()
+        def _set_busy():
+            self._busy = b'receive-objects-v2'
+            self.conn.write(b'receive-objects-v2\n')
+        objcache_maker = objcache_maker or self._make_objcache
+        return PackWriter_Remote(self.conn,
+                                 bloom=self._get_bloom(),
+                                 exists=self._exists,
+                                 objcache_maker = objcache_maker,
+                                 suggest_packs = self._suggest_packs,
+                                 onopen = _set_busy,
+                                 onclose = self._not_busy,
+                                 ensure_busy = self.ensure_busy,
+                                 compression_level=compression_level,
+                                 max_pack_size=max_pack_size,
+                                 max_pack_objects=max_pack_objects)
+
+    def read_ref(self, refname):
+        self._require_command(b'read-ref')
+        self.check_busy()
+        self.conn.write(b'read-ref %s\n' % refname)
+        r = self.conn.readline().strip()
+        self.check_ok()
+        if r:
+            assert(len(r) == 40)   # hexified sha
+            return unhexlify(r)
+        else:
+            return None   # nonexistent ref
+
+    def update_ref(self, refname, newval, oldval):
+        self._require_command(b'update-ref')
+        self.check_busy()
+        self.conn.write(b'update-ref %s\n%s\n%s\n'
+                        % (refname, hexlify(newval),
+                           hexlify(oldval) if oldval else b''))
+        self.check_ok()
+
+    def join(self, id):
+        self._require_command(b'join')
+        self.check_busy()
+        self._busy = b'join'
+        conn = self._reply_conn()
+        # Send 'cat' so we'll work fine with older versions
+        conn.write(b'cat %s\n' % re.sub(br'[\n\r]', b'_', id))
+        while 1:
+            sz = struct.unpack('!I', conn.read(4))[0]
+            if not sz: break
+            yield conn.read(sz)
+        # FIXME: ok to assume the only NotOk is a KeyError? (it is true atm)
+        e = self.check_ok(conn)
+        self._not_busy()
+        if e:
+            raise KeyError(str(e))
+
+    def _read_object_info(self):
+        # Read one object of a cat-batch or cat-stream reply (cf.
+        # BupProtocolServer._write_object()) and return (oidx, type,
+        # size, reader), or all None if the object is missing.
+        info = self.conn.readline()
+        if info == b'missing\n':
+            return None, None, None, None
+        if not (info and info.endswith(b'\n')):
+            raise ClientError('Hit EOF while looking for object info: %r'
+                              % info)
+        fields = info[:-1].split(b' ')
+        if len(fields) == 4:
+            oidx, oid_t, size, zsize = fields
+            size = int(size)
+            data = zlib.decompress(b''.join(chunkyreader(self.conn,
+                                                         int(zsize))))
+            if len(data) != size:
+                raise ClientError('object %s has size %d, not %d'
+                                  % (oidx, len(data), size))
+            return oidx, oid_t, size, iter((data,))
+        oidx, oid_t, size = fields
+        size = int(size)
+        return oidx, oid_t, size, chunkyreader(self.conn, size)
+
+    def cat_batch(self, refs):
+        self._require_command(b'cat-batch')
+        self.check_busy()
+        self._busy = b'cat-batch'
+        conn = self.conn
+        conn.write(b'cat-batch\n')
+        # FIXME: do we want (only) binary protocol?
+        for ref in refs:
+            assert ref
+            assert b'\n' not in ref
+            conn.write(ref)
+            conn.write(b'\n')
+        conn.write(b'\n')
+        for ref in refs:
+            info = self._read_object_info()
+            yield info
+            if info[0]:
+                detritus = next(info[3], None)
+                if detritus:
+                    raise ClientError('unexpected leftover data '
+                                      + repr(detritus))
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+
+    def has_cat_stream(self):
+        return b'cat-stream' in self._available_commands
+
+    def cat_stream(self, refs, window=CAT_STREAM_WINDOW):
+        """Yield (oidx, type, size, reader) for each ref in refs like
+        cat_batch(), but send the refs to the server while the answers
+        arrive, with up to window refs outstanding, so that fetching
+        many objects doesn't cost one round trip each.  The next ref
+        is only taken from refs after the previous item's reader has
+        been consumed, so refs may be a generator that decides when to
+        stop.
+
+        """
+        self._require_command(b'cat-stream')
+        self.check_busy()
+        self._busy = b'cat-stream'
+        conn = self.conn
+        conn.write(b'cat-stream\n')
+        refs = iter(refs)
+        outstanding = 0
+        more = True
+        while True:
+            while more and outstanding < window:
+                ref = next(refs, None)
+                if ref is None:
+                    more = False
+                    conn.write(b'\n')
+                    break
+                assert ref
+                assert b'\n' not in ref
+                conn.write(ref)
+                conn.write(b'\n')
+                outstanding += 1
+            if not outstanding:
+                break
+            info = self._read_object_info()
+            outstanding -= 1
+            yield info
+            if info[0]:
+                detritus = next(info[3], None)
+                if detritus:
+                    raise ClientError('unexpected leftover data '
+                                      + repr(detritus))
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+
+    def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
+        patterns = patterns or tuple()
+        self._require_command(b'refs')
+        self.check_busy()
+        self._busy = b'refs'
+        conn = self._reply_conn()
+        conn.write(b'refs %d %d\n' % (1 if limit_to_heads else 0,
+                                      1 if limit_to_tags else 0))
+        for pattern in patterns:
+            assert b'\n' not in pattern
+            conn.write(pattern)
+            conn.write(b'\n')
+        conn.write(b'\n')
+        for line in lines_until_sentinel(conn, b'\n', ClientError):
+            line = line[:-1]
+            oidx, name = line.split(b' ')
+            if len(oidx) != 40:
+                raise ClientError('Invalid object fingerprint in %r' % line)
+            if not name:
+                raise ClientError('Invalid reference name in %r' % line)
+            yield name, unhexlify(oidx)
+        # FIXME: confusing
+        not_ok = self.check_ok(conn)
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+
+    def rev_list(self, refs, parse=None, format=None):
+        """See git.rev_list for the general semantics, but note that with the
+        current interface, the parse function must be able to handle
+        (consume) any blank lines produced by the format because the
+        first one received that it doesn't consume will be interpreted
+        as a terminator for the entire rev-list result.
+
+        """
+        self._require_command(b'rev-list')
+        if format:
+            assert b'\n' not in format
+            assert parse
+        for ref in refs:
+            assert ref
+            assert b'\n' not in ref
+        self.check_busy()
+        self._busy = b'rev-list'
+        conn = self._reply_conn()
+        conn.write(b'rev-list\n')
+        conn.write(b'\n')
+        if format:
+            conn.write(format)
+        conn.write(b'\n')
+        for ref in refs:
+            conn.write(ref)
+            conn.write(b'\n')
+        conn.write(b'\n')
+        if not format:
+            for line in lines_until_sentinel(conn, b'\n', ClientError):
+                line = line.strip()
+                assert len(line) == 40
+                yield line
+        else:
+            for line in lines_until_sentinel(conn, b'\n', ClientError):
+                if not line.startswith(b'commit '):
+                    raise ClientError('unexpected line ' + repr(line))
+                cmt_oidx = line[7:].strip()
+                assert len(cmt_oidx) == 40
+                yield cmt_oidx, parse(conn)
+        # FIXME: confusing
+        not_ok = self.check_ok(conn)
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+
+    def resolve(self, path, parent=None, want_meta=True, follow=True):
+        self._require_command(b'resolve')
+        self.check_busy()
+        self._busy = b'resolve'
+        conn = self._reply_conn()
+        conn.write(b'resolve %d\n' % ((1 if want_meta else 0)
+                                      | (2 if follow else 0)
+                                      | (4 if parent else 0)))
+        if parent:
+            protocol.write_resolution(conn, parent)
+        write_bvec(conn, path)
+        success = ord(conn.read(1))
+        assert success in (0, 1)
+        if success:
+            result = protocol.read_resolution(conn)
+        else:
+            result = protocol.read_ioerror(conn)
+        # FIXME: confusing
+        not_ok = self.check_ok(conn)
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+        if isinstance(result, vfs.IOError):
+            raise result
+        return result
+
+    def config(self, name, opttype=None):
+        # if the server doesn't support this, it can't be set
+        if not 'config' in self._available_commands:
+            return None
+        self.check_busy()
+        if opttype is None:
+            opttype = b'string'
+        # name is last so it can contain spaces
+        self.conn.write(b'config %s %s\n' % (opttype, name))
+        # strip \n (only, not all whitespace)
+        val = self.conn.readline()[:-1]
+        self.check_ok()
+        if val == b'\x00':
+            return None
+        if opttype == b'int':
+            return int(val)
+        if opttype == b'bool':
+            return val == b'1'
+        return val
+
+
+class PackWriter_Remote(git.PackWriter):
+    def __init__(self, conn, objcache_maker, suggest_packs,
+                 onopen, onclose,
+                 ensure_busy,
+                 compression_level=None,
+                 max_pack_size=None,
+                 max_pack_objects=None,
+                 bloom=None, exists=None):
+        git.PackWriter.__init__(self,
+                                objcache_maker=objcache_maker,
+                                compression_level=compression_level,
+                                max_pack_size=max_pack_size,
+                                max_pack_objects=max_pack_objects)
+        self.file = conn
+        self.filename = b'remote socket'
+        self.suggest_packs = suggest_packs
+        self.onopen = onopen
+        self.onclose = onclose
+        self.ensure_busy = ensure_busy
+        self._packopen = False
+        self._bwcount = 0
+        self._bwtime = time.time()
+        # With the server's bloom filter, only send the objects it
+        # definitely doesn't have right away, and collect the others
+        # until we can ask (via exists) about a whole batch of them.
+        self._bloom = bloom
+        self._exists = exists
+        self._maybe_present = []
+        self._maybe_present_bytes = 0
+        self.skipped = 0
+
+    def _open(self):
+        if not self._packopen:
+            self.onopen()
+            self._packopen = True
+
+    def _write_encoded(self, sha, datalist):
+        if self._bloom and self._bloom.exists(sha):
+            data = b''.join(datalist)
+            self._maybe_present.append((sha, data))
+            self._maybe_present_bytes += len(data)
+            if len(self._maybe_present) >= MAYBE_PRESENT_BATCH \
+               or self._maybe_present_bytes >= MAYBE_PRESENT_MAX_BYTES:
+                self._write_maybe_present()
+            return sha
+        return git.PackWriter._write_encoded(self, sha, datalist)
+
+    def _write_maybe_present(self):
+        objs = self._maybe_present
+        if not objs:
+            return
+        self._maybe_present = []
+        self._maybe_present_bytes = 0
+        found = self._exists([sha for sha, data in objs])
+        for (sha, data), present in zip(objs, found):
+            if present:
+                self.skipped += 1
+            else:
+                git.PackWriter._write_encoded(self, sha, (data,))
+        debug1('client: server had %d of %d probable objects\n'
+               % (sum(found), len(objs)))
+
+    def _end(self, run_midx=True):
+        assert(run_midx)  # We don't support this via remote yet
+        if self.file:
+            self._write_maybe_present()
+        if self._packopen and self.file:
+            self.file.write(b'\0\0\0\0')
+            self._packopen = False
+            self.onclose() # Unbusy
+            self.objcache = None
+            return self.suggest_packs() # Returns last idx received
+
+    def close(self):
+        id = self._end()
+        self.file = None
+        return id
+
+    def abort(self):
+        raise ClientError("don't know how to abort remote pack writing")
+
+    def _raw_write(self, datalist, sha):
+        assert(self.file)
+        if not self._packopen:
+            self._open()
+        self.ensure_busy()
+        data = b''.join(datalist)
+        assert(data)
+        assert(sha)
+        crc = zlib.crc32(data) & 0xffffffff
+        outbuf = b''.join((struct.pack('!I', len(data) + 20 + 4),
+                           sha,
+                           struct.pack('!I', crc),
+                           data))
+        try:
+            (self._bwcount, self._bwtime) = _raw_write_bwlimit(
+                    self.file, outbuf, self._bwcount, self._bwtime)
+        except IOError as e:
+            reraise(ClientError(e))
+        self.outbytes += len(data)
+        self.count += 1
+
+        if self.file.has_input():
+            self.objcache.close_temps()
+            self.suggest_packs()
+            self.objcache.refresh()
+
+        return sha, crc
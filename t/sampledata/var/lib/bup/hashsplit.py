@@ -0,0 +1,176 @@
+
+from __future__ import absolute_import
+import io, math, os
+
+from bup import _helpers, compat, helpers
+from bup._helpers import HashSplitter, RecordHashSplitter
+from bup.compat import buffer, py_maj
+
+
+BUP_BLOBBITS = 13
+BUP_TREE_BLOBBITS = 13
+MAX_PER_TREE = 256
+progress_callback = None
+DEFAULT_FANOUT = 16
+# Amount of blob data handed to a thread at once by split_to_blobs()
+PREPARE_BATCH_BYTES = 1024 * 1024
+# The content-defined chunking algorithms (HashSplitter modes), see
+# the bup.splitter setting.  Changing it breaks deduplication against
+# everything stored before, just like changing bup.blobbits.
+SPLITTERS = {b'rollsum': 0, b'fastcdc': 1}
+DEFAULT_SPLITTER = b'rollsum'
+
+GIT_MODE_FILE = 0o100644
+GIT_MODE_TREE = 0o40000
+GIT_MODE_SYMLINK = 0o120000
+
+
+def hashsplit_iter(files, keep_boundaries, progress, fanout=None, blobbits=None,
+                   splitter=None):
+    fanbits = int(math.log(fanout or DEFAULT_FANOUT, 2))
+    blobbits = blobbits or BUP_BLOBBITS
+    mode = SPLITTERS[splitter or DEFAULT_SPLITTER]
+    # yield from ...
+    for buf, level in _helpers.HashSplitter(files, bits=blobbits, progress=progress,
+                                            keep_boundaries=keep_boundaries,
+                                            fanbits=fanbits, mode=mode):
+        yield buf, level
+
+
+def _batched_blobs(it, batch_bytes):
+    batch = []
+    size = 0
+    for blob, level in it:
+        batch.append((blob, level))
+        size += len(blob)
+        if size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def _prepared_blobs(makeblobs, prepare, files, keep_boundaries, progress,
+                    fanout, blobbits, splitter, jobs):
+    # Hand the blobs to the threads in batches, the average blob is
+    # far too small to pay for the thread handoff on its own.
+    def prepare_batch(batch):
+        return [(prepare(blob), len(blob), level) for blob, level in batch]
+    batches = _batched_blobs(hashsplit_iter(files, keep_boundaries, progress,
+                                            fanout, blobbits, splitter),
+                             PREPARE_BATCH_BYTES)
+    for batch in helpers.parallel_imap(prepare_batch, batches, jobs):
+        shas = makeblobs([prepared for prepared, size, level in batch])
+        for sha, (prepared, size, level) in zip(shas, batch):
+            yield sha, size, level
+
+
+total_split = 0
+def split_to_blobs(makeblob, files, keep_boundaries, progress, fanout=None,
+                   blobbits=None, prepare=None, jobs=1, splitter=None):
+    """Yield (sha, size, level) for each blob split from files.
+
+    If prepare is provided, it's called for every blob (by up to
+    jobs threads at once, see repo.prepare_data()), and makeblob is
+    given lists of its results (in order) rather than the blobs
+    themselves, and must return the corresponding list of shas (see
+    repo.write_prepared_many()).
+    """
+    global total_split
+    if prepare:
+        blobs = _prepared_blobs(makeblob, prepare, files, keep_boundaries,
+                                progress, fanout, blobbits, splitter, jobs)
+    else:
+        blobs = ((makeblob(blob), len(blob), level)
+                 for blob, level in hashsplit_iter(files, keep_boundaries,
+                                                   progress, fanout, blobbits,
+                                                   splitter))
+    for (sha, size, level) in blobs:
+        total_split += size
+        if progress_callback:
+            progress_callback(size)
+        yield (sha, size, level)
+
+
+def _make_shalist(l):
+    ofs = 0
+    l = list(l)
+    total = sum(size for mode,sha,size, in l)
+    vlen = len(b'%x' % total)
+    shalist = []
+    for (mode, sha, size) in l:
+        shalist.append((mode, b'%0*x' % (vlen,ofs), sha))
+        ofs += size
+    assert(ofs == total)
+    return (shalist, total)
+
+
+def _squish(maketree, stacks, n):
+    i = 0
+    while i < n or len(stacks[i]) >= MAX_PER_TREE:
+        while len(stacks) <= i+1:
+            stacks.append([])
+        if len(stacks[i]) == 1:
+            stacks[i+1] += stacks[i]
+        elif stacks[i]:
+            (shalist, size) = _make_shalist(stacks[i])
+            tree = maketree(shalist)
+            stacks[i+1].append((GIT_MODE_TREE, tree, size))
+        stacks[i] = []
+        i += 1
+
+
+def split_to_shalist(makeblob, maketree, files,
+                     keep_boundaries, progress=None,
+                     fanout=None, blobbits=None, prepare=None, jobs=1,
+                     splitter=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress,
+                        fanout, blobbits, prepare=prepare, jobs=jobs,
+                        splitter=splitter)
+    assert(fanout != 0)
+    if not fanout:
+        shal = []
+        for (sha,size,level) in sl:
+            shal.append((GIT_MODE_FILE, sha, size))
+        return _make_shalist(shal)[0]
+    else:
+        stacks = [[]]
+        for (sha,size,level) in sl:
+            stacks[0].append((GIT_MODE_FILE, sha, size))
+            _squish(maketree, stacks, level)
+        #log('stacks: %r\n' % [len(i) for i in stacks])
+        _squish(maketree, stacks, len(stacks)-1)
+        #log('stacks: %r\n' % [len(i) for i in stacks])
+        return _make_shalist(stacks[-1])[0]
+
+
+def split_to_blob_or_tree(makeblob, maketree, files,
+                          keep_boundaries, progress=None,
+                          fanout=None, blobbits=None, prepare=None, jobs=1,
+                          splitter=None):
+    shalist = list(split_to_shalist(makeblob, maketree,
+                                    files, keep_boundaries,
+                                    progress, fanout, blobbits,
+                                    prepare=prepare, jobs=jobs,
+                                    splitter=splitter))
+    if len(shalist) == 1:
+        return (shalist[0][0], shalist[0][2])
+    elif len(shalist) == 0:
+        if prepare:
+            return (GIT_MODE_FILE, makeblob([prepare(b'')])[0])
+        return (GIT_MODE_FILE, makeblob(b''))
+    else:
+        return (GIT_MODE_TREE, maketree(shalist))
+
+
+def open_noatime(name):
+    fd = _helpers.open_noatime(name)
+    try:
+        return os.fdopen(fd, 'rb', 1024*1024)
+    except:
+        try:
+            os.close(fd)
+        except:
+            pass
+        raise
@@ -0,0 +1,388 @@
+"""Database of the paths of the hard-linked (nlink > 1) files in the index.
+
+The database (normally bupindex.hlink) is memory mapped and only
+consulted as needed, so that the cost of opening it doesn't depend on
+the number of hard links, and the changes made by add_path(), etc. are
+kept in memory until they're written (along with everything else) to a
+new file that replaces the old one in commit_save().
+
+The file begins with a header (see _HEADER_SIG) that's followed by a
+table of the nodes sorted by (dev, ino), each pointing to the list of
+its paths in the heap at the end of the file, and then a table of the
+paths, sorted by path, each pointing to the path in the heap and
+naming its node.  The entries of both tables are _ENTLEN bytes long.
+In the heap, each path is followed by a NUL, and each list of paths
+by another NUL.
+
+Since the unchanged entries of a table are copied wholesale, along
+with the heap, the strings for a new entry are appended to the heap,
+and the heap is only rebuilt from scratch (dropping the strings that
+no entry refers to any more) when at least half of it is garbage.
+
+"""
+
+from __future__ import absolute_import
+import errno, os, shutil, struct, tempfile
+
+from bup import compat
+from bup.compat import range
+from bup.helpers import mmap_read
+
+if compat.py_maj > 2:
+    import pickle
+    def _load_pickle(f):
+        # Python 2 wrote the paths (and nodes) as str
+        return pickle.load(f, encoding='bytes')
+else:
+    import cPickle as pickle
+    _load_pickle = pickle.load
+
+
+HLINK_HDR = b'BUPH\0\0\0\1'
+_HEADER_SIG = '!QQQQ'  # node count, path count, heap size, heap garbage
+_HEADER_LEN = len(HLINK_HDR) + struct.calcsize(_HEADER_SIG)
+_NODE_SIG = '!QQQ'  # dev, ino, heap offset of the paths
+_PATH_SIG = '!QQQ'  # heap offset of the path, dev, ino
+_ENTLEN = struct.calcsize(_NODE_SIG)
+_COPY_CHUNK = 1 << 20
+
+# See HLinkDB._merge()
+_COPY, _KEEP, _NEW = range(3)
+
+
+class Error(Exception):
+    pass
+
+
+class HLinkDB:
+    def __init__(self, filename):
+        self._filename = filename
+        self._save_prepared = None
+        self._tmpname = None
+        # The changes since the file was written: map a (dev, ino)
+        # node to the list of its paths (empty if it no longer has
+        # any), and a path to its node (None if it's been deleted).
+        self._node_paths = {}
+        self._path_node = {}
+        self._map = b''
+        self._node_count = self._path_count = 0
+        self._heap_size = self._garbage = 0
+        self._legacy = False
+        f = None
+        try:
+            f = open(filename, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                pass
+            else:
+                raise
+        if f:
+            try:
+                hdr = f.read(len(HLINK_HDR))
+                if hdr == HLINK_HDR:
+                    self._map = mmap_read(f, close=False)
+                else:
+                    # Written by an older version as a pickled
+                    # {'dev:ino': [path, ...]}, which is all read, and
+                    # then rewritten in the current format.
+                    f.seek(0)
+                    self._load_legacy(_load_pickle(f))
+            finally:
+                f.close()
+                f = None
+        if self._map:
+            (self._node_count, self._path_count,
+             self._heap_size, self._garbage) \
+                 = struct.unpack_from(_HEADER_SIG, self._map, len(HLINK_HDR))
+        self._nodes_ofs = _HEADER_LEN
+        self._paths_ofs = self._nodes_ofs + self._node_count * _ENTLEN
+        self._heap_ofs = self._paths_ofs + self._path_count * _ENTLEN
+        if len(self._map) and \
+           len(self._map) != self._heap_ofs + self._heap_size:
+            raise Error('%r is truncated or corrupt' % self._filename)
+
+    def _load_legacy(self, node_paths):
+        self._legacy = True
+        for node, paths in compat.items(node_paths):
+            if not isinstance(node, str):
+                node = node.decode('ascii')
+            dev, ino = node.split(':')
+            node = (int(dev), int(ino))
+            self._node_paths[node] = list(paths)
+            for path in paths:
+                self._path_node[path] = node
+
+    def _heap_string(self, ofs, end):
+        start = self._heap_ofs + ofs
+        return self._map[start : self._map.find(end, start)]
+
+    def _node_at(self, i):
+        return struct.unpack_from(_NODE_SIG, self._map,
+                                  self._nodes_ofs + i * _ENTLEN)
+
+    def _path_at(self, i):
+        ofs, dev, ino = struct.unpack_from(_PATH_SIG, self._map,
+                                           self._paths_ofs + i * _ENTLEN)
+        return ofs, (dev, ino)
+
+    def _find_node(self, node):
+        """Return (i, found) where i is the index of node in the node
+        table, or the index it would have."""
+        start, end = 0, self._node_count
+        while start < end:
+            mid = start + (end - start) // 2
+            if self._node_at(mid)[:2] < node:
+                start = mid + 1
+            else:
+                end = mid
+        return start, (start < self._node_count
+                       and self._node_at(start)[:2] == node)
+
+    def _find_path(self, path):
+        """Return (i, found) where i is the index of path in the path
+        table, or the index it would have."""
+        start, end = 0, self._path_count
+        while start < end:
+            mid = start + (end - start) // 2
+            if self._heap_string(self._path_at(mid)[0], b'\0') < path:
+                start = mid + 1
+            else:
+                end = mid
+        return start, (start < self._path_count
+                       and self._heap_string(self._path_at(start)[0],
+                                             b'\0') == path)
+
+    def _paths(self, node):
+        """Return the list of the paths of node, which may be empty."""
+        paths = self._node_paths.get(node)
+        if paths is not None:
+            return paths
+        i, found = self._find_node(node)
+        if not found:
+            return []
+        return self._heap_string(self._node_at(i)[2], b'\0\0').split(b'\0')
+
+    def _node(self, path):
+        """Return the node of path, or None."""
+        if path in self._path_node:
+            return self._path_node[path]
+        i, found = self._find_path(path)
+        if not found:
+            return None
+        return self._path_at(i)[1]
+
+    def _paths_for_update(self, node):
+        paths = self._node_paths.get(node)
+        if paths is None:
+            paths = self._node_paths[node] = list(self._paths(node))
+        return paths
+
+    def _merge(self, count, find, changes, compact):
+        """Yield what one of the tables should contain once changes
+        (sorted (key, value) pairs, where a value of None means remove
+        the entry) have been applied: (_COPY, start, end) for runs of
+        unchanged entries that can be copied as is, (_KEEP, i) for an
+        unchanged entry whose strings must be copied to the new heap
+        (when compact is true, instead of any runs), and (_NEW, key,
+        value) for the new and changed entries."""
+        pos = 0
+        for key, value in changes:
+            i, found = find(key)
+            if compact:
+                for j in range(pos, i):
+                    yield _KEEP, j
+            elif i > pos:
+                yield _COPY, pos, i
+            pos = i + 1 if found else i
+            if value is not None:
+                yield _NEW, key, value
+        if compact:
+            for j in range(pos, count):
+                yield _KEEP, j
+        elif count > pos:
+            yield _COPY, pos, count
+
+    def _write(self, f):
+        node_changes = sorted((node, paths or None)
+                              for node, paths
+                              in compat.items(self._node_paths))
+        path_changes = sorted(compat.items(self._path_node))
+        # Only rebuild the heap once at least half of it would be
+        # garbage, i.e. after roughly as much has been appended to it
+        # as was there to start with.
+        garbage = self._garbage
+        added = 0
+        for node, paths in node_changes:
+            i, found = self._find_node(node)
+            if found:
+                garbage += len(self._heap_string(self._node_at(i)[2],
+                                                 b'\0\0')) + 2
+            if paths:
+                added += sum(len(p) + 1 for p in paths) + 1
+        for path, node in path_changes:
+            if self._find_path(path)[1]:
+                garbage += len(path) + 1
+            if node is not None:
+                added += len(path) + 1
+        compact = garbage * 2 >= self._heap_size + added
+        if compact:
+            heap_size = garbage = 0
+        else:
+            heap_size = self._heap_size
+
+        heap = tempfile.TemporaryFile()
+        try:
+            def heap_append(data):
+                ofs = heap_size + heap.tell()
+                heap.write(data)
+                return ofs
+
+            def copy(start, end):
+                for ofs in range(start, end, _COPY_CHUNK):
+                    f.write(self._map[ofs : min(end, ofs + _COPY_CHUNK)])
+
+            def encode_node(node, paths):
+                ofs = heap_append(b''.join(p + b'\0' for p in paths) + b'\0')
+                return struct.pack(_NODE_SIG, node[0], node[1], ofs)
+
+            def encode_path(path, node):
+                ofs = heap_append(path + b'\0')
+                return struct.pack(_PATH_SIG, ofs, node[0], node[1])
+
+            def write_table(table_ofs, entries, keep, encode):
+                written = 0
+                for entry in entries:
+                    if entry[0] == _COPY:
+                        _, start, end = entry
+                        copy(table_ofs + start * _ENTLEN,
+                             table_ofs + end * _ENTLEN)
+                        written += end - start
+                    else:
+                        if entry[0] == _KEEP:
+                            f.write(encode(*keep(entry[1])))
+                        else:
+                            f.write(encode(entry[1], entry[2]))
+                        written += 1
+                return written
+
+            def keep_node(i):
+                dev, ino, ofs = self._node_at(i)
+                return (dev, ino), self._heap_string(ofs, b'\0\0').split(b'\0')
+
+            def keep_path(i):
+                ofs, node = self._path_at(i)
+                return self._heap_string(ofs, b'\0'), node
+
+            f.write(b'\0' * _HEADER_LEN)
+            node_count = write_table(self._nodes_ofs,
+                                     self._merge(self._node_count,
+                                                 self._find_node,
+                                                 node_changes, compact),
+                                     keep_node, encode_node)
+            path_count = write_table(self._paths_ofs,
+                                     self._merge(self._path_count,
+                                                 self._find_path,
+                                                 path_changes, compact),
+                                     keep_path, encode_path)
+            if not compact:
+                copy(self._heap_ofs, self._heap_ofs + self._heap_size)
+            heap_size += heap.tell()
+            heap.seek(0)
+            shutil.copyfileobj(heap, f)
+        finally:
+            heap.close()
+        f.seek(0)
+        f.write(HLINK_HDR)
+        f.write(struct.pack(_HEADER_SIG, node_count, path_count,
+                            heap_size, garbage))
+        return node_count
+
+    def prepare_save(self):
+        """ Commit all of the relevant data to disk.  Do as much work
+        as possible without actually making the changes visible."""
+        if self._save_prepared:
+            raise Error('save of %r already in progress' % self._filename)
+        if self._node_paths or self._path_node or self._legacy:
+            (dir, name) = os.path.split(self._filename)
+            (ffd, self._tmpname) = tempfile.mkstemp(b'.tmp', name, dir)
+            try:
+                try:
+                    f = os.fdopen(ffd, 'wb', 65536)
+                except:
+                    os.close(ffd)
+                    raise
+                try:
+                    node_count = self._write(f)
+                finally:
+                    f.close()
+                    f = None
+                if not node_count:
+                    os.unlink(self._tmpname)
+                    self._tmpname = None
+            except:
+                tmpname = self._tmpname
+                self._tmpname = None
+                if tmpname:
+                    os.unlink(tmpname)
+                raise
+        elif self._map:
+            self._save_prepared = 'unchanged'
+            return
+        self._save_prepared = True
+
+    def commit_save(self):
+        if not self._save_prepared:
+            raise Error('cannot commit save of %r; no save prepared'
+                        % self._filename)
+        if self._tmpname:
+            os.rename(self._tmpname, self._filename)
+            self._tmpname = None
+        elif self._save_prepared != 'unchanged':
+            # No data -- delete _filename if it exists.
+            try:
+                os.unlink(self._filename)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    pass
+                else:
+                    raise
+        self._save_prepared = None
+
+    def abort_save(self):
+        if self._tmpname:
+            os.unlink(self._tmpname)
+            self._tmpname = None
+
+    def __del__(self):
+        self.abort_save()
+
+    def add_path(self, path, dev, ino):
+        # Assume path is new.
+        node = (dev, ino)
+        self._path_node[path] = node
+        link_paths = self._paths_for_update(node)
+        if path not in link_paths:
+            link_paths.append(path)
+
+    def _del_node_path(self, node, path):
+        link_paths = self._paths_for_update(node)
+        link_paths.remove(path)
+
+    def change_path(self, path, new_dev, new_ino):
+        prev_node = self._node(path)
+        if prev_node:
+            self._del_node_path(prev_node, path)
+        self.add_path(path, new_dev, new_ino)
+
+    def del_path(self, path):
+        # Path may not be in db (if updating a pre-hardlink support index).
+        node = self._node(path)
+        if node:
+            self._del_node_path(node, path)
+            self._path_node[path] = None
+
+    def node_paths(self, dev, ino):
+        paths = self._paths((dev, ino))
+        if not paths:
+            raise KeyError('%s:%s' % (dev, ino))
+        return paths
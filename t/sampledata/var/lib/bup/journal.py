@@ -0,0 +1,157 @@
+"""Journal of the directories that have changed since the last index.
+
+While it runs, bup watch appends a record to the journal (the index
+file name plus .journal) for every directory whose entries change (a
+DIR record), and for every directory that appears, e.g. via mkdir or
+rename, or whose content is otherwise unknown, e.g. when the kernel's
+event queue overflowed (a TREE record).  Each record is the kind byte
+followed by the absolute path of the directory (ending in /) and a
+NUL.
+
+bup index --from-journal moves the records to the .journal.pending
+file before it starts, and only removes them from there once the
+index has been updated, so that the changes aren't lost if it fails.
+It only trusts the journal while a watcher is running, which is
+determined by the lock the watcher holds on the .journal.watch file,
+and which also lists the roots the watcher is watching.
+
+"""
+
+from __future__ import absolute_import
+from contextlib import contextmanager
+import errno, fcntl, os
+
+from bup.helpers import atomically_replaced_file
+
+
+DIR = b'D'
+TREE = b'R'
+
+
+def _journal_path(indexfile):
+    return indexfile + b'.journal'
+
+def _pending_path(indexfile):
+    return indexfile + b'.journal.pending'
+
+def _watch_path(indexfile):
+    return indexfile + b'.journal.watch'
+
+
+def encode_records(records):
+    return b''.join(kind + path + b'\0' for kind, path in records)
+
+
+def decode_records(data):
+    """Return the set of (kind, path) records in data."""
+    return set((rec[:1], rec[1:]) for rec in data.split(b'\0') if rec)
+
+
+class JournalWriter:
+    """Append records (a set) to the journal of indexfile, skipping
+    any that are already there."""
+    def __init__(self, indexfile):
+        self.path = _journal_path(indexfile)
+        self._written = set()
+        self._size = 0
+
+    def append(self, records):
+        with open(self.path, 'ab') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_size < self._size:
+                # The journal has been taken (see take()).
+                self._written = set()
+            data = encode_records(r for r in records if r not in self._written)
+            if data:
+                f.write(data)
+                f.flush()
+                self._written.update(records)
+            self._size = f.tell()
+
+
+@contextmanager
+def watching(indexfile):
+    """Hold the lock that tells bup index that the journal of
+    indexfile is being maintained, and yield a function that must be
+    called with the roots being watched once they're all watched.
+    Raise an IOError with errno EWOULDBLOCK if another watcher holds
+    the lock."""
+    fd = os.open(_watch_path(indexfile), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.ftruncate(fd, 0)
+        def publish(roots):
+            # Terminated by an empty record, so that a reader can
+            # tell a complete list from a partial one.
+            os.write(fd, b''.join(root + b'\0' for root in roots) + b'\0')
+        yield publish
+        os.ftruncate(fd, 0)
+    finally:
+        os.close(fd)
+
+
+def watched_roots(indexfile):
+    """Return the roots being watched for indexfile, or None if no
+    watcher is (yet) running."""
+    try:
+        f = open(_watch_path(indexfile), 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    with f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        else:
+            return None
+        data = f.read()
+    if not data.endswith(b'\0\0'):
+        return None
+    return data[:-2].split(b'\0')
+
+
+def take(indexfile):
+    """Move the records in the journal of indexfile to its pending
+    file, and return the set of all the pending records, including
+    any left there by a run that didn't finish()."""
+    try:
+        f = open(_journal_path(indexfile), 'r+b')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        with f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            data = f.read()
+            if data:
+                with open(_pending_path(indexfile), 'ab') as pending:
+                    pending.write(data)
+                    pending.flush()
+                    os.fsync(pending.fileno())
+                f.truncate(0)
+    try:
+        with open(_pending_path(indexfile), 'rb') as pending:
+            return decode_records(pending.read())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return set()
+
+
+def finish(indexfile, remaining):
+    """Replace the pending records of indexfile with remaining, i.e.
+    the ones that weren't handled."""
+    path = _pending_path(indexfile)
+    if remaining:
+        with atomically_replaced_file(path, 'wb') as f:
+            f.write(encode_records(remaining))
+    else:
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
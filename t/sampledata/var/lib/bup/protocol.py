@@ -0,0 +1,615 @@
+from __future__ import absolute_import
+import os, re, struct, zlib
+from binascii import hexlify, unhexlify
+
+from bup import git, vfs, vint
+from bup.compat import environ, hexstr, int_types
+from bup.io import byte_stream, path_msg
+from bup.vint import read_bvec, write_bvec
+from bup.vint import read_vint, write_vint
+from bup.vint import read_vuint, write_vuint
+from bup.git import MissingObject
+from bup.helpers import (debug1, debug2, linereader, lines_until_sentinel, log)
+from bup.vfs import Item, Chunky, RevList, Root, Tags, Commit, FakeLink
+from bup.metadata import Metadata
+
+
+def read_item(port):
+    def read_m(port, has_meta):
+        if has_meta:
+            m = Metadata.read(port)
+            return m
+        return read_vuint(port)
+    kind, has_meta = vint.recv(port, 'sV')
+    if kind == b'Item':
+        oid, meta = read_bvec(port), read_m(port, has_meta)
+        return Item(oid=oid, meta=meta)
+    if kind == b'Chunky':
+        oid, meta = read_bvec(port), read_m(port, has_meta)
+        return Chunky(oid=oid, meta=meta)
+    if kind == b'RevList':
+        oid, meta = read_bvec(port), read_m(port, has_meta)
+        return RevList(oid=oid, meta=meta)
+    if kind == b'Root':
+        return Root(meta=read_m(port, has_meta))
+    if kind == b'Tags':
+        return Tags(meta=read_m(port, has_meta))
+    if kind == b'Commit':
+        oid, coid = vint.recv(port, 'ss')
+        meta = read_m(port, has_meta)
+        return Commit(oid=oid, coid=coid, meta=meta)
+    if kind == b'FakeLink':
+        target, meta = read_bvec(port), read_m(port, has_meta)
+        return FakeLink(target=target, meta=meta)
+    assert False
+
+def write_item(port, item):
+    kind = type(item)
+    name = bytes(kind.__name__.encode('ascii'))
+    meta = item.meta
+    has_meta = 1 if isinstance(meta, Metadata) else 0
+    if kind in (Item, Chunky, RevList):
+        assert len(item.oid) == 20
+        if has_meta:
+            vint.send(port, 'sVs', name, has_meta, item.oid)
+            Metadata.write(meta, port, include_path=False)
+        else:
+            vint.send(port, 'sVsV', name, has_meta, item.oid, item.meta)
+    elif kind in (Root, Tags):
+        if has_meta:
+            vint.send(port, 'sV', name, has_meta)
+            Metadata.write(meta, port, include_path=False)
+        else:
+            vint.send(port, 'sVV', name, has_meta, item.meta)
+    elif kind == Commit:
+        assert len(item.oid) == 20
+        assert len(item.coid) == 20
+        if has_meta:
+            vint.send(port, 'sVss', name, has_meta, item.oid, item.coid)
+            Metadata.write(meta, port, include_path=False)
+        else:
+            vint.send(port, 'sVssV', name, has_meta, item.oid, item.coid,
+                      item.meta)
+    elif kind == FakeLink:
+        if has_meta:
+            vint.send(port, 'sVs', name, has_meta, item.target)
+            Metadata.write(meta, port, include_path=False)
+        else:
+            vint.send(port, 'sVsV', name, has_meta, item.target, item.meta)
+    else:
+        assert False
+
+def write_ioerror(port, ex):
+    assert isinstance(ex, vfs.IOError)
+    write_vuint(port,
+                (1 if ex.errno is not None else 0)
+                | (2 if ex.strerror is not None else 0)
+                | (4 if ex.terminus is not None else 0))
+    if ex.errno is not None:
+        write_vint(port, ex.errno)
+    if ex.strerror is not None:
+        write_bvec(port, ex.strerror.encode('utf-8'))
+    if ex.terminus is not None:
+        write_resolution(port, ex.terminus)
+
+def read_ioerror(port):
+    mask = read_vuint(port)
+    no = read_vint(port) if 1 & mask else None
+    msg = read_bvec(port).decode('utf-8') if 2 & mask else None
+    term = read_resolution(port) if 4 & mask else None
+    return vfs.IOError(errno=no, message=msg, terminus=term)
+
+def write_resolution(port, resolution):
+    write_vuint(port, len(resolution))
+    for name, item in resolution:
+        write_bvec(port, name)
+        if item:
+            port.write(b'\x01')
+            write_item(port, item)
+        else:
+            port.write(b'\x00')
+
+def read_resolution(port):
+    n = read_vuint(port)
+    result = []
+    for i in range(n):
+        name = read_bvec(port)
+        have_item = ord(port.read(1))
+        assert have_item in (0, 1)
+        item = read_item(port) if have_item else None
+        result.append((name, item))
+    return tuple(result)
+
+class CompressingConn:
+    """Wrap conn so that everything written is sent as a zlib stream,
+    in frames of a 32-bit length followed by that much compressed
+    data, up to an empty frame written by ok() or error(), which then
+    go to conn as usual.  The pending data is flushed whenever we're
+    about to wait for the other side (cf. BaseConn.read()).
+
+    """
+    def __init__(self, conn, level):
+        self.conn = conn
+        self._z = zlib.compressobj(level)
+
+    def _send(self, data):
+        if data:
+            self.conn.write(struct.pack('!I', len(data)))
+            self.conn.write(data)
+
+    def write(self, data):
+        # Keep each call's output (and so each frame) reasonably small.
+        for i in range(0, len(data), 1024 * 1024):
+            self._send(self._z.compress(data[i:i + 1024 * 1024]))
+
+    def flush(self):
+        self._send(self._z.flush(zlib.Z_SYNC_FLUSH))
+
+    def read(self, size):
+        self.flush()
+        return self.conn.read(size)
+
+    def readline(self):
+        self.flush()
+        return self.conn.readline()
+
+    def has_input(self):
+        return self.conn.has_input()
+
+    def _finish(self):
+        self._send(self._z.flush())
+        self.conn.write(struct.pack('!I', 0))
+
+    def ok(self):
+        self._finish()
+        self.conn.ok()
+
+    def error(self, s):
+        self._finish()
+        self.conn.error(s)
+
+
+class DecompressingConn:
+    """Read the frames written by a CompressingConn from conn, and
+    provide their content via read() and readline()."""
+    def __init__(self, conn):
+        self.conn = conn
+        self._z = zlib.decompressobj()
+        self._buf = b''
+        self._done = False
+
+    def _fill(self):
+        if self._done:
+            return False
+        n = struct.unpack('!I', self.conn.read(4))[0]
+        if not n:
+            self._buf += self._z.flush()
+            self._done = True
+            return True
+        data = self.conn.read(n)
+        if len(data) != n:
+            raise Exception('expected %d bytes of compressed data, got %d'
+                            % (n, len(data)))
+        self._buf += self._z.decompress(data)
+        return True
+
+    def read(self, size):
+        while len(self._buf) < size and self._fill():
+            pass
+        result, self._buf = self._buf[:size], self._buf[size:]
+        return result
+
+    def readline(self):
+        while b'\n' not in self._buf and self._fill():
+            pass
+        i = self._buf.find(b'\n') + 1 or len(self._buf)
+        result, self._buf = self._buf[:i], self._buf[i:]
+        return result
+
+    def write(self, data):
+        self.conn.write(data)
+
+    def has_input(self):
+        return bool(self._buf) or self.conn.has_input()
+
+    def _drain(self, onextra):
+        while self._fill():
+            pass
+        if self._buf:
+            onextra(self._buf)
+            self._buf = b''
+
+    def drain_and_check_ok(self):
+        self._drain(lambda data: None)
+        return self.conn.drain_and_check_ok()
+
+    def check_ok(self):
+        def onextra(data):
+            raise Exception('expected "ok", got %r' % data)
+        self._drain(onextra)
+        return self.conn.check_ok()
+
+
+# When the client asks for compression (see compress()), the replies
+# to these commands are compressed as a whole via a CompressingConn.
+# cat-batch and cat-stream instead send each object compressed on its
+# own, so that an object that's already stored compressed can be sent
+# as is (cf. _write_object()), and the other commands' replies are too
+# small to bother.
+_compressed_reply_commands = frozenset([b'list-indexes', b'send-index',
+                                        b'bloom', b'refs', b'rev-list',
+                                        b'resolve', b'join', b'cat'])
+
+# Objects bigger than this are sent uncompressed (unless they're
+# stored compressed) rather than compressing them in memory.
+_max_compressed_object = 16 * 1024 * 1024
+
+_oidx_rx = re.compile(br'^[0-9a-fA-F]{40}$')
+
+def _command(fn):
+    fn.bup_server_command = True
+    return fn
+
+class BupProtocolServer:
+    def __init__(self, conn, backend, permitted_commands=None):
+        self.conn = conn
+        self._backend = backend
+        self._commands = self._get_commands(permitted_commands)
+        self.suspended = False
+        self.repo = None
+        self._compression = None
+
+    def _get_commands(self, permitted_commands):
+        commands = []
+        for name in dir(self):
+            fn = getattr(self, name)
+
+            if getattr(fn, 'bup_server_command', False):
+                cmdname = name.replace('_', '-').encode('ascii')
+                if permitted_commands is None or cmdname in permitted_commands:
+                    commands.append(cmdname)
+
+        return commands
+
+    @_command
+    def quit(self, args):
+        # implementation is actually not here
+        pass
+
+    @_command
+    def help(self, args):
+        self.conn.write(b'Commands:\n    %s\n' % b'\n    '.join(sorted(self._commands)))
+        self.conn.ok()
+
+    def init_session(self, repo_dir=None):
+        if self.repo and repo_dir:
+            self.repo.close()
+            self.repo = None
+            self.suspended = False
+        if not self.repo:
+            self.repo = self._backend(repo_dir)
+            debug1('bup server: bupdir is %r\n' % self.repo.repo_dir)
+            debug1('bup server: serving in %s mode\n'
+                   % (self.repo.dumb_server_mode and 'dumb' or 'smart'))
+
+    @_command
+    def compress(self, args):
+        level = int(args)
+        if not 0 <= level <= 9:
+            raise Exception('invalid compression level %r' % args)
+        self._compression = level or None
+        self.conn.ok()
+
+    @_command
+    def init_dir(self, arg):
+        self._backend.create(arg)
+        self.init_session(arg)
+        self.conn.ok()
+
+    @_command
+    def set_dir(self, arg):
+        self.init_session(arg)
+        self.conn.ok()
+
+    @_command
+    def list_indexes(self, junk):
+        self.init_session()
+        suffix = b' load' if self.repo.dumb_server_mode else b''
+        for f in self.repo.list_indexes():
+            # must end with .idx to not confuse everything, so filter
+            # here ... even if the subclass might not yield anything
+            # else to start with
+            if f.endswith(b'.idx'):
+                self.conn.write(b'%s%s\n' % (f, suffix))
+        self.conn.ok()
+
+    def _send_size(self, size):
+        self.conn.write(struct.pack('!I', size))
+
+    @_command
+    def send_index(self, name):
+        self.init_session()
+        assert(name.find(b'/') < 0)
+        assert(name.endswith(b'.idx'))
+        self.repo.send_index(name, self.conn, self._send_size)
+        self.conn.ok()
+
+    @_command
+    def bloom(self, args):
+        self.init_session()
+        data = self.repo.make_bloom().data
+        self.conn.write(struct.pack('!Q', len(data)))
+        self.conn.write(data)
+        self.conn.ok()
+
+    @_command
+    def exists(self, args):
+        self.init_session()
+        oids = [unhexlify(x[:-1])
+                for x in lines_until_sentinel(self.conn, b'\n', Exception)]
+        found = self.repo.exists_many(oids)
+        self.conn.write(b''.join(b'1' if x else b'0' for x in found))
+        self.conn.write(b'\n')
+        self.conn.ok()
+
+    def _check(self, expected, actual, msg):
+        if expected != actual:
+            self.repo.abort_writing()
+            raise Exception(msg % (expected, actual))
+
+    @_command
+    def receive_objects_v2(self, junk):
+        self.init_session()
+        suggested = set()
+        if self.suspended:
+            self.suspended = False
+        else:
+            if self.repo.dumb_server_mode:
+                objcache_maker = lambda : None
+            else:
+                objcache_maker = None
+        # FIXME: this goes together with the direct accesses below
+        self.repo._ensure_packwriter()
+        while 1:
+            ns = self.conn.read(4)
+            if not ns:
+                self.repo.abort_writing()
+                raise Exception('object read: expected length header, got EOF\n')
+            n = struct.unpack('!I', ns)[0]
+            #debug2('expecting %d bytes\n' % n)
+            if not n:
+                # FIXME: don't be lazy and count ourselves, or something, at least
+                # don't access self.repo internals
+                debug1('bup server: received %d object%s.\n'
+                    % (self.repo._packwriter.count,
+                       self.repo._packwriter.count != 1 and "s" or ''))
+                fullpath = self.repo.finish_writing(run_midx=not self.repo.dumb_server_mode)
+                if fullpath:
+                    (dir, name) = os.path.split(fullpath)
+                    self.conn.write(b'%s.idx\n' % name)
+                self.conn.ok()
+                return
+            elif n == 0xffffffff:
+                debug2('bup server: receive-objects suspended.\n')
+                self.suspended = True
+                self.conn.ok()
+                return
+
+            shar = self.conn.read(20)
+            crcr = struct.unpack('!I', self.conn.read(4))[0]
+            n -= 20 + 4
+            buf = self.conn.read(n)  # object sizes in bup are reasonably small
+            #debug2('read %d bytes\n' % n)
+            self._check(n, len(buf), 'object read: expected %d bytes, got %d\n')
+            if not self.repo.dumb_server_mode:
+                result = self.repo.exists(shar, want_source=True)
+                if result:
+                    oldpack = result.pack
+                    assert(oldpack.endswith(b'.idx'))
+                    (dir,name) = os.path.split(oldpack)
+                    if not (name in suggested):
+                        debug1("bup server: suggesting index %s\n"
+                               % git.shorten_hash(name))
+                        debug1("bup server:   because of object %s\n"
+                               % hexstr(shar))
+                        self.conn.write(b'index %s\n' % name)
+                        suggested.add(name)
+                    continue
+            # FIXME: figure out the right abstraction for this; or better yet,
+            #        make the protocol aware of the object type
+            nw, crc = self.repo._packwriter._raw_write((buf,), sha=shar)
+            self._check(crcr, crc, 'object read: expected crc %d, got %d\n')
+        # NOTREACHED
+
+    @_command
+    def read_ref(self, refname):
+        self.init_session()
+        r = self.repo.read_ref(refname)
+        self.conn.write(b'%s\n' % hexlify(r or b''))
+        self.conn.ok()
+
+    @_command
+    def update_ref(self, refname):
+        self.init_session()
+        newval = self.conn.readline().strip()
+        oldval = self.conn.readline().strip()
+        self.repo.update_ref(refname, unhexlify(newval), unhexlify(oldval))
+        self.conn.ok()
+
+    @_command
+    def join(self, id):
+        self.init_session()
+        try:
+            for blob in self.repo.join(id):
+                self.conn.write(struct.pack('!I', len(blob)))
+                self.conn.write(blob)
+        except KeyError as e:
+            log('server: error: %s\n' % str(e).encode('utf-8'))
+            self.conn.write(b'\0\0\0\0')
+            self.conn.error(e)
+        else:
+            self.conn.write(b'\0\0\0\0')
+            self.conn.ok()
+
+    cat = join # apocryphal alias
+
+    def _write_object(self, ref):
+        # Write "missing", or "oidx type size", followed by the data,
+        # or with compression, "oidx type size zsize", followed by the
+        # zsize bytes of the compressed data.
+        level = self._compression
+        if level is not None and _oidx_rx.match(ref):
+            stored = self.repo.stored_object(unhexlify(ref))
+            if stored:
+                obj_t, size, zdata = stored
+                self.conn.write(b'%s %s %d %d\n'
+                                % (ref.lower(), obj_t, size, len(zdata)))
+                self.conn.write(zdata)
+                return
+        it = self.repo.cat(ref)
+        info = next(it)
+        if not info[0]:
+            self.conn.write(b'missing\n')
+            return
+        if level is not None and info[2] <= _max_compressed_object:
+            zdata = zlib.compress(b''.join(it), level)
+            self.conn.write(b'%s %s %d %d\n' % (info + (len(zdata),)))
+            self.conn.write(zdata)
+            return
+        self.conn.write(b'%s %s %d\n' % info)
+        for buf in it:
+            self.conn.write(buf)
+
+    @_command
+    def cat_batch(self, dummy):
+        self.init_session()
+        # For now, avoid potential deadlock by just reading them all
+        for ref in tuple(lines_until_sentinel(self.conn, b'\n', Exception)):
+            self._write_object(ref[:-1])
+        self.conn.ok()
+
+    @_command
+    def cat_stream(self, dummy):
+        self.init_session()
+        # Unlike cat-batch, answer each ref as soon as it arrives, so
+        # that the client can keep sending refs while it reads the
+        # answers.  The client limits the number of outstanding refs
+        # (cf. Client.cat_stream()) so that neither side can block
+        # the other by filling up the pipes.
+        for ref in lines_until_sentinel(self.conn, b'\n', Exception):
+            self._write_object(ref[:-1])
+        self.conn.ok()
+
+    @_command
+    def refs(self, args):
+        limit_to_heads, limit_to_tags = args.split()
+        assert limit_to_heads in (b'0', b'1')
+        assert limit_to_tags in (b'0', b'1')
+        limit_to_heads = int(limit_to_heads)
+        limit_to_tags = int(limit_to_tags)
+        self.init_session()
+        patterns = tuple(x[:-1] for x in lines_until_sentinel(self.conn, b'\n', Exception))
+        for name, oid in self.repo.refs(patterns, limit_to_heads, limit_to_tags):
+            assert b'\n' not in name
+            self.conn.write(b'%s %s\n' % (hexlify(oid), name))
+        self.conn.write(b'\n')
+        self.conn.ok()
+
+    @_command
+    def rev_list(self, _):
+        self.init_session()
+        count = self.conn.readline()
+        if not count:
+            raise Exception('Unexpected EOF while reading rev-list count')
+        assert count == b'\n'
+        count = None
+        fmt = self.conn.readline()
+        if not fmt:
+            raise Exception('Unexpected EOF while reading rev-list format')
+        fmt = None if fmt == b'\n' else fmt[:-1]
+        refs = tuple(x[:-1] for x in lines_until_sentinel(self.conn, b'\n', Exception))
+
+        try:
+            for buf in self.repo.rev_list_raw(refs, fmt):
+                self.conn.write(buf)
+            self.conn.write(b'\n')
+            self.conn.ok()
+        except git.GitError as e:
+            self.conn.write(b'\n')
+            self.conn.error(str(e).encode('ascii'))
+            raise
+
+    @_command
+    def resolve(self, args):
+        self.init_session()
+        (flags,) = args.split()
+        flags = int(flags)
+        want_meta = bool(flags & 1)
+        follow = bool(flags & 2)
+        have_parent = bool(flags & 4)
+        parent = read_resolution(self.conn) if have_parent else None
+        path = read_bvec(self.conn)
+        if not len(path):
+            raise Exception('Empty resolve path')
+        try:
+            res = list(self.repo.resolve(path, parent, want_meta, follow))
+        except vfs.IOError as ex:
+            res = ex
+        if isinstance(res, vfs.IOError):
+            self.conn.write(b'\0')  # error
+            write_ioerror(self.conn, res)
+        else:
+            self.conn.write(b'\1')  # success
+            write_resolution(self.conn, res)
+        self.conn.ok()
+
+    @_command
+    def config(self, args):
+        self.init_session()
+        opttype, key = args.split(None, 1)
+        opttype = opttype.decode('ascii')
+        if opttype == 'string':
+            opttype = None
+        val = self.repo.config(key, opttype=opttype)
+        if val is None:
+            self.conn.write(b'\x00\n')
+        elif isinstance(val, int_types) or isinstance(val, bool):
+            self.conn.write(b'%d\n' % val)
+        else:
+            self.conn.write(b'%s\n' % val)
+        self.conn.ok()
+
+    def handle(self):
+        commands = self._commands
+
+        # FIXME: this protocol is totally lame and not at all future-proof.
+        # (Especially since we abort completely as soon as *anything* bad happens)
+        lr = linereader(self.conn)
+        for _line in lr:
+            line = _line.strip()
+            if not line:
+                continue
+            debug1('bup server: command: %r\n' % line)
+            words = line.split(b' ', 1)
+            cmd = words[0]
+
+            if not cmd in commands:
+                raise Exception('unknown server command: %r\n' % line)
+
+            rest = len(words) > 1 and words[1] or ''
+            if cmd == b'quit':
+                break
+
+            cmdattr = cmd.replace(b'-', b'_').decode('ascii', errors='replace')
+            if (self._compression is not None
+                and cmd in _compressed_reply_commands):
+                conn = self.conn
+                self.conn = CompressingConn(conn, self._compression)
+                try:
+                    getattr(self, cmdattr)(rest)
+                finally:
+                    self.conn = conn
+            else:
+                getattr(self, cmdattr)(rest)
+
+        debug1('bup server: done\n')
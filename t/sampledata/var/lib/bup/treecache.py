@@ -0,0 +1,145 @@
+"""Persistent on-disk cache of tree objects and their metadata.
+
+Each entry is keyed by the oid of a tree (or of the commit that refers
+to it), and holds the raw tree data along with the content of the
+tree's .bupm (if any), so that the vfs can list a directory, metadata
+included, without asking the repository for anything.  Since the
+entries are content-addressed, they never become stale, and the cache
+can be shared by any number of processes.
+
+The total size of the entries is kept (roughly) below max_bytes by
+evicting the least recently used entries (by mtime, which get()
+updates) whenever put() notices that the cache has grown too large.
+
+"""
+
+from __future__ import absolute_import
+from binascii import hexlify
+from io import BytesIO
+import errno, os
+
+from bup.helpers import atomically_replaced_file, mkdirp, unlink
+from bup.vint import read_vuint, write_bvec, write_vuint
+
+
+_entry_magic = b'BTC\1'
+
+class TreeCache(object):
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Unknown until the first put(), so that processes that only
+        # read never have to scan the cache.
+        self._size = None
+        self._last = None
+
+    def _entry_path(self, oid):
+        oidx = hexlify(oid)
+        return os.path.join(self.path, oidx[:2], oidx)
+
+    def get(self, oid):
+        """Return (tree_data, bupm_data) for oid, where bupm_data is None
+        if the tree has no .bupm, or return None if oid isn't in the
+        cache."""
+        last = self._last
+        if last and last[0] == oid:
+            return last[1]
+        path = self._entry_path(oid)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as ex:
+            if ex.errno == errno.ENOENT:
+                return None
+            raise
+        entry = _decode_entry(data)
+        if entry is None:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:  # evicted by someone else
+                raise
+        self._last = oid, entry
+        return entry
+
+    def put(self, oid, tree_data, bupm_data):
+        """Remember tree_data and bupm_data (None if the tree has no
+        .bupm) for oid."""
+        path = self._entry_path(oid)
+        mkdirp(os.path.dirname(path))
+        with atomically_replaced_file(path, 'wb') as f:
+            f.write(_entry_magic)
+            write_bvec(f, tree_data)
+            if bupm_data is None:
+                write_vuint(f, 0)
+            else:
+                write_vuint(f, 1)
+                write_bvec(f, bupm_data)
+            size = f.tell()
+        self._last = oid, (tree_data, bupm_data)
+        if self._size is None:
+            self._size = sum(st.st_size for _, st in self._entries())
+        else:
+            self._size += size
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _entries(self):
+        try:
+            subdirs = os.listdir(self.path)
+        except OSError as ex:
+            if ex.errno == errno.ENOENT:
+                return
+            raise
+        for subdir in subdirs:
+            subdir = os.path.join(self.path, subdir)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if len(name) != 40:  # e.g. put()'s temporary files
+                    continue
+                path = os.path.join(subdir, name)
+                try:
+                    yield path, os.lstat(path)
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+
+    def _evict(self):
+        # Rescan, since other processes may have added (or evicted)
+        # entries, and then drop the oldest until we're well below
+        # the limit, so that we don't have to do this again soon.
+        entries = sorted(self._entries(), key=lambda x: x[1].st_mtime)
+        size = sum(st.st_size for _, st in entries)
+        target = self.max_bytes * 3 // 4
+        for path, st in entries:
+            if size <= target:
+                break
+            unlink(path)
+            size -= st.st_size
+        self._size = size
+        self._last = None
+
+
+def _decode_entry(data):
+    # Treat anything unexpected (e.g. an entry written by some other
+    # version) as a miss.
+    if not data.startswith(_entry_magic):
+        return None
+    f = BytesIO(data)
+    f.seek(len(_entry_magic))
+    try:
+        tree_len = read_vuint(f)
+        tree_data = f.read(tree_len)
+        bupm_data = None
+        if read_vuint(f):
+            bupm_len = read_vuint(f)
+            bupm_data = f.read(bupm_len)
+            if len(bupm_data) != bupm_len:
+                return None
+    except EOFError:
+        return None
+    if len(tree_data) != tree_len or f.tell() != len(data):
+        return None
+    return tree_data, bupm_data
@@ -97,4 +97,16 @@ $(pwd)/src/a/
 $(pwd)/src/a-link
 $(pwd)/src/"
 
+WVSTART "drecurse --jobs"
+WVPASS mkdir -p src/d/e/f
+WVPASS cp -pPR "$top/lib/bup" src/d/e/f/
+WVPASS cp -pPR "$top/Documentation" src/d/
+WVPASS ln -s d/e src/d-link
+WVPASSEQ "$(bup drecurse -j 4 src)" "$(bup drecurse src)"
+WVPASSEQ "$(bup drecurse -j 4 --exclude src/d/e src)" \
+         "$(bup drecurse --exclude src/d/e src)"
+WVPASSEQ "$(bup drecurse -j 2 --exclude-rx '/t/' "$(pwd)/src")" \
+         "$(bup drecurse --exclude-rx '/t/' "$(pwd)/src")"
+WVPASSEQ "$(bup drecurse -j 4 src/d-link)" "src/d-link"
+
 WVPASS rm -rf "$tmpdir"
@@ -103,4 +103,20 @@ result="$(stat --format='%A %U %G %x' mnt/src/latest/pre-epoch)"
 WVPASSEQ "$result" "-rw-r--r-- $user $group 1970-01-01 00:00:00.000000000 +0000"
 
 WVPASS fusermount -uz mnt
+
+WVSTART "concurrent and random access reads"
+WVPASS mkdir big
+WVPASS bup random 5M > big/data
+WVPASS bup index big
+WVPASS bup save -n big --strip big
+WVPASS bup fuse --readahead 256k --cache-size 1M mnt
+WVPASS cmp big/data mnt/big/latest/data &
+cmp_pid=$!
+WVPASS cmp big/data mnt/big/latest/data
+WVPASS wait "$cmp_pid"
+WVPASS dd if=mnt/big/latest/data of=part-mnt bs=4096 skip=1000 count=3
+WVPASS dd if=big/data of=part-src bs=4096 skip=1000 count=3
+WVPASS cmp part-src part-mnt
+WVPASS fusermount -uz mnt
+
 WVPASS rm -rf "$tmpdir"
@@ -124,4 +124,50 @@ WVPASS bup save -r ":$BUP_DIR" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR/fake/path" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR" -n r-test $D/fake/path
 
+
+WVSTART "index --jobs"
+D=jobs.tmp
+WVPASS force-delete $D
+WVPASS mkdir -p $D/x/y/z $D/w
+WVPASS cp -pPR "$top/lib/bup" $D/x/y/z/
+WVPASS cp -pPR "$top/Documentation" $D/w/
+WVPASS touch $D/x/1 $D/w/2
+WVPASS ln $D/x/1 $D/x/y/1-link
+WVPASS ln -s 1 $D/x/1-symlink
+WVPASS bup index -f serial.idx -u $D
+WVPASS bup index -f jobs.idx --check -j 4 -u $D
+WVPASSEQ "$(bup index -f jobs.idx -s)" "$(bup index -f serial.idx -s)"
+WVPASS rm -r $D/x/y/z/bup/t
+WVPASS touch $D/w/2 $D/x/3
+WVPASS bup tick
+WVPASS bup index -f serial.idx -u $D
+WVPASSEQ "$(bup index -f jobs.idx --check -j 4 -us $D)" \
+         "$(bup index -f serial.idx -s $D)"
+WVPASS bup index -f jobs.idx -m -j 3 -u --exclude $D/w $D
+WVPASS bup index -f serial.idx -m -u --exclude $D/w $D
+WVPASSEQ "$(bup index -f jobs.idx -s)" "$(bup index -f serial.idx -s)"
+
+
+WVSTART "index --compact"
+D=compact.tmp
+WVPASS force-delete $D
+WVPASS mkdir -p $D/x
+WVPASS touch $D/x/1 $D/x/2 $D/3
+WVPASS chmod 600 $D/x/1 $D/3
+WVPASS chmod 640 $D/x/2
+WVPASS bup index -f compact.idx -u $D
+WVPASS chmod 604 $D/x/1 $D/3
+WVPASS chmod 644 $D/x/2
+WVPASS bup tick
+WVPASS bup index -f compact.idx -u $D
+size="$(WVPASS stat -c %s compact.idx.meta)" || exit $?
+WVPASS bup index -f compact.idx --compact
+WVPASS test "$(stat -c %s compact.idx.meta)" -lt "$size"
+WVPASS bup index -f compact.idx --check -p > /dev/null
+WVPASS bup save -f compact.idx -n compact --strip $D
+WVPASS force-delete restore.tmp
+WVPASS bup restore -C restore.tmp /compact/latest/
+WVPASSEQ "$(cd restore.tmp && stat -c '%n %a' x/1 x/2 3)" \
+         "$(cd $D && stat -c '%n %a' x/1 x/2 3)"
+
 WVPASS rm -rf "$tmpdir"
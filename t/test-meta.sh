@@ -94,6 +94,12 @@ test-src-save-restore()
         WVPASS bup restore -C src-restore "/src/latest$(pwd)/"
         WVPASS test -d src-restore/src
         WVPASS "$TOP/t/compare-trees" -c src/ src-restore/src/
+        # Test extract with concurrent file writes.
+        WVPASS force-delete src-restore
+        WVPASS mkdir src-restore
+        WVPASS bup restore -j4 -C src-restore "/src/latest$(pwd)/"
+        WVPASS test -d src-restore/src
+        WVPASS "$TOP/t/compare-trees" -c src/ src-restore/src/
         WVPASS rm -rf src.bup
     )
 }
@@ -0,0 +1,141 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+. t/lib.sh || exit $?
+
+set -o pipefail
+
+if [ "$(uname -s)" != Linux ]; then
+    WVSTART 'watch (skipped: not Linux)'
+    exit 0
+fi
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+export BUP_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+WVPASS cd "$tmpdir"
+WVPASS bup init
+src="$(pwd -P)/src"
+watch_pid=''
+
+wait-for()
+{
+    local i
+    for ((i = 0; i < 100; i++)); do
+        "$@" && return 0
+        sleep 0.1
+    done
+    return 1
+}
+
+journal-has()
+{
+    grep -qaF "$1" "$BUP_DIR/bupindex.journal" 2>/dev/null
+}
+
+sync-requested-since()
+{
+    test "$(od -An -tx1 "$BUP_DIR/bupindex.journal.sync")" != "$1"
+}
+
+start-watch()
+{
+    rm -f "$BUP_DIR/bupindex.journal.watch"
+    "$top/bup" watch "$@" "$src" &
+    watch_pid=$!
+    # The roots are only published once everything is being watched
+    wait-for test -s "$BUP_DIR/bupindex.journal.watch"
+}
+
+stop-watch()
+{
+    kill "$watch_pid" && wait "$watch_pid"
+    watch_pid=''
+}
+
+trap 'test "$watch_pid" && kill "$watch_pid"' EXIT
+
+# Index src with --from-journal (the main index), and from scratch
+# (full.idx), and check that they're the same.
+index-both()
+{
+    WVPASS bup index -u --from-journal "$@" "$src" > from-journal.log \
+        || return $?
+    WVPASS bup index -f full.idx -u "$src" || return $?
+    WVPASSEQ "$(bup index -s "$src")" "$(bup index -f full.idx -s "$src")"
+}
+
+for backend in inotify fanotify; do
+    WVSTART "watch --$backend"
+    WVPASS rm -rf src "$BUP_DIR"/bupindex* full.idx*
+    WVPASS mkdir -p src/a/b src/c src/quiet/d src/moved/e
+    WVPASS touch src/a/b/1 src/c/2 src/quiet/d/3 src/moved/e/4
+    WVPASS bup index -u "$src"
+    WVPASS bup index -f full.idx -u "$src"
+    if ! start-watch "--$backend"; then
+        test "$watch_pid" && stop-watch
+        if test "$backend" = fanotify; then
+            WVSTART 'watch --fanotify (skipped: not permitted here)'
+            continue
+        fi
+        WVFAIL true
+    fi
+
+    # The journal knows nothing about what happened before the
+    # watcher started, so the first run scans everything.
+    index-both -v
+    WVPASS grep -qx "$src/quiet/d/" from-journal.log
+
+    WVPASS echo x > src/a/b/1
+    WVPASS rm src/c/2
+    WVPASS mkdir -p src/new/f
+    WVPASS touch src/new/f/5
+    WVPASS mv src/moved src/a/moved
+    WVPASS chmod 700 src/c
+    WVPASS mkdir src/sync
+    WVPASS wait-for journal-has "$src/sync/"
+    index-both -v
+    WVFAIL grep -qx "$src/quiet/d/" from-journal.log
+    WVPASS grep -qx "$src/new/f/" from-journal.log
+    WVPASS grep -qx "$src/a/moved/e/" from-journal.log
+    bup index -s "$src" | WVPASS grep -qx "D $src/c/2"
+    bup index -s "$src" | WVPASS grep -qx "D $src/moved/e/4"
+
+    # bup index asks the watcher for what it hasn't added yet.
+    WVPASS rm -r src/a/moved src/new
+    index-both
+    bup index -s "$src" | WVPASS grep -qx "D $src/a/moved/e/4"
+    WVPASS echo y > src/quiet/d/3
+    index-both -v
+    WVPASS grep -qx "$src/quiet/d/" from-journal.log
+
+    # Even changes the watcher hasn't read yet when bup index starts.
+    WVPASS kill -STOP "$watch_pid"
+    WVPASS echo z > src/quiet/d/3
+    sync_before="$(od -An -tx1 "$BUP_DIR/bupindex.journal.sync")"
+    bup index -u --from-journal -v "$src" > from-journal.log &
+    index_pid=$!
+    WVPASS wait-for sync-requested-since "$sync_before"
+    WVPASS kill -CONT "$watch_pid"
+    WVPASS wait "$index_pid"
+    WVPASS grep -qx "$src/quiet/d/" from-journal.log
+    WVFAIL grep -qx "$src/a/b/" from-journal.log
+
+    # If the watcher doesn't answer, everything is scanned.
+    WVPASS kill -STOP "$watch_pid"
+    WVPASS touch src/c/7
+    index-both -v
+    WVPASS kill -CONT "$watch_pid"
+    WVPASS grep -qx "$src/a/b/" from-journal.log
+    WVPASSEQ "$(bup index -s "$src/c/7")" "A $src/c/7"
+
+    # Nothing recorded after the watcher stops can be trusted.
+    WVPASS stop-watch
+    WVPASS touch src/quiet/d/6
+    WVPASS bup index -u --from-journal "$src" 2>&1 | WVPASS grep -q 'not running'
+    WVPASSEQ "$(bup index -s "$src/quiet/d/6")" "A $src/quiet/d/6"
+done
+
+WVPASS rm -rf "$tmpdir"
@@ -66,6 +66,40 @@ WVPASSEQ "$(curl --unix-socket ./socket http://localhost/static/styles.css)" \
 
 WVPASSEQ '¡excitement!' "$(cat result)"
 WVPASS cmp "$(echo -ne 'src/whee \x80\x90\xff')" result2
+
+url='http://localhost/%C2%A1excitement%21/latest/data'
+WVPASS curl -sD headers --unix-socket ./socket "$url" > /dev/null
+WVPASS grep -qi '^Accept-Ranges: bytes' headers
+etag="$(grep -i '^Etag:' headers | cut -d' ' -f2 | tr -d '\r')"
+WVPASS test "$etag"
+
+WVPASSEQ 'excite' \
+         "$(curl -s --unix-socket ./socket -r 2-7 "$url")"
+WVPASSEQ 'ent!' \
+         "$(curl -s --unix-socket ./socket -r -5 "$url" | head -c 4)"
+WVPASSEQ 206 \
+         "$(curl -s -o /dev/null -w '%{http_code}' --unix-socket ./socket \
+                 -r 2-7 "$url")"
+WVPASSEQ 416 \
+         "$(curl -s -o /dev/null -w '%{http_code}' --unix-socket ./socket \
+                 -r 100- "$url")"
+WVPASS curl -sD headers --unix-socket ./socket -r 0-1,4-5 "$url" > parts
+WVPASS grep -qi '^Content-Type: multipart/byteranges; boundary=' headers
+WVPASS grep -q '^Content-Range: bytes 0-1/' parts
+WVPASS grep -q '^Content-Range: bytes 4-5/' parts
+WVPASSEQ 304 \
+         "$(curl -s -o /dev/null -w '%{http_code}' --unix-socket ./socket \
+                 -H "If-None-Match: $etag" "$url")"
+# A stale If-Range means the whole file
+WVPASSEQ 200 \
+         "$(curl -s -o /dev/null -w '%{http_code}' --unix-socket ./socket \
+                 -H 'If-Range: "0000"' -r 2-7 "$url")"
+
+WVPASS curl --unix-socket ./socket \
+       'http://localhost/.vfs-cache-stats' > cache-stats
+WVPASS grep -q '"rvl": {' cache-stats
+WVPASS grep -q '"hits": ' cache-stats
+
 WVPASS kill -s TERM "$web_pid"
 WVPASS wait "$web_pid"
 